@@ -0,0 +1,173 @@
+"""
+Очередь журнала действий пользователей (таблица user_logs) с пакетной записью в фоне.
+
+database.log_user_action раньше на каждую строку делал commit, а затем
+query(UserLog).order_by(timestamp.desc()).offset(1500) — сортировку всего журнала и удаление
+лишних строк по одной. Вызывается он по несколько раз на каждую запись/перенос и обновление токена.
+Теперь строка только ставится в очередь (enqueue), а фоновый поток пишет накопленное одним
+многострочным INSERT ... VALUES (...), (...) — когда набралось AUDIT_LOG_BATCH_SIZE строк
+или прошло AUDIT_LOG_FLUSH_SEC секунд. При завершении процесса очередь дописывается (atexit).
+
+Время строки (timestamp) фиксируется при постановке в очередь, поэтому порядок журнала не зависит
+от момента записи. Кто читает журнал в том же процессе (веб-панель), вызывает flush() перед чтением.
+
+Если БД временно занята ("database is locked"), пачка возвращается в начало очереди и пишется
+при следующей попытке. Постоянная ошибка (ограничение, кодировка) не блокирует журнал: пачка
+делится пополам до строки, которую записать нельзя, — она отбрасывается. Очередь ограничена
+_MAX_QUEUE строками: при переполнении отбрасываются самые старые.
+
+Ограничение размера журнала (AUDIT_LOG_KEEP_ROWS строк) — периодическая задача trim_logs
+(в боте — через очередь db_writer): удаляет старые строки порциями по id, без сортировки
+всей таблицы на каждую запись.
+"""
+import atexit
+import logging
+import threading
+import time as time_mod
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import delete, insert, select
+from sqlalchemy.exc import OperationalError
+
+from config import AUDIT_LOG_BATCH_SIZE, AUDIT_LOG_FLUSH_SEC, AUDIT_LOG_KEEP_ROWS
+from database import UserLog, get_db_session
+import metrics
+
+_TRIM_CHUNK = 500  # строк за один DELETE при очистке журнала
+_MAX_QUEUE = 50000  # строк в очереди; при переполнении (БД долго недоступна) старые отбрасываются
+
+_lock = threading.Lock()
+_flush_lock = threading.Lock()  # одна запись в БД одновременно: порядок пачек = порядок очереди
+_wakeup = threading.Event()
+_queue: List[Dict[str, Any]] = []
+_writer: Optional[threading.Thread] = None
+# Последняя ошибка обновления токена по (пользователь, действие): подавление дубликатов без запроса к БД
+_last_errors: Dict[Tuple[int, str], Tuple[Optional[str], datetime]] = {}
+
+
+def enqueue(telegram_user_id: int, action: str, details: Optional[str] = None, *,
+            source: str = 'unknown', status: str = 'info') -> None:
+    """Ставит строку журнала в очередь; запись в БД — в фоновом потоке."""
+    row = {
+        'telegram_user_id': telegram_user_id,
+        'action': action,
+        'details': details,
+        'source': source,
+        'status': status,
+        'timestamp': datetime.utcnow(),
+    }
+    with _lock:
+        _queue.append(row)
+        _trim_queue()
+        if status == 'error':
+            _last_errors[(telegram_user_id, action)] = (details, row['timestamp'])
+        size = len(_queue)
+        _ensure_writer()
+    metrics.inc('audit_log_enqueued_total')
+    if size >= AUDIT_LOG_BATCH_SIZE:
+        _wakeup.set()
+
+
+def last_error(telegram_user_id: int, action: str) -> Optional[Tuple[Optional[str], datetime]]:
+    """(details, timestamp) последней ошибки action пользователя, записанной этим процессом."""
+    with _lock:
+        return _last_errors.get((telegram_user_id, action))
+
+
+def _trim_queue() -> None:
+    """Отбрасывает самые старые строки сверх _MAX_QUEUE (под _lock)."""
+    overflow = len(_queue) - _MAX_QUEUE
+    if overflow > 0:
+        del _queue[:overflow]
+        metrics.inc('audit_log_dropped_total', overflow)
+        logging.warning(f"audit_log: queue overflow, dropped {overflow} oldest rows")
+
+
+def _is_transient(err: Exception) -> bool:
+    return isinstance(err, OperationalError) and ('locked' in str(err).lower() or 'busy' in str(err).lower())
+
+
+def flush() -> int:
+    """Пишет всю очередь в БД (пачками по AUDIT_LOG_BATCH_SIZE строк, commit на пачку); возвращает число строк."""
+    with _flush_lock:
+        with _lock:
+            rows = _queue[:]
+            del _queue[:]
+        if not rows:
+            return 0
+        pending = [rows[i:i + AUDIT_LOG_BATCH_SIZE] for i in range(0, len(rows), AUDIT_LOG_BATCH_SIZE)]
+        written = 0
+        session = get_db_session()
+        try:
+            while pending:
+                part = pending.pop(0)
+                try:
+                    session.execute(insert(UserLog).values(part))
+                    session.commit()
+                    written += len(part)
+                except Exception as e:
+                    session.rollback()
+                    metrics.inc('audit_log_flush_errors_total')
+                    if _is_transient(e):
+                        # БД занята: незаписанное вернём в начало очереди, следующая попытка — по таймеру
+                        rest = part + [row for chunk in pending for row in chunk]
+                        with _lock:
+                            _queue[:0] = rest
+                            _trim_queue()
+                        logging.warning(f"audit_log: flush of {len(rest)} rows postponed: {e}")
+                        break
+                    if len(part) == 1:
+                        metrics.inc('audit_log_dropped_total')
+                        logging.warning(f"audit_log: dropped row action={part[0].get('action')}: {e}")
+                        continue
+                    # Постоянная ошибка: ищем строку-виновника делением пачки пополам
+                    mid = len(part) // 2
+                    pending[:0] = [part[:mid], part[mid:]]
+        finally:
+            session.close()
+    if written:
+        metrics.inc('audit_log_written_total', written)
+    return written
+
+
+def _ensure_writer() -> None:
+    """Запускает фоновый поток записи (под _lock)."""
+    global _writer
+    if _writer is None or not _writer.is_alive():
+        _writer = threading.Thread(target=_run_writer, name='audit-log-writer', daemon=True)
+        _writer.start()
+
+
+def _run_writer() -> None:
+    while True:
+        _wakeup.wait(AUDIT_LOG_FLUSH_SEC)
+        _wakeup.clear()
+        try:
+            flush()
+        except Exception as e:
+            logging.warning(f"audit_log: writer error: {e}")
+            time_mod.sleep(AUDIT_LOG_FLUSH_SEC)
+
+
+def trim_logs(session, keep: int = AUDIT_LOG_KEEP_ROWS, chunk: int = _TRIM_CHUNK) -> int:
+    """Оставляет в user_logs последние keep строк (по id); удаляет порциями по chunk с commit на каждую."""
+    cutoff = session.execute(
+        select(UserLog.id).order_by(UserLog.id.desc()).offset(keep).limit(1)
+    ).scalar()
+    if cutoff is None:
+        return 0
+    deleted = 0
+    while True:
+        ids = select(UserLog.id).where(UserLog.id <= cutoff).order_by(UserLog.id).limit(chunk)
+        removed = session.execute(delete(UserLog).where(UserLog.id.in_(ids))).rowcount or 0
+        session.commit()
+        deleted += removed
+        if removed < chunk:
+            break
+    if deleted:
+        logging.info(f"audit_log.trim_logs: deleted={deleted} keep={keep}")
+    return deleted
+
+
+atexit.register(flush)
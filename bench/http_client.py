@@ -0,0 +1,112 @@
+"""
+Бенчмарк HTTP-клиента ЕМИАС: module-level requests.post (новое соединение на каждый запрос)
+против общего пула keep-alive соединений http_client.post.
+
+Запуск из корня проекта:
+    python bench/http_client.py [--requests 300] [--threads 8] [--latency-ms 0]
+
+Поднимается локальный мок-сервер (http.server, HTTP/1.1 keep-alive), отвечающий JSON, похожим на
+getAvailableResourceScheduleInfo; --latency-ms добавляет задержку ответа. Для каждого клиента
+печатаются медиана, p95 и среднее время запроса, число новых TCP-соединений на сервере
+и общая пропускная способность при --threads параллельных потоках.
+Сервер без TLS, поэтому выигрыш здесь меньше реального: к ЕМИАС каждое новое соединение — ещё и TLS-рукопожатие.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time as time_mod
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests  # noqa: E402
+
+import http_client  # noqa: E402
+import rate_limit  # noqa: E402
+
+RESPONSE = json.dumps({"payload": {"scheduleOfDay": [
+    {"date": "2025-10-10", "scheduleBySlot": [{"slot": [
+        {"startTime": f"2025-10-10T{h:02d}:{m:02d}:00+03:00", "endTime": f"2025-10-10T{h:02d}:{m + 14:02d}:00+03:00"}
+        for h in range(8, 20) for m in (0, 15, 30, 45)
+    ]}]}
+]}}).encode('utf-8')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+    connections = 0
+    _lock = threading.Lock()
+
+    def setup(self):
+        super().setup()
+        with _Handler._lock:
+            _Handler.connections += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.latency:
+            time_mod.sleep(self.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(RESPONSE)))
+        self.end_headers()
+        self.wfile.write(RESPONSE)
+
+    def log_message(self, *args):
+        pass
+
+
+def run(label, post, url, count, threads):
+    payload = {"omsNumber": "0000000000000000", "birthDate": "1990-01-01", "availableResourceId": 1}
+    connections_before = _Handler.connections
+
+    def one(_):
+        started = time_mod.perf_counter()
+        response = post(url, json=payload, headers={"ei-token": "bench"}, timeout=10)
+        response.json()
+        return time_mod.perf_counter() - started
+
+    started = time_mod.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        latencies = sorted(pool.map(one, range(count)))
+    elapsed = time_mod.perf_counter() - started
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{label:<26} median={statistics.median(latencies) * 1e3:7.2f} ms  p95={p95 * 1e3:7.2f} ms  "
+          f"mean={statistics.mean(latencies) * 1e3:7.2f} ms  connections={_Handler.connections - connections_before:>4}  "
+          f"rps={count / elapsed:8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    args = parser.parse_args()
+
+    _Handler.latency = args.latency_ms / 1000
+    # Замеряется только транспорт — лимиты частоты запросов к ЕМИАС здесь не нужны
+    rate_limit.limiter = rate_limit.RateLimiter(global_rate=0, user_rate=0, endpoint_rates={})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/api-eip/v3/saOrchestrator/getAvailableResourceScheduleInfo"
+
+    print(f"requests={args.requests} threads={args.threads} latency={args.latency_ms} ms "
+          f"pool_size={http_client.EMIAS_HTTP_POOL_SIZE}")
+    # Прогрев (импорты, DNS, первый пул)
+    requests.post(url, json={}, timeout=10)
+    http_client.post(url, json={})
+
+    run("before: requests.post", requests.post, url, args.requests, args.threads)
+    run("after: http_client.post", http_client.post, url, args.requests, args.threads)
+    http_client.close()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
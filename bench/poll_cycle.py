@@ -0,0 +1,300 @@
+"""
+Сквозной бенчмарк цикла поллера: check_schedule_updates против локального мока ЕМИАС (mock_emias.py).
+
+Запуск из корня проекта:
+    python bench/poll_cycle.py [--users 50] [--doctors 30] [--tracks 200] [--cycles 5] [--warmup 1]
+                               [--interval 0] [--latency-ms 20-80] [--error-rate 0] [--churn-sec 2]
+                               [--out poll_cycle.json]
+
+Что делается:
+  1. поднимается mock_emias.py отдельным процессом на свободном порту, бот направляется на него
+     (EMIAS_API_BASE_URL); ограничение частоты запросов по умолчанию выключено (EMIAS_RATE_* = 0),
+     чтобы мерить поллер, а не rate_limit — заданные в окружении значения не переопределяются;
+  2. DATABASE_URL указывает на временную SQLite-базу, в неё кладутся --users пользователей
+     (профиль + токены), --doctors врачей мока и --tracks треков: ручные и с автозаписью, группы
+     bulk_batch со stop_after_first, правила в строковой («понедельник 08:00-12:00») и dict-форме;
+  3. --warmup + --cycles раз выполняется check_schedule_updates; сообщения Telegram не отправляются,
+     а записываются (bot.bot подменяется).
+
+По каждому циклу: время цикла, число запросов к ЕМИАС (по /mock/stats мока, с разбивкой по методам),
+число SQL-выражений (событие before_cursor_execute движка), число уведомлений и задержка
+«обнаружение → уведомление» — от получения ответа с расписанием до отправки сообщения подписчику
+(для автозаписи — включая саму запись). Итог — медианы/p95 по циклам без прогрева и пиковый RSS процесса.
+Результат пишется в JSON (--out), чтобы регрессии поллера сравнивались числами.
+"""
+import argparse
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import random
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time as time_mod
+import urllib.request
+import uuid
+from datetime import date, datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+WEEKDAYS = ['понедельник', 'вторник', 'среда', 'четверг', 'пятница']
+
+# Момент получения расписания в текущей задаче _fetch_and_fan_out (contextvar живёт в пределах задачи)
+_detected_at = contextvars.ContextVar('detected_at', default=None)
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _http_json(url: str, data: bytes = None):
+    with urllib.request.urlopen(urllib.request.Request(url, data=data, method='POST' if data is not None else 'GET'), timeout=5) as r:
+        return json.loads(r.read().decode('utf-8'))
+
+
+def start_mock(args, port: int) -> subprocess.Popen:
+    cmd = [sys.executable, os.path.join(ROOT, 'mock_emias.py'), '--port', str(port),
+           '--doctors', str(args.doctors), '--latency-ms', args.latency_ms, '--error-rate', str(args.error_rate),
+           '--unauthorized-rate', str(args.unauthorized_rate), '--churn-sec', str(args.churn_sec),
+           '--density', str(args.density), '--seed', str(args.seed)]
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time_mod.monotonic() + 15
+    while time_mod.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"mock_emias.py завершился с кодом {proc.returncode}")
+        try:
+            _http_json(f"http://127.0.0.1:{port}/mock/stats")
+            return proc
+        except OSError:
+            time_mod.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError("mock_emias.py не ответил за 15 секунд")
+
+
+def make_rules(rng: random.Random):
+    """Правила трека: пустые, строковые (старый формат) или dict (канонический)."""
+    kind = rng.random()
+    h = rng.randint(8, 16)
+    time_range = f"{h:02d}:00-{h + rng.randint(1, 4):02d}:00"
+    if kind < 0.15:
+        return []
+    if kind < 0.45:
+        return [f"{rng.choice(WEEKDAYS)} {time_range}", rng.choice(WEEKDAYS)]
+    if kind < 0.8:
+        return [{"type": "weekday", "value": rng.choice(WEEKDAYS), "timeRanges": [time_range]},
+                {"type": "any", "value": "", "timeRanges": ["08:00-10:00"]}]
+    day = date.today() + timedelta(days=rng.randint(1, 10))
+    return [{"type": "date", "value": day.isoformat(), "timeRanges": [time_range] if rng.random() < 0.7 else []}]
+
+
+def seed(session, args, mock_doctors):
+    from database import DoctorInfo, Specialty, UserProfile, UserToken, UserTrackedDoctor
+
+    rng = random.Random(args.seed)
+    now = datetime.utcnow()
+    users = [100000 + i for i in range(args.users)]
+    for uid in users:
+        session.add(UserProfile(telegram_user_id=uid, oms_number=f"{7700000000000000 + uid}", birth_date="1980-01-01"))
+        session.add(UserToken(telegram_user_id=uid, access_token=f"bench-{uid}", refresh_token=f"bench-r-{uid}",
+                              expires_at=now + timedelta(hours=6), issued_at=now))
+    for code, name in {(str(d['arSpecialityId']), d['arSpecialityName']) for d in mock_doctors}:
+        session.add(Specialty(code=code, name=name))
+    for d in mock_doctors:
+        session.add(DoctorInfo(doctor_api_id=str(d['id']), name=d['name'], complex_resource_id=str(d['complexResource'][0]['id']),
+                               ar_speciality_id=str(d['arSpecialityId']), ar_speciality_name=d['arSpecialityName']))
+
+    pairs = [(u, str(d['id'])) for u in users for d in mock_doctors]
+    rng.shuffle(pairs)
+    pairs = pairs[:args.tracks]
+    by_user = {}
+    for uid, doctor_api_id in pairs:
+        by_user.setdefault(uid, []).append(doctor_api_id)
+    counts = {'manual': 0, 'auto_booking': 0, 'bulk_batch': 0}
+    for uid, doctor_ids in by_user.items():
+        # Часть пользователей добавляет врачей группой (bulk_batch, stop_after_first, автозапись)
+        batch_id = uuid.uuid4().hex if len(doctor_ids) >= 3 and rng.random() < args.batch_share else None
+        for idx, doctor_api_id in enumerate(doctor_ids):
+            in_batch = batch_id is not None and idx < 3
+            auto = in_batch or rng.random() < args.auto_share
+            session.add(UserTrackedDoctor(
+                telegram_user_id=uid, doctor_api_id=doctor_api_id, active=True, auto_booking=auto,
+                tracking_rules=make_rules(rng), bulk_batch_id=batch_id if in_batch else None, stop_after_first=in_batch,
+            ))
+            counts['bulk_batch' if in_batch else 'auto_booking' if auto else 'manual'] += 1
+    session.commit()
+    return counts
+
+
+class RecordingBot:
+    """Вместо Telegram: запоминает уведомления и задержку от получения расписания."""
+
+    def __init__(self):
+        self.sent = 0
+        self.latencies = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent += 1
+        detected = _detected_at.get()
+        if detected is not None:
+            self.latencies.append(time_mod.perf_counter() - detected)
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def _summary(values):
+    if not values:
+        return None
+    return {'median': round(statistics.median(values), 4), 'p95': round(_percentile(values, 0.95), 4),
+            'max': round(max(values), 4), 'mean': round(statistics.mean(values), 4)}
+
+
+def _rss_mb() -> float:
+    # ru_maxrss: килобайты в Linux, байты в macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+async def run_cycles(args, bot_module, recorder, statements, mock_url):
+    from emias_api import close_async_http
+
+    original_fetch = bot_module.fetch_doctor_schedule
+
+    async def timed_fetch(*a, **kw):
+        result = await original_fetch(*a, **kw)
+        _detected_at.set(time_mod.perf_counter())
+        return result
+
+    bot_module.fetch_doctor_schedule = timed_fetch
+    cycles = []
+    measured_latencies = []
+    try:
+        for n in range(args.warmup + args.cycles):
+            before_calls = _http_json(mock_url + '/mock/stats')['calls']
+            before_statements, before_sent, before_lat = statements[0], recorder.sent, len(recorder.latencies)
+            started = time_mod.perf_counter()
+            await bot_module.check_schedule_updates()
+            elapsed = time_mod.perf_counter() - started
+            after_calls = _http_json(mock_url + '/mock/stats')['calls']
+            calls = {k: v - before_calls.get(k, 0) for k, v in after_calls.items()
+                     if ':' not in k and v - before_calls.get(k, 0)}
+            cycle = {
+                'cycle': n,
+                'warmup': n < args.warmup,
+                'cycle_sec': round(elapsed, 4),
+                'emias_calls': sum(calls.values()),
+                'emias_calls_by_endpoint': calls,
+                'db_statements': statements[0] - before_statements,
+                'notifications': recorder.sent - before_sent,
+                'notify_latency_sec': _summary(recorder.latencies[before_lat:]),
+                'peak_rss_mb': _rss_mb(),
+            }
+            cycles.append(cycle)
+            if not cycle['warmup']:
+                measured_latencies.extend(recorder.latencies[before_lat:])
+            print(f"cycle {n}{' (warmup)' if cycle['warmup'] else ''}: {cycle['cycle_sec']:.3f}s "
+                  f"emias={cycle['emias_calls']} sql={cycle['db_statements']} notify={cycle['notifications']} "
+                  f"rss={cycle['peak_rss_mb']}MB")
+            if args.interval > 0 and n + 1 < args.warmup + args.cycles:
+                await asyncio.sleep(args.interval)
+    finally:
+        bot_module.fetch_doctor_schedule = original_fetch
+        await close_async_http()
+    return cycles, measured_latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--doctors', type=int, default=30)
+    parser.add_argument('--tracks', type=int, default=200)
+    parser.add_argument('--cycles', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1, help='первые циклы (пустой baseline) не входят в итог')
+    parser.add_argument('--interval', type=float, default=0.0, help='пауза между циклами, с')
+    parser.add_argument('--auto-share', type=float, default=0.1, help='доля треков с автозаписью')
+    parser.add_argument('--batch-share', type=float, default=0.2, help='доля пользователей с группой bulk_batch')
+    parser.add_argument('--latency-ms', default='20-80')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--unauthorized-rate', type=float, default=0.0)
+    parser.add_argument('--churn-sec', type=float, default=2.0)
+    parser.add_argument('--density', type=float, default=0.15)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--out', default='poll_cycle.json')
+    args = parser.parse_args()
+
+    port = _free_port()
+    mock_url = f"http://127.0.0.1:{port}"
+    os.environ['EMIAS_API_BASE_URL'] = f"{mock_url}/api-eip/"
+    os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456789:bench-poll-cycle-token')
+    for key in ('EMIAS_RATE_GLOBAL', 'EMIAS_RATE_PER_USER'):
+        os.environ.setdefault(key, '0')
+
+    tmp_dir = tempfile.mkdtemp(prefix='bench_poll_')
+    # Вся работа — во временной SQLite-базе (схему создаёт database при импорте), рабочая БД не трогается
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tmp_dir, 'bench.db')}"
+    mock = start_mock(args, port)
+    try:
+        from sqlalchemy import event
+
+        import database
+        engine = database.engine
+        statements = [0]
+
+        @event.listens_for(engine, 'before_cursor_execute')
+        def _count(conn, cursor, statement, parameters, context, executemany):
+            statements[0] += 1
+
+        from mock_emias import MockEmias, MockSettings
+        mock_doctors = MockEmias(args.doctors, MockSettings(seed=args.seed)).doctors
+        session = database.get_db_session()
+        try:
+            tracks = seed(session, args, mock_doctors)
+        finally:
+            session.close()
+
+        import bot as bot_module
+        logging.getLogger().setLevel(args.log_level.upper())
+        recorder = RecordingBot()
+        bot_module.bot = recorder
+
+        cycles, latencies = asyncio.run(run_cycles(args, bot_module, recorder, statements, mock_url))
+    finally:
+        mock.terminate()
+        mock.wait(timeout=10)
+
+    measured = [c for c in cycles if not c['warmup']] or cycles
+    result = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'params': vars(args),
+        'tracks': tracks,
+        'summary': {
+            'cycle_sec': _summary([c['cycle_sec'] for c in measured]),
+            'emias_calls_per_cycle': _summary([c['emias_calls'] for c in measured]),
+            'db_statements_per_cycle': _summary([c['db_statements'] for c in measured]),
+            'notifications_per_cycle': _summary([c['notifications'] for c in measured]),
+            'notify_latency_sec': _summary(latencies),
+            'peak_rss_mb': max(c['peak_rss_mb'] for c in cycles),
+        },
+        'cycles': cycles,
+    }
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(json.dumps(result['summary'], ensure_ascii=False, indent=2))
+    print(f"-> {args.out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""
+Микро-бенчмарк сопоставления слотов с правилами отслеживания: slots/sec до и после компиляции правил.
+
+Запуск из корня проекта:
+    python bench/rules_match.py [--slots 20000] [--repeat 5]
+
+"до"    — построчный интерпретатор правил (копия прежней bot.slot_matches_tracking_rules);
+"после" — rules_engine.compile_tracking_rules(...).matches().
+Перед замером проверяется, что обе реализации дают одинаковый результат для каждого слота.
+"""
+import argparse
+import os
+import sys
+import time as time_mod
+from datetime import datetime, date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rules_engine import WEEKDAY_NAME_TO_INDEX, compile_tracking_rules, parse_date_rule, parse_time_range  # noqa: E402
+
+
+def _legacy_time_matches_ranges(slot_time, ranges):
+    if not ranges:
+        return True
+    for range_str in ranges:
+        parsed = parse_time_range(range_str)
+        if not parsed:
+            continue
+        start, end = parsed
+        if start <= end:
+            if start <= slot_time <= end:
+                return True
+        else:
+            if slot_time >= start or slot_time <= end:
+                return True
+    return False
+
+
+def legacy_slot_matches(slot_dt, rules):
+    if not rules:
+        return True
+    slot_date = slot_dt.date()
+    slot_time = slot_dt.time().replace(second=0, microsecond=0, tzinfo=None)
+    for rule in rules:
+        rule_type = (rule.get("type") or "").lower()
+        value = (rule.get("value") or "").strip().lower()
+        time_ranges = rule.get("timeRanges") or []
+        if rule_type == "weekday":
+            weekday_idx = WEEKDAY_NAME_TO_INDEX.get(value)
+            if weekday_idx is None or slot_dt.weekday() != weekday_idx:
+                continue
+            if _legacy_time_matches_ranges(slot_time, time_ranges):
+                return True
+        elif rule_type == "date":
+            target_date = parse_date_rule(value, datetime.now().year)
+            if not target_date or target_date != slot_date:
+                continue
+            if _legacy_time_matches_ranges(slot_time, time_ranges):
+                return True
+        elif rule_type == "relative_date":
+            if value == "сегодня":
+                target_date = date.today()
+            elif value == "завтра":
+                target_date = date.today() + timedelta(days=1)
+            else:
+                continue
+            if target_date != slot_date:
+                continue
+            if _legacy_time_matches_ranges(slot_time, time_ranges):
+                return True
+        elif rule_type == "any":
+            if _legacy_time_matches_ranges(slot_time, time_ranges):
+                return True
+    return False
+
+
+def make_rules():
+    today = date.today()
+    return [
+        {"type": "weekday", "value": "понедельник", "timeRanges": ["08:00-12:00"]},
+        {"type": "weekday", "value": "среда", "timeRanges": ["10:00-13:00", "17:00-19:30"]},
+        {"type": "weekday", "value": "пятница", "timeRanges": []},
+        {"type": "date", "value": (today + timedelta(days=9)).strftime('%Y-%m-%d'), "timeRanges": ["16:00-17:00"]},
+        {"type": "date", "value": (today + timedelta(days=12)).strftime('%d.%m.%Y'), "timeRanges": ["09:00-11:00"]},
+        {"type": "relative_date", "value": "завтра", "timeRanges": ["11:20-19:00"]},
+        {"type": "any", "value": "", "timeRanges": ["22:00-06:00"]},
+    ]
+
+
+def make_slots(count):
+    start = datetime.now().replace(hour=7, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    slots = []
+    current = start
+    while len(slots) < count:
+        slots.append(current)
+        current += timedelta(minutes=12)
+        if current.hour >= 21:
+            current = (current + timedelta(days=1)).replace(hour=7, minute=0)
+    return slots
+
+
+def bench(label, fn, slots, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time_mod.perf_counter()
+        fn(slots)
+        elapsed = time_mod.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    rate = len(slots) / best if best else float('inf')
+    print(f"{label:<28} {rate:>14,.0f} slots/sec  (best of {repeat}: {best * 1000:.1f} ms)")
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--slots', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rules = make_rules()
+    slots = make_slots(args.slots)
+
+    compiled = compile_tracking_rules(rules)
+    mismatches = [s for s in slots if legacy_slot_matches(s, rules) != compiled.matches(s)]
+    if mismatches:
+        print(f"MISMATCH on {len(mismatches)} slots, e.g. {mismatches[0]}")
+        sys.exit(1)
+    matched = sum(1 for s in slots if compiled.matches(s))
+    print(f"slots={len(slots)} rules={len(rules)} matched={matched}")
+
+    def run_legacy(ss):
+        return [legacy_slot_matches(s, rules) for s in ss]
+
+    def run_compiled(ss):
+        # Как в filter_slots_by_rules/collect_matching_slots: одна компиляция (из кэша) на список слотов
+        matcher = compile_tracking_rules(rules)
+        return [matcher.matches(s) for s in ss]
+
+    def run_per_slot_lookup(ss):
+        # Как slot_matches_tracking_rules: обращение к кэшу на каждый слот
+        return [compile_tracking_rules(rules).matches(s) for s in ss]
+
+    before = bench("legacy interpreter", run_legacy, slots, args.repeat)
+    after = bench("compiled, one lookup", run_compiled, slots, args.repeat)
+    bench("compiled, lookup per slot", run_per_slot_lookup, slots, args.repeat)
+    print(f"speedup x{after / before:.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Бенчмарк пакетной проверки слотов: один врач, много подписчиков (slot_batch.match_subscribers).
+
+Запуск из корня проекта:
+    python bench/slot_batch.py [--slots 10000] [--subscribers 1000] [--skip-per-track]
+
+Сравниваются:
+  per-track  — как раньше: каждый подписчик разбирает payload и проверяет слоты сам (collect_matching_slots);
+  batch/py   — payload разбирается один раз, правила проверяются CompiledRules.matches() в цикле;
+  batch/numpy — таблица «подписчик × день × минута» и одна выборка (если NumPy установлен).
+Перед замером результаты всех путей сверяются между собой.
+"""
+import argparse
+import os
+import random
+import sys
+import time as time_mod
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import slot_batch  # noqa: E402
+from slot_batch import ScheduleSlots, match_subscribers  # noqa: E402
+
+WEEKDAYS = ['понедельник', 'вторник', 'среда', 'четверг', 'пятница', 'суббота', 'воскресенье']
+
+
+def make_payload(count):
+    days = []
+    start = (datetime.now() + timedelta(days=1)).replace(hour=8, minute=0, second=0, microsecond=0)
+    per_day = 12 * 13  # 08:00-21:00 каждые 5 минут
+    day_count = (count + per_day - 1) // per_day
+    produced = 0
+    for d in range(day_count):
+        day_start = start + timedelta(days=d)
+        slots = []
+        for i in range(per_day):
+            if produced >= count:
+                break
+            st = day_start + timedelta(minutes=5 * i)
+            slots.append({"startTime": st.strftime('%Y-%m-%dT%H:%M:%S+03:00'), "endTime": (st + timedelta(minutes=5)).strftime('%Y-%m-%dT%H:%M:%S+03:00')})
+            produced += 1
+        days.append({"date": day_start.strftime('%Y-%m-%d'), "scheduleBySlot": [{"slot": slots}]})
+    return {"scheduleOfDay": days}, day_count
+
+
+def make_rules(rng, day_count):
+    rules = []
+    for _ in range(rng.randint(0, 4)):
+        kind = rng.random()
+        h = rng.randint(7, 19)
+        tr = f"{h:02d}:{rng.choice(['00', '15', '30'])}-{min(h + rng.randint(1, 4), 23):02d}:00"
+        if kind < 0.5:
+            rules.append({"type": "weekday", "value": rng.choice(WEEKDAYS), "timeRanges": [tr] if rng.random() < 0.8 else []})
+        elif kind < 0.85:
+            day = datetime.now().date() + timedelta(days=rng.randint(1, max(1, day_count)))
+            rules.append({"type": "date", "value": day.strftime('%Y-%m-%d'), "timeRanges": [tr]})
+        else:
+            rules.append({"type": "any", "value": "", "timeRanges": [tr]})
+    return rules
+
+
+def timed(label, fn):
+    started = time_mod.perf_counter()
+    result = fn()
+    elapsed = time_mod.perf_counter() - started
+    print(f"{label:<12} {elapsed * 1000:>10.1f} ms")
+    return result, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--slots', type=int, default=10000)
+    parser.add_argument('--subscribers', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--skip-per-track', action='store_true', help='не замерять старый путь (он самый долгий)')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    payload, day_count = make_payload(args.slots)
+    rules = [make_rules(rng, day_count) for _ in range(args.subscribers)]
+    print(f"slots={args.slots} days={day_count} subscribers={args.subscribers} numpy={'yes' if slot_batch.np is not None else 'no'}")
+
+    results = {}
+    if not args.skip_per_track:
+        results['per-track'], _ = timed("per-track", lambda: [match_subscribers(payload, [r], use_numpy=False)[0] for r in rules])
+    results['batch/py'], _ = timed("batch/py", lambda: match_subscribers(payload, rules, use_numpy=False))
+    if slot_batch.np is not None:
+        results['batch/numpy'], _ = timed("batch/numpy", lambda: match_subscribers(payload, rules, use_numpy=True))
+        slots = ScheduleSlots(payload)
+        timed("numpy only", lambda: match_subscribers(None, rules, slots=slots, use_numpy=True))
+
+    reference = results['batch/py']
+    for label, res in results.items():
+        if res != reference:
+            print(f"MISMATCH: {label} differs from batch/py")
+            sys.exit(1)
+    print(f"matches total={sum(len(r) for r in reference)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""
+Бенчмарк хранения расписания врача: полный JSON scheduleOfDay против slot_codec.SlotTable.
+
+Запуск из корня проекта:
+    python bench/slot_codec.py [--days 14] [--repeat 20]
+
+Сравниваются размер записи doctor_schedules, время записи (json.dumps / SlotTable.encode),
+время чтения baseline (json.loads + разбор слотов / SlotTable.decode) и diff двух расписаний
+(разность множеств строк, как compare_schedules_payloads / слияние массивов SlotTable.difference)
+по двум сохранённым записям: оба расписания читаются из хранимой формы (JSON-текст / blob).
+Перед замером проверяется, что оба пути дают одинаковые наборы слотов и одинаковый diff.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time as time_mod
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from slot_codec import SlotTable  # noqa: E402
+
+
+def make_schedule(days, seed):
+    """scheduleOfDay, похожий на ответ ЕМИАС: слоты по 15 минут в двух кабинетах с метаданными."""
+    rng = random.Random(seed)
+    result = []
+    start = (datetime.now() + timedelta(days=1)).replace(hour=8, minute=0, second=0, microsecond=0)
+    for d in range(days):
+        day_start = start + timedelta(days=d)
+        blocks = []
+        for room in ('101', '214'):
+            slots = []
+            for i in range(48):
+                if rng.random() < 0.3:
+                    continue
+                st = day_start + timedelta(minutes=15 * i)
+                slots.append({
+                    "startTime": st.strftime('%Y-%m-%dT%H:%M:%S+03:00'),
+                    "endTime": (st + timedelta(minutes=15)).strftime('%Y-%m-%dT%H:%M:%S+03:00'),
+                })
+            blocks.append({
+                "cabinetNumber": room,
+                "room": {"id": int(room), "number": room, "lpuShortName": "ГП № 1 Ф 2", "defaultAddress": "Москва, ул. Примерная, д. 1"},
+                "receptionInfo": [{"id": 1, "name": "Первичный приём"}],
+                "slot": slots,
+            })
+        result.append({"date": day_start.strftime('%Y-%m-%d'), "scheduleBySlot": blocks})
+    return result
+
+
+def parse_labels(schedule_days):
+    # Как bot.parse_schedule_payload
+    labels = set()
+    for day_info in schedule_days:
+        for slot_block in day_info.get("scheduleBySlot", []):
+            for s in slot_block.get("slot", []):
+                start_time = s.get("startTime", "")
+                if len(start_time) >= 16:
+                    labels.add(f"{start_time[:10]} {start_time[11:16]}")
+    return labels
+
+
+def bench(label, fn, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time_mod.perf_counter()
+        fn()
+        elapsed = time_mod.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{label:<34} {best * 1e6:>10.1f} us")
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, default=14)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    old_days = make_schedule(args.days, seed=1)
+    new_days = make_schedule(args.days, seed=2)
+    old_text = json.dumps(old_days, ensure_ascii=False)
+    new_text = json.dumps(new_days, ensure_ascii=False)
+    old_blob = SlotTable.from_schedule_days(old_days).encode()
+    new_blob = SlotTable.from_schedule_days(new_days).encode()
+    new_table = SlotTable.decode(new_blob)
+
+    old_labels, new_labels = parse_labels(old_days), parse_labels(new_days)
+    old_table = SlotTable.decode(old_blob)
+    if old_table.slot_labels() != old_labels:
+        print("MISMATCH: decoded slots differ from JSON")
+        sys.exit(1)
+    added = {SlotTable.label(m) for m in new_table.difference(old_table)}
+    removed = {SlotTable.label(m) for m in old_table.difference(new_table)}
+    if added != new_labels - old_labels or removed != old_labels - new_labels:
+        print("MISMATCH: diff differs")
+        sys.exit(1)
+
+    print(f"days={args.days} slots={len(old_table)} added={len(added)} removed={len(removed)}")
+    print(f"{'stored size, JSON':<34} {len(old_text.encode('utf-8')):>10} bytes")
+    print(f"{'stored size, SlotTable':<34} {len(old_blob):>10} bytes")
+
+    bench("write: json.dumps", lambda: json.dumps(new_days, ensure_ascii=False), args.repeat)
+    bench("write: SlotTable.encode", lambda: SlotTable.from_schedule_days(new_days).encode(), args.repeat)
+    bench("read baseline: json.loads+parse", lambda: parse_labels(json.loads(old_text)), args.repeat)
+    bench("read baseline: SlotTable.decode", lambda: SlotTable.decode(old_blob), args.repeat)
+
+    def json_diff():
+        old, new = parse_labels(json.loads(old_text)), parse_labels(json.loads(new_text))
+        return new - old, old - new
+
+    bench("diff: JSON sets", json_diff, args.repeat)
+
+    def table_diff():
+        old, new = SlotTable.decode(old_blob), SlotTable.decode(new_blob)
+        return new.difference(old), old.difference(new)
+
+    bench("diff: SlotTable.difference", table_diff, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""
+Нагрузочный тест конкурентного доступа к SQLite: писатели «как поллер» и читатели «как веб-панель».
+
+Запуск из корня проекта:
+    python bench/sqlite_concurrency.py [--writers 4] [--readers 8] [--seconds 10] [--doctors 200]
+
+Для каждого режима создаётся свежая временная база (режим журнала хранится в файле):
+  plain   — create_engine как было раньше: журнал DELETE, без прагм, пул по умолчанию;
+  tuned   — database.make_engine: WAL, synchronous=NORMAL, busy_timeout, кэш, mmap, пул под потоки;
+            писатели пишут из своих потоков;
+  writer  — то же, но записи писателей идут через очередь db_writer (один писатель).
+Писатель — save_doctor_schedule случайного врача со случайным набором слотов, читатель —
+выборка расписаний и треков пачки врачей. Печатаются записи/чтения в секунду, p50/p95 задержки
+и число ошибок (в т.ч. "database is locked").
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time as time_mod
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Импорт database создаёт схему в DATABASE_URL — направляем его во временную базу, не в рабочую
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='bench_sqlite_init_'), 'init.db')}"
+
+from sqlalchemy import create_engine  # noqa: E402
+
+import database  # noqa: E402
+from database import DoctorInfo, DoctorSchedule, UserTrackedDoctor, save_doctor_schedule  # noqa: E402
+import db_writer  # noqa: E402
+
+
+def make_days(rng, count=60):
+    start = (datetime.now() + timedelta(days=1)).replace(hour=8, minute=0, second=0, microsecond=0)
+    slots = sorted(rng.sample(range(14 * 48), count))
+    days = {}
+    for idx in slots:
+        st = start + timedelta(days=idx // 48, minutes=15 * (idx % 48))
+        days.setdefault(st.strftime('%Y-%m-%d'), []).append({
+            "startTime": st.strftime('%Y-%m-%dT%H:%M:%S+03:00'),
+            "endTime": (st + timedelta(minutes=15)).strftime('%Y-%m-%dT%H:%M:%S+03:00'),
+        })
+    return [{"date": d, "scheduleBySlot": [{"slot": s}]} for d, s in days.items()]
+
+
+def bind(engine):
+    database.engine = engine
+    database.SessionLocal.configure(bind=engine)
+    database.Base.metadata.create_all(bind=engine)
+
+
+def seed(doctors):
+    session = database.get_db_session()
+    try:
+        for i in range(doctors):
+            session.add(DoctorInfo(doctor_api_id=str(i), name=f"doctor {i}", complex_resource_id=str(i)))
+            session.add(UserTrackedDoctor(telegram_user_id=i % 50, doctor_api_id=str(i), tracking_rules=[]))
+        session.commit()
+    finally:
+        session.close()
+
+
+def run_mode(mode, args, tmp_dir):
+    url = f"sqlite:///{os.path.join(tmp_dir, mode + '.db')}"
+    if mode == 'plain':
+        engine = create_engine(url, connect_args={"check_same_thread": False})
+    else:
+        engine = database.make_engine(url)
+    bind(engine)
+    seed(args.doctors)
+
+    stop = threading.Event()
+    lock = threading.Lock()
+    stats = {'write': [], 'read': [], 'write_errors': 0, 'read_errors': 0, 'locked': 0}
+
+    def record(kind, started, err=None):
+        with lock:
+            if err is None:
+                stats[kind].append(time_mod.perf_counter() - started)
+            else:
+                stats[kind + '_errors'] += 1
+                if 'locked' in str(err).lower():
+                    stats['locked'] += 1
+
+    def writer(seed_value):
+        rng = random.Random(seed_value)
+        while not stop.is_set():
+            doctor_api_id = str(rng.randrange(args.doctors))
+            days = make_days(rng)
+            started = time_mod.perf_counter()
+            try:
+                if mode == 'writer':
+                    db_writer.call(save_doctor_schedule, doctor_api_id, days)
+                else:
+                    session = database.get_db_session()
+                    try:
+                        save_doctor_schedule(session, doctor_api_id, days)
+                    except Exception:
+                        session.rollback()
+                        raise
+                    finally:
+                        session.close()
+                record('write', started)
+            except Exception as e:
+                record('write', started, e)
+
+    def reader(seed_value):
+        rng = random.Random(seed_value)
+        while not stop.is_set():
+            ids = [str(rng.randrange(args.doctors)) for _ in range(20)]
+            started = time_mod.perf_counter()
+            session = database.get_db_session()
+            try:
+                session.query(DoctorSchedule).filter(DoctorSchedule.doctor_api_id.in_(ids)).all()
+                session.query(UserTrackedDoctor).filter(UserTrackedDoctor.doctor_api_id.in_(ids)).all()
+                record('read', started)
+            except Exception as e:
+                record('read', started, e)
+            finally:
+                session.close()
+
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(args.writers)]
+    threads += [threading.Thread(target=reader, args=(1000 + i,)) for i in range(args.readers)]
+    for t in threads:
+        t.start()
+    time_mod.sleep(args.seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    engine.dispose()
+    return stats
+
+
+def _ms(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--doctors', type=int, default=200)
+    parser.add_argument('--modes', default='plain,tuned,writer')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix='bench_sqlite_')
+    print(f"writers={args.writers} readers={args.readers} seconds={args.seconds} doctors={args.doctors}")
+    for mode in args.modes.split(','):
+        stats = run_mode(mode.strip(), args, tmp_dir)
+        writes, reads = stats['write'], stats['read']
+        print(
+            f"{mode:7s} writes/s={len(writes) / args.seconds:8.1f} "
+            f"write p50={_ms(writes, 0.5):7.1f}ms p95={_ms(writes, 0.95):7.1f}ms | "
+            f"reads/s={len(reads) / args.seconds:8.1f} "
+            f"read p50={_ms(reads, 0.5):7.1f}ms p95={_ms(reads, 0.95):7.1f}ms | "
+            f"errors: write={stats['write_errors']} read={stats['read_errors']} locked={stats['locked']}"
+            + (f" mean_write={statistics.mean(writes) * 1000:.1f}ms" if writes else "")
+        )
+
+
+if __name__ == '__main__':
+    main()
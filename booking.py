@@ -0,0 +1,270 @@
+"""
+Запись и перенос (createAppointment / shiftAppointment) с дедлайном и хеджированием.
+
+Один медленный ответ ЕМИАС раньше стоил спорного слота: запрос ждал свой таймаут целиком.
+Теперь каждая попытка записи укладывается в бюджет BOOKING_DEADLINE_SEC:
+  1. отправляется первый запрос;
+  2. если он не ответил за наблюдаемый p95 латентности эндпоинта (до накопления статистики —
+     BOOKING_HEDGE_DEFAULT_SEC), проверяется getAppointmentReceptionsByPatient: если запись на этот
+     слот уже есть (первый запрос дошёл), второй запрос не отправляется. Проверка ограничена
+     остатком бюджета, за который второй запрос ещё успевает (дедлайн минус p95), — если его нет,
+     она пропускается и остаётся проверка после дедлайна (п. 4);
+  3. иначе отправляется второй, такой же запрос; берётся первый успешный ответ, остальные отменяются;
+  4. если к дедлайну успеха нет, а исход неизвестен (таймаут, сетевая ошибка), записи пациента
+     проверяются ещё раз — запись, созданная «потерянным» запросом, считается успехом, чтобы
+     вызывающий код не повторил её и не создал дубль.
+Двойная запись на тот же слот невозможна и на стороне ЕМИАС (слот занимает первый запрос),
+проверки выше защищают от повторов вызывающего кода на другие слоты.
+
+Латентность каждой попытки пишется в LatencyTracker (p95 — порог хеджирования) и в metrics.
+Попытки, отменённые хеджем или дедлайном, тоже пишутся — цензурированным замером (прошедшее время,
+настоящая латентность не меньше): иначе медленные ответы выпадали бы из выборки, p95 занижался
+и хеджирование со временем срабатывало бы всё раньше.
+Асинхронный путь — для бота, синхронный (потоки) — для service_shift и веб-панели.
+"""
+import asyncio
+import logging
+import threading
+import time as time_mod
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait as futures_wait
+from typing import Any, Deque, Dict, Optional
+
+from config import BOOKING_DEADLINE_SEC, BOOKING_HEDGE_DEFAULT_SEC
+from emias_api import (URL_GET_RECEPTIONS, _receptions_payload, emias_post_request,
+                       emias_post_request_async)
+from http_client import endpoint_name
+import metrics
+import rate_limit
+
+_MIN_SAMPLES = 20
+_MIN_ATTEMPT_TIMEOUT = 1.0
+_VERIFY_TIMEOUT = 5.0
+
+
+class LatencyTracker:
+    """Последние латентности попыток эндпоинта и их p95."""
+
+    def __init__(self, size: int = 200):
+        self._samples: Deque[float] = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def p95(self) -> Optional[float]:
+        with self._lock:
+            if len(self._samples) < _MIN_SAMPLES:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+    def hedge_delay(self, deadline: float) -> float:
+        """Через сколько секунд без ответа отправлять второй запрос (не позже середины бюджета)."""
+        p95 = self.p95()
+        return min(p95 if p95 is not None else BOOKING_HEDGE_DEFAULT_SEC, deadline / 2)
+
+
+_trackers: Dict[str, LatencyTracker] = {}
+
+
+def tracker(endpoint: str) -> LatencyTracker:
+    return _trackers.setdefault(endpoint, LatencyTracker())
+
+
+def _is_success(response: Any) -> bool:
+    # Тот же критерий, что у вызывающих (bot._book_appointment_once): payload или appointmentId
+    return isinstance(response, dict) and ("payload" in response or "appointmentId" in response)
+
+
+def _is_uncertain(response: Any) -> bool:
+    """Исход неизвестен: ответа нет или ЕМИАС не объяснил ошибку (таймаут, сеть, 5xx)."""
+    return not isinstance(response, dict) or response.get("Описание") in (None, "Неизвестная ошибка")
+
+
+def _find_booked(receptions: Any, payload: dict) -> Optional[dict]:
+    """Запись пациента на слот из payload (тот же ресурс и время начала) в ответе getAppointmentReceptionsByPatient."""
+    data = receptions.get("payload") if isinstance(receptions, dict) else None
+    if not isinstance(data, dict):
+        return None
+    resource = str(payload.get("availableResourceId"))
+    start = str(payload.get("startTime") or "")[:16]
+    for appt in data.get("appointments") or data.get("appointment") or []:
+        if str(appt.get("availableResourceId")) == resource and str(appt.get("startTime") or "")[:16] == start:
+            # Ответ в форме успешного createAppointment/shiftAppointment
+            return {"payload": {"appointmentId": appt.get("appointmentId") or appt.get("id")}, "verified": True}
+    return None
+
+
+def _record_attempt(endpoint: str, attempt: int, seconds: float, response: Any, cancelled: bool = False) -> None:
+    """cancelled — попытка отменена до ответа: seconds — нижняя граница её латентности."""
+    tracker(endpoint).record(seconds)
+    outcome = 'cancelled' if cancelled else 'ok' if _is_success(response) else 'error'
+    metrics.inc(f'booking_attempts_{outcome}_total')
+    metrics.set_gauge(f'booking_last_latency_{endpoint}', round(seconds, 3))
+    p95 = tracker(endpoint).p95()
+    if p95 is not None:
+        metrics.set_gauge(f'booking_p95_{endpoint}', round(p95, 3))
+    logging.info(f"booking: {endpoint} attempt={attempt} latency={seconds:.2f}s outcome={outcome}")
+
+
+def _verified(endpoint: str, booked: Optional[dict], stage: str) -> Optional[dict]:
+    if booked is not None:
+        metrics.inc('booking_verified_total')
+        logging.info(f"booking: {endpoint} already booked (verified via receptions, {stage})")
+    return booked
+
+
+# ----------------------------- ASYNC -----------------------------
+async def _receptions_async(user_id: int, timeout: float) -> Optional[dict]:
+    receptions_payload = _receptions_payload(user_id)
+    if receptions_payload is None:
+        return None
+    try:
+        return await asyncio.wait_for(
+            emias_post_request_async(user_id, URL_GET_RECEPTIONS, receptions_payload,
+                                     timeout=timeout, priority=rate_limit.BOOKING),
+            timeout)
+    except asyncio.TimeoutError:
+        return None
+
+
+async def _verify_async(user_id: int, payload: dict, timeout: float) -> Optional[dict]:
+    return _find_booked(await _receptions_async(user_id, timeout), payload)
+
+
+async def is_booked_async(user_id: int, available_resource_id: Any, start_iso: str,
+                          timeout: float = _VERIFY_TIMEOUT) -> Optional[bool]:
+    """Есть ли у пациента запись на слот (ресурс + время начала): True/False, None — записи получить не удалось."""
+    receptions = await _receptions_async(user_id, timeout)
+    if not isinstance(receptions, dict) or not isinstance(receptions.get("payload"), dict):
+        return None
+    return _find_booked(receptions, {"availableResourceId": available_resource_id, "startTime": start_iso}) is not None
+
+
+async def booking_write_async(user_id: int, url: str, payload: dict,
+                              deadline: float = BOOKING_DEADLINE_SEC) -> Optional[dict]:
+    """createAppointment/shiftAppointment с дедлайном, хеджированием и защитой от дублей (см. модуль)."""
+    loop = asyncio.get_running_loop()
+    endpoint = endpoint_name(url)
+    deadline_at = loop.time() + deadline
+
+    def remaining() -> float:
+        return deadline_at - loop.time()
+
+    async def attempt(number: int):
+        started = loop.time()
+        try:
+            response = await emias_post_request_async(user_id, url, payload, timeout=max(_MIN_ATTEMPT_TIMEOUT, remaining()))
+        except asyncio.CancelledError:
+            _record_attempt(endpoint, number, loop.time() - started, None, cancelled=True)
+            raise
+        _record_attempt(endpoint, number, loop.time() - started, response)
+        return response
+
+    hedge_delay = tracker(endpoint).hedge_delay(deadline)
+    pending = {asyncio.create_task(attempt(1))}
+    done, pending = await asyncio.wait(pending, timeout=hedge_delay)
+    if pending:
+        # Проверка записей — пока второй запрос ещё успевает уложиться в дедлайн; первый запрос ждём параллельно
+        budget = min(_VERIFY_TIMEOUT, remaining() - hedge_delay)
+        if budget >= _MIN_ATTEMPT_TIMEOUT:
+            verify = asyncio.create_task(_verify_async(user_id, payload, budget))
+            await asyncio.wait(pending | {verify}, timeout=budget, return_when=asyncio.FIRST_COMPLETED)
+            booked = verify.result() if verify.done() and not verify.cancelled() and verify.exception() is None else None
+            verify.cancel()
+            if _verified(endpoint, booked, 'before hedge'):
+                for task in pending:
+                    task.cancel()
+                return booked
+            done = {task for task in pending if task.done()}
+            pending -= done
+        if pending:
+            metrics.inc('booking_hedges_total')
+            pending.add(asyncio.create_task(attempt(2)))
+
+    last, uncertain = None, False
+    try:
+        while done or pending:
+            for task in done:
+                response = task.result()
+                if _is_success(response):
+                    return response
+                last, uncertain = response, uncertain or _is_uncertain(response)
+            if not pending or remaining() <= 0:
+                break
+            done, pending = await asyncio.wait(pending, timeout=remaining(), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in pending:
+            task.cancel()
+    if pending:
+        uncertain = True
+        metrics.inc('booking_deadline_exceeded_total')
+    if uncertain:
+        booked = _verified(endpoint, await _verify_async(user_id, payload, _VERIFY_TIMEOUT), 'after failure')
+        if booked:
+            return booked
+    return last if last is not None else {"Описание": f"ЕМИАС не ответил за {deadline:.0f} с"}
+
+
+# ----------------------------- SYNC -----------------------------
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='booking')
+
+
+def _verify(user_id: int, payload: dict, timeout: float) -> Optional[dict]:
+    receptions_payload = _receptions_payload(user_id)
+    if receptions_payload is None:
+        return None
+    return _find_booked(emias_post_request(user_id, URL_GET_RECEPTIONS, receptions_payload, timeout=timeout), payload)
+
+
+def booking_write(user_id: int, url: str, payload: dict, deadline: float = BOOKING_DEADLINE_SEC) -> Optional[dict]:
+    """Синхронный аналог booking_write_async (попытки выполняются в пуле потоков)."""
+    endpoint = endpoint_name(url)
+    deadline_at = time_mod.monotonic() + deadline
+
+    def remaining() -> float:
+        return deadline_at - time_mod.monotonic()
+
+    def attempt(number: int):
+        started = time_mod.monotonic()
+        response = emias_post_request(user_id, url, payload, timeout=max(_MIN_ATTEMPT_TIMEOUT, remaining()))
+        _record_attempt(endpoint, number, time_mod.monotonic() - started, response)
+        return response
+
+    hedge_delay = tracker(endpoint).hedge_delay(deadline)
+    pending = {_executor.submit(attempt, 1)}
+    done, pending = futures_wait(pending, timeout=hedge_delay)
+    if pending:
+        # Проверка записей — пока второй запрос ещё успевает уложиться в дедлайн
+        budget = min(_VERIFY_TIMEOUT, remaining() - hedge_delay)
+        if budget >= _MIN_ATTEMPT_TIMEOUT:
+            booked = _verify(user_id, payload, budget)
+            if _verified(endpoint, booked, 'before hedge'):
+                return booked
+            done = {future for future in pending if future.done()}
+            pending -= done
+        if pending:
+            metrics.inc('booking_hedges_total')
+            pending.add(_executor.submit(attempt, 2))
+
+    last, uncertain = None, False
+    while done or pending:
+        for future in done:
+            response = future.result()
+            if _is_success(response):
+                return response
+            last, uncertain = response, uncertain or _is_uncertain(response)
+        if not pending or remaining() <= 0:
+            break
+        done, pending = futures_wait(pending, timeout=remaining(), return_when=FIRST_COMPLETED)
+    if pending:
+        # Потоки с запросами дорабатывают сами (их нельзя прервать), результат уже не нужен
+        uncertain = True
+        metrics.inc('booking_deadline_exceeded_total')
+    if uncertain:
+        booked = _verified(endpoint, _verify(user_id, payload, _VERIFY_TIMEOUT), 'after failure')
+        if booked:
+            return booked
+    return last if last is not None else {"Описание": f"ЕМИАС не ответил за {deadline:.0f} с"}
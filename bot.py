@@ -1,3 +1,4 @@
+import copy
 import logging
 from aiogram import Bot, Dispatcher, types
 from aiogram.types import Message, BotCommand
@@ -6,9 +7,10 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 
 from config import TELEGRAM_BOT_TOKEN, require_token
-from database import init_db, get_db_session, save_tokens, get_tokens, save_profile, get_profile, get_equivalent_speciality_codes, UserDoctorLink, log_user_action, DoctorSchedule, Specialty, UserProfile, LPUAddress, _extract_short_name
+from database import init_db, get_db_session, get_tokens, save_profile, get_profile, get_equivalent_speciality_codes, UserDoctorLink, log_user_action, Specialty, UserProfile, LPUAddress, _extract_short_name
 from emias_api import get_whoami, refresh_emias_token, get_assignments_referrals_info
 from rules_parser import parse_user_tracking_input
+import token_manager
 
 logging.basicConfig(level=logging.INFO)
 
@@ -70,9 +72,7 @@ async def refresh_token_handler(message: Message, state: FSMContext) -> None:
     access_token = data.get("access_token")
     expires_in = 3600  # Время жизни токена в секундах (можно задать динамически)
 
-    session = get_db_session()
-    save_tokens(session, message.from_user.id, access_token, refresh_token, expires_in)
-    session.close()
+    token_manager.store_tokens(message.from_user.id, access_token, refresh_token, expires_in)
 
     await message.answer("Токены успешно сохранены!")
     await state.clear()
@@ -134,7 +134,7 @@ async def get_password_handler(message: Message) -> None:
 
 
 # Обработчик /get_profile_info – получает данные из профиля и запрашивает информацию по API
-from datetime import datetime, date, time, timedelta
+from datetime import datetime, timedelta
 from aiogram.types import Message
 from database import get_db_session, get_tokens, get_profile, log_user_action
 from emias_api import get_whoami
@@ -409,7 +409,7 @@ async def get_receptions_handler(message: Message) -> None:
 
 
 from aiogram.types import CallbackQuery
-from typing import Optional, List, Union
+from typing import Optional, List, Union, Dict
 
 
 async def process_reschedule(callback_query: CallbackQuery):
@@ -438,8 +438,9 @@ async def process_reschedule(callback_query: CallbackQuery):
         doctors_info = payload.get("doctorsInfo", [])
         not_available_doctors = payload.get("notAvailableDoctors", [])
 
-        # Сохраняем данные о врачах
+        # Сохраняем данные о врачах одним набором (save_or_update_doctors: IN-запросы, пачечная запись, один commit)
         session = get_db_session()
+        doctors_to_save = []
         # Доступные ресурсы
         for block in doctors_info:
             block_lpu_id = block.get("lpuId") or block.get("lpuID")
@@ -466,8 +467,8 @@ async def process_reschedule(callback_query: CallbackQuery):
                             resource["lpuShortName"] = room.get("lpuShortName")
                         if room.get("defaultAddress") and not resource.get("lpuAddress"):
                             resource["lpuAddress"] = room.get("defaultAddress")
-                # save_or_update_doctor сам достанет room.defaultAddress / addressPointId из complexResource
-                save_or_update_doctor(session, callback_query.from_user.id, resource)
+                # save_or_update_doctors сам достанет room.defaultAddress / addressPointId из complexResource
+                doctors_to_save.append(resource)
         # Недоступные врачи
         for doc in not_available_doctors:
             # Обогатить данными из room, если есть
@@ -483,8 +484,8 @@ async def process_reschedule(callback_query: CallbackQuery):
                         doc["lpuShortName"] = room.get("lpuShortName")
                     if room.get("defaultAddress") and not doc.get("lpuAddress"):
                         doc["lpuAddress"] = room.get("defaultAddress")
-            save_or_update_doctor(session, callback_query.from_user.id, doc)
-        session.commit()
+            doctors_to_save.append(doc)
+        save_or_update_doctors(session, callback_query.from_user.id, doctors_to_save)
 
         # --- Отправляем информацию о доступных врачах ---
         if doctors_info:
@@ -512,16 +513,12 @@ async def process_reschedule(callback_query: CallbackQuery):
                             callback_data=f"do_reschedule:{appt_id}:{resource_id}:{c_id}"
                         )
                         kb.inline_keyboard.append([reschedule_btn])
-                        schedule_response = get_available_resource_schedule_info(
-                            user_id, resource_id, c_id, appt_id
-                        )
-                        if schedule_response and schedule_response.get("payload"):
-                            schedule_text = "\n\n" + format_schedule_message_simple(schedule_response.get("payload"))
+                        client = EmiasClient(user_id)
+                        schedule = await client.schedule(resource_id, c_id, appt_id)
+                        if schedule is not None:
+                            schedule_text = "\n\n" + format_schedule_message_simple(schedule)
                         else:
-                            error_desc = schedule_response.get("Описание") if schedule_response else None
-                            if not error_desc and schedule_response and schedule_response.get("payload"):
-                                error_desc = schedule_response.get("payload").get("Описание")
-                            schedule_text = "\n\n" + (error_desc or "Расписание недоступно")
+                            schedule_text = "\n\n" + (client.last_error or "Расписание недоступно")
                         msg_text += schedule_text
                         msg_text = safe_html(msg_text)
                         await callback_query.message.answer(msg_text, reply_markup=kb, parse_mode="HTML")
@@ -701,57 +698,44 @@ async def do_reschedule_callback(callback_query: CallbackQuery):
         user_id = callback_query.from_user.id
 
         # Найти самый ранний слот для этого ресурса
-        schedule_response = get_available_resource_schedule_info(user_id, resource_id, c_id, appt_id)
-        if not schedule_response or not schedule_response.get("payload"):
+        schedule = await EmiasClient(user_id).schedule(resource_id, c_id, appt_id)
+        if schedule is None:
             await callback_query.answer("Не удалось получить расписание.", show_alert=True)
             return
 
         # Использовать логику из blood.py для поиска слота
         # Но упростить: взять первый доступный слот
-        earliest_slot = None
-        for day in schedule_response.get("payload").get("scheduleOfDay", []):
-            for slot_block in day.get("scheduleBySlot", []):
-                for slot in slot_block.get("slot", []):
-                    start_time = slot.get("startTime")
-                    end_time = slot.get("endTime")
-                    if start_time and end_time:
-                        earliest_slot = (start_time, end_time)
-                        break
-                if earliest_slot:
-                    break
-            if earliest_slot:
-                break
-
+        earliest_slot = schedule.first_slot()
         if not earliest_slot:
             await callback_query.answer("Нет доступных слотов.", show_alert=True)
             return
 
-        start_time, end_time = earliest_slot
+        start_time, end_time = earliest_slot.start_iso, earliest_slot.end_iso
 
         # Получить reception_type_id (только из Specialty, т.к. в расписании его нет и не будет)
         reception_type_id = 0
-        from database import get_db_session as _gdb, DoctorInfo, Specialty, log_user_action as _lua
-        _sess = _gdb()
-        try:
-            doc = _sess.query(DoctorInfo).filter_by(doctor_api_id=str(resource_id)).first()
-            if doc and doc.ar_speciality_id:
-                spec = _sess.query(Specialty).filter_by(code=doc.ar_speciality_id).first()
-                if spec and spec.reception_type_id not in (None, ""):
-                    try:
-                        reception_type_id = int(spec.reception_type_id)
-                    except Exception:
-                        reception_type_id = 0
-                else:
-                    try:
-                        _lua(_sess, user_id, 'api_reception_type_missing_db', f'spec {doc.ar_speciality_id}', source='bot', status='info')
-                    except Exception:
-                        pass
-        finally:
-            _sess.close()
+        from database import get_db_session as _gdb, log_user_action as _lua
+        import ref_cache
+        doc = ref_cache.get_doctor(resource_id)
+        if doc and doc.ar_speciality_id:
+            spec = ref_cache.get_specialty(doc.ar_speciality_id)
+            if spec and spec.reception_type_id not in (None, ""):
+                try:
+                    reception_type_id = int(spec.reception_type_id)
+                except Exception:
+                    reception_type_id = 0
+            else:
+                _sess = _gdb()
+                try:
+                    _lua(_sess, user_id, 'api_reception_type_missing_db', f'spec {doc.ar_speciality_id}', source='bot', status='info')
+                except Exception:
+                    pass
+                finally:
+                    _sess.close()
 
-        # Вызвать shift_appointment
-        from emias_api import shift_appointment
-        response = shift_appointment(
+        # Вызвать shift_appointment (асинхронно: запрос не блокирует обработчики бота)
+        from emias_api import shift_appointment_async
+        response = await shift_appointment_async(
             user_id=user_id,
             available_resource_id=resource_id,
             complex_resource_id=c_id,
@@ -774,21 +758,19 @@ async def do_reschedule_callback(callback_query: CallbackQuery):
                     success = True
                     appointment_new_id = inner.get('appointmentId')
         # Извлекаем детали для сообщения
-        avail_res = schedule_response.get("payload", {}).get("availableResource", {})
-        doctor_name = avail_res.get("name", "Врач")
+        doctor_name = schedule.doctor_name or "Врач"
         from database import log_user_action, get_db_session
         sess = None
         try:
             sess = get_db_session()
             if success:
                 # Парсим дату/время
-                from datetime import datetime
                 months = {1:"января",2:"февраля",3:"марта",4:"апреля",5:"мая",6:"июня",7:"июля",8:"августа",9:"сентября",10:"октября",11:"ноября",12:"декабря"}
-                try:
-                    start_dt = datetime.fromisoformat(start_time)
+                start_dt, end_dt = earliest_slot.start, earliest_slot.end
+                if start_dt and end_dt:
                     date_str = f"{start_dt.day} {months.get(start_dt.month, start_dt.strftime('%B'))} {start_dt.year}"
-                    time_str = f"{start_dt.strftime('%H:%M')} - {datetime.fromisoformat(end_time).strftime('%H:%M')}"
-                except Exception:
+                    time_str = f"{start_dt.strftime('%H:%M')} - {end_dt.strftime('%H:%M')}"
+                else:
                     date_str = start_time[:10] if start_time else "Неизвестно"
                     time_str = f"{start_time[11:16] if start_time else '??:??'} - {end_time[11:16] if end_time else '??:??'}"
                 # Формат единого стиля (ручной перенос):
@@ -797,12 +779,9 @@ async def do_reschedule_callback(callback_query: CallbackQuery):
                 # 🩺 Специальность (если есть)
                 # 📅 1 октября 2025
                 # 🕒 12:12
-                speciality_name = avail_res.get("arSpecialityName") or avail_res.get("arSpeciality") or ""
+                speciality_name = schedule.speciality_name
                 # Для единобразия берём только время начала
-                try:
-                    start_only = datetime.fromisoformat(start_time).strftime('%H:%M') if start_time else time_str.split('-')[0]
-                except Exception:
-                    start_only = time_str.split('-')[0]
+                start_only = start_dt.strftime('%H:%M') if start_dt else time_str.split('-')[0]
                 lines = [
                     "✅ Приём перенесён!",
                     f"👨‍⚕️ {doctor_name}",
@@ -1164,14 +1143,12 @@ def build_doctor_toggle_keyboard(session, user_id: int, doctor_api_id: str) -> I
     return keyboard
 
 
-from emias_api import get_available_resource_schedule_info
-
 from datetime import datetime
 
 
-def format_schedule_message_simple(schedule_payload: dict) -> str:
+def format_schedule_message_simple(schedule_payload) -> str:
     """
-    Формирует сообщение с расписанием на основе полученного payload.
+    Формирует сообщение с расписанием на основе полученного payload (или уже разобранного Schedule).
 
     Формат сообщения:
       <b>Расписание:</b>
@@ -1190,27 +1167,13 @@ def format_schedule_message_simple(schedule_payload: dict) -> str:
         7: "июля", 8: "августа", 9: "сентября", 10: "октября", 11: "ноября", 12: "декабря"
     }
 
-    schedule_of_day = schedule_payload.get("scheduleOfDay", [])
-    for day in schedule_of_day:
-        date_str = day.get("date", "Неизвестная дата")
-        # Пробуем преобразовать дату из формата YYYY-MM-DD в "день месяц"
-        try:
-            dt = datetime.strptime(date_str, "%Y-%m-%d")
-            formatted_date = f"{dt.day} {months.get(dt.month, date_str)}"
-        except Exception:
-            formatted_date = date_str
-
-        times = []
-        schedule_by_slot = day.get("scheduleBySlot", [])
-        for slot_info in schedule_by_slot:
-            slots = slot_info.get("slot", [])
-            for slot in slots:
-                start = slot.get("startTime", "")
-                if len(start) >= 16:
-                    # Из строки ISO-формата берем символы с 11 до 16 (HH:MM)
-                    times.append(start[11:16])
-                else:
-                    times.append(start)
+    for day in as_schedule(schedule_payload).days:
+        date_str = day.date_str or "Неизвестная дата"
+        # Дата уже разобрана в Day.date — выводим "день месяц"
+        formatted_date = f"{day.date.day} {months.get(day.date.month, date_str)}" if day.date else date_str
+
+        # Из строки ISO-формата берем символы с 11 до 16 (HH:MM)
+        times = [slot.start_iso[11:16] if len(slot.start_iso) >= 16 else slot.start_iso for slot in day.slots]
         times_str = ", ".join(times)
         lines.append(f"{formatted_date}: {times_str}")
 
@@ -1436,88 +1399,6 @@ async def get_clinics_handler(message: Message, command: CommandObject):
     await message.answer("Команда /get_clinics отключена.")
 
 
-from collections.abc import Mapping, Sequence
-
-# набор возможных вариантов ключа
-_SPECIALITY_KEYS = {
-    "specialityId",
-    "specialtyId",
-    "doctorSpecialityId",
-    "doctorSpecialtyId",
-}
-
-def _to_str_or_empty(value) -> str:
-    if value is None:
-        return ""
-    try:
-        return str(int(value))
-    except (ValueError, TypeError):
-        # если это не число (на всякий), просто str()
-        return str(value).strip()
-
-def extract_speciality_id_from_appointment(appt: dict) -> str:
-    """Возвращает specialityId из записи, учитывая любые варианты вложенности/имен."""
-    if not appt or not isinstance(appt, Mapping):
-        return ""
-
-    # Специальный случай диагностических процедур (LDP): используем ldpTypeId как псевдо-"специальность"
-    if appt.get("type") == "LDP":
-        to_ldp = appt.get("toLdp")
-        if isinstance(to_ldp, Mapping):
-            ldp_type_id = to_ldp.get("ldpTypeId")
-            if ldp_type_id not in (None, "", 0):
-                try:
-                    return str(int(ldp_type_id))
-                except (ValueError, TypeError):
-                    return str(ldp_type_id)
-
-    # 1) быстрые явные пути
-    # верхний уровень
-    for k in _SPECIALITY_KEYS:
-        if k in appt and appt[k] not in (None, "", 0):
-            return _to_str_or_empty(appt[k])
-
-    # toDoctor
-    to_doctor = appt.get("toDoctor")
-    if isinstance(to_doctor, Mapping):
-        for k in _SPECIALITY_KEYS:
-            if k in to_doctor and to_doctor[k] not in (None, "", 0):
-                return _to_str_or_empty(to_doctor[k])
-
-    # referral
-    referral = appt.get("referral")
-    if isinstance(referral, Mapping):
-        for k in _SPECIALITY_KEYS:
-            if k in referral and referral[k] not in (None, "", 0):
-                return _to_str_or_empty(referral[k])
-
-    # 2) общий глубокий поиск (dicts/lists/tuples)
-    stack = [appt]
-    seen = set()
-    while stack:
-        node = stack.pop()
-        if id(node) in seen:
-            continue
-        seen.add(id(node))
-
-        if isinstance(node, Mapping):
-            # прямое попадание ключа
-            for k in _SPECIALITY_KEYS:
-                if k in node and node[k] not in (None, "", 0):
-                    return _to_str_or_empty(node[k])
-            # углубляемся
-            for v in node.values():
-                if isinstance(v, (Mapping, Sequence)) and not isinstance(v, (str, bytes)):
-                    stack.append(v)
-
-        elif isinstance(node, Sequence) and not isinstance(node, (str, bytes)):
-            for v in node:
-                if isinstance(v, (Mapping, Sequence)) and not isinstance(v, (str, bytes)):
-                    stack.append(v)
-
-    return ""
-
-
 @router.message(Command("favourites"))
 async def favourites_handler(message: Message):
     session = get_db_session()
@@ -1560,8 +1441,9 @@ async def favourites_handler(message: Message):
             ]
         )
 
-        if schedule_response and schedule_response.get("payload"):
-            schedule_text = format_schedule_message_simple(schedule_response.get("payload"))
+        schedule = Schedule.from_response(schedule_response)
+        if schedule is not None:
+            schedule_text = format_schedule_message_simple(schedule)
             doctor_info_text = f"<b>{doctor.name}</b>\n{doctor.ar_speciality_name}"
             await message.answer(
                 f"{doctor_info_text}\n{schedule_text}",
@@ -1576,9 +1458,7 @@ async def favourites_handler(message: Message):
                 if link and link.appointment_id:
                     has_appointment = True
                     break
-            error_desc = schedule_response.get("Описание") if schedule_response else None
-            if not error_desc and schedule_response and schedule_response.get("payload"):
-                error_desc = schedule_response.get("payload").get("Описание")
+            error_desc = error_description(schedule_response)
             # Показываем исходный текст из API без подмены; если его нет – fallback.
             msg = f"{doctor.name} ({doctor.ar_speciality_name}): {error_desc or 'Не удалось получить расписание для врача.'}"
             await message.answer(msg, reply_markup=combined_keyboard)
@@ -2102,59 +1982,31 @@ def parse_user_tracking_input_legacy(text: str):
     return rules
 
 
-def _freeze_rules_if_needed(track, session):
-    """Однократно конвертирует относительные/дни недели правила уже сохранённого трека в абсолютные даты.
-    Нужна для старых записей, созданных до введения фиксации при вводе.
+def _freeze_rules_if_needed(rules):
+    """Однократно приводит правила уже сохранённого трека к канонической форме rules_engine
+    (строки старого веба, 'сегодня'/'завтра', даты не в ISO). Нужна для старых записей,
+    созданных до нормализации при вводе. Каноническая форма берётся из кэша компиляции,
+    поэтому для уже нормализованных правил это одно сравнение списков.
+    Возвращает новые правила или None, если менять нечего (запись — за вызывающим кодом).
     """
-    changed = False
-    frozen = []
-    if not track.tracking_rules:
-        return
-    today = datetime.now().date()
-    current_wd = datetime.now().weekday()
-    for r in track.tracking_rules:
-        if not isinstance(r, dict):
-            frozen.append(r)
-            continue
-        rtype = (r.get('type') or '').lower()
-        value = (r.get('value') or '').strip().lower()
-        trs = r.get('timeRanges') or []
-        # Заморозка только для 'сегодня'/'завтра' если вдруг они ещё лежат
-        if rtype in ('relative_date', 'date') and value in ('сегодня', 'завтра'):
-            target = today if value == 'сегодня' else today + timedelta(days=1)
-            frozen.append({'type': 'date', 'value': target.strftime('%Y-%m-%d'), 'timeRanges': trs})
-            changed = True
-        elif rtype == 'weekday':
-            # оставляем как есть – повторяющееся правило
-            frozen.append({'type': 'weekday', 'value': value, 'timeRanges': trs})
-        elif rtype == 'date':
-            dt_p = _parse_date_rule(value, datetime.now().year)
-            if dt_p and re.match(r'^\d{4}-\d{2}-\d{2}$', value) is None:
-                frozen.append({'type': 'date', 'value': dt_p.strftime('%Y-%m-%d'), 'timeRanges': trs})
-                changed = True
-            else:
-                frozen.append(r)
-        else:
-            frozen.append(r)
-    if changed:
-        track.tracking_rules = frozen
-        try:
-            session.commit()
-            logging.debug(f"FROZE_RULES user={track.telegram_user_id} doctor={track.doctor_api_id}")
-        except Exception as fr_err:
-            session.rollback()
-            logging.warning(f"FROZE_RULES_COMMIT_FAIL user={track.telegram_user_id} doctor={track.doctor_api_id}: {fr_err}")
+    if not rules:
+        return None
+    canonical = compile_tracking_rules(rules).normalized
+    if canonical == rules:
+        return None
+    # Копия: объекты из кэша компиляции не должны попадать в БД/снимок (их могут изменить на месте)
+    return copy.deepcopy(canonical)
 
 
-def _cleanup_outdated_rules(track, session):
-    """Удаляет устаревшие date правила (дата < сегодня)."""
-    if not track.tracking_rules:
-        return
+def _cleanup_outdated_rules(rules):
+    """Удаляет устаревшие date правила (дата < сегодня). Возвращает новые правила или None, если менять нечего."""
+    if not rules:
+        return None
     today = datetime.now().date()
     cleaned = []
-    removed_count = 0
+    changed = False
     
-    for r in track.tracking_rules:
+    for r in rules:
         if not isinstance(r, dict):
             cleaned.append(r)
             continue
@@ -2178,14 +2030,7 @@ def _cleanup_outdated_rules(track, session):
                 cleaned.append(r)
         else:
             cleaned.append(r)
-    if changed:
-        track.tracking_rules = cleaned
-        try:
-            session.commit()
-            logging.info(f"CLEANUP_OUTDATED user={track.telegram_user_id} doctor={track.doctor_api_id} removed={removed_count}")
-        except Exception as cl_err:
-            session.rollback()
-            logging.warning(f"CLEANUP_OUTDATED_FAIL user={track.telegram_user_id}: {cl_err}")
+    return cleaned if changed else None
 
 
 async def help_handler(message: Message) -> None:
@@ -2247,12 +2092,23 @@ def register_handlers(dp: Dispatcher) -> None:
 
 
 import asyncio
+import dataclasses
 from aiogram import Bot, Dispatcher
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from database import get_db_session, UserTrackedDoctor, DoctorInfo, DoctorSchedule, UserDoctorLink
-from emias_api import get_available_resource_schedule_info
+from database import get_db_session, UserTrackedDoctor, DoctorInfo, UserDoctorLink, save_doctor_schedule
+from emias_api import get_available_resource_schedule_info_async
 from aiogram.types import Message
-from config import TELEGRAM_BOT_TOKEN
+from config import TELEGRAM_BOT_TOKEN, POLL_CONCURRENCY, RECEPTIONS_CACHE_TTL, AUDIT_LOG_TRIM_INTERVAL_SEC
+from emias_client import EmiasClient, error_description
+from emias_models import Appointment, Schedule, as_schedule
+from poll_snapshot import DoctorView, PollSnapshot, PollWrites, ScheduleView, TrackView, write_track_rows
+from slot_batch import match_subscribers
+from slot_codec import SlotTable
+from slot_events import SlotEventRecorder, compact_slot_events
+import audit_log
+import circuit_breaker
+import db_writer
+import metrics
 
 # Проверяем наличие токена до инициализации
 try:
@@ -2268,50 +2124,74 @@ bot = Bot(token=TELEGRAM_BOT_TOKEN)
 dp = Dispatcher()
 scheduler = AsyncIOScheduler()
 
-import json
+import weakref
 
 
-async def get_schedule_for_doctor(session, user_id: int, doctor: DoctorInfo, use_appointment: bool = True):
-    """
-    Получает расписание для врача, пробуя разные appointment_id.
-    1. Обновляем актуальные записи из API.
-    2. Пробуем для специальностей 602, 69, если основная специальность врача одна из них.
-    3. Пробуем для основной специальности врача.
-    4. Пробуем без appointment_id, если нет записи.
+# Кэш записей пользователя (getAppointmentReceptionsByPatient): user_id -> (время получения, [Appointment]).
+# TTL меньше интервала поллера, поэтому в каждом цикле записи запрашиваются один раз на пользователя,
+# а все его треки и авто-запись внутри цикла используют один и тот же (уже разобранный) ответ.
+_receptions_cache: dict[int, tuple[float, List[Appointment]]] = {}
+# Замки живут, пока их кто-то держит или ждёт (WeakValueDictionary) — не копятся по всем пользователям
+_receptions_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+def _prune_receptions_cache(now: float) -> None:
+    """Удаляет просроченные записи кэша (пользователи, которых больше не опрашивают)."""
+    for uid in [uid for uid, (ts, _) in _receptions_cache.items() if now - ts >= RECEPTIONS_CACHE_TTL]:
+        del _receptions_cache[uid]
+
+
+async def get_appointments_cached(user_id: int, force: bool = False) -> Optional[List[Appointment]]:
+    """Возвращает записи пользователя из кэша (не старше RECEPTIONS_CACHE_TTL) или запрашивает их из API.
+
+    Одновременные вызовы для одного пользователя ждут единственный запрос. Ошибка запроса не кэшируется.
     """
-    if not doctor.complex_resource_id:
-        return None
+    lock = _receptions_locks.get(user_id)
+    if lock is None:
+        lock = _receptions_locks[user_id] = asyncio.Lock()
+    async with lock:
+        now = asyncio.get_running_loop().time()
+        cached = _receptions_cache.get(user_id)
+        if not force and cached and now - cached[0] < RECEPTIONS_CACHE_TTL:
+            return cached[1]
+        appointments = await EmiasClient(user_id).appointments()
+        if appointments is not None:
+            _prune_receptions_cache(now)
+            _receptions_cache[user_id] = (now, appointments)
+        else:
+            _receptions_cache.pop(user_id, None)
+        return appointments
+
 
-    # Обновляем актуальные записи из API
-    appointments_data = get_appointment_receptions_by_patient(user_id)
-    if appointments_data:
-        appointments = appointments_data.get("appointment", [])
+def invalidate_receptions_cache(user_id: int):
+    """Сбрасывает кэш записей пользователя (после создания/переноса записи)."""
+    _receptions_cache.pop(user_id, None)
+
+
+def _sync_user_doctor_links(session, user_id: int, appointments: Optional[List[Appointment]]):
+    """Приводит UserDoctorLink пользователя в соответствие с его актуальными записями из API."""
+    if appointments is not None:
         existing_specs = set()
         for appt in appointments:
-            appt_spec_id = extract_speciality_id_from_appointment(appt)
+            appt_spec_id = appt.speciality_id
             if appt_spec_id:
                 existing_specs.add(appt_spec_id)
-            appointment_id = appt.get("appointmentId") or appt.get("id")
-            if appointment_id and appt_spec_id:
+            if appt.id and appt_spec_id:
                 link = session.query(UserDoctorLink).filter_by(telegram_user_id=user_id, doctor_speciality=appt_spec_id).first()
                 if link:
-                    link.appointment_id = str(appointment_id)
+                    link.appointment_id = str(appt.id)
                     # Сохраняем referral_id если есть
-                    ref = appt.get("referral") or {}
-                    ref_id = ref.get("referralId") or ref.get("id")
-                    if ref_id:
-                        link.referral_id = str(ref_id)
+                    if appt.referral_id:
+                        link.referral_id = appt.referral_id
                 else:
                     # Создаем новую связь (в частности для LDP 600034 и т.п.)
                     link = UserDoctorLink(
                         telegram_user_id=user_id,
                         doctor_speciality=str(appt_spec_id),
-                        appointment_id=str(appointment_id),
+                        appointment_id=str(appt.id),
                     )
-                    ref = appt.get("referral") or {}
-                    ref_id = ref.get("referralId") or ref.get("id")
-                    if ref_id:
-                        link.referral_id = str(ref_id)
+                    if appt.referral_id:
+                        link.referral_id = appt.referral_id
                     session.add(link)
         # Очищаем appointment_id для specs без активных записей
         all_links = session.query(UserDoctorLink).filter_by(telegram_user_id=user_id).all()
@@ -2320,6 +2200,22 @@ async def get_schedule_for_doctor(session, user_id: int, doctor: DoctorInfo, use
                 link.appointment_id = None
         session.commit()
 
+
+async def resolve_schedule_context(session, user_id: int, doctor: DoctorInfo, use_appointment: bool = True) -> Optional[int]:
+    """
+    Синхронизирует записи пользователя (UserDoctorLink) из API и подбирает appointment_id,
+    с которым нужно запрашивать расписание врача (None — запрос без appointment_id).
+
+    Для обработчиков с собственной сессией; поллер сессию не держит (PollWrites.sync_links).
+    """
+    # Обновляем актуальные записи из API (через кэш)
+    appointments = await get_appointments_cached(user_id)
+    _sync_user_doctor_links(session, user_id, appointments)
+    return _pick_appointment_id(appointments, doctor) if use_appointment else None
+
+
+def _pick_appointment_id(appointments: Optional[List[Appointment]], doctor) -> Optional[int]:
+    """appointment_id записи пользователя к этому врачу или на эквивалентную специальность (None — нет такой)."""
     speciality_priorities = []
     # logging.info(f"Получаем расписание для врача: {doctor.name} (ID: {doctor.doctor_api_id}), специальность: {doctor.ar_speciality_id}")
     if doctor.ar_speciality_id in ["602", "69"]:
@@ -2333,482 +2229,615 @@ async def get_schedule_for_doctor(session, user_id: int, doctor: DoctorInfo, use
 
     # Проверяем, есть ли appointment_id из API для этого врача или эквивалентных специальностей
     appointment_id = None
-    if use_appointment and appointments_data:
-        appointments = appointments_data.get("appointment", [])
+    if appointments:
+        equivalent_codes = get_equivalent_speciality_codes(doctor.ar_speciality_id)
         for appt in appointments:
-            if str(appt.get("availableResourceId", "")) == str(doctor.doctor_api_id):
-                appt_id = appt.get("appointmentId") or appt.get("id")
-                if appt_id:
-                    try:
-                        appointment_id = int(appt_id)
-                        break
-                    except (ValueError, TypeError):
-                        pass
-            if appointment_id is None:
-                appt_spec_id = extract_speciality_id_from_appointment(appt)
-                if appt_spec_id in get_equivalent_speciality_codes(doctor.ar_speciality_id):
-                    appt_id = appt.get("appointmentId") or appt.get("id")
-                    if appt_id:
-                        try:
-                            appointment_id = int(appt_id)
-                            break
-                        except (ValueError, TypeError):
-                            pass
-    if use_appointment:
-        logging.info(f"appointment_id candidate: {appointment_id}")
-    if use_appointment and appointment_id:
+            if not isinstance(appt.id, int):
+                continue
+            if appt.available_resource_id == str(doctor.doctor_api_id) or appt.speciality_id in equivalent_codes:
+                appointment_id = appt.id
+                break
+    logging.info(f"appointment_id candidate: {appointment_id}")
+    return appointment_id
+
+
+async def fetch_doctor_schedule(user_id: int, doctor: DoctorInfo, appointment_id: Optional[int] = None, autosave: bool = True):
+    """Запрашивает расписание врача (с appointment_id, если он есть, иначе — по inquiryPurposeId).
+    autosave=False — ответ не сохраняется в doctor_schedules (поллер сохраняет baseline сам)."""
+    if appointment_id:
         # Прямой запрос с appointment_id без предварительного варианта.
         try:
-            return get_available_resource_schedule_info(
+            return await get_available_resource_schedule_info_async(
                 user_id,
                 available_resource_id=doctor.doctor_api_id,
                 complex_resource_id=doctor.complex_resource_id,
                 appointment_id=appointment_id,
+                autosave=autosave,
             )
         except Exception as e:
             logging.error(f"Ошибка при запросе расписания с appointment_id={appointment_id}: {e}")
             # Падаем в обычный запрос без appointment_id ниже.
 
     # Если нет appointment_id, пробуем без
-    return get_available_resource_schedule_info(
-        user_id, doctor.doctor_api_id, doctor.complex_resource_id
+    return await get_available_resource_schedule_info_async(
+        user_id, doctor.doctor_api_id, doctor.complex_resource_id, autosave=autosave
     )
 
 
+async def get_schedule_for_doctor(session, user_id: int, doctor: DoctorInfo, use_appointment: bool = True):
+    """
+    Получает расписание для врача, пробуя разные appointment_id.
+    1. Обновляем актуальные записи из API.
+    2. Пробуем для специальностей 602, 69, если основная специальность врача одна из них.
+    3. Пробуем для основной специальности врача.
+    4. Пробуем без appointment_id, если нет записи.
+    """
+    if not doctor.complex_resource_id:
+        return None
+    appointment_id = await resolve_schedule_context(session, user_id, doctor, use_appointment=use_appointment)
+    return await fetch_doctor_schedule(user_id, doctor, appointment_id)
+
+
+class ScheduleBaseline:
+    """
+    Последний сохранённый снапшот расписания врача, считанный до запроса нового.
+    Слоты декодируются лениво — только если кому-то из подписчиков понадобился diff:
+    при неизменившемся отпечатке слотов до декодирования обычно не доходит.
+    """
+
+    def __init__(self, record: Optional[ScheduleView]):
+        self.missing = record is None
+        self.fingerprint = record.fingerprint if record is not None else None
+        self._record = record
+        self._table = None
+
+    @classmethod
+    def of_table(cls, table: SlotTable) -> 'ScheduleBaseline':
+        """Baseline из уже разобранного расписания (прошлый ответ группы, см. _group_baselines)."""
+        baseline = cls(None)
+        baseline.missing = False
+        baseline.fingerprint = table.fingerprint()
+        baseline._table = table
+        return baseline
+
+    @property
+    def table(self) -> SlotTable:
+        if self._table is None:
+            try:
+                self._table = self._record.slot_table() if self._record is not None else SlotTable.from_schedule_days([])
+            except Exception:
+                # logging.warning(f"BASELINE_CAPTURE_PARSE_FAIL {doctor.name}: {cap_err}; treating as empty old data")
+                self._table = SlotTable.from_schedule_days([])
+        return self._table
+
+
+# Замки автозаписи по пользователю; живут, пока их держат или ждут (как _receptions_locks)
+_auto_booking_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+def _auto_booking_lock(user_id: int) -> asyncio.Lock:
+    lock = _auto_booking_locks.get(user_id)
+    if lock is None:
+        lock = _auto_booking_locks[user_id] = asyncio.Lock()
+    return lock
+
+
+def _auto_booking_armed(track: TrackView, writes: PollWrites) -> bool:
+    """Автозапись трека всё ещё включена с учётом изменений этого цикла: не отключена
+    успешной записью и группа stop_after_first не израсходована (batch не очищен)."""
+    if not writes.track_value(track, 'auto_booking'):
+        return False
+    return not track.stop_after_first or writes.track_value(track, 'bulk_batch_id') == track.bulk_batch_id
+
+
+async def _evaluate_tracked_doctor(track: TrackView, doctor: DoctorView, writes: PollWrites, schedule: Optional[Schedule], baseline,
+                                  appointment_id: Optional[int] = None, matching_slots: Optional[list] = None,
+                                  new_table: Optional[SlotTable] = None):
+    """
+    Оценивает один трек по уже полученному расписанию: подбор слотов, сравнение с baseline,
+    уведомления и автозапись. baseline — ScheduleBaseline из снимка цикла, считанный
+    ДО запроса нового расписания и общий для всех подписчиков врача. schedule — ответ,
+    разобранный один раз на группу запроса (emias_models.Schedule). Изменения трека копятся
+    в writes до конца цикла; только отключение автозаписи и группы после успешной записи
+    пишется сразу (write_track_rows через db_writer).
+    """
+    user_id = track.telegram_user_id
+    baseline_missing = baseline.missing
+
+    if schedule is None:
+        return  # переход к следующему отслеживанию
+
+    new_schedule = schedule.schedule_days
+
+    normalized_rules = compile_tracking_rules(track.tracking_rules).normalized
+    # matching_slots может прийти уже посчитанным пакетно для всех подписчиков (slot_batch)
+    if matching_slots is None:
+        matching_slots = collect_matching_slots(schedule, normalized_rules)
+    best_slot_info = matching_slots[0] if matching_slots else None
+    best_slot_display = best_slot_info[0] if best_slot_info else None
+
+    # Старое расписание уже считано выше (old_schedule_record / baseline_missing)
+
+    # ===================== AUTO-BOOKING BRANCH =====================
+    # Проблема (наблюдалась): пока включена автозапись, мы ранее НЕ обновляли baseline,
+    # поэтому когда автозапись выключалась (успешная запись) – следующий цикл видел «старый» снапшот
+    # и считал ВСЕ текущие слоты added. Теперь даже в режиме auto_booking мы обновляем baseline
+    # (без вычисления diff и без уведомлений) чтобы состояние было консистентным.
+    # (baseline сохраняет в check_schedule_updates группа-владелец врача — см. _baseline_owner_keys)
+    auto_booking = writes.track_value(track, 'auto_booking')
+    if auto_booking:
+        if best_slot_display:
+            # Группы запроса обрабатываются параллельно: без замка пользователя треки одной группы
+            # stop_after_first у разных врачей записали бы его несколько раз
+            async with _auto_booking_lock(user_id):
+                # Пока ждали замок, соседняя запись могла отключить этот трек или израсходовать группу
+                if _auto_booking_armed(track, writes):
+                    # logging.info(f"Auto-book INIT {doctor.name}: trying slot={best_slot_display}")
+                    # Слот и appointment_id уже известны из текущего цикла — идём сразу в create/shift
+                    success, result_kind = await book_appointment(
+                        user_id, doctor.doctor_api_id, best_slot_display,
+                        start_iso=best_slot_info[1], end_iso=best_slot_info[2], appointment_id=appointment_id,
+                        reception_type_id=writes.snapshot.reception_type_id(doctor), doctor=doctor,
+                    )
+                    logging.info(f"Auto-book RESULT {doctor.name}: slot={best_slot_display} success={success} kind={result_kind}")
+                    # Уведим пользователя и при успехе выключим автозапись (одноразовая логика)
+                    if success:
+                        # Единый формат (авто):
+                        # ✅ Автозапись  / ✅ Автоперенос
+                        # 👨‍⚕️ Имя врача
+                        # 🩺 Специальность
+                        # 📅 1 октября 2025
+                        # 🕒 11:12
+                        # Автозапись отключена.
+                        if result_kind == "shift":
+                            action = 'auto_book_shift'
+                            header = "✅ Автоперенос"
+                        else:
+                            action = 'auto_book_success'
+                            header = "✅ Автозапись"
+
+                        # Парсим слот для даты/времени
+                        human_date = best_slot_display
+                        human_time = best_slot_display[-5:]
+                        try:
+                            from datetime import datetime as _dt
+                            _months = {1:"января",2:"февраля",3:"марта",4:"апреля",5:"мая",6:"июня",7:"июля",8:"августа",9:"сентября",10:"октября",11:"ноября",12:"декабря"}
+                            dt_parsed = _dt.strptime(best_slot_display, "%Y-%m-%d %H:%M")
+                            human_date = f"{dt_parsed.day} {_months.get(dt_parsed.month, dt_parsed.strftime('%B'))} {dt_parsed.year}"
+                            human_time = dt_parsed.strftime('%H:%M')
+                        except Exception:
+                            pass
+
+                        spec_line = doctor.ar_speciality_name or ''
+                        note_lines = [header, f"👨‍⚕️ {doctor.name}"]
+                        if spec_line:
+                            note_lines.append(f"🩺 {spec_line}")
+                        note_lines.append(f"📅 {human_date}")
+                        note_lines.append(f"🕒 {human_time}")
+                        note_lines.append("Автозапись отключена.")
+                        # Если трек принадлежит batch со стратегией stop_after_first – отключаем авто-запись у остальных
+                        siblings_disabled = []
+                        disabled_track_ids = [track.id]
+                        try:
+                            if writes.track_value(track, 'stop_after_first'):
+                                consumed_batch = writes.track_value(track, 'bulk_batch_id')
+                                # batch_id должен быть валидным (hex длиной 32). Если None / пусто / 'None' – не трогаем других.
+                                is_valid_batch = False
+                                if isinstance(consumed_batch, str) and len(consumed_batch) == 32 and all(c in '0123456789abcdef' for c in consumed_batch.lower()):
+                                    is_valid_batch = True
+                                if is_valid_batch:
+                                    sibling_q = [
+                                        t for t in writes.snapshot.tracks
+                                        if t.telegram_user_id == user_id and t.id != track.id
+                                        and writes.track_value(t, 'bulk_batch_id') == consumed_batch
+                                        and writes.track_value(t, 'auto_booking')
+                                    ]
+                                    for sib in sibling_q:
+                                        # Группа считается израсходованной – отключаем автозапись, очищаем batch и стоп-флаг
+                                        writes.update_track(sib.id, auto_booking=False, bulk_batch_id=None, stop_after_first=False)
+                                        siblings_disabled.append(sib.doctor_api_id)
+                                        disabled_track_ids.append(sib.id)
+                                        try:
+                                            log_user_action(None, user_id, 'auto_booking_group_disabled', f"doctor={sib.doctor_api_id} batch={consumed_batch}", source='bot', status='info')
+                                        except Exception:
+                                            pass
+                                    # Текущий трек тоже отделяем от группы
+                                    writes.update_track(track.id, bulk_batch_id=None, stop_after_first=False)
+                                    if siblings_disabled:
+                                        try:
+                                            named = []
+                                            if len(siblings_disabled) <= 25:
+                                                for did in siblings_disabled:
+                                                    sib_doctor = writes.snapshot.doctors.get(did)
+                                                    named.append(sib_doctor.name if sib_doctor and sib_doctor.name else did)
+                                            else:
+                                                named = siblings_disabled[:25]
+                                            if named:
+                                                preview_list = ', '.join(named[:6]) + (' …' if len(named) > 6 else '')
+                                                note_lines.append(f"Остановлена авто-запись ещё для {len(siblings_disabled)} в группе: {preview_list}")
+                                        except Exception:
+                                            note_lines.append(f"Остановлена авто-запись ещё для {len(siblings_disabled)} треков группы.")
+                                    else:
+                                        note_lines.append("Группа завершена (других врачей не осталось).")
+                                    try:
+                                        log_user_action(None, user_id, 'bulk_batch_consumed', f"batch={consumed_batch} winner={doctor.doctor_api_id} disabled={len(siblings_disabled)}", source='bot', status='success')
+                                    except Exception:
+                                        pass
+                                else:
+                                    # Некорректный (или отсутствующий) batch_id — не трогаем других.
+                                    # Сбрасываем только текущий stop_after_first, чтобы не повторять попытку.
+                                    if consumed_batch in (None, '', 'None'):
+                                        writes.update_track(track.id, stop_after_first=False)
+                                        # НЕ отключаем остальных с NULL.
+                                        note_lines.append("(Группа не задана — отключена только текущая автозапись.)")
+                        except Exception as batch_err:
+                            logging.warning(f"Failed stop_after_first batch handling batch={track.bulk_batch_id} err={batch_err}")
+                        note = "\n".join(note_lines)
+                        writes.update_track(track.id, auto_booking=False)
+                        # Запись уже сделана — отключение пишем сразу, а не в конце цикла: иначе при сбое
+                        # итоговой записи следующий цикл записал бы пользователя ещё раз
+                        try:
+                            disabled_rows = writes.pending_track_rows(disabled_track_ids)
+                            await db_writer.run(write_track_rows, disabled_rows)
+                            writes.mark_track_rows_written(disabled_rows)
+                        except Exception as wr_err:
+                            logging.warning(f"Failed to persist auto-booking disable user={user_id} tracks={disabled_track_ids}: {wr_err}")
+                        try:
+                            log_user_action(None, user_id, action, f"doctor={doctor.doctor_api_id} slot={best_slot_display}", source='bot', status='success')
+                        except Exception:
+                            pass
+                    else:
+                        action = 'auto_book_fail'
+                        note = (
+                            f"⚠️ Автозапись не удалась\n"
+                            f"👨‍⚕️ {doctor.name} ({doctor.ar_speciality_name})\n"
+                            f"Слот: {best_slot_display}\n"
+                            f"Ошибка: {safe_html(result_kind) if result_kind else 'Неизвестная ошибка'}"
+                        )
+                        try:
+                            log_user_action(None, user_id, action, f"doctor={doctor.doctor_api_id} slot={best_slot_display} err={result_kind}", source='bot', status='error')
+                        except Exception:
+                            pass
+                    # Отправка пользователю (всегда пробуем, даже при ошибке логирования)
+                    try:
+                        await bot.send_message(user_id, safe_html(note), parse_mode="HTML")
+                    except Exception as send_err:
+                        logging.warning(f"Failed to send auto-book notification to user {user_id}: {send_err}")
+        # Отключение автозаписи уже записано выше (write_track_rows)
+        return  # переходим к следующему отслеживанию
+
+    # Больше НЕ перечитываем baseline (чтобы не изменился между захватом и diff)
+    if baseline_missing:
+        logging.info(f"Baseline missing for {doctor.name} (first seen this run)")
+
+    # Сравнение по компактному представлению слотов (без разбора JSON старого расписания)
+    if new_table is None:
+        new_table = SlotTable.from_schedule_days(new_schedule)
+    old_table = baseline.table
+    added, removed, changes_text = compare_slot_tables(old_table, new_table)
+
+    # Даже если нет текстовых изменений (changes_text пуст), всё равно проверяем слоты по правилам
+    relevant_added = filter_slots_by_rules(added, normalized_rules)
+    # Все текущие подходящие слоты (могут быть те же, что и раньше)
+    all_current_slots = new_table.slot_labels()
+    all_relevant_now = filter_slots_by_rules(all_current_slots, normalized_rules)
+
+    # Определяем сколько релевантных слотов было раньше, чтобы поймать сценарий "было 0 стало N" без diff added
+    try:
+        old_slots_all = old_table.slot_labels()
+    except Exception:
+        old_slots_all = set()
+    old_relevant_before = filter_slots_by_rules(old_slots_all, normalized_rules)
+    old_relevant_count = len(old_relevant_before)
+
+    initial_reveal = False
+    if (old_relevant_count == 0 and len(all_relevant_now) > 0 and not relevant_added) or (baseline_missing and all_relevant_now):
+        initial_reveal = True
+
+    # DEBUG: логируем статус специально отслеживаемых слотов
+    if DEBUG_SLOTS:
+        try:
+            # old_slots_all уже вычислен выше; all_current_slots / all_relevant_now тоже есть
+            relevant_added_set = set(relevant_added)
+            all_relevant_now_set = set(all_relevant_now)
+            for dbg_slot in DEBUG_SLOTS:
+                logging.info(
+                    "DEBUG_SLOT doctor=%s slot=%s old_present=%s new_present=%s in_added=%s in_relevant_added=%s in_all_relevant_now=%s initial_reveal=%s",
+                    doctor.name,
+                    dbg_slot,
+                    dbg_slot in old_slots_all,
+                    dbg_slot in all_current_slots,
+                    dbg_slot in added,
+                    dbg_slot in relevant_added_set,
+                    dbg_slot in all_relevant_now_set,
+                    initial_reveal
+                )
+        except Exception as dbg_e:
+            logging.warning(f"DEBUG_SLOT logging error: {dbg_e}")
+# Ручной режим (auto_booking = False):
+# Требование: уведомлять только при появлении новых релевантных слотов или при первом появлении вообще.
+    if not auto_booking:
+        have_relevant_now = bool(all_relevant_now)
+        # Условие: либо initial_reveal (раньше было 0), либо есть новые релевантные (relevant_added)
+        if initial_reveal or relevant_added:
+            new_schedule_text = format_schedule_message_simple(schedule)
+            msg_parts = [
+                ("📢 <b>Появились подходящие слоты!</b>" if initial_reveal else "📢 <b>Новые подходящие слоты!</b>"),
+                f"👨‍⚕️ {doctor.name} ({doctor.ar_speciality_name})"
+            ]
+            # Показываем только новые релевантные слоты (или все, если initial_reveal)
+            slots_for_keyboard = all_relevant_now if initial_reveal else relevant_added
+            if slots_for_keyboard:
+                msg_parts.extend([
+                    "",
+                    "🎯 <b>Доступно:</b>",
+                    group_slots_by_date(set(slots_for_keyboard))
+                ])
+            if best_slot_display and have_relevant_now:
+                msg_parts.extend(["", f"🔎 Ближайший: {best_slot_display}"])
+            msg_parts.extend(["", f"📅 {new_schedule_text}"])
+
+            msg = "\n".join(p for p in msg_parts if p is not None)
+
+            keyboard = None
+            if slots_for_keyboard:
+                MAX_BTNS = 30
+                sorted_slots = sorted(slots_for_keyboard)[:MAX_BTNS]
+                buttons = []
+                row = []
+                for slot in sorted_slots:
+                    display_time = slot.split()[1] if ' ' in slot else slot
+                    row.append(InlineKeyboardButton(text=display_time, callback_data=f"book_slot:{doctor.doctor_api_id}:{slot}"))
+                    if len(row) == 3:
+                        buttons.append(row)
+                        row = []
+                if row:
+                    buttons.append(row)
+                keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
+
+            if len(msg) > 4000:
+                parts = [msg[i:i+4000] for i in range(0, len(msg), 4000)]
+                for i, part in enumerate(parts):
+                    reply_markup = keyboard if i == len(parts) - 1 else None
+                    await bot.send_message(user_id, safe_html(part), parse_mode="HTML", reply_markup=reply_markup)
+            else:
+                await bot.send_message(user_id, safe_html(msg), parse_mode="HTML", reply_markup=keyboard)
+        # Переходим к следующему треку
+        return
+
+# Сколько подписчиков группы пробовать по очереди, если токены предыдущего не сработали
+_FETCH_TOKEN_ATTEMPTS = 3
+# Прошлое расписание групп, не ведущих baseline врача (ключ запроса -> ScheduleBaseline)
+_group_baselines: Dict[tuple, 'ScheduleBaseline'] = {}
+
+
+def _baseline_owner_keys(keys) -> Dict[str, tuple]:
+    """Группа запроса, которая ведёт baseline и историю слотов врача (doctor_api_id -> ключ).
+
+    У врача может быть несколько групп (с appointment_id разных пользователей и без него), и их
+    расписания различаются; если baseline сохраняет каждая, он «прыгает» между ними, а diff и
+    slot_events фиксируют несуществующие изменения. Владелец один: группа без appointment_id
+    (расписание не зависит от пользователя), иначе — с наименьшим ключом. Выбор не зависит
+    от порядка, в котором корутины планирования заполнили группы.
+    """
+    owners: Dict[str, tuple] = {}
+    for key in sorted(keys, key=lambda k: (k[2][0] != 'purpose', k)):
+        owners.setdefault(key[0], key)
+    return owners
+
+
+def _schedule_fetch_key(snapshot: PollSnapshot, doctor: DoctorView, appointment_id: Optional[int]) -> tuple:
+    """Ключ дедупликации запроса расписания: (available_resource_id, complex_resource_id, контекст).
+
+    Контекст — appointment_id (если запрос идёт с ним) либо inquiryPurposeId специальности врача.
+    """
+    if appointment_id:
+        context = ('appointment', str(appointment_id))
+    else:
+        context = ('purpose', str(snapshot.inquiry_purpose_id(doctor)))
+    return str(doctor.doctor_api_id), str(doctor.complex_resource_id), context
+
+
 async def check_schedule_updates():
     """
     Проверяет изменения в расписании для всех отслеживаемых врачей (UserTrackedDoctor).
     Если изменения обнаружены, отправляет сообщение пользователю.
     Если включён режим авто-записи, пытается записаться на подходящий слот аналогично скриптам blood.py/shift.
+
+    Цикл состоит из этапов:
+      1. для каждого трека подбирается контекст запроса (appointment_id / inquiryPurposeId);
+      2. треки группируются по ключу _schedule_fetch_key, и каждое уникальное расписание
+         запрашивается один раз — число запросов к ЕМИАС растёт с числом врачей, а не треков;
+      3. ответ раздаётся всем подписчикам группы; baseline врача считывается до запросов
+         и общий для всех, поэтому каждый подписчик видит одинаковый diff;
+      4. baseline и история слотов врача пишутся одной группой-владельцем (_baseline_owner_keys);
+         остальные группы врача сравнивают со своим прошлым ответом (_group_baselines).
+    Запрос группы идёт токенами подписчика; если ответа нет или токен отклонён, пробуется следующий.
+    Этапы выполняются конкурентно (не более POLL_CONCURRENCY одновременно), запросы к ЕМИАС
+    идут через aiohttp и не блокируют обработчики бота. Данные цикла (треки, врачи, расписания,
+    связи, специальности) читаются в начале одним снимком PollSnapshot; все записи цикла
+    (правила, автозапись, связи, baseline, история слотов, удаление треков) копятся в PollWrites
+    и пишутся в конце одной задачей db_writer с одним commit. Корутины цикла не делят сессию БД:
+    снимок читается до их запуска, а запись (book_appointment, отключение автозаписи) открывает
+    свою сессию или идёт через db_writer. В лог пишется длительность цикла.
     """
     logging.info("Starting check_schedule_updates")
+    loop = asyncio.get_running_loop()
+    cycle_started = loop.time()
     session = get_db_session()
-    tracked_doctors = session.query(UserTrackedDoctor).all()
+    try:
+        # Baseline расписаний входит в снимок — он считан строго до запросов нового расписания
+        snapshot = PollSnapshot.load(session)
+    finally:
+        session.close()
+    tracked_doctors = snapshot.tracks
 
     if not tracked_doctors:
-        session.close()
         logging.info("No tracked doctors")
         return  # Никто ничего не отслеживает
 
-    tracks_to_delete = []
-    tracks_to_disable_auto = []
+    # История слотов: diff врача пишет только группа-владелец его baseline
+    slot_events = SlotEventRecorder()
+    writes = PollWrites(snapshot, slot_events)
+    semaphore = asyncio.Semaphore(max(1, POLL_CONCURRENCY))
+    synced_users = set()  # связи UserDoctorLink синхронизируются один раз на пользователя за цикл
+    suspended_tracks = [0]
+    doctors = snapshot.doctors
 
-    for track in tracked_doctors:
-        user_id = track.telegram_user_id
-        doctor = session.query(DoctorInfo).filter_by(doctor_api_id=track.doctor_api_id).first()
-        if not doctor:
-            tracks_to_delete.append(track)  # Врач не найден, удаляем отслеживание
-            continue
+    # --- 1. Контекст запроса для каждого трека ---
+    fetch_groups: Dict[tuple, List[TrackView]] = {}
+    fetch_context: Dict[tuple, Tuple[DoctorView, Optional[int]]] = {}
 
+    async def _plan(track):
+        doctor = doctors.get(track.doctor_api_id)
+        if not doctor:
+            writes.delete_track(track.id)  # Врач не найден, удаляем отслеживание
+            return
         if not track.active:
-            continue  # Отслеживание приостановлено
-
+            return  # Отслеживание приостановлено
+        if not doctor.complex_resource_id:
+            return
+        if circuit_breaker.user_suspended(track.telegram_user_id):
+            suspended_tracks[0] += 1  # мёртвые токены (invalid_grant) или пауза после ошибок
+            return
         # Однократно фиксируем относительные/weekday правила в абсолютные даты (для старых треков)
         try:
-            _freeze_rules_if_needed(track, session)
-            _cleanup_outdated_rules(track, session)
+            rules = _freeze_rules_if_needed(track.tracking_rules)
+            if rules is not None:
+                logging.debug(f"FROZE_RULES user={track.telegram_user_id} doctor={track.doctor_api_id}")
+            cleaned = _cleanup_outdated_rules(rules if rules is not None else track.tracking_rules)
+            if cleaned is not None:
+                logging.info(f"CLEANUP_OUTDATED user={track.telegram_user_id} doctor={track.doctor_api_id}")
+                rules = cleaned
+            if rules is not None:
+                writes.update_track(track.id, tracking_rules=rules)
+                track = dataclasses.replace(track, tracking_rules=rules)
         except Exception as fr_ex:
             logging.debug(f"Freeze rules skipped (non-critical) doctor={track.doctor_api_id}: {fr_ex}")
-
-        # СТАРОЕ РАСПИСАНИЕ ДОЛЖНО БЫТЬ СЧИТАНО ДО ЗАПРОСА НОВОГО
-        # (по требованию: schedule_response внутри get_schedule_for_doctor может опосредованно влиять на состояние)
-        old_schedule_record = session.query(DoctorSchedule).filter_by(
-            doctor_api_id=track.doctor_api_id
-        ).first()
-        baseline_missing = old_schedule_record is None
-        old_schedule_json_raw = old_schedule_record.schedule_text if old_schedule_record else None
-        if old_schedule_json_raw is not None:
-            try:
-                old_data = json.loads(old_schedule_json_raw)
-                # logging.debug(
-                #     "BASELINE_CAPTURE %s: bytes=%d days=%d baseline_missing=%s", 
-                #     doctor.name,
-                #     len(old_schedule_json_raw.encode('utf-8')),
-                #     len(old_data) if isinstance(old_data, list) else -1,
-                #     baseline_missing
-                # )
-            except Exception as cap_err:
-                # logging.warning(f"BASELINE_CAPTURE_PARSE_FAIL {doctor.name}: {cap_err}; treating as empty old data")
-                old_data = []
-        else:
-            old_data = []
-
-        # Получаем актуальное расписание с логикой повторного запроса при сообщении об активной записи
-        schedule_response = await get_schedule_for_doctor(session, user_id, doctor, use_appointment=True)
-
-        if not schedule_response or not schedule_response.get("payload"):
-            continue  # переход к следующему отслеживанию
-
-        new_schedule = schedule_response.get("payload").get("scheduleOfDay") or []
-        new_schedule_json = json.dumps(new_schedule, ensure_ascii=False)
-
-        normalized_rules = _normalize_rules(track.tracking_rules)
-        matching_slots = collect_matching_slots(schedule_response.get("payload"), normalized_rules)
-        best_slot_info = matching_slots[0] if matching_slots else None
-        best_slot_display = best_slot_info[0] if best_slot_info else None
-
-        # Если ничего не подобрали, но в новом расписании есть слоты — диагностируем почему
-        if not matching_slots and new_schedule:
-            try:
-                # Соберём ВСЕ raw слоты
-                raw_slots_full = parse_schedule_payload(new_schedule)
-                future_raw = []
-                now_local_diag = datetime.now().replace(second=0, microsecond=0)
-                for s in sorted(raw_slots_full):
-                    try:
-                        dt = datetime.strptime(s, "%Y-%m-%d %H:%M")
-                        if dt > now_local_diag:
-                            future_raw.append(dt)
-                    except ValueError:
-                        continue
-                future_raw = future_raw[:25]  # ограничим диагностический объём
-
-                # Подробный разбор первой пачки слотов по правилам
-                def _analyze(dt: datetime, rules: List[Dict[str, Any]]):
-                    reasons = []
-                    if not rules:
-                        return {"match": True, "reasons": ["no_rules -> always_true"]}
-                    slot_date = dt.date()
-                    slot_time_obj = dt.time().replace(second=0, microsecond=0)
-                    for idx, rule in enumerate(rules):
-                        rtype = (rule.get('type') or '').lower()
-                        val = (rule.get('value') or '').strip().lower()
-                        trs = rule.get('timeRanges') or []
-                        rule_ok = False
-                        detail = {"rule_index": idx, "type": rtype, "value": val, "timeRanges": trs}
-                        if rtype == 'weekday':
-                            wd = WEEKDAY_NAME_TO_INDEX.get(val)
-                            if wd is not None and dt.weekday() == wd:
-                                time_ok = _time_matches_ranges(slot_time_obj, trs)
-                                rule_ok = time_ok
-                                detail["weekday_ok"] = True
-                                detail["time_ok"] = time_ok
-                            else:
-                                detail["weekday_ok"] = False
-                        elif rtype == 'date':
-                            td = _parse_date_rule(val, datetime.now().year)
-                            if td == slot_date:
-                                time_ok = _time_matches_ranges(slot_time_obj, trs)
-                                rule_ok = time_ok
-                                detail["date_ok"] = True
-                                detail["time_ok"] = time_ok
-                            else:
-                                detail["date_ok"] = False
-                        elif rtype == 'relative_date':
-                            if val == 'сегодня':
-                                target = date.today()
-                            elif val == 'завтра':
-                                target = date.today() + timedelta(days=1)
-                            else:
-                                target = None
-                            if target and target == slot_date:
-                                time_ok = _time_matches_ranges(slot_time_obj, trs)
-                                rule_ok = time_ok
-                                detail["rel_date_ok"] = True
-                                detail["time_ok"] = time_ok
-                            else:
-                                detail["rel_date_ok"] = False
-                        elif rtype == 'any':
-                            time_ok = _time_matches_ranges(slot_time_obj, trs)
-                            rule_ok = time_ok
-                            detail["time_ok"] = time_ok
-                        detail["rule_match"] = rule_ok
-                        reasons.append(detail)
-                        if rule_ok:
-                            # Достаточно одного правила
-                            return {"match": True, "reasons": reasons}
-                    return {"match": False, "reasons": reasons}
-
-            except Exception as diag_err:
-                logging.warning(f"NO_MATCH_DIAG_ERROR {doctor.name}: {diag_err}")
-
-        # Старое расписание уже считано выше (old_schedule_record / baseline_missing)
-
-        # ===================== AUTO-BOOKING BRANCH =====================
-        # Проблема (наблюдалась): пока включена автозапись, мы ранее НЕ обновляли baseline,
-        # поэтому когда автозапись выключалась (успешная запись) – следующий цикл видел «старый» снапшот
-        # и считал ВСЕ текущие слоты added. Теперь даже в режиме auto_booking мы обновляем baseline
-        # (без вычисления diff и без уведомлений) чтобы состояние было консистентным.
-        if track.auto_booking:
+        async with semaphore:
             try:
-                # UPSERT DoctorSchedule baseline
-                if baseline_missing or not old_schedule_record:
-                    old_schedule_record = session.query(DoctorSchedule).filter_by(doctor_api_id=doctor.doctor_api_id).first()
-                if not old_schedule_record:
-                    old_schedule_record = DoctorSchedule(doctor_api_id=doctor.doctor_api_id, schedule_text=new_schedule_json)
-                    session.add(old_schedule_record)
-                else:
-                    old_schedule_record.schedule_text = new_schedule_json
-                session.commit()
-            except Exception as bl_err:
-                session.rollback()
-                logging.warning(f"[AUTO_BOOK] Failed to sync baseline for {doctor.name}: {bl_err}")
-
-            if best_slot_display:
-                # logging.info(f"Auto-book INIT {doctor.name}: trying slot={best_slot_display}")
-                success, result_kind = await book_appointment(user_id, doctor.doctor_api_id, best_slot_display)
-                logging.info(f"Auto-book RESULT {doctor.name}: slot={best_slot_display} success={success} kind={result_kind}")
-                # Уведим пользователя и при успехе выключим автозапись (одноразовая логика)
-                if success:
-                    # Единый формат (авто):
-                    # ✅ Автозапись  / ✅ Автоперенос
-                    # 👨‍⚕️ Имя врача
-                    # 🩺 Специальность
-                    # 📅 1 октября 2025
-                    # 🕒 11:12
-                    # Автозапись отключена.
-                    if result_kind == "shift":
-                        action = 'auto_book_shift'
-                        header = "✅ Автоперенос"
-                    else:
-                        action = 'auto_book_success'
-                        header = "✅ Автозапись"
+                appointments = await get_appointments_cached(track.telegram_user_id)
+            except Exception as ctx_err:
+                logging.warning(f"check_schedule_updates: context user={track.telegram_user_id} doctor={track.doctor_api_id} failed: {ctx_err}")
+                return
+        if track.telegram_user_id not in synced_users:
+            synced_users.add(track.telegram_user_id)
+            writes.sync_links(track.telegram_user_id, appointments)
+        appointment_id = _pick_appointment_id(appointments, doctor)
+        key = _schedule_fetch_key(snapshot, doctor, appointment_id)
+        fetch_groups.setdefault(key, []).append(track)
+        fetch_context.setdefault(key, (doctor, appointment_id))
+
+    await asyncio.gather(*(_plan(t) for t in tracked_doctors))
+
+    # --- 2. Baseline по каждому врачу — из снимка, считанного до запросов нового расписания ---
+    baselines = {}
+    for doctor_api_id, _, _ in fetch_groups:
+        if doctor_api_id not in baselines:
+            baselines[doctor_api_id] = ScheduleBaseline(snapshot.schedules.get(doctor_api_id))
+    owner_keys = _baseline_owner_keys(fetch_groups)
+    # Прошлые ответы групп-не-владельцев: только ещё существующие ключи (без роста по всем ключам)
+    group_baselines = {k: v for k, v in _group_baselines.items() if k in fetch_groups and owner_keys[k[0]] != k}
+
+    # --- 3. Один запрос на уникальный ключ, ответ раздаётся всем подписчикам ---
+    skipped_by_fingerprint = [0]
+
+    async def _fetch_schedule(key):
+        """Расписание группы токенами подписчиков по очереди: следующий пробуется, только если
+        ответа нет (нет токенов, токен не обновился) или ЕМИАС отклонил токен (пользователь на паузе)."""
+        doctor, appointment_id = fetch_context[key]
+        attempts = 0
+        for user_id in dict.fromkeys(t.telegram_user_id for t in fetch_groups[key]):
+            if attempts >= _FETCH_TOKEN_ATTEMPTS:
+                break
+            if circuit_breaker.user_suspended(user_id):
+                continue
+            attempts += 1
+            response = await fetch_doctor_schedule(user_id, doctor, appointment_id, autosave=False)
+            if response is not None and not circuit_breaker.user_suspended(user_id):
+                return response
+            logging.info(f"check_schedule_updates: fetch {key} with tokens of user={user_id} failed, trying next subscriber")
+        return None
 
-                    # Парсим слот для даты/времени
-                    human_date = best_slot_display
-                    human_time = best_slot_display[-5:]
-                    try:
-                        from datetime import datetime as _dt
-                        _months = {1:"января",2:"февраля",3:"марта",4:"апреля",5:"мая",6:"июня",7:"июля",8:"августа",9:"сентября",10:"октября",11:"ноября",12:"декабря"}
-                        dt_parsed = _dt.strptime(best_slot_display, "%Y-%m-%d %H:%M")
-                        human_date = f"{dt_parsed.day} {_months.get(dt_parsed.month, dt_parsed.strftime('%B'))} {dt_parsed.year}"
-                        human_time = dt_parsed.strftime('%H:%M')
-                    except Exception:
-                        pass
+    def _save_group_baseline(key, owner, doctor, new_schedule, new_table):
+        if owner:
+            writes.save_baseline(doctor.doctor_api_id, new_schedule, new_table)
+        else:
+            group_baselines[key] = ScheduleBaseline.of_table(new_table)
 
-                    spec_line = doctor.ar_speciality_name or ''
-                    note_lines = [header, f"👨‍⚕️ {doctor.name}"]
-                    if spec_line:
-                        note_lines.append(f"🩺 {spec_line}")
-                    note_lines.append(f"📅 {human_date}")
-                    note_lines.append(f"🕒 {human_time}")
-                    note_lines.append("Автозапись отключена.")
-                    # Если трек принадлежит batch со стратегией stop_after_first – отключаем авто-запись у остальных
-                    siblings_disabled = []
-                    try:
-                        if getattr(track, 'stop_after_first', False):
-                            consumed_batch = getattr(track, 'bulk_batch_id', None)
-                            # batch_id должен быть валидным (hex длиной 32). Если None / пусто / 'None' – не трогаем других.
-                            is_valid_batch = False
-                            if isinstance(consumed_batch, str) and len(consumed_batch) == 32 and all(c in '0123456789abcdef' for c in consumed_batch.lower()):
-                                is_valid_batch = True
-                            if is_valid_batch:
-                                sibling_q = session.query(UserTrackedDoctor).filter(
-                                    UserTrackedDoctor.telegram_user_id == user_id,
-                                    UserTrackedDoctor.bulk_batch_id == consumed_batch,
-                                    UserTrackedDoctor.id != track.id,
-                                    UserTrackedDoctor.auto_booking == True
-                                ).all()
-                                for sib in sibling_q:
-                                    if sib.auto_booking:
-                                        sib.auto_booking = False
-                                    # Группа считается израсходованной – очищаем batch и стоп-флаг
-                                    sib.bulk_batch_id = None
-                                    sib.stop_after_first = False
-                                    siblings_disabled.append(sib.doctor_api_id)
-                                    try:
-                                        log_user_action(session, user_id, 'auto_booking_group_disabled', f"doctor={sib.doctor_api_id} batch={consumed_batch}", source='bot', status='info')
-                                    except Exception:
-                                        pass
-                                # Текущий трек тоже отделяем от группы
-                                track.bulk_batch_id = None
-                                track.stop_after_first = False
-                                if siblings_disabled:
-                                    try:
-                                        named = []
-                                        if len(siblings_disabled) <= 25:
-                                            docs = session.query(DoctorInfo).filter(DoctorInfo.doctor_api_id.in_(siblings_disabled)).all()
-                                            name_map = {d.doctor_api_id: d.name for d in docs}
-                                            for did in siblings_disabled:
-                                                nm = name_map.get(did, did)
-                                                named.append(nm)
-                                        else:
-                                            named = siblings_disabled[:25]
-                                        if named:
-                                            preview_list = ', '.join(named[:6]) + (' …' if len(named) > 6 else '')
-                                            note_lines.append(f"Остановлена авто-запись ещё для {len(siblings_disabled)} в группе: {preview_list}")
-                                    except Exception:
-                                        note_lines.append(f"Остановлена авто-запись ещё для {len(siblings_disabled)} треков группы.")
-                                else:
-                                    note_lines.append("Группа завершена (других врачей не осталось).")
-                                # Фиксируем изменения
-                                try:
-                                    session.commit()
-                                except Exception as _c_err:
-                                    logging.warning(f"Failed commit after batch consume: {consumed_batch} err={_c_err}")
-                                try:
-                                    log_user_action(session, user_id, 'bulk_batch_consumed', f"batch={consumed_batch} winner={doctor.doctor_api_id} disabled={len(siblings_disabled)}", source='bot', status='success')
-                                except Exception:
-                                    pass
-                            else:
-                                # Некорректный (или отсутствующий) batch_id — не трогаем других.
-                                # Сбрасываем только текущий stop_after_first, чтобы не повторять попытку.
-                                if consumed_batch in (None, '', 'None'):
-                                    track.stop_after_first = False
-                                    # НЕ отключаем остальных с NULL.
-                                    note_lines.append("(Группа не задана — отключена только текущая автозапись.)")
-                    except Exception as batch_err:
-                        logging.warning(f"Failed stop_after_first batch handling batch={getattr(track,'bulk_batch_id',None)} err={batch_err}")
-                    note = "\n".join(note_lines)
-                    track.auto_booking = False
-                    try:
-                        log_user_action(session, user_id, action, f"doctor={doctor.doctor_api_id} slot={best_slot_display}", source='bot', status='success')
-                    except Exception:
-                        pass
-                else:
-                    action = 'auto_book_fail'
-                    note = (
-                        f"⚠️ Автозапись не удалась\n"
-                        f"👨‍⚕️ {doctor.name} ({doctor.ar_speciality_name})\n"
-                        f"Слот: {best_slot_display}\n"
-                        f"Ошибка: {safe_html(result_kind) if result_kind else 'Неизвестная ошибка'}"
-                    )
-                    try:
-                        log_user_action(session, user_id, action, f"doctor={doctor.doctor_api_id} slot={best_slot_display} err={result_kind}", source='bot', status='error')
-                    except Exception:
-                        pass
-                # Отправка пользователю (всегда пробуем, даже при ошибке логирования)
-                try:
-                    await bot.send_message(user_id, safe_html(note), parse_mode="HTML")
-                except Exception as send_err:
-                    logging.warning(f"Failed to send auto-book notification to user {user_id}: {send_err}")
-            # Сохраняем возможное отключение автозаписи
+    async def _fetch_and_fan_out(key):
+        doctor, appointment_id = fetch_context[key]
+        async with semaphore:
             try:
-                session.commit()
-            except Exception as commit_err:
-                session.rollback()
-                # logging.warning(f"[AUTO_BOOK] Commit error after booking attempt for {doctor.name}: {commit_err}")
-            continue  # переходим к следующему отслеживанию
-
-        # Больше НЕ перечитываем baseline (чтобы не изменился между захватом и diff)
-        if baseline_missing:
-            logging.info(f"Baseline missing for {doctor.name} (first seen this run)")
-
-        # Сравнение
-        added, removed, changes_text = compare_schedules_payloads(old_data, new_schedule)
-        # После сравнения обновляем или создаём запись расписания
-        # UPSERT DoctorSchedule after diff
-        if baseline_missing or not old_schedule_record:
-            old_schedule_record = session.query(DoctorSchedule).filter_by(doctor_api_id=doctor.doctor_api_id).first()
-        if not old_schedule_record:
-            old_schedule_record = DoctorSchedule(doctor_api_id=doctor.doctor_api_id, schedule_text=new_schedule_json)
-            session.add(old_schedule_record)
+                schedule_response = await _fetch_schedule(key)
+            except Exception as fetch_err:
+                logging.warning(f"check_schedule_updates: fetch {key} failed: {fetch_err}")
+                return
+        # Ответ разбирается один раз: дальше все подписчики работают с моделью
+        schedule = Schedule.from_response(schedule_response)
+        if schedule is None:
+            return
+        new_schedule = schedule.schedule_days
+        owner = owner_keys[key[0]] == key
+        baseline = baselines[key[0]] if owner else group_baselines.get(key, baselines[key[0]])
+        new_table = SlotTable.from_schedule_days(new_schedule)
+        new_fingerprint = new_table.fingerprint()
+        subscribers = fetch_groups[key]
+        if owner and baseline.fingerprint != new_fingerprint and not baseline.missing:
+            slot_events.record_diff(doctor.doctor_api_id, baseline.table, new_table)
+        if baseline.fingerprint is not None and baseline.fingerprint == new_fingerprint:
+            # Набор слотов не изменился: diff пуст, уведомлять не о чем. Оцениваем только треки
+            # с автозаписью — им нужна попытка записи на подходящий слот в каждом цикле.
+            evaluate = [t for t in subscribers if writes.track_value(t, 'auto_booking')]
         else:
-            old_schedule_record.schedule_text = new_schedule_json
-        session.commit()
-
-        # Даже если нет текстовых изменений (changes_text пуст), всё равно проверяем слоты по правилам
-        relevant_added = filter_slots_by_rules(added, normalized_rules)
-        relevant_removed = filter_slots_by_rules(removed, normalized_rules)
-        # Все текущие подходящие слоты (могут быть те же, что и раньше)
-        all_current_slots = parse_schedule_payload(
-            schedule_response.get("payload").get("scheduleOfDay") or []
-        )
-        all_relevant_now = filter_slots_by_rules(all_current_slots, normalized_rules)
-        
-        # # Информативный лог только при изменениях или активности
-        # if relevant_added or relevant_removed or (not all_relevant_now and matching_slots):
-        #     logging.info(
-        #         "Relevant for %s: new_added=%d, new_removed=%d, total_now=%d, best_slot=%s",
-        #         doctor.name,
-        #         len(relevant_added),
-        #         len(relevant_removed),
-        #         len(all_relevant_now),
-        #         best_slot_display or "-"
-        #     )
-
-        # Определяем сколько релевантных слотов было раньше, чтобы поймать сценарий "было 0 стало N" без diff added
+            evaluate = subscribers
+        skipped_by_fingerprint[0] += len(subscribers) - len(evaluate)
+        metrics.inc('schedule_evaluations_total', len(evaluate))
+        metrics.inc('schedule_evaluations_skipped_total', len(subscribers) - len(evaluate))
+        subscribers = evaluate
+        if not subscribers:
+            _save_group_baseline(key, owner, doctor, new_schedule, new_table)
+            return
+        # Быстрый путь: подходящие слоты всех подписчиков считаются одним пакетом (NumPy, если установлен)
+        batch_slots = None
         try:
-            old_slots_all = parse_schedule_payload(old_data) if old_data else set()
-        except Exception:
-            old_slots_all = set()
-        old_relevant_before = filter_slots_by_rules(old_slots_all, normalized_rules)
-        old_relevant_count = len(old_relevant_before)
-
-        initial_reveal = False
-        if (old_relevant_count == 0 and len(all_relevant_now) > 0 and not relevant_added) or (baseline_missing and all_relevant_now):
-            initial_reveal = True
-
-        # DEBUG: логируем статус специально отслеживаемых слотов
-        if DEBUG_SLOTS:
+            batch_slots = match_subscribers(schedule, [t.tracking_rules for t in subscribers])
+        except Exception as batch_err:
+            logging.warning(f"check_schedule_updates: batch match {key} failed, falling back per track: {batch_err}")
+        for idx, track in enumerate(subscribers):
             try:
-                # old_slots_all уже вычислен выше; all_current_slots / all_relevant_now тоже есть
-                new_all_slots = parse_schedule_payload(new_schedule) if new_schedule else set()
-                added_set = added if isinstance(added, set) else set(added)
-                relevant_added_set = set(relevant_added)
-                all_relevant_now_set = set(all_relevant_now)
-                # for dbg_slot in DEBUG_SLOTS:
-                #     logging.info(
-                #         "DEBUG_SLOT doctor=%s slot=%s old_present=%s new_present=%s in_added=%s in_relevant_added=%s in_all_relevant_now=%s initial_reveal=%s",
-                #         doctor.name,
-                #         dbg_slot,
-                #         dbg_slot in (old_slots_all if 'old_slots_all' in locals() else set()),
-                #         dbg_slot in new_all_slots,
-                #         dbg_slot in added_set,
-                #         dbg_slot in relevant_added_set,
-                #         dbg_slot in all_relevant_now_set,
-                #         initial_reveal
-                #     )
-            except Exception as dbg_e:
-                logging.warning(f"DEBUG_SLOT logging error: {dbg_e}")
-    # Ручной режим (auto_booking = False):
-    # Требование: уведомлять только при появлении новых релевантных слотов или при первом появлении вообще.
-        if not track.auto_booking:
-            have_relevant_now = bool(all_relevant_now)
-            # Условие: либо initial_reveal (раньше было 0), либо есть новые релевантные (relevant_added)
-            if initial_reveal or relevant_added:
-                new_schedule_text = format_schedule_message_simple(schedule_response.get("payload"))
-                msg_parts = [
-                    ("📢 <b>Появились подходящие слоты!</b>" if initial_reveal else "📢 <b>Новые подходящие слоты!</b>"),
-                    f"👨‍⚕️ {doctor.name} ({doctor.ar_speciality_name})"
-                ]
-                # Показываем только новые релевантные слоты (или все, если initial_reveal)
-                slots_for_keyboard = all_relevant_now if initial_reveal else relevant_added
-                if slots_for_keyboard:
-                    msg_parts.extend([
-                        "",
-                        "🎯 <b>Доступно:</b>",
-                        group_slots_by_date(set(slots_for_keyboard))
-                    ])
-                if best_slot_display and have_relevant_now:
-                    msg_parts.extend(["", f"🔎 Ближайший: {best_slot_display}"])
-                msg_parts.extend(["", f"📅 {new_schedule_text}"])
-
-                msg = "\n".join(p for p in msg_parts if p is not None)
-
-                keyboard = None
-                if slots_for_keyboard:
-                    MAX_BTNS = 30
-                    sorted_slots = sorted(slots_for_keyboard)[:MAX_BTNS]
-                    buttons = []
-                    row = []
-                    for slot in sorted_slots:
-                        display_time = slot.split()[1] if ' ' in slot else slot
-                        row.append(InlineKeyboardButton(text=display_time, callback_data=f"book_slot:{doctor.doctor_api_id}:{slot}"))
-                        if len(row) == 3:
-                            buttons.append(row)
-                            row = []
-                    if row:
-                        buttons.append(row)
-                    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
+                await _evaluate_tracked_doctor(
+                    track, doctor, writes, schedule, baseline, appointment_id,
+                    matching_slots=batch_slots[idx] if batch_slots is not None else None,
+                    new_table=new_table,
+                )
+            except Exception as track_err:
+                logging.exception(f"check_schedule_updates: track user={track.telegram_user_id} doctor={track.doctor_api_id} failed: {track_err}")
+        # --- 4. Baseline — только группа-владелец, остальные запоминают свой ответ ---
+        _save_group_baseline(key, owner, doctor, new_schedule, new_table)
 
-                if len(msg) > 4000:
-                    parts = [msg[i:i+4000] for i in range(0, len(msg), 4000)]
-                    for i, part in enumerate(parts):
-                        reply_markup = keyboard if i == len(parts) - 1 else None
-                        await bot.send_message(user_id, safe_html(part), parse_mode="HTML", reply_markup=reply_markup)
-                else:
-                    await bot.send_message(user_id, safe_html(msg), parse_mode="HTML", reply_markup=keyboard)
-            # Переходим к следующему треку
-            continue
+    await asyncio.gather(*(_fetch_and_fan_out(k) for k in list(fetch_groups)))
+    _group_baselines.clear()
+    _group_baselines.update(group_baselines)
 
-    for t in tracks_to_delete:
-        session.delete(t)
-    for t in tracks_to_disable_auto:
-        t.auto_booking = False
-    session.commit()
-    session.close()
-    logging.info("Finished check_schedule_updates")
+    # --- 5. Все записи цикла — одной задачей писателя, один commit ---
+    written = {}
+    try:
+        written = await db_writer.run(writes.flush, writes.pending_track_rows())
+    except Exception as wr_err:
+        logging.warning(f"check_schedule_updates: cycle writes failed (cycle={slot_events.cycle_id}): {wr_err}")
+    elapsed = loop.time() - cycle_started
+    subscribed = sum(len(v) for v in fetch_groups.values())
+    skipped = skipped_by_fingerprint[0]
+    metrics.inc('poll_cycles_total')
+    metrics.set_gauge('poll_last_cycle_seconds', round(elapsed, 2))
+    metrics.set_gauge('poll_last_cycle_skip_ratio', round(skipped / subscribed, 3) if subscribed else 0.0)
+    metrics.set_gauge('poll_last_cycle_suspended_tracks', suspended_tracks[0])
+    logging.info(
+        f"Finished check_schedule_updates: cycle={slot_events.cycle_id} tracks={len(tracked_doctors)} evaluated={subscribed - skipped} "
+        f"skipped_unchanged={skipped} suspended={suspended_tracks[0]} schedule_fetches={len(fetch_groups)} concurrency={POLL_CONCURRENCY} "
+        f"writes={written} elapsed={elapsed:.2f}s"
+    )
 
 
 async def try_offer_slots_for_track(track: UserTrackedDoctor, session):
@@ -2824,9 +2853,8 @@ async def try_offer_slots_for_track(track: UserTrackedDoctor, session):
     if not schedule_response or not schedule_response.get("payload"):
         return
 
-    new_schedule = schedule_response.get("payload").get("scheduleOfDay") or []
-    new_slots = parse_schedule_payload(new_schedule)
-    normalized_rules = _normalize_rules(track.tracking_rules)
+    new_slots = parse_schedule_payload(Schedule.from_response(schedule_response))
+    normalized_rules = compile_tracking_rules(track.tracking_rules).normalized
     logging.info(f"Rules (normalized): {normalized_rules}")
     logging.info(f"New slots count: {len(new_slots)}")
     relevant_slots = filter_slots_by_rules(new_slots, normalized_rules)
@@ -2879,26 +2907,16 @@ async def send_slot_selection_message(track: UserTrackedDoctor, session):
         return
 
     new_schedule = schedule_response.get("payload").get("scheduleOfDay") or []
-    new_schedule_json = json.dumps(new_schedule, ensure_ascii=False)
     # Обновим расписание
-    old_schedule_record = session.query(DoctorSchedule).filter_by(
-        doctor_api_id=doctor.doctor_api_id
-    ).first()
-    if not old_schedule_record:
-        session.add(DoctorSchedule(
-            doctor_api_id=doctor.doctor_api_id,
-            schedule_text=new_schedule_json
-        ))
-    else:
-        old_schedule_record.schedule_text = new_schedule_json
-    session.commit()
+    save_doctor_schedule(session, doctor.doctor_api_id, new_schedule)
 
-    normalized_rules = _normalize_rules(track.tracking_rules)
-    relevant_added = filter_slots_by_rules(parse_schedule_payload(new_schedule), normalized_rules)
+    schedule = Schedule.from_response(schedule_response)
+    normalized_rules = compile_tracking_rules(track.tracking_rules).normalized
+    relevant_added = filter_slots_by_rules(schedule.labels(), normalized_rules)
     if not relevant_added:
         return
 
-    new_schedule_text = format_schedule_message_simple(schedule_response.get("payload"))
+    new_schedule_text = format_schedule_message_simple(schedule)
 
     msg_parts = [
         f"ℹ️ <b>Подходящие слоты для записи</b>\n"
@@ -2930,252 +2948,16 @@ MONTHS = {
     '09': 'сентября', '10': 'октября', '11': 'ноября', '12': 'декабря',
 }
 
-MONTH_NAME_TO_NUM = {
-    'январь': 1, 'января': 1,
-    'февраль': 2, 'февраля': 2,
-    'март': 3, 'марта': 3,
-    'апрель': 4, 'апреля': 4,
-    'май': 5, 'мая': 5,
-    'июнь': 6, 'июня': 6,
-    'июль': 7, 'июля': 7,
-    'август': 8, 'августа': 8,
-    'сентябрь': 9, 'сентября': 9,
-    'октябрь': 10, 'октября': 10,
-    'ноябрь': 11, 'ноября': 11,
-    'декабрь': 12, 'декабря': 12,
-}
-
-WEEKDAY_NAME_TO_INDEX = {
-    'понедельник': 0,
-    'вторник': 1,
-    'среда': 2,
-    'четверг': 3,
-    'пятница': 4,
-    'суббота': 5,
-    'воскресенье': 6,
-}
-
-
-def _parse_time_range(range_str: str) -> Optional[Tuple[time, time]]:
-    if not range_str:
-        return None
-    cleaned = range_str.strip().replace('.', ':')
-    parts = cleaned.split('-', maxsplit=1)
-    if len(parts) == 2:
-        try:
-            start = time.fromisoformat(parts[0].strip())
-            end = time.fromisoformat(parts[1].strip())
-            return start, end
-        except ValueError:
-            return None
-    # Try to parse as HH:MM:HH:MM
-    colon_parts = cleaned.split(':')
-    if len(colon_parts) == 4:
-        try:
-            start = time(int(colon_parts[0]), int(colon_parts[1]))
-            end = time(int(colon_parts[2]), int(colon_parts[3]))
-            return start, end
-        except (ValueError, IndexError):
-            pass
-    # Fallback to single time
-    try:
-        point = time.fromisoformat(cleaned)
-        return point, point
-    except ValueError:
-        return None
-
-
-def _time_matches_ranges(slot_time: time, ranges: Optional[List[str]]) -> bool:
-    if not ranges:
-        return True
-    for range_str in ranges:
-        parsed = _parse_time_range(range_str)
-        if not parsed:
-            continue
-        start, end = parsed
-        if start <= end:
-            if start <= slot_time <= end:
-                return True
-        else:  # интервал «через полночь»
-            if slot_time >= start or slot_time <= end:
-                return True
-    return False
-
-
-def _parse_date_rule(value: str, reference_year: int) -> Optional[date]:
-    if not value:
-        return None
-    v = value.strip().lower()
-    if v in ("сегодня",):
-        return datetime.now().date()
-    if v in ("завтра",):
-        return datetime.now().date() + timedelta(days=1)
-
-    # ISO форматы
-    for fmt in ('%Y-%m-%d', '%d.%m.%Y'):
-        try:
-            return datetime.strptime(v, fmt).date()
-        except ValueError:
-            continue
-
-    # Форматы без года
-    if v.count('.') >= 1:
-        parts = [p for p in v.split('.') if p]
-        if len(parts) >= 2 and parts[0].isdigit() and parts[1].isdigit():
-            day = int(parts[0])
-            month = int(parts[1])
-            year = int(parts[2]) if len(parts) >= 3 and parts[2].isdigit() else reference_year
-            try:
-                return date(year, month, day)
-            except ValueError:
-                pass
-    tokens = v.replace('-', ' ').split()
-    if tokens and tokens[0].isdigit():
-        day = int(tokens[0])
-        month = MONTH_NAME_TO_NUM.get(tokens[1]) if len(tokens) >= 2 else None
-        year = None
-        if len(tokens) >= 3 and tokens[2].isdigit():
-            year = int(tokens[2])
-        if month:
-            try:
-                return date(year or reference_year, month, day)
-            except ValueError:
-                pass
-    return None
-
-
-def _parse_string_rule(raw: str) -> Optional[Dict[str, Any]]:
-    """Преобразует старый строковый формат правила (например: 'завтра 11:20-19:00' или 'понедельник 08:00-12:00')
-    в структурированный dict: {type,value,timeRanges}.
-    Поддерживаемые префиксы: дни недели, 'сегодня', 'завтра', ISO-дата YYYY-MM-DD, дата в формате DD.MM.YYYY.
-    Если префикс не распознан, считаем тип any (ограничение только по времени).
-    """
-    if not raw or not isinstance(raw, str):
-        return None
-    s = raw.strip()
-    if not s:
-        return None
-    # Найти диапазон времени через дефис
-    time_match = re.search(r'(\d{1,2}[:.]\d{2})\s?-\s?(\d{1,2}[:.]\d{2})', s)
-    time_ranges: List[str] = []
-    if time_match:
-        tr = f"{time_match.group(1).replace('.',':')}-{time_match.group(2).replace('.',':')}"
-        time_ranges.append(tr)
-        prefix_part = s[:time_match.start()].strip()
-    else:
-        prefix_part = s
-    prefix_lower = prefix_part.lower()
-    rule_type = 'any'
-    value = ''
-    # Weekday
-    if prefix_lower in WEEKDAY_NAME_TO_INDEX:
-        rule_type = 'weekday'
-        value = prefix_lower
-    elif prefix_lower in ('сегодня', 'завтра'):
-        rule_type = 'relative_date'
-        value = prefix_lower
-    else:
-        # ISO date
-        iso_date = None
-        for fmt in ('%Y-%m-%d', '%d.%m.%Y'):
-            try:
-                dt = datetime.strptime(prefix_lower, fmt)
-                iso_date = dt.strftime('%Y-%m-%d')
-                break
-            except ValueError:
-                continue
-        if iso_date:
-            rule_type = 'date'
-            value = iso_date
-        else:
-            # Попытка DD.MM или DD месяц (рус.) без года
-            if re.match(r'^\d{1,2}\.\d{1,2}$', prefix_lower):
-                try:
-                    day, month = prefix_lower.split('.')
-                    dt = date(datetime.now().year, int(month), int(day))
-                    value = dt.strftime('%Y-%m-%d')
-                    rule_type = 'date'
-                except ValueError:
-                    pass
-            else:
-                tokens = prefix_lower.split()
-                if tokens and tokens[0].isdigit() and len(tokens) >= 2 and tokens[1] in MONTH_NAME_TO_NUM:
-                    try:
-                        d = int(tokens[0])
-                        m = MONTH_NAME_TO_NUM[tokens[1]]
-                        dt = date(datetime.now().year, m, d)
-                        value = dt.strftime('%Y-%m-%d')
-                        rule_type = 'date'
-                    except ValueError:
-                        pass
-    return {
-        'type': rule_type,
-        'value': value,
-        'timeRanges': time_ranges
-    }
-
-
-def _normalize_rules(rules: Optional[List[Any]]) -> List[Dict[str, Any]]:
-    """Принимает список правил в новом (dict) или старом (str) формате и возвращает список dict."""
-    if not rules:
-        return []
-    normalized: List[Dict[str, Any]] = []
-    for r in rules:
-        if isinstance(r, dict):
-            # Гарантируем поля
-            normalized.append({
-                'type': (r.get('type') or '').lower() or 'any',
-                'value': r.get('value') or '',
-                'timeRanges': r.get('timeRanges') or []
-            })
-        elif isinstance(r, str):
-            parsed = _parse_string_rule(r)
-            if parsed:
-                normalized.append(parsed)
-    return normalized
+from rules_engine import (
+    compile_tracking_rules,
+    parse_date_rule as _parse_date_rule,
+)
 
 
 def slot_matches_tracking_rules(slot_dt: datetime, rules: Optional[List[Dict[str, Any]]]) -> bool:
-    if not rules:
-        return True
-
-    slot_date = slot_dt.date()
-    slot_time_obj = slot_dt.timetz() if hasattr(slot_dt, "timetz") else slot_dt.time()
-    slot_time = slot_time_obj.replace(second=0, microsecond=0, tzinfo=None)
-
-    for rule in rules:
-        rule_type = (rule.get("type") or "").lower()
-        value = (rule.get("value") or "").strip().lower()
-        time_ranges = rule.get("timeRanges") or []
-
-        if rule_type == "weekday":
-            weekday_idx = WEEKDAY_NAME_TO_INDEX.get(value)
-            if weekday_idx is None or slot_dt.weekday() != weekday_idx:
-                continue
-            if _time_matches_ranges(slot_time, time_ranges):
-                return True
-        elif rule_type == "date":
-            target_date = _parse_date_rule(value, datetime.now().year)
-            if not target_date or target_date != slot_date:
-                continue
-            if _time_matches_ranges(slot_time, time_ranges):
-                return True
-        elif rule_type == "relative_date":
-            if value == "сегодня":
-                target_date = date.today()
-            elif value == "завтра":
-                target_date = date.today() + timedelta(days=1)
-            else:
-                continue
-            if target_date != slot_date:
-                continue
-            if _time_matches_ranges(slot_time, time_ranges):
-                return True
-        elif rule_type == "any":
-            if _time_matches_ranges(slot_time, time_ranges):
-                return True
-
-    return False
+    """Проверяет слот по правилам. Правила компилируются один раз (rules_engine) и берутся из кэша;
+    в циклах по слотам лучше один раз вызвать compile_tracking_rules и использовать .matches()."""
+    return compile_tracking_rules(rules).matches(slot_dt)
 
 
 def filter_slots_by_rules(slots: Optional[Set[str]], rules: Optional[List[Dict[str, Any]]]) -> List[str]:
@@ -3183,6 +2965,7 @@ def filter_slots_by_rules(slots: Optional[Set[str]], rules: Optional[List[Dict[s
         return []
     filtered: List[str] = []
     now_local = datetime.now().replace(tzinfo=None)
+    compiled = compile_tracking_rules(rules)
     for slot in sorted(slots):
         try:
             slot_dt = datetime.strptime(slot, "%Y-%m-%d %H:%M")
@@ -3190,11 +2973,11 @@ def filter_slots_by_rules(slots: Optional[Set[str]], rules: Optional[List[Dict[s
             continue
         if slot_dt <= now_local:
             continue
-        if slot_matches_tracking_rules(slot_dt, rules):
+        if compiled.matches(slot_dt):
             filtered.append(slot)
     return filtered
-def collect_matching_slots(schedule_payload: Dict[str, Any], rules: Optional[List[Dict[str, Any]]]) -> List[Tuple[str, str, str]]:
-    """Собирает ВСЕ подходящие (по rules) будущие слоты из payload.
+def collect_matching_slots(schedule_payload: Union[Schedule, Dict[str, Any], None], rules: Optional[List[Dict[str, Any]]]) -> List[Tuple[str, str, str]]:
+    """Собирает ВСЕ подходящие (по rules) будущие слоты из payload или Schedule.
 
     Возвращает список кортежей (display, start_iso, end_iso) отсортированный по времени.
     display: "YYYY-MM-DD HH:MM".
@@ -3202,101 +2985,27 @@ def collect_matching_slots(schedule_payload: Dict[str, Any], rules: Optional[Lis
     """
     if not schedule_payload:
         return []
+    compiled = compile_tracking_rules(rules)
+    # Будущие слоты с разобранными датами уже отсортированы в Schedule.future_slots
+    return [(s.display, s.start_iso, s.end_iso) for s in as_schedule(schedule_payload).future_slots()
+            if compiled.matches(s.start)]
 
-    collected: List[Tuple[datetime, str, str]] = []
-    now_utc = datetime.now()
-
-    for day in schedule_payload.get("scheduleOfDay", []):
-        for slot_block in day.get("scheduleBySlot", []):
-            for slot in slot_block.get("slot", []):
-                start_iso = slot.get("startTime")
-                if not start_iso:
-                    continue
-                try:
-                    start_dt = datetime.fromisoformat(start_iso)
-                except ValueError:
-                    continue
-                end_iso = slot.get("endTime") or ""
-
-                cmp_dt = start_dt
-                # Сравниваем с now в той же таймзоне, если она присутствует
-                if start_dt.tzinfo is not None:
-                    now_cmp = datetime.now(start_dt.tzinfo)
-                else:
-                    now_cmp = now_utc
 
-                if cmp_dt <= now_cmp:
-                    continue
-                if not slot_matches_tracking_rules(cmp_dt, rules):
-                    continue
-
-                collected.append((cmp_dt, start_iso, end_iso))
-
-    if not collected:
-        return []
-
-    collected.sort(key=lambda x: x[0])
-    result: List[Tuple[str, str, str]] = []
-    for dt_obj, start_iso, end_iso in collected:
-        result.append((dt_obj.strftime("%Y-%m-%d %H:%M"), start_iso, end_iso))
-    return result
-
-
-def find_first_matching_slot(schedule_payload: Dict[str, Any], rules: Optional[List[Dict[str, Any]]]) -> Optional[Tuple[str, str, str]]:
+def find_first_matching_slot(schedule_payload: Union[Schedule, Dict[str, Any], None], rules: Optional[List[Dict[str, Any]]]) -> Optional[Tuple[str, str, str]]:
     if not schedule_payload:
         return None
-
-    best: Optional[Tuple[datetime, str, str]] = None
-    now_utc = datetime.now()
-
-    for day in schedule_payload.get("scheduleOfDay", []):
-        for slot_block in day.get("scheduleBySlot", []):
-            for slot in slot_block.get("slot", []):
-                start_iso = slot.get("startTime")
-                if not start_iso:
-                    continue
-                try:
-                    start_dt = datetime.fromisoformat(start_iso)
-                except ValueError:
-                    continue
-
-                end_iso = slot.get("endTime")
-
-                cmp_dt = start_dt
-                if start_dt.tzinfo is not None:
-                    now_cmp = datetime.now(start_dt.tzinfo)
-                else:
-                    now_cmp = now_utc
-
-                if cmp_dt <= now_cmp:
-                    continue
-                if not slot_matches_tracking_rules(cmp_dt, rules):
-                    continue
-
-                if not best or cmp_dt < best[0]:
-                    best = (cmp_dt, start_iso, end_iso or "")
-
-    if not best:
-        return None
-
-    display = best[0].strftime("%Y-%m-%d %H:%M")
-    return display, best[1], best[2]
+    compiled = compile_tracking_rules(rules)
+    for s in as_schedule(schedule_payload).future_slots():
+        if compiled.matches(s.start):
+            return s.display, s.start_iso, s.end_iso
+    return None
 
 
-def parse_schedule_payload(payload: List[Dict]) -> Set[str]:
+def parse_schedule_payload(payload) -> Set[str]:
     """
-    Преобразует payload расписания в множество слотов вида "YYYY-MM-DD HH:MM".
+    Преобразует расписание (scheduleOfDay, payload или Schedule) в множество слотов вида "YYYY-MM-DD HH:MM".
     """
-    slots_set = set()
-    for day_info in payload:
-        schedule_by_slot = day_info.get("scheduleBySlot", [])
-        for slot_block in schedule_by_slot:
-            for s in slot_block.get("slot", []):
-                start_time = s.get("startTime", "");  # пример: "2025-03-24T18:15:00+03:00"
-                if len(start_time) >= 16:
-                    dt_str = f"{start_time[:10]} {start_time[11:16]}"  # "YYYY-MM-DD HH:MM"
-                    slots_set.add(dt_str)
-    return slots_set
+    return as_schedule(payload).labels()
 
 
 def group_slots_by_date(slots: Set[str]) -> str:
@@ -3337,9 +3046,23 @@ def compare_schedules_payloads(
 
     added_slots = new_slots - old_slots
     removed_slots = old_slots - new_slots
+    return added_slots, removed_slots, format_slot_changes(added_slots, removed_slots)
+
+
+def compare_slot_tables(old_table: SlotTable, new_table: SlotTable) -> Tuple[Set[str], Set[str], Optional[str]]:
+    """
+    То же, что compare_schedules_payloads, но по компактному представлению (slot_codec.SlotTable):
+    разность считается слиянием отсортированных массивов, строки "YYYY-MM-DD HH:MM" строятся только для изменений.
+    """
+    added_slots = {SlotTable.label(m) for m in new_table.difference(old_table)}
+    removed_slots = {SlotTable.label(m) for m in old_table.difference(new_table)}
+    return added_slots, removed_slots, format_slot_changes(added_slots, removed_slots)
 
+
+def format_slot_changes(added_slots: Set[str], removed_slots: Set[str]) -> Optional[str]:
+    """Человекочитаемая строка об изменениях слотов или None, если изменений нет."""
     if not added_slots and not removed_slots:
-        return set(), set(), None
+        return None
 
     changes = []
 
@@ -3351,29 +3074,85 @@ def compare_schedules_payloads(
         added_text = group_slots_by_date(added_slots)
         changes.append(f"📌 <b>Добавлены слоты:</b>\n{added_text}")
 
-    changes_text = "\n\n".join(changes)
-    return added_slots, removed_slots, changes_text
+    return "\n\n".join(changes)
+
+
+REFERRAL_REQUIRED_MSG = 'Требуется направление для записи'
+SLOT_NOT_FOUND_MSG = 'Слот больше не доступен в расписании'
+NO_RESPONSE_MSG = 'Нет ответа от сервера'
+# Ошибки, после которых исход записи неизвестен (таймаут, сеть, ЕМИАС не объяснил отказ)
+_UNCERTAIN_BOOKING_ERRORS = ('Неизвестная ошибка', NO_RESPONSE_MSG, 'ЕМИАС не ответил')
+# Отказы до запроса в ЕМИАС: повтор с другим слотом их не исправит
+_LOCAL_BOOKING_ERRORS = (REFERRAL_REQUIRED_MSG, 'Врач не найден в базе данных', 'Недостаточно данных о враче', 'Некорректный идентификатор врача')
 
 
-async def book_appointment(user_id: int, doctor_api_id: str, slot: str) -> tuple[bool, str | None]:
+def _is_slot_rejection(result: Optional[str]) -> bool:
+    """ЕМИАС ответил и явно отказал в записи на слот (а не таймаут или локальная проверка)."""
+    return bool(result) and result not in _LOCAL_BOOKING_ERRORS and not result.startswith(_UNCERTAIN_BOOKING_ERRORS)
+
+
+async def book_appointment(user_id: int, doctor_api_id: str, slot: str,
+                           start_iso: Optional[str] = None, end_iso: Optional[str] = None,
+                           appointment_id: Optional[int] = None,
+                           reception_type_id: Optional[int] = None,
+                           doctor=None) -> tuple[bool, str | None]:
     """
     Пытается записать пользователя на слот или перенести существующую запись.
-    - Ищет врача в БД (`DoctorInfo`) по doctor_api_id.
-    - Запрашивает расписание через get_available_resource_schedule_info и находит слот по строке
-      формата "YYYY-MM-DD HH:MM".
+
+    Быстрый путь (авто-запись из поллера): если переданы start_iso/end_iso уже найденного слота,
+    расписание повторно не запрашивается — сразу вызывается create/shift; doctor (DoctorView снимка)
+    и reception_type_id избавляют от запросов DoctorInfo/Specialty. Медленный путь (свежее расписание
+    и повтор записи) выполняется, только если ЕМИАС явно отказал по слоту И записи пациента
+    подтверждают, что записи на этот слот нет. При неизвестном исходе (таймаут, нет ответа)
+    повтора нет: потерянный запрос проверяет booking, а следующий цикл поллера попробует снова.
+
+    Без start_iso/end_iso (ручная запись по кнопке) слот ищется в свежем расписании.
+
+    Возвращает (True, "create"|"shift") при успехе, иначе (False, текст ошибки).
+    """
+    if not (start_iso and end_iso):
+        return await _book_appointment_once(user_id, doctor_api_id, slot, None, None, appointment_id, reception_type_id)
+
+    success, result = await _book_appointment_once(user_id, doctor_api_id, slot, start_iso, end_iso, appointment_id, reception_type_id, doctor)
+    if success or not _is_slot_rejection(result):
+        return success, result
+    from booking import is_booked_async  # booking импортирует emias_api
+    booked = await is_booked_async(user_id, doctor_api_id, start_iso)
+    if booked:
+        logging.info(f"Fast booking rejected doctor={doctor_api_id} slot={slot}: {result}; receptions already show the slot")
+        invalidate_receptions_cache(user_id)
+        return True, "shift" if appointment_id else "create"
+    if booked is None:
+        logging.info(f"Fast booking rejected doctor={doctor_api_id} slot={slot}: {result}; receptions unavailable, not retrying")
+        return success, result
+    logging.info(f"Fast booking rejected doctor={doctor_api_id} slot={slot}: {result}; verifying slot and retrying once")
+    return await _book_appointment_once(user_id, doctor_api_id, slot, None, None, appointment_id, reception_type_id, doctor)
+
+
+async def _book_appointment_once(user_id: int, doctor_api_id: str, slot: str,
+                                 start_iso: Optional[str], end_iso: Optional[str],
+                                 known_appointment_id: Optional[int],
+                                 known_reception_type_id: Optional[int],
+                                 known_doctor=None) -> tuple[bool, str | None]:
+    """
+    Одна попытка записи/переноса (см. book_appointment).
+    - Ищет врача в БД (`DoctorInfo`) по doctor_api_id, если его не передали (known_doctor).
+    - Если start_iso/end_iso не заданы — запрашивает расписание через get_available_resource_schedule_info
+      и находит слот по строке формата "YYYY-MM-DD HH:MM".
     - Если у пользователя есть существующая запись (UserDoctorLink для эквивалентных кодов специальности),
       делает shiftAppointment, иначе вызывает createAppointment.
     - Сохраняет/обновляет `UserDoctorLink.appointment_id` при успешной операции.
-
-    Возвращает True при успешной записи/переносе, иначе False.
     """
     # Импортируем здесь, чтобы не поломать порядок импортов в модуле
-    from emias_api import get_available_resource_schedule_info, create_appointment, shift_appointment, get_appointment_receptions_by_patient
+    from emias_api import (
+        create_appointment_async,
+        shift_appointment_async,
+    )
     from database import get_db_session, DoctorInfo, UserDoctorLink, Specialty, get_equivalent_speciality_codes
 
     session = get_db_session()
     try:
-        doctor = session.query(DoctorInfo).filter_by(doctor_api_id=str(doctor_api_id)).first()
+        doctor = known_doctor or session.query(DoctorInfo).filter_by(doctor_api_id=str(doctor_api_id)).first()
         if not doctor:
             return False, "Врач не найден в базе данных"
         if not doctor.complex_resource_id:
@@ -3386,7 +3165,7 @@ async def book_appointment(user_id: int, doctor_api_id: str, slot: str) -> tuple
             try:
                 available_resource_id = int(str(doctor.doctor_api_id))
             except Exception:
-                return False
+                return False, "Некорректный идентификатор врача"
 
         try:
             complex_resource_id = int(doctor.complex_resource_id)
@@ -3395,24 +3174,16 @@ async def book_appointment(user_id: int, doctor_api_id: str, slot: str) -> tuple
 
         # Проверяем, есть ли у пользователя запись к специальности врача через API
         logging.info(f"Doctor ar_speciality_id: {doctor.ar_speciality_id}, equivalent codes: {get_equivalent_speciality_codes(doctor.ar_speciality_id)}")
-        appointment_id = None
-        appointments_data = get_appointment_receptions_by_patient(user_id)
-        if appointments_data:
-            appointments = appointments_data.get("appointments") or appointments_data.get("appointment") or []
+        appointment_id = known_appointment_id
+        appointments = await get_appointments_cached(user_id) if not appointment_id else None
+        if appointments:
             logging.info(f"User has {len(appointments)} appointments")
             for appt in appointments:
-                appt_spec_id = extract_speciality_id_from_appointment(appt)
-                appt_id_value = appt.get("appointmentId") or appt.get("id")
-                logging.info(f"Appointment spec: {appt_spec_id}, id: {appt_id_value}")
-                if appt_spec_id and appt_spec_id in get_equivalent_speciality_codes(doctor.ar_speciality_id):
-                    appointment_id = appt_id_value
+                logging.info(f"Appointment spec: {appt.speciality_id}, id: {appt.id}")
+                if appt.speciality_id and appt.speciality_id in get_equivalent_speciality_codes(doctor.ar_speciality_id):
+                    appointment_id = appt.id
                     if appointment_id:
-                        try:
-                            appointment_id = int(appointment_id)
-                            break
-                        except Exception:
-                            appointment_id = appointment_id
-                            break
+                        break
 
         # Если не нашли через API, проверим в DB
         if not appointment_id:
@@ -3426,74 +3197,57 @@ async def book_appointment(user_id: int, doctor_api_id: str, slot: str) -> tuple
                         logging.error(f"Ошибка конвертации appointment_id из БД {link.appointment_id}: {e}")
                         continue
 
-        if appointment_id:
-            schedule_response = get_available_resource_schedule_info(user_id, available_resource_id, complex_resource_id, appointment_id=appointment_id)
-        else:
-            schedule_response = get_available_resource_schedule_info(user_id, available_resource_id, complex_resource_id)
-        if not schedule_response or not schedule_response.get("payload") or not schedule_response.get("payload").get("scheduleOfDay"):
-            error_desc = schedule_response.get("Описание") if schedule_response else None
-            if not error_desc and schedule_response and schedule_response.get("payload"):
-                error_desc = schedule_response.get("payload").get("Описание")
-            error_msg = error_desc or "Не удалось получить расписание для врача"
-            try:
-                log_user_action(session, user_id, 'api_get_schedule_fail', f'Доктор {doctor_api_id}: {error_msg}', source='bot', status='error')
-            except Exception:
-                pass
-            return False, error_msg
-
-        # Формат входного slot: "YYYY-MM-DD HH:MM" -> сравниваем по префиксу ISO "YYYY-MM-DDTHH:MM"
-        target_prefix = slot.replace(" ", "T")[:16]
-        start_iso = None
-        end_iso = None
-
-        for day in schedule_response.get("payload").get("scheduleOfDay", []):
-            for slot_block in day.get("scheduleBySlot", []):
-                for s in slot_block.get("slot", []):
-                    st = s.get("startTime")
-                    if not st:
-                        continue
-                    if st[:16] == target_prefix:
-                        start_iso = st
-                        end_iso = s.get("endTime")
-                        break
-                if start_iso:
-                    break
-            if start_iso:
-                break
+        # Слот уже найден вызывающим (быстрый путь) — расписание повторно не запрашиваем
+        if not (start_iso and end_iso):
+            client = EmiasClient(user_id)
+            schedule = await client.schedule(available_resource_id, complex_resource_id, appointment_id=appointment_id or None)
+            if schedule is None or not schedule.days:
+                error_msg = client.last_error or "Не удалось получить расписание для врача"
+                try:
+                    log_user_action(session, user_id, 'api_get_schedule_fail', f'Доктор {doctor_api_id}: {error_msg}', source='bot', status='error')
+                except Exception:
+                    pass
+                return False, error_msg
 
-        if not start_iso or not end_iso:
-            try:
-                log_user_action(session, user_id, 'api_slot_not_found', f'Доктор {doctor_api_id} слот {slot}', source='bot', status='warning')
-            except Exception:
-                pass
-            return False
+            # Формат входного slot: "YYYY-MM-DD HH:MM" -> сравниваем по префиксу ISO "YYYY-MM-DDTHH:MM"
+            found = schedule.find(slot)
+            if found:
+                start_iso, end_iso = found.start_iso, found.end_iso
+
+            if not start_iso or not end_iso:
+                try:
+                    log_user_action(session, user_id, 'api_slot_not_found', f'Доктор {doctor_api_id} слот {slot}', source='bot', status='warning')
+                except Exception:
+                    pass
+                return False, SLOT_NOT_FOUND_MSG
 
         # Определяем reception_type_id (только из Specialty – расписание его не содержит)
-        reception_type_id = 0
-        try:
-            if doctor.ar_speciality_id:
-                spec = session.query(Specialty).filter_by(code=doctor.ar_speciality_id).first()
-                if not spec:
-                    # Автоматически создаём Specialty, если отсутствует (например, новый ldpType)
-                    spec = Specialty(code=doctor.ar_speciality_id, name=doctor.ar_speciality_name or doctor.ar_speciality_id, reception_type_id=1863)
-                    session.add(spec)
-                    session.commit()
-                if spec and spec.reception_type_id not in (None, "", 0):
-                    try:
-                        reception_type_id = int(spec.reception_type_id)
-                    except Exception:
-                        reception_type_id = 1863  # default fallback
-                else:
-                    reception_type_id = 1863  # default if missing or 0
-                    try:
-                        log_user_action(session, user_id, 'api_reception_type_missing_db', f'Доктор {doctor_api_id} spec {doctor.ar_speciality_id}', source='bot', status='info')
-                    except Exception:
-                        pass
-        except Exception as rt_err:
+        reception_type_id = known_reception_type_id or 0
+        if not known_reception_type_id:
             try:
-                log_user_action(session, user_id, 'api_reception_type_fail', f'Доктор {doctor_api_id} err={rt_err}', source='bot', status='warning')
-            except Exception:
-                pass
+                if doctor.ar_speciality_id:
+                    spec = session.query(Specialty).filter_by(code=doctor.ar_speciality_id).first()
+                    if not spec:
+                        # Автоматически создаём Specialty, если отсутствует (например, новый ldpType)
+                        spec = Specialty(code=doctor.ar_speciality_id, name=doctor.ar_speciality_name or doctor.ar_speciality_id, reception_type_id=1863)
+                        session.add(spec)
+                        session.commit()
+                    if spec and spec.reception_type_id not in (None, "", 0):
+                        try:
+                            reception_type_id = int(spec.reception_type_id)
+                        except Exception:
+                            reception_type_id = 1863  # default fallback
+                    else:
+                        reception_type_id = 1863  # default if missing or 0
+                        try:
+                            log_user_action(session, user_id, 'api_reception_type_missing_db', f'Доктор {doctor_api_id} spec {doctor.ar_speciality_id}', source='bot', status='info')
+                        except Exception:
+                            pass
+            except Exception as rt_err:
+                try:
+                    log_user_action(session, user_id, 'api_reception_type_fail', f'Доктор {doctor_api_id} err={rt_err}', source='bot', status='warning')
+                except Exception:
+                    pass
 
         # Логируем попытку (shift или create)
         try:
@@ -3505,7 +3259,7 @@ async def book_appointment(user_id: int, doctor_api_id: str, slot: str) -> tuple
             pass
         # Если есть существующая запись — пробуем перенести
         if appointment_id:
-            resp = shift_appointment(user_id, available_resource_id, complex_resource_id, start_iso, end_iso, appointment_id, reception_type_id)
+            resp = await shift_appointment_async(user_id, available_resource_id, complex_resource_id, start_iso, end_iso, appointment_id, reception_type_id)
             if resp and ("payload" in resp or "appointmentId" in resp):
                 # Обновляем appointment_id, если новый
                 new_id = None
@@ -3519,12 +3273,12 @@ async def book_appointment(user_id: int, doctor_api_id: str, slot: str) -> tuple
                         else:
                             session.add(UserDoctorLink(telegram_user_id=user_id, doctor_speciality=spec_code, appointment_id=str(new_id)))
                     session.commit()
-                doc = session.query(DoctorInfo).filter_by(doctor_api_id=str(doctor_api_id)).first()
-                title = f"{doc.name} ({doc.ar_speciality_name})" if doc else doctor_api_id
+                title = f"{doctor.name} ({doctor.ar_speciality_name})"
                 log_user_action(session, user_id, 'api_shift_appointment', f'Перенос к врачу {title} на {slot}', source='bot', status='success')
+                invalidate_receptions_cache(user_id)
                 return True, "shift"
             else:
-                error_message = resp.get("Описание", "Неизвестная ошибка") if resp else "Нет ответа от сервера"
+                error_message = resp.get("Описание", "Неизвестная ошибка") if resp else NO_RESPONSE_MSG
                 try:
                     log_user_action(session, user_id, 'api_shift_appointment_fail', f'Доктор {doctor_api_id} слот {slot} ошибка: {error_message}', source='bot', status='error')
                 except Exception:
@@ -3559,7 +3313,7 @@ async def book_appointment(user_id: int, doctor_api_id: str, slot: str) -> tuple
                 if referral_policy == 0:  # strict
                     if not has_referral:
                         log_user_action(session, user_id, 'api_create_referral_required', f'doctor={doctor_api_id} slot={slot}', source='bot', status='error')
-                        return False, 'Требуется направление для записи'
+                        return False, REFERRAL_REQUIRED_MSG
                 elif referral_policy == 1:  # fallback
                     if not has_referral:
                         # просто логируем инфо, но не блокируем
@@ -3572,7 +3326,7 @@ async def book_appointment(user_id: int, doctor_api_id: str, slot: str) -> tuple
                     log_user_action(session, user_id, 'api_create_referral_policy_err', f'doc={doctor_api_id} err={_ref_err}', source='bot', status='warning')
                 except Exception:
                     pass
-        resp = create_appointment(user_id, available_resource_id, complex_resource_id, start_iso, end_iso, reception_type_id)
+        resp = await create_appointment_async(user_id, available_resource_id, complex_resource_id, start_iso, end_iso, reception_type_id)
         if resp and ("payload" in resp or "appointmentId" in resp):
             new_id = None
             if isinstance(resp, dict):
@@ -3588,24 +3342,19 @@ async def book_appointment(user_id: int, doctor_api_id: str, slot: str) -> tuple
                         session.add(UserDoctorLink(telegram_user_id=user_id, doctor_speciality=spec_code, appointment_id=str(new_id)))
                 session.commit()
             log_user_action(session, user_id, 'api_create_appointment', f'Запись к врачу {doctor_api_id} на {slot}', source='bot', status='success')
+            invalidate_receptions_cache(user_id)
             return True, "create"
         else:
-            # Попробуем найти appointment_id снова через API
-            appointments_data = get_appointment_receptions_by_patient(user_id)
-            if appointments_data:
-                appointments = appointments_data.get("appointments") or appointments_data.get("appointment") or []
+            # Попробуем найти appointment_id снова через API (мимо кэша — состояние могло измениться)
+            appointments = await get_appointments_cached(user_id, force=True)
+            if appointments:
                 for appt in appointments:
-                    appt_spec_id = str(appt.get("specialityId", ""))
-                    if appt_spec_id in get_equivalent_speciality_codes(doctor.ar_speciality_id):
-                        appointment_id = appt.get("appointmentId") or appt.get("id")
+                    if appt.speciality_id in get_equivalent_speciality_codes(doctor.ar_speciality_id):
+                        appointment_id = appt.id
                         if appointment_id:
-                            try:
-                                appointment_id = int(appointment_id)
-                                break
-                            except Exception:
-                                appointment_id = appointment_id
+                            break
             if appointment_id:
-                resp2 = shift_appointment(user_id, available_resource_id, complex_resource_id, start_iso, end_iso, appointment_id, reception_type_id)
+                resp2 = await shift_appointment_async(user_id, available_resource_id, complex_resource_id, start_iso, end_iso, appointment_id, reception_type_id)
                 if resp2 and ("payload" in resp2 or "appointmentId" in resp2):
                     # Обновляем appointment_id, если новый
                     new_id = None
@@ -3619,19 +3368,19 @@ async def book_appointment(user_id: int, doctor_api_id: str, slot: str) -> tuple
                             else:
                                 session.add(UserDoctorLink(telegram_user_id=user_id, doctor_speciality=spec_code, appointment_id=str(new_id)))
                         session.commit()
-                    doc = session.query(DoctorInfo).filter_by(doctor_api_id=str(doctor_api_id)).first()
-                    title = f"{doc.name} ({doc.ar_speciality_name})" if doc else doctor_api_id
+                    title = f"{doctor.name} ({doctor.ar_speciality_name})"
                     log_user_action(session, user_id, 'api_shift_appointment', f'Перенос к врачу {title} на {slot}', source='bot', status='success')
+                    invalidate_receptions_cache(user_id)
                     return True, "shift"
                 else:
-                    error_message = resp2.get("Описание", "Неизвестная ошибка") if resp2 else "Нет ответа от сервера"
+                    error_message = resp2.get("Описание", "Неизвестная ошибка") if resp2 else NO_RESPONSE_MSG
                     try:
                         log_user_action(session, user_id, 'api_shift_appointment_fail', f'Доктор {doctor_api_id} слот {slot} ошибка: {error_message}', source='bot', status='error')
                     except Exception:
                         pass
                     return False, error_message
             else:
-                error_message = resp.get("Описание", "Неизвестная ошибка") if resp else "Нет ответа от сервера"
+                error_message = resp.get("Описание", "Неизвестная ошибка") if resp else NO_RESPONSE_MSG
                 try:
                     log_user_action(session, user_id, 'api_create_appointment_fail', f'Доктор {doctor_api_id} слот {slot} ошибка: {error_message}', source='bot', status='error')
                 except Exception:
@@ -3641,6 +3390,36 @@ async def book_appointment(user_id: int, doctor_api_id: str, slot: str) -> tuple
         session.close()
 
 
+async def compact_slot_events_job():
+    """Раз в сутки удаляет из slot_events события старше SLOT_EVENTS_RETENTION_DAYS.
+    DELETE идёт через очередь db_writer: не блокирует цикл событий и не конкурирует с записями поллера."""
+    try:
+        await db_writer.run(compact_slot_events)
+    except Exception as e:
+        logging.warning(f"compact_slot_events failed: {e}")
+
+
+async def trim_audit_log_job():
+    """Ограничивает журнал действий (user_logs) последними AUDIT_LOG_KEEP_ROWS строками.
+    DELETE идёт через очередь db_writer, как и compact_slot_events_job."""
+    try:
+        await db_writer.run(audit_log.trim_logs)
+    except Exception as e:
+        logging.warning(f"audit_log trim failed: {e}")
+
+
+async def refresh_tokens_job():
+    """Заранее обновляет токены ЕМИАС, срок которых подходит к концу (token_manager)."""
+    try:
+        refreshed = await token_manager.refresh_due_tokens(
+            lambda uid: refresh_emias_token(uid, source='system', force=True)
+        )
+        if refreshed:
+            logging.info(f"Background token refresh: refreshed={refreshed}")
+    except Exception as e:
+        logging.warning(f"Background token refresh failed: {e}")
+
+
 def start_schedule_checker(interval_seconds: int = 60):
     """Запускает планировщик задач, выполняющий check_schedule_updates каждые interval_seconds.
     Предотвращает повторную регистрацию задания, если оно уже добавлено.
@@ -3651,6 +3430,9 @@ def start_schedule_checker(interval_seconds: int = 60):
             logging.info("Schedule checker already running")
             return
         scheduler.add_job(check_schedule_updates, 'interval', seconds=interval_seconds, id='schedule_checker', max_instances=1)
+        scheduler.add_job(compact_slot_events_job, 'interval', hours=24, id='slot_events_compactor', max_instances=1)
+        scheduler.add_job(refresh_tokens_job, 'interval', seconds=30, id='token_refresher', max_instances=1)
+        scheduler.add_job(trim_audit_log_job, 'interval', seconds=AUDIT_LOG_TRIM_INTERVAL_SEC, id='audit_log_trimmer', max_instances=1)
         scheduler.start()
         logging.info(f"Schedule checker started (interval={interval_seconds}s)")
     except Exception as e:
@@ -3687,6 +3469,12 @@ async def main():
     ]
     await bot.set_my_commands(commands)
 
+    # Токены всех пользователей — в память одним запросом (дальше запросы к ЕМИАС не читают user_tokens)
+    try:
+        logging.info(f"Preloaded tokens: {token_manager.preload_tokens()}")
+    except Exception as e:
+        logging.warning(f"Token preload failed: {e}")
+
     # Выполняем первую проверку расписания сразу при запуске
     await check_schedule_updates()
 
@@ -3694,7 +3482,11 @@ async def main():
     start_schedule_checker()
 
     # Стартуем бота
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        from emias_api import close_async_http
+        await close_async_http()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,38 @@
+"""
+Проверка, что модули приложения импортируются (python check_imports.py).
+
+compileall ловит только синтаксис; NameError в аннотациях и выражениях уровня модуля
+(имя из typing, импортированное ниже по файлу, и т.п.) всплывает лишь при импорте —
+то есть при старте бота. Скрипт импортирует точки входа (а через них — все модули)
+с фиктивным токеном бота и временной SQLite-базой; запускается при сборке образа (Dockerfile).
+"""
+import importlib
+import os
+import sys
+import tempfile
+import traceback
+
+# Точки входа run_all (бот и веб-панель) и мок ЕМИАС; остальные модули импортируются через них
+MODULES = ('bot', 'web_app', 'run_all', 'mock_emias')
+
+
+def main() -> int:
+    # Bot() проверяет формат токена при создании (импорт bot), а database создаёт движок при импорте
+    os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:import-check')
+    tmp_dir = tempfile.mkdtemp(prefix='import_check_')
+    os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(tmp_dir, 'check.db')}")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    failed = []
+    for name in MODULES:
+        try:
+            importlib.import_module(name)
+        except Exception:
+            failed.append(name)
+            print(f"FAIL import {name}:\n{traceback.format_exc()}")
+        else:
+            print(f"ok   import {name}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,222 @@
+"""
+Предохранители (circuit breaker) по эндпоинтам ЕМИАС и пауза для пользователей с ошибками.
+
+Когда ЕМИАС деградирует, каждый цикл поллера раньше бил в тот же эндпоинт по каждому треку.
+Теперь у каждого эндпоинта (последний сегмент пути URL) свой предохранитель:
+  * closed — запросы идут; EMIAS_BREAKER_FAILURES подряд сетевых ошибок / 5xx / 429 размыкают его;
+  * open — запросы не отправляются, вызывающий сразу получает ошибку; время размыкания начинается
+    с EMIAS_BREAKER_OPEN_SEC и удваивается при каждом неудачном пробном запросе (до EMIAS_BREAKER_MAX_OPEN_SEC);
+  * half_open — по истечении паузы пропускается один пробный запрос: успех замыкает предохранитель,
+    ошибка снова размыкает.
+Ответы 4xx (кроме 429) — бизнес-ошибки конкретного запроса, на предохранитель не влияют.
+
+Пользователи:
+  * user_failed/user_succeeded — экспоненциальная пауза (60 с, 120 с, ... до часа) после ошибок,
+    вызванных самим пользователем (токен не обновляется, отклонён даже после обновления);
+    поллер пропускает треки пользователя на время паузы;
+  * park_user — «мёртвые» учётные данные (invalid_grant): пользователь не опрашивается и запросы
+    от его имени не отправляются, пока он не пришлёт новые токены (/auth, /user/update_tokens —
+    token_manager.store_tokens снимает парковку). Состояние в памяти процесса: после рестарта
+    первое же обновление токена снова припаркует такого пользователя.
+
+Состояние видно в админ-панели (snapshot). Модуль потокобезопасен.
+"""
+import logging
+import threading
+import time as time_mod
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from config import EMIAS_BREAKER_FAILURES, EMIAS_BREAKER_MAX_OPEN_SEC, EMIAS_BREAKER_OPEN_SEC
+import metrics
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+_PROBE_TIMEOUT_SEC = 60  # пробный запрос, не сообщивший результат, через столько секунд считается потерянным
+_USER_BACKOFF_MIN_SEC = 60
+_USER_BACKOFF_MAX_SEC = 3600
+
+
+def is_failure_status(status: int) -> bool:
+    """Ответ, говорящий о проблеме ЕМИАС, а не запроса: сетевая ошибка (0), 5xx, 429."""
+    return status == 0 or status == 429 or status >= 500
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int = EMIAS_BREAKER_FAILURES,
+                 open_sec: float = EMIAS_BREAKER_OPEN_SEC, max_open_sec: float = EMIAS_BREAKER_MAX_OPEN_SEC):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.open_sec = open_sec
+        self.max_open_sec = max_open_sec
+        self.state = CLOSED
+        self.failures = 0
+        self.trips = 0  # размыканий подряд без успешного запроса — множитель паузы
+        self.open_until = 0.0
+        self.probe_started = 0.0
+        self.last_error: Optional[str] = None
+        self.changed_at = datetime.utcnow()
+        self._lock = threading.Lock()
+
+    def _set_state(self, state: str) -> None:
+        if state != self.state:
+            logging.warning(f"circuit_breaker: {self.name} {self.state} -> {state} (failures={self.failures}, trips={self.trips})")
+            self.state = state
+            self.changed_at = datetime.utcnow()
+
+    def allow(self) -> bool:
+        """Можно ли отправить запрос сейчас. В half_open пропускает один пробный."""
+        now = time_mod.monotonic()
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if now < self.open_until:
+                    return False
+                self._set_state(HALF_OPEN)
+            elif now - self.probe_started < _PROBE_TIMEOUT_SEC:
+                return False  # пробный запрос ещё идёт
+            self.probe_started = now
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.trips = 0
+            self._set_state(CLOSED)
+
+    def record_failure(self, error: Optional[str] = None) -> None:
+        with self._lock:
+            self.failures += 1
+            self.last_error = error
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.trips += 1
+                pause = min(self.open_sec * (2 ** (self.trips - 1)), self.max_open_sec)
+                self.open_until = time_mod.monotonic() + pause
+                if self.state != OPEN:
+                    metrics.inc('emias_breaker_opened_total')
+                self._set_state(OPEN)
+
+    def record_status(self, status: int, error: Optional[str] = None) -> None:
+        """Учитывает результат запроса по HTTP-статусу (0 — сетевая ошибка)."""
+        if is_failure_status(status):
+            self.record_failure(error or (f"HTTP {status}" if status else 'network error'))
+        else:
+            self.record_success()
+
+    def describe_open(self) -> str:
+        return f"ЕМИАС: {self.name} временно недоступен, повтор через {round(self.retry_in())} с"
+
+    def retry_in(self) -> float:
+        """Через сколько секунд предохранитель пропустит пробный запрос."""
+        return max(0.0, self.open_until - time_mod.monotonic()) if self.state == OPEN else 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'endpoint': self.name,
+                'state': self.state,
+                'failures': self.failures,
+                'trips': self.trips,
+                'retry_in': round(self.retry_in()),
+                'last_error': self.last_error,
+                'changed_at': self.changed_at,
+            }
+
+
+_lock = threading.Lock()
+_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def for_endpoint(endpoint: str) -> CircuitBreaker:
+    breaker = _breakers.get(endpoint)
+    if breaker is None:
+        with _lock:
+            breaker = _breakers.setdefault(endpoint, CircuitBreaker(endpoint))
+    return breaker
+
+
+# ----------------------------- Пользователи -----------------------------
+class _UserState:
+    __slots__ = ('failures', 'until', 'parked_reason', 'parked_at')
+
+    def __init__(self):
+        self.failures = 0
+        self.until = 0.0
+        self.parked_reason: Optional[str] = None
+        self.parked_at: Optional[datetime] = None
+
+
+_users: Dict[int, _UserState] = {}
+
+
+def user_failed(user_id: int) -> float:
+    """Ошибка из-за пользователя: продлевает его паузу. Возвращает её длительность в секундах."""
+    with _lock:
+        state = _users.setdefault(user_id, _UserState())
+        state.failures += 1
+        delay = min(_USER_BACKOFF_MIN_SEC * (2 ** (state.failures - 1)), _USER_BACKOFF_MAX_SEC)
+        state.until = time_mod.monotonic() + delay
+    metrics.inc('emias_user_backoffs_total')
+    return delay
+
+
+def user_succeeded(user_id: int) -> None:
+    if user_id not in _users:
+        return
+    with _lock:
+        state = _users.get(user_id)
+        if state is not None and state.parked_reason is None:
+            del _users[user_id]
+
+
+def park_user(user_id: int, reason: str) -> bool:
+    """Паркует пользователя до повторной авторизации. True — если он не был припаркован (стоит залогировать)."""
+    with _lock:
+        state = _users.setdefault(user_id, _UserState())
+        newly = state.parked_reason is None
+        state.parked_reason = reason
+        if newly:
+            state.parked_at = datetime.utcnow()
+    if newly:
+        logging.warning(f"circuit_breaker: user={user_id} parked: {reason}")
+        metrics.inc('emias_users_parked_total')
+    return newly
+
+
+def unpark_user(user_id: int) -> None:
+    """Новые токены пользователя: снимает парковку и паузу."""
+    with _lock:
+        state = _users.pop(user_id, None)
+    if state is not None and state.parked_reason:
+        logging.info(f"circuit_breaker: user={user_id} unparked")
+
+
+def parked_reason(user_id: int) -> Optional[str]:
+    state = _users.get(user_id)
+    return state.parked_reason if state else None
+
+
+def user_suspended(user_id: int) -> Optional[str]:
+    """Почему пользователя сейчас не стоит опрашивать (парковка или пауза), None — можно."""
+    state = _users.get(user_id)
+    if state is None:
+        return None
+    if state.parked_reason:
+        return f"parked: {state.parked_reason}"
+    remaining = state.until - time_mod.monotonic()
+    return f"backoff {round(remaining)}s" if remaining > 0 else None
+
+
+def snapshot() -> Dict[str, List[Dict[str, Any]]]:
+    """Состояние для админ-панели: {'endpoints': [...], 'parked': [...], 'backoff': [...]}."""
+    with _lock:
+        breakers = list(_breakers.values())
+        users = list(_users.items())
+    now = time_mod.monotonic()
+    return {
+        'endpoints': [b.as_dict() for b in sorted(breakers, key=lambda b: b.name)],
+        'parked': [{'user_id': uid, 'reason': s.parked_reason, 'since': s.parked_at}
+                   for uid, s in users if s.parked_reason],
+        'backoff': [{'user_id': uid, 'failures': s.failures, 'retry_in': round(s.until - now)}
+                    for uid, s in users if not s.parked_reason and s.until > now],
+    }
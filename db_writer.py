@@ -0,0 +1,104 @@
+"""
+Очередь записи в БД с одним писателем (отдельный поток со своей сессией).
+
+SQLite допускает одного писателя одновременно: когда поллер, веб-панель и фоновые задачи пишут
+параллельно, остальные ждут busy_timeout и при длинных транзакциях получают "database is locked".
+Записи поллера (baseline расписаний, история слотов, итоговый commit цикла) идут через эту очередь
+и выполняются строго по одной, поэтому не конкурируют друг с другом; чтения веб-панели остаются
+параллельными (WAL, см. database.make_engine).
+
+Задача — функция fn(session, *args): выполняется в потоке писателя на новой сессии, после неё
+делается commit. Если БД всё же занята другим процессом (OperationalError "database is locked"),
+задача повторяется с паузой.
+
+    await db_writer.run(save_doctor_schedule, doctor_api_id, days)   # из корутины
+    db_writer.call(fn, ...)                                          # из синхронного кода
+"""
+import asyncio
+import logging
+import queue
+import threading
+import time as time_mod
+from concurrent.futures import Future
+from typing import Any, Callable, Optional
+
+from sqlalchemy.exc import OperationalError
+
+from database import get_db_session
+import metrics
+
+_LOCKED_RETRIES = 3  # повторы задачи при "database is locked"
+_RETRY_DELAY_SEC = 0.1  # пауза перед первым повтором, дальше удваивается
+
+_queue: "queue.Queue[tuple]" = queue.Queue()
+_lock = threading.Lock()
+_thread: Optional[threading.Thread] = None
+
+
+def submit(fn: Callable[..., Any], *args: Any) -> Future:
+    """Ставит задачу fn(session, *args) в очередь писателя; результат — в Future."""
+    future: Future = Future()
+    _queue.put((fn, args, future))
+    _ensure_thread()
+    metrics.set_gauge('db_writer_queue_size', _queue.qsize())
+    return future
+
+
+async def run(fn: Callable[..., Any], *args: Any) -> Any:
+    """То же из корутины: цикл событий не блокируется, пока задача ждёт очереди и БД."""
+    return await asyncio.wrap_future(submit(fn, *args))
+
+
+def call(fn: Callable[..., Any], *args: Any, timeout: Optional[float] = None) -> Any:
+    """То же из синхронного кода: ждёт выполнения задачи."""
+    return submit(fn, *args).result(timeout)
+
+
+def _ensure_thread() -> None:
+    global _thread
+    with _lock:
+        if _thread is None or not _thread.is_alive():
+            _thread = threading.Thread(target=_run_writer, name='db-writer', daemon=True)
+            _thread.start()
+
+
+def _is_locked(err: OperationalError) -> bool:
+    return 'locked' in str(err).lower() or 'busy' in str(err).lower()
+
+
+def _execute(fn: Callable[..., Any], args: tuple) -> Any:
+    for attempt in range(_LOCKED_RETRIES + 1):
+        session = get_db_session()
+        try:
+            result = fn(session, *args)
+            session.commit()
+            return result
+        except OperationalError as e:
+            session.rollback()
+            if not _is_locked(e) or attempt == _LOCKED_RETRIES:
+                raise
+            metrics.inc('db_writer_lock_retries_total')
+            time_mod.sleep(_RETRY_DELAY_SEC * 2 ** attempt)
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+
+def _run_writer() -> None:
+    while True:
+        fn, args, future = _queue.get()
+        if not future.set_running_or_notify_cancel():
+            continue
+        started = time_mod.perf_counter()
+        try:
+            future.set_result(_execute(fn, args))
+        except Exception as e:
+            metrics.inc('db_writer_errors_total')
+            logging.warning(f"db_writer: {getattr(fn, '__name__', fn)} failed: {e}")
+            future.set_exception(e)
+        finally:
+            metrics.inc('db_writer_jobs_total')
+            metrics.set_gauge('db_writer_last_job_ms', round((time_mod.perf_counter() - started) * 1000, 1))
+            metrics.set_gauge('db_writer_queue_size', _queue.qsize())
@@ -1,25 +1,42 @@
 from datetime import datetime, timezone, timedelta
-from pathlib import Path
-import os, time, threading
+import asyncio
+
+import aiohttp
+import requests
+from typing import Optional, Dict, Any, List, Tuple, Union
+from urllib.parse import urljoin
+from sqlalchemy.orm import Session
+from config import EMIAS_API_BASE_URL
+from database import get_db_session, log_user_action
+import circuit_breaker
+import http_client
+import metrics
+import ref_cache
+import token_manager
+
+# Все адреса ЕМИАС строятся от EMIAS_API_BASE_URL (по умолчанию https://emias.info/api-eip/):
+# для локального мок-сервера (mock_emias.py) достаточно указать его адрес.
+# web-api (refreshTokens, whoAmI) — соседний путь на том же хосте.
+API_BASE_URL = EMIAS_API_BASE_URL.rstrip('/') + '/'
+WEB_API_BASE_URL = urljoin(API_BASE_URL, '../web-api/')
 
-import requests, json
-from typing import Optional, Dict, Any
-from database import get_db_session, get_tokens, save_tokens, get_profile, log_user_action, UserToken
+
+def api_url(path: str) -> str:
+    """'v3/saOrchestrator/createAppointment' -> полный адрес от EMIAS_API_BASE_URL."""
+    return API_BASE_URL + path.lstrip('/')
 
 
 def get_specialities_info(user_id: int) -> list:
-    url = "https://emias.info/api-eip/v6/saOrchestrator/getSpecialitiesInfo"
-    session = get_db_session()
-    profile = get_profile(session, user_id)
+    url = api_url("v6/saOrchestrator/getSpecialitiesInfo")
+    profile = ref_cache.get_profile(user_id)
     if not profile:
         print("Не удалось получить данные (OMS/birthDate) из БД.")
-        session.close()
         return None
-    session.close()
 
     payload = {
         "omsNumber": profile.oms_number,
         "birthDate": profile.birth_date,
+        "isChatBotEnabled": False
     }
     response = emias_post_request(user_id=user_id, url=url, payload=payload)
     return response.get("payload") if response else None
@@ -41,45 +58,13 @@ def is_token_expired(expires_at):
     return now >= expires_at
 
 
-_REFRESH_THREAD_LOCKS = {}
 MIN_REFRESH_INTERVAL_SEC = 300  # не чаще одного успешного обновления раз в 5 минут (если не force и не истёк)
-LOCK_STALE_SEC = 120            # считать файл-замок протухшим
-LOCK_DIR = (Path(__file__).resolve().parent.parent / 'data')
-LOCK_DIR.mkdir(parents=True, exist_ok=True)
-
-def _acquire_file_lock(user_id: int) -> bool:
-    lock_path = LOCK_DIR / f"refresh_lock_{user_id}"
-    now = time.time()
-    try:
-        if lock_path.exists():
-            try:
-                # stale?
-                if now - lock_path.stat().st_mtime > LOCK_STALE_SEC:
-                    lock_path.unlink(missing_ok=True)
-                else:
-                    return False
-            except Exception:
-                return False
-        # atomic create
-        fd = os.open(str(lock_path), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
-        os.close(fd)
-        return True
-    except FileExistsError:
-        return False
-    except Exception:
-        return False
-
-def _release_file_lock(user_id: int):
-    try:
-        (LOCK_DIR / f"refresh_lock_{user_id}").unlink(missing_ok=True)
-    except Exception:
-        pass
 
 def refresh_emias_token(user_id: int, source: str = 'system', force: bool = False) -> str:
     """
     Обновляет access_token для пользователя, используя refreshToken, сохранённый в БД.
 
-    Отправляет POST-запрос на https://emias.info/web-api/refreshTokens/ с телом:
+    Отправляет POST-запрос на <web-api>/refreshTokens/ с телом:
     {
         "refreshToken": "<текущий refreshToken>"
     }
@@ -93,55 +78,25 @@ def refresh_emias_token(user_id: int, source: str = 'system', force: bool = Fals
         "refresh_token": "<новый refresh_token>"
     }
 
-    Если обновление успешно, функция обновляет данные в БД и возвращает новый access_token,
-    иначе возвращает None.
+    Если обновление успешно, функция обновляет данные (в памяти token_manager и, если токен
+    изменился, в БД) и возвращает новый access_token, иначе возвращает None.
     """
-    session = get_db_session()
-    tokens = get_tokens(session, user_id)
+    tokens = token_manager.get_tokens(user_id)
 
     if tokens is None:
-        session.close()
         print(f"[refresh_emias_token] Токены для пользователя {user_id} не найдены.")
         return None
 
-    # Извлекаем текущий refresh_token / expires_at / issued_at (issued_at добавлен в модель)
     access_token_current, refresh_token, expires_at = tokens
-    # issued_at доступен при чтении токена через ORM, дополнительная выборка не нужна
 
-    # Throttle: если недавно (<=15s) был успешный refresh — возвращаем текущий access_token
-    from database import UserLog, UserToken as _UT
-    try:
-        throttle_sess = get_db_session()
-        last_success = (throttle_sess.query(UserLog)
-                        .filter_by(telegram_user_id=user_id, action='api_refresh_token', status='success')
-                        .order_by(UserLog.timestamp.desc()).first())
-        # Если есть issued_at в user_tokens – используем более точную метку
-        ut_row = throttle_sess.query(_UT).filter_by(telegram_user_id=user_id).first()
-        issued_at_val = getattr(ut_row, 'issued_at', None)
-        now_utc = datetime.utcnow()
-        if not force:
-            if issued_at_val and (now_utc - (issued_at_val if issued_at_val.tzinfo is None else issued_at_val.replace(tzinfo=None))).total_seconds() < MIN_REFRESH_INTERVAL_SEC and not is_token_expired(expires_at):
-                throttle_sess.close()
-                return access_token_current
-            if last_success and (now_utc - last_success.timestamp).total_seconds() < 30 and not is_token_expired(expires_at):
-                throttle_sess.close()
-                return access_token_current
-        throttle_sess.close()
-    except Exception:
-        try:
-            throttle_sess.close()
-        except Exception:
-            pass
-
-    # File lock (межпроцессный) – если не получили, просто возвращаем текущий токен (избегаем гонки)
-    have_lock = _acquire_file_lock(user_id)
-    if not have_lock:
-        if force:
-            # При force ждём немного и ещё раз пробуем (один ретрай)
-            time.sleep(0.4)
-            have_lock = _acquire_file_lock(user_id)
-        if not have_lock:
-            # Не удалось получить лок – при обычном режиме просто возвращаем текущий токен
+    # refresh_token уже отклонён (invalid_grant) — до новых токенов от пользователя не обновляем
+    if circuit_breaker.parked_reason(user_id):
+        return None
+
+    # Throttle: если токен недавно обновлялся (issued_at из памяти) и ещё жив — возвращаем текущий
+    previous_issued_at = token_manager.issued_at(user_id)
+    if not force and previous_issued_at and not is_token_expired(expires_at):
+        if (datetime.utcnow() - previous_issued_at).total_seconds() < MIN_REFRESH_INTERVAL_SEC:
             return access_token_current
 
     # Если токен ещё жив и это не принудительный refresh — не обновляем
@@ -152,12 +107,37 @@ def refresh_emias_token(user_id: int, source: str = 'system', force: bool = Fals
                 remaining = (exp_dt - datetime.utcnow()).total_seconds()
                 # Рефрешим только если осталось <= 5 минут
                 if remaining > 300:
-                    _release_file_lock(user_id)
                     return access_token_current
     except Exception:
         pass
 
-    url = "https://emias.info/web-api/refreshTokens/"
+    # Одно обновление на пользователя: параллельные вызовы ждут результат уже идущего (singleflight)
+    return token_manager.singleflight(user_id, lambda: _refresh_tokens_now(user_id, source, previous_issued_at))
+
+
+def _refresh_tokens_now(user_id: int, source: str, previous_issued_at: Optional[datetime]) -> Optional[str]:
+    """Собственно запрос refreshTokens (выполняется внутри token_manager.singleflight)."""
+    previous_refresh_token = (token_manager.get_tokens(user_id) or (None, None, None))[1]
+    # Межпроцессный замок: бот, веб и поллер могут обновлять токен одного пользователя одновременно
+    with token_manager.refresh_guard(user_id) as acquired:
+        # Под замком — токены из БД: другой процесс мог уже обновить refresh_token
+        access_token_current, refresh_token, _ = token_manager.get_tokens(user_id, reload=True) or (None, None, None)
+        if not refresh_token:
+            return None
+        if not acquired:
+            print(f"[refresh_emias_token] user={user_id}: обновление идёт в другом процессе, используем текущий токен")
+            return access_token_current
+        if refresh_token != previous_refresh_token or token_manager.issued_at(user_id) != previous_issued_at:
+            # Пока ждали своей очереди, токен уже обновил другой вызов или процесс — повторно не обновляем
+            return access_token_current
+        return _request_token_refresh(user_id, source, previous_issued_at, access_token_current, refresh_token)
+
+
+def _request_token_refresh(user_id: int, source: str, previous_issued_at: Optional[datetime],
+                           access_token_current: Optional[str], refresh_token: str) -> Optional[str]:
+    """POST refreshTokens и сохранение результата (под refresh_guard)."""
+
+    url = WEB_API_BASE_URL + "refreshTokens/"
     headers = {
         "Content-Type": "application/json"
     }
@@ -167,7 +147,7 @@ def refresh_emias_token(user_id: int, source: str = 'system', force: bool = Fals
 
     try:
         print(f"[refresh_emias_token] POST {url} user={user_id}")
-        response = requests.post(url, headers=headers, json=payload, timeout=10)
+        response = http_client.post(url, headers=headers, json=payload, user_id=user_id)
         response.raise_for_status()
         data = response.json()
 
@@ -176,30 +156,30 @@ def refresh_emias_token(user_id: int, source: str = 'system', force: bool = Fals
         expires_in = data.get("expires_in", 3600)  # время жизни токена в секундах
 
         if new_access_token and new_refresh_token:
-            # Сохраняем новые токены в базу данных
-            save_tokens(session, user_id, new_access_token, new_refresh_token, expires_in)
-            # Если источник явно не указан вызывающим кодом (system), предполагаем что чаще это бот
-            log_source = source if source else 'system'
-            # Логируем только если токен действительно изменился и интервал прошёл
-            log_ok = True
+            session = get_db_session()
             try:
-                if new_access_token == access_token_current:
-                    log_ok = False
-                else:
-                    last_succ = (session.query(UserLog)
-                                 .filter_by(telegram_user_id=user_id, action='api_refresh_token', status='success')
-                                 .order_by(UserLog.timestamp.desc()).first())
-                    if last_succ and (datetime.utcnow() - last_succ.timestamp).total_seconds() < MIN_REFRESH_INTERVAL_SEC:
-                        log_ok = False
-            except Exception:
-                pass
-            if log_ok:
-                log_user_action(session, user_id, 'api_refresh_token', 'Токены обновлены', source=log_source, status='success')
+                # Сохраняем новые токены (в БД — только если они действительно изменились)
+                changed = token_manager.store_tokens(user_id, new_access_token, new_refresh_token, expires_in, session=session)
+                # Если источник явно не указан вызывающим кодом (system), предполагаем что чаще это бот
+                log_source = source if source else 'system'
+                # Логируем только если токен действительно изменился и интервал прошёл
+                log_ok = changed and not (
+                    previous_issued_at
+                    and (datetime.utcnow() - previous_issued_at).total_seconds() < MIN_REFRESH_INTERVAL_SEC
+                )
+                if log_ok:
+                    log_user_action(session, user_id, 'api_refresh_token', 'Токены обновлены', source=log_source, status='success')
+            finally:
+                session.close()
             return new_access_token
         else:
             msg = f"Некорректный ответ при обновлении токена: {data}"
             print(msg)
-            log_user_action(session, user_id, 'api_refresh_token', msg, source=source or 'system', status='error')
+            session = get_db_session()
+            try:
+                log_user_action(session, user_id, 'api_refresh_token', msg, source=source or 'system', status='error')
+            finally:
+                session.close()
             return None
     except requests.exceptions.RequestException as e:
         # Попробуем извлечь тело ответа, если есть
@@ -224,32 +204,97 @@ def refresh_emias_token(user_id: int, source: str = 'system', force: bool = Fals
         if invalid_grant_note:
             err += invalid_grant_note
         print(err)
-        # Первая попытка логирования в текущей сессии
-        logged = False
+        if invalid_grant_note:
+            # refresh_token мог смениться в другом процессе (веб/бот) — перечитаем токены из БД;
+            # если там тот же отклонённый токен, учётные данные мёртвые: паркуем пользователя до /auth
+            token_manager.invalidate(user_id)
+            fresh = token_manager.get_tokens(user_id)
+            if not fresh or fresh[1] == refresh_token:
+                if not circuit_breaker.park_user(user_id, 'invalid_grant'):
+                    return None  # уже припаркован и залогирован
+        elif isinstance(e, http_client.CircuitOpenError):
+            return None  # ЕМИАС недоступен — не пишем в журнал пользователя на каждый вызов
         try:
-            log_user_action(session, user_id, 'api_refresh_token', err, source=source or 'system', status='error')
-            logged = True
+            log_session = get_db_session()
+            log_user_action(log_session, user_id, 'api_refresh_token', err, source=source or 'system', status='error')
+            log_session.close()
         except Exception as le:
-            print(f"log_user_action failed in refresh_emias_token primary session: {le}")
-        # Резервная попытка с новой сессией
-        if not logged:
-            try:
-                fallback_sess = get_db_session()
-                log_user_action(fallback_sess, user_id, 'api_refresh_token', err, source=source or 'system', status='error')
-                fallback_sess.close()
-            except Exception as le2:
-                print(f"Fallback logging failed: {le2}")
+            print(f"log_user_action failed in refresh_emias_token: {le}")
         return None
-    finally:
-        session.close()
-        _release_file_lock(user_id)
+
+
+# Признаки ответа ЕМИАС «токен недействителен» (кроме HTTP 401) в error.code / error.description
+_INVALID_TOKEN_MARKERS = ('invalid_token', 'invalid token', 'token expired', 'токен')
+
+
+def _is_invalid_token_response(status: int, body: Any) -> bool:
+    if status == 401:
+        return True
+    error = body.get("error") if isinstance(body, dict) else None
+    if isinstance(error, dict):
+        text = f"{error.get('code', '')} {error.get('description', '')}".lower()
+        return any(marker in text for marker in _INVALID_TOKEN_MARKERS)
+    return False
+
+
+def _error_description(body: Any) -> Optional[str]:
+    error = body.get("error") if isinstance(body, dict) else None
+    return error.get("description") if isinstance(error, dict) else None
+
+
+def _circuit_open_body(error: Exception) -> dict:
+    return {"error": {"code": "circuit_open", "description": str(error)}}
+
+
+def _record_user_outcome(user_id: int, status: int, body: Any) -> None:
+    """Пауза пользователя (circuit_breaker): токен отклонён даже после обновления — ошибка на его стороне."""
+    if 0 < status < 400 and body is not None:
+        circuit_breaker.user_succeeded(user_id)
+    elif _is_invalid_token_response(status, body):
+        circuit_breaker.user_failed(user_id)
+
+
+def _refresh_failure_is_users(user_id: int) -> bool:
+    """
+    Токен не обновился по причине на стороне пользователя. Не так, если он уже припаркован
+    (invalid_grant записан в журнал при парковке) или предохранитель refreshTokens разомкнут (недоступен ЕМИАС).
+    """
+    if circuit_breaker.parked_reason(user_id):
+        return False
+    return circuit_breaker.for_endpoint('refreshTokens').state == circuit_breaker.CLOSED
+
+
+def _refresh_rejected_token(user_id: int, rejected_token: str) -> Optional[str]:
+    """
+    Токен отклонён ЕМИАС (401 / invalid token). Если его уже заменил другой вызов — берём новый,
+    иначе принудительно обновляем (параллельные вызовы присоединяются к одному обновлению).
+    """
+    tokens = token_manager.get_tokens(user_id)
+    if tokens and tokens[0] != rejected_token:
+        return tokens[0]
+    return refresh_emias_token(user_id, source='system', force=True)
+
+
+def _post_with_token(user_id: int, url: str, access_token: str, payload: dict, timeout: Optional[float]):
+    """Один POST к ЕМИАС через общий пул: (HTTP-статус или 0 при сетевой ошибке, JSON-тело или None)."""
+    try:
+        response = http_client.post(url, headers={"ei-token": access_token}, json=payload, timeout=timeout,
+                                    user_id=user_id)
+    except http_client.CircuitOpenError as e:
+        return 0, _circuit_open_body(e)
+    except requests.exceptions.RequestException:
+        return 0, None
+    try:
+        return response.status_code, response.json()
+    except ValueError:
+        return response.status_code, None
 
 
 def emias_post_request(
         user_id: int,
         url: str,
         payload: dict,
-        timeout: int = 10
+        timeout: Optional[float] = None
 ) -> Optional[dict]:
     """
     Универсальная функция для отправки POST-запроса к ЭМИАС.
@@ -258,69 +303,159 @@ def emias_post_request(
       2) Проверяет, не просрочен ли токен (через is_token_expired).
       3) Если просрочен, то вызывает refresh_emias_token.
       4) Формирует заголовки (ei-token) и выполняет POST-запрос.
-      5) Возвращает ответ (JSON) либо None при ошибке.
+      5) Если ЕМИАС отклонил токен (401 / invalid token) — обновляет его и повторяет запрос один раз.
+      6) Возвращает ответ (JSON) либо словарь с описанием ошибки.
 
     :param user_id: Идентификатор пользователя (нужен для получения/обновления токена).
     :param url: Эндпоинт, куда делается запрос.
     :param payload: Тело запроса (JSON).
-    :param timeout: Таймаут запроса в секундах (по умолчанию 10).
+    :param timeout: Таймаут запроса в секундах (по умолчанию — таймаут эндпоинта, http_client.timeout_for).
     :return: Распарсенный JSON (словарь) или None в случае ошибки.
     """
-    session = get_db_session()
-    tokens = get_tokens(session, user_id)
+    # Токены берутся из памяти token_manager — без запроса к БД на каждый вызов
+    tokens = token_manager.get_tokens(user_id)
 
     if not tokens:
-        session.close()
         print("Не найдены токены для данного пользователя.")
         return None
 
     access_token, _, expires_at = tokens
 
+    if circuit_breaker.parked_reason(user_id):
+        print(f"Пользователь {user_id} припаркован до повторной авторизации (/auth).")
+        return None
+
     # Проверяем, не истёк ли срок действия access_token
     if is_token_expired(expires_at):
         # Пытаемся обновить
         new_token = refresh_emias_token(user_id, source='system')
         if not new_token:
-            from database import log_user_action
-            try:
-                log_user_action(session, user_id, 'api_refresh_token', 'Не удалось обновить токен (просрочен, требуется /auth)', source='system', status='error')
-            except Exception:
-                pass
-            session.close()
+            if _refresh_failure_is_users(user_id):
+                circuit_breaker.user_failed(user_id)
+                session = get_db_session()
+                try:
+                    log_user_action(session, user_id, 'api_refresh_token', 'Не удалось обновить токен (просрочен, требуется /auth)', source='system', status='error')
+                except Exception:
+                    pass
+                finally:
+                    session.close()
             print("Не удалось обновить токен.")
             return None
         access_token = new_token
 
-    # Теперь токен точно актуален
-    headers = {
-        "ei-token": access_token,
-    }
+    status, body = _post_with_token(user_id, url, access_token, payload, timeout)
+    if _is_invalid_token_response(status, body):
+        new_token = _refresh_rejected_token(user_id, access_token)
+        if new_token:
+            metrics.inc('emias_token_retries_total')
+            status, body = _post_with_token(user_id, url, new_token, payload, timeout)
+    _record_user_outcome(user_id, status, body)
+    if 0 < status < 400 and body is not None:
+        return body
+
+    error_description = _error_description(body)
+    error_message = f"Ошибка при запросе {url}"
+    if error_description:
+        error_message += f"\nОписание: {error_description}"
+    print(error_message)
+    print(f"Payload: {payload}")
+    return {"Описание": error_description or "Неизвестная ошибка"}
+
 
+# ----------------------------- ASYNC (aiohttp) -----------------------------
+# Асинхронные варианты для поллера бота: не блокируют цикл событий aiogram.
+# Сессия aiohttp (общий пул соединений) — http_client.get_async_session.
+
+
+async def close_async_http():
+    """Закрывает общие HTTP-клиенты (при остановке бота)."""
+    await http_client.close_async()
+    http_client.close()
+
+
+async def _post_with_token_async(user_id: int, url: str, access_token: str, payload: dict, timeout: Optional[float],
+                                 priority: Optional[int] = None):
+    """Один POST через общую aiohttp-сессию: (HTTP-статус или 0 при сетевой ошибке, JSON-тело или None)."""
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=timeout)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        error_message = f"Ошибка при запросе {url}"
-        error_description = None
-        try:
-            # Попытка получить дополнительную информацию из ответа, если он есть
-            error_description = response.json().get("error", {}).get("description")
-            error_message += f"\nОписание: {error_description}"
-        except (NameError, AttributeError, ValueError):
-            # NameError: если response не был присвоен
-            # AttributeError/ValueError: если response.json() не удался или не содержит нужных ключей
-            pass
-        
-        print(error_message)
-        print(f"Payload: {payload}")
-        return {"Описание": error_description or "Неизвестная ошибка"}
-    finally:
-        session.close()
+        await http_client.throttle_async(url, user_id, priority)
+    except http_client.CircuitOpenError as e:
+        return 0, _circuit_open_body(e)
+    try:
+        http = http_client.get_async_session()
+        async with http.post(url, headers={"ei-token": access_token}, json=payload,
+                             timeout=http_client.async_timeout_for(url, timeout)) as response:
+            http_client.record_result(url, response.status)
+            try:
+                return response.status, await response.json(content_type=None)
+            except (ValueError, aiohttp.ContentTypeError):
+                return response.status, None
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        http_client.record_result(url, 0, type(e).__name__)
+        return 0, None
+
+
+async def emias_post_request_async(
+        user_id: int,
+        url: str,
+        payload: dict,
+        timeout: Optional[float] = None,
+        priority: Optional[int] = None
+) -> Optional[dict]:
+    """Асинхронный аналог emias_post_request (та же семантика ответа, включая повтор после 401).
+    priority — приоритет в rate_limit (по умолчанию по эндпоинту).
+
+    Обновление токена (requests + БД) выполняется в отдельном потоке,
+    чтобы не блокировать цикл событий.
+    """
+    tokens = token_manager.get_tokens(user_id)
+
+    if not tokens:
+        print("Не найдены токены для данного пользователя.")
+        return None
+
+    access_token, _, expires_at = tokens
+
+    if circuit_breaker.parked_reason(user_id):
+        print(f"Пользователь {user_id} припаркован до повторной авторизации (/auth).")
+        return None
+
+    if is_token_expired(expires_at):
+        new_token = await asyncio.to_thread(refresh_emias_token, user_id, 'system')
+        if not new_token:
+            if _refresh_failure_is_users(user_id):
+                circuit_breaker.user_failed(user_id)
+                session = get_db_session()
+                try:
+                    log_user_action(session, user_id, 'api_refresh_token', 'Не удалось обновить токен (просрочен, требуется /auth)', source='system', status='error')
+                except Exception:
+                    pass
+                finally:
+                    session.close()
+            print("Не удалось обновить токен.")
+            return None
+        access_token = new_token
+
+    status, body = await _post_with_token_async(user_id, url, access_token, payload, timeout, priority)
+    if _is_invalid_token_response(status, body):
+        new_token = await asyncio.to_thread(_refresh_rejected_token, user_id, access_token)
+        if new_token:
+            metrics.inc('emias_token_retries_total')
+            status, body = await _post_with_token_async(user_id, url, new_token, payload, timeout, priority)
+    _record_user_outcome(user_id, status, body)
+    if 0 < status < 400 and body is not None:
+        return body
+
+    error_description = _error_description(body)
+    error_message = f"Ошибка при запросе {url}"
+    if error_description:
+        error_message += f"\nОписание: {error_description}"
+    print(error_message)
+    print(f"Payload: {payload}")
+    return {"Описание": error_description or "Неизвестная ошибка"}
 
 
 def get_whoami(user_id: int) -> dict:
-    url = "https://emias.info/web-api/whoAmI/"
+    url = WEB_API_BASE_URL + "whoAmI/"
     payload = {
         "accessToken": ""  # В whoAmI есть поле "accessToken", но оно продублируется – обычно оно не критично
     }
@@ -328,20 +463,18 @@ def get_whoami(user_id: int) -> dict:
 
 
 def get_assignments_referrals_info(user_id: int) -> dict:
-    url = "https://emias.info/api-eip/v2/saOrchestrator/getAssignmentsReferralsInfo"
-    session = get_db_session()
-    profile = get_profile(session, user_id)
+    url = api_url("v2/saOrchestrator/getAssignmentsReferralsInfo")
+    profile = ref_cache.get_profile(user_id)
     if not profile:
         print("Не удалось получить данные (OMS/birthDate) из БД.")
-        session.close()
         return None
-    session.close()
 
     payload = {
         "omsNumber": profile.oms_number,
         "birthDate": profile.birth_date,
     }
-    return emias_post_request(user_id=user_id, url=url, payload=payload).get("payload")
+    response = emias_post_request(user_id=user_id, url=url, payload=payload)
+    return response.get("payload") if response else None
 
 def sync_referrals_to_links(user_id: int) -> int:
     """Получает getAssignmentsReferralsInfo и сохраняет referralId в UserDoctorLink по speciality.
@@ -377,71 +510,43 @@ def sync_referrals_to_links(user_id: int) -> int:
     return updates
 
 
-def get_appointment_receptions_by_patient(user_id: int) -> dict:
-    url = "https://emias.info/api-eip/v8/saOrchestrator/getAppointmentReceptionsByPatient"
-    session = get_db_session()
-    profile = get_profile(session, user_id)
-    if not profile:
-        print("Не удалось получить данные (OMS/birthDate) из БД.")
-        session.close()
-        return None
-    session.close()
+URL_GET_RECEPTIONS = api_url("v8/saOrchestrator/getAppointmentReceptionsByPatient")
 
-    payload = {
-        "omsNumber": profile.oms_number,
-        "birthDate": profile.birth_date,
-    }
-    response = emias_post_request(user_id=user_id, url=url, payload=payload)
-    # Убрано подробное логирование количества записей (только создание/перенос пишем в логи)
-    return response.get("payload") if response else None
-
-
-from database import get_profile
 
-
-def get_specialities_info(user_id: int) -> list:
-    url = "https://emias.info/api-eip/v6/saOrchestrator/getSpecialitiesInfo"
-    session = get_db_session()
-    profile = get_profile(session, user_id)
+def _receptions_payload(user_id: int) -> Optional[dict]:
+    profile = ref_cache.get_profile(user_id)
     if not profile:
         print("Не удалось получить данные (OMS/birthDate) из БД.")
-        session.close()
         return None
-    session.close()
-
-    payload = {
+    return {
         "omsNumber": profile.oms_number,
         "birthDate": profile.birth_date,
-        "isChatBotEnabled": False
     }
-    response = emias_post_request(user_id=user_id, url=url, payload=payload)
-    return response.get("payload") if response else None
 
 
-import requests
-from typing import Optional, List, Union
-from database import get_db_session, get_tokens
-
-
-from typing import Optional, Tuple
-from sqlalchemy.orm import Session
-from database import DoctorInfo, Specialty
+def get_appointment_receptions_by_patient(user_id: int) -> dict:
+    payload = _receptions_payload(user_id)
+    if payload is None:
+        return None
+    response = emias_post_request(user_id=user_id, url=URL_GET_RECEPTIONS, payload=payload)
+    # Убрано подробное логирование количества записей (только создание/перенос пишем в логи)
+    return response.get("payload") if response else None
 
-from typing import Union, Tuple
 
 def resolve_inquiry_purpose_codes(
-    session: Session,
+    session: Optional[Session],
     available_resource_id: int,
 ) -> Tuple[Union[int, str], Union[int, str]]:
     """
     Возвращает inquiry_purpose_code и inquiry_purpose_id по available_resource_id.
 
+    Врач и специальность берутся из ref_cache (session не используется, оставлен для совместимости).
     Если в базе данных значение NULL — возвращает "" вместо None.
     :return: (inquiry_purpose_code, inquiry_purpose_id) — могут быть int или ""
     """
-    doctor = session.query(DoctorInfo).filter_by(doctor_api_id=available_resource_id).first()
+    doctor = ref_cache.get_doctor(available_resource_id)
     if doctor and doctor.ar_speciality_id:
-        specialty = session.query(Specialty).filter_by(code=doctor.ar_speciality_id).first()
+        specialty = ref_cache.get_specialty(doctor.ar_speciality_id)
         if specialty:
             return (
                 specialty.ar_inquiry_purpose_code if specialty.ar_inquiry_purpose_code is not None else "",
@@ -460,25 +565,21 @@ def get_doctors_info(
     Функция-обёртка для запроса к эндпоинту /getDoctorsInfo.
     """
 
-    session = get_db_session()
-    profile = get_profile(session, user_id)
+    profile = ref_cache.get_profile(user_id)
     if not profile:
         print("Не удалось получить данные (OMS/birthDate) из БД.")
-        session.close()
         return None
 
     # Определяем inquiryPurposeId по speciality_id
-    from database import Specialty
     inquiry_purpose_id = 61  # fallback значение
 
     if speciality_id and len(speciality_id) == 1:
-        specialty = session.query(Specialty).filter_by(code=speciality_id[0]).first()
+        specialty = ref_cache.get_specialty(speciality_id[0])
         if specialty and specialty.ar_inquiry_purpose_id:
             inquiry_purpose_id = specialty.ar_inquiry_purpose_id
     print(f"Используем inquiry_purpose_id: {inquiry_purpose_id} для speciality_id: {speciality_id}")
-    session.close()
 
-    url = "https://emias.info/api-eip/v4/saOrchestrator/getDoctorsInfo"
+    url = api_url("v4/saOrchestrator/getDoctorsInfo")
     payload = {
         "omsNumber": profile.oms_number,
         "birthDate": profile.birth_date,
@@ -502,16 +603,12 @@ def get_lpus_for_speciality(user_id: int, speciality_code: str) -> Optional[dict
     }
     Возвращает полный распарсенный JSON или None при ошибке.
     """
-    # Предположим, у нас есть функция get_profile()
-    # для получения из базы omsNumber и birthDate по user_id:
-    session = get_db_session()
-    profile = get_profile(session, user_id)
-    session.close()
+    profile = ref_cache.get_profile(user_id)
     if not profile:
         print("Не найден профиль пользователя, не можем получить omsNumber/birthDate")
         return None
 
-    url = "https://emias.info/api-eip/v3/saOrchestrator/getLpusForSpeciality"
+    url = api_url("v3/saOrchestrator/getLpusForSpeciality")
     payload = {
         "omsNumber": profile.oms_number,
         "birthDate": profile.birth_date,
@@ -521,7 +618,10 @@ def get_lpus_for_speciality(user_id: int, speciality_code: str) -> Optional[dict
     return emias_post_request(user_id, url, payload)
 
 
-def create_appointment(
+URL_CREATE_APPOINTMENT = api_url("v3/saOrchestrator/createAppointment")
+
+
+def _create_appointment_payload(
     user_id: int,
     available_resource_id: int,
     complex_resource_id: int,
@@ -530,27 +630,19 @@ def create_appointment(
     reception_type_id: int,
     inquiry_purpose_code: Optional[int] = None,
     inquiry_purpose_id: Optional[int] = None
-) -> Optional[Dict[str, Any]]:
-    """
-    Создает новую запись к врачу
-    """
-    url = "https://emias.info/api-eip/v3/saOrchestrator/createAppointment"
-
-    session = get_db_session()
-    profile = get_profile(session, user_id)
+) -> Optional[dict]:
+    profile = ref_cache.get_profile(user_id)
 
     if not profile:
         print("Не найден профиль пользователя: нет omsNumber/birthDate.")
-        session.close()
         return None
 
     # Получаем коды из specialty при необходимости
     if inquiry_purpose_code is None or inquiry_purpose_id is None:
-        inquiry_purpose_code, inquiry_purpose_id = resolve_inquiry_purpose_codes(session, available_resource_id)
+        inquiry_purpose_code, inquiry_purpose_id = resolve_inquiry_purpose_codes(None, available_resource_id)
 
-    session.close()
-
-    payload = {
+    # referralId отключён
+    return {
         "omsNumber": profile.oms_number,
         "birthDate": profile.birth_date,
         "availableResourceId": available_resource_id,
@@ -561,90 +653,105 @@ def create_appointment(
         "inquiryPurposeCode": inquiry_purpose_code,
         "inquiryPurposeId": inquiry_purpose_id
     }
-    # referralId отключён
 
-    return emias_post_request(user_id, url, payload)
 
-def get_available_resource_schedule_info(
+def create_appointment(
     user_id: int,
     available_resource_id: int,
     complex_resource_id: int,
-    appointment_id: Optional[int] = None,
+    start_time: str,
+    end_time: str,
+    reception_type_id: int,
     inquiry_purpose_code: Optional[int] = None,
     inquiry_purpose_id: Optional[int] = None
-) -> Optional[dict]:
+) -> Optional[Dict[str, Any]]:
     """
-    Делает запрос к /getAvailableResourceScheduleInfo, возвращая JSON-ответ
-    с расписанием врача и данными по ресурсу.
+    Создает новую запись к врачу (с дедлайном и хеджированием — booking.booking_write)
     """
-    url = "https://emias.info/api-eip/v3/saOrchestrator/getAvailableResourceScheduleInfo"
+    payload = _create_appointment_payload(
+        user_id, available_resource_id, complex_resource_id, start_time, end_time,
+        reception_type_id, inquiry_purpose_code, inquiry_purpose_id
+    )
+    if payload is None:
+        return None
+    from booking import booking_write  # booking импортирует этот модуль
+    return booking_write(user_id, URL_CREATE_APPOINTMENT, payload)
+
+URL_GET_SCHEDULE = api_url("v3/saOrchestrator/getAvailableResourceScheduleInfo")
 
-    session = get_db_session()
-    profile = get_profile(session, user_id)
+
+def _schedule_payload(
+    user_id: int,
+    available_resource_id: int,
+    complex_resource_id: int,
+    appointment_id: Optional[int] = None,
+    inquiry_purpose_code: Optional[int] = None,
+    inquiry_purpose_id: Optional[int] = None
+) -> Optional[dict]:
+    profile = ref_cache.get_profile(user_id)
 
     if not profile:
         print("Не найден профиль пользователя: нет omsNumber/birthDate.")
-        session.close()
         return None
 
     if (inquiry_purpose_code is None or inquiry_purpose_id is None) and appointment_id is None:
-        inquiry_purpose_code, inquiry_purpose_id = resolve_inquiry_purpose_codes(session, available_resource_id)
+        inquiry_purpose_code, inquiry_purpose_id = resolve_inquiry_purpose_codes(None, available_resource_id)
 
-    session.close()
-
-    payload = {
+    return {
         "omsNumber": profile.oms_number,
         "birthDate": profile.birth_date,
         "availableResourceId": available_resource_id,
         "complexResourceId": complex_resource_id,
-    **({"appointmentId": int(appointment_id) if isinstance(appointment_id, str) else appointment_id} if appointment_id else {
-        "inquiryPurposeId": inquiry_purpose_id
-    })
-}
-    response = emias_post_request(user_id, url, payload)
+        **({"appointmentId": int(appointment_id) if isinstance(appointment_id, str) else appointment_id} if appointment_id else {
+            "inquiryPurposeId": inquiry_purpose_id
+        })
+    }
 
-    # Автосохранение расписания в doctor_schedules при любом успешном ответе с scheduleOfDay
+
+def _autosave_schedule(available_resource_id, response: Optional[dict]) -> None:
+    """Автосохранение расписания в doctor_schedules при любом успешном ответе с scheduleOfDay.
+    Неизменившийся набор слотов (по отпечатку) не перезаписывается."""
     try:
         if response and response.get("payload") is not None:
             schedule_days = response.get("payload", {}).get("scheduleOfDay")
             if schedule_days is not None:  # даже пустой список сохраняем, чтобы в веб не было "Нет сохранённого"
-                from database import DoctorSchedule, DoctorInfo  # get_db_session уже импортирован модулем
-                sess = get_db_session()
+                from database import save_doctor_schedule  # get_db_session уже импортирован модулем
                 # Убедимся что есть запись о враче (FK). Если нет — пропускаем сохранение.
-                doctor_exists = sess.query(DoctorInfo).filter_by(doctor_api_id=str(available_resource_id)).first()
-                if doctor_exists:
-                    rec = sess.query(DoctorSchedule).filter_by(doctor_api_id=str(available_resource_id)).first()
-                    serialized = json.dumps(schedule_days, ensure_ascii=False)
-                    now_dt = datetime.utcnow()
-                    if rec:
-                        rec.schedule_text = serialized
-                        # updated_at может быть TEXT в БД — сохраняем ISO строку для совместимости
-                        try:
-                            rec.updated_at = now_dt
-                        except Exception:
-                            rec.updated_at = now_dt.strftime('%Y-%m-%d %H:%M:%S')
-                    else:
-                        try:
-                            rec = DoctorSchedule(
-                                doctor_api_id=str(available_resource_id),
-                                schedule_text=serialized,
-                                updated_at=now_dt
-                            )
-                        except Exception:
-                            rec = DoctorSchedule(
-                                doctor_api_id=str(available_resource_id),
-                                schedule_text=serialized,
-                                updated_at=now_dt.strftime('%Y-%m-%d %H:%M:%S')
-                            )
-                        sess.add(rec)
-                    sess.commit()
-                sess.close()
+                if ref_cache.get_doctor(available_resource_id):
+                    sess = get_db_session()
+                    save_doctor_schedule(sess, str(available_resource_id), schedule_days)
+                    sess.close()
     except Exception as e:
         # Тихо логировать в stdout чтобы не ломать основной поток
         print(f"[WARN] Не удалось автосохранить расписание для {available_resource_id}: {e}")
+
+
+def get_available_resource_schedule_info(
+    user_id: int,
+    available_resource_id: int,
+    complex_resource_id: int,
+    appointment_id: Optional[int] = None,
+    inquiry_purpose_code: Optional[int] = None,
+    inquiry_purpose_id: Optional[int] = None
+) -> Optional[dict]:
+    """
+    Делает запрос к /getAvailableResourceScheduleInfo, возвращая JSON-ответ
+    с расписанием врача и данными по ресурсу.
+    """
+    payload = _schedule_payload(
+        user_id, available_resource_id, complex_resource_id,
+        appointment_id, inquiry_purpose_code, inquiry_purpose_id
+    )
+    if payload is None:
+        return None
+    response = emias_post_request(user_id, URL_GET_SCHEDULE, payload)
+    _autosave_schedule(available_resource_id, response)
     return response
 
-def shift_appointment(
+URL_SHIFT_APPOINTMENT = api_url("v3/saOrchestrator/shiftAppointment")
+
+
+def _shift_appointment_payload(
     user_id: int,
     available_resource_id: int,
     complex_resource_id: int,
@@ -652,21 +759,15 @@ def shift_appointment(
     end_time: str,
     appointment_id: int,
     reception_type_id: int
-) -> Optional[Dict[str, Any]]:
-    """
-    Переносит существующую запись на новое время
-    """
-    url = "https://emias.info/api-eip/v3/saOrchestrator/shiftAppointment"
-    
-    session = get_db_session()
-    profile = get_profile(session, user_id)
-    session.close()
+) -> Optional[dict]:
+    profile = ref_cache.get_profile(user_id)
 
     if not profile:
         print("Не найден профиль пользователя: нет omsNumber/birthDate.")
         return None
 
-    payload = {
+    # referralId отключён
+    return {
         "omsNumber": profile.oms_number,
         "birthDate": profile.birth_date,
         "availableResourceId": available_resource_id,
@@ -676,10 +777,104 @@ def shift_appointment(
         "appointmentId": appointment_id,
         "receptionTypeId": reception_type_id
     }
-    # referralId отключён
 
-    response = emias_post_request(user_id, url, payload)
-    if response is None:
+
+def shift_appointment(
+    user_id: int,
+    available_resource_id: int,
+    complex_resource_id: int,
+    start_time: str,
+    end_time: str,
+    appointment_id: int,
+    reception_type_id: int
+) -> Optional[Dict[str, Any]]:
+    """
+    Переносит существующую запись на новое время (с дедлайном и хеджированием — booking.booking_write)
+    """
+    payload = _shift_appointment_payload(
+        user_id, available_resource_id, complex_resource_id, start_time, end_time,
+        appointment_id, reception_type_id
+    )
+    if payload is None:
+        return None
+
+    from booking import booking_write  # booking импортирует этот модуль
+    return booking_write(user_id, URL_SHIFT_APPOINTMENT, payload)
+
+
+async def get_appointment_receptions_by_patient_async(user_id: int) -> Optional[dict]:
+    payload = _receptions_payload(user_id)
+    if payload is None:
+        return None
+    response = await emias_post_request_async(user_id, URL_GET_RECEPTIONS, payload)
+    return response.get("payload") if response else None
+
+
+async def get_assignments_referrals_info_async(user_id: int) -> Optional[dict]:
+    url = api_url("v2/saOrchestrator/getAssignmentsReferralsInfo")
+    payload = _receptions_payload(user_id)  # те же omsNumber/birthDate
+    if payload is None:
+        return None
+    response = await emias_post_request_async(user_id, url, payload)
+    return response.get("payload") if response else None
+
+
+async def get_available_resource_schedule_info_async(
+    user_id: int,
+    available_resource_id: int,
+    complex_resource_id: int,
+    appointment_id: Optional[int] = None,
+    inquiry_purpose_code: Optional[int] = None,
+    inquiry_purpose_id: Optional[int] = None,
+    autosave: bool = True
+) -> Optional[dict]:
+    """autosave=False — не сохранять ответ в doctor_schedules (поллер сам ведёт baseline)."""
+    payload = _schedule_payload(
+        user_id, available_resource_id, complex_resource_id,
+        appointment_id, inquiry_purpose_code, inquiry_purpose_id
+    )
+    if payload is None:
         return None
+    response = await emias_post_request_async(user_id, URL_GET_SCHEDULE, payload)
+    if autosave:
+        _autosave_schedule(available_resource_id, response)
+    return response
+
 
-    return response
\ No newline at end of file
+async def create_appointment_async(
+    user_id: int,
+    available_resource_id: int,
+    complex_resource_id: int,
+    start_time: str,
+    end_time: str,
+    reception_type_id: int,
+    inquiry_purpose_code: Optional[int] = None,
+    inquiry_purpose_id: Optional[int] = None
+) -> Optional[Dict[str, Any]]:
+    payload = _create_appointment_payload(
+        user_id, available_resource_id, complex_resource_id, start_time, end_time,
+        reception_type_id, inquiry_purpose_code, inquiry_purpose_id
+    )
+    if payload is None:
+        return None
+    from booking import booking_write_async  # booking импортирует этот модуль
+    return await booking_write_async(user_id, URL_CREATE_APPOINTMENT, payload)
+
+
+async def shift_appointment_async(
+    user_id: int,
+    available_resource_id: int,
+    complex_resource_id: int,
+    start_time: str,
+    end_time: str,
+    appointment_id: int,
+    reception_type_id: int
+) -> Optional[Dict[str, Any]]:
+    payload = _shift_appointment_payload(
+        user_id, available_resource_id, complex_resource_id, start_time, end_time,
+        appointment_id, reception_type_id
+    )
+    if payload is None:
+        return None
+    from booking import booking_write_async  # booking импортирует этот модуль
+    return await booking_write_async(user_id, URL_SHIFT_APPOINTMENT, payload)
@@ -0,0 +1,84 @@
+"""
+EmiasClient — асинхронный клиент ЕМИАС от имени пользователя, возвращающий модели emias_models.
+
+Запросы идут через те же функции emias_api (токены, rate_limit, предохранители, автосохранение
+расписания), но ответ разбирается один раз здесь: вызывающий код получает Schedule / [Appointment] /
+[Referral] вместо словарей и не обходит JSON и не разбирает ISO-даты сам.
+
+    client = EmiasClient(user_id)
+    schedule = await client.schedule(doctor_api_id, complex_resource_id, appointment_id)
+    if schedule is None:
+        print(client.last_error)
+
+Для Flask и service_shift (синхронный код) — методы *_sync с тем же результатом.
+При ошибке методы возвращают None, описание ошибки ЕМИАС (поле "Описание") — в last_error.
+"""
+from typing import Any, List, Optional
+
+import emias_api
+from emias_models import (Appointment, Referral, Schedule, appointments_from_payload,
+                          referrals_from_payload)
+
+
+def error_description(response: Any) -> Optional[str]:
+    """Описание ошибки из ответа ЕМИАС (верхний уровень или внутри payload)."""
+    if not isinstance(response, dict):
+        return None
+    payload = response.get("payload")
+    return response.get("Описание") or (payload.get("Описание") if isinstance(payload, dict) else None)
+
+
+class EmiasClient:
+    __slots__ = ('user_id', 'last_error')
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.last_error: Optional[str] = None
+
+    def _schedule_result(self, response: Any) -> Optional[Schedule]:
+        schedule = Schedule.from_response(response)
+        self.last_error = error_description(response) if schedule is None else None
+        return schedule
+
+    def _payload_result(self, payload: Any, parse) -> Optional[list]:
+        if payload is None:
+            self.last_error = "Нет ответа ЕМИАС"
+            return None
+        self.last_error = None
+        return parse(payload)
+
+    # ----------------------------- ASYNC -----------------------------
+    async def schedule(self, available_resource_id: int, complex_resource_id: int,
+                       appointment_id: Optional[int] = None, autosave: bool = True) -> Optional[Schedule]:
+        """Расписание врача (getAvailableResourceScheduleInfo); с appointment_id — для переноса записи."""
+        response = await emias_api.get_available_resource_schedule_info_async(
+            self.user_id, available_resource_id, complex_resource_id,
+            appointment_id=appointment_id, autosave=autosave,
+        )
+        return self._schedule_result(response)
+
+    async def appointments(self) -> Optional[List[Appointment]]:
+        """Записи пациента (getAppointmentReceptionsByPatient)."""
+        payload = await emias_api.get_appointment_receptions_by_patient_async(self.user_id)
+        return self._payload_result(payload, appointments_from_payload)
+
+    async def referrals(self) -> Optional[List[Referral]]:
+        """Направления пациента (getAssignmentsReferralsInfo)."""
+        payload = await emias_api.get_assignments_referrals_info_async(self.user_id)
+        return self._payload_result(payload, referrals_from_payload)
+
+    # ----------------------------- SYNC -----------------------------
+    def schedule_sync(self, available_resource_id: int, complex_resource_id: int,
+                      appointment_id: Optional[int] = None) -> Optional[Schedule]:
+        response = emias_api.get_available_resource_schedule_info(
+            self.user_id, available_resource_id, complex_resource_id, appointment_id=appointment_id,
+        )
+        return self._schedule_result(response)
+
+    def appointments_sync(self) -> Optional[List[Appointment]]:
+        return self._payload_result(emias_api.get_appointment_receptions_by_patient(self.user_id),
+                                    appointments_from_payload)
+
+    def referrals_sync(self) -> Optional[List[Referral]]:
+        return self._payload_result(emias_api.get_assignments_referrals_info(self.user_id),
+                                    referrals_from_payload)
@@ -0,0 +1,321 @@
+"""
+Типизированные модели ответов ЕМИАС: расписание (Schedule -> Day -> Slot), записи (Appointment), направления (Referral).
+Независимый модуль без зависимостей от aiogram/SQLAlchemy.
+
+Ответ разбирается один раз: обход payload.scheduleOfDay[].scheduleBySlot[].slot[] и разбор ISO-дат
+выполняются при построении модели, дальше код работает с готовыми атрибутами (slot.start — datetime,
+slot.label — "YYYY-MM-DD HH:MM"). Классы с __slots__ — расписание из тысяч слотов занимает заметно
+меньше памяти, чем те же словари JSON. Исходный JSON остаётся в .raw: его сохраняет doctor_schedules,
+из него берутся поля, не вынесенные в модель.
+
+Функции бота, принимавшие payload (collect_matching_slots, parse_schedule_payload, ...), принимают и Schedule:
+as_schedule() разбирает payload, только если передан сырой JSON.
+"""
+from collections.abc import Mapping, Sequence
+from datetime import date, datetime
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+
+def parse_iso(value: Any) -> Optional[datetime]:
+    """ISO-строка ЕМИАС ("2025-03-24T18:15:00+03:00", "...Z", без таймзоны) -> datetime, None если не разбирается."""
+    if not value or not isinstance(value, str):
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+def parse_date(value: Any) -> Optional[date]:
+    """"YYYY-MM-DD..." или "DD.MM.YYYY" -> date."""
+    if not value or not isinstance(value, str):
+        return None
+    for fmt in ('%Y-%m-%d', '%d.%m.%Y'):
+        try:
+            return datetime.strptime(value[:10], fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+def _to_int(value: Any) -> Optional[int]:
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        return None
+
+
+def _now_for(dt: datetime, now_naive: datetime) -> datetime:
+    # Сравниваем с now в той же таймзоне, если она присутствует
+    return datetime.now(dt.tzinfo) if dt.tzinfo is not None else now_naive
+
+
+# ----------------------------- Расписание -----------------------------
+class Slot:
+    """Слот расписания. start/end — datetime (с таймзоной ответа) или None, если строка не разбирается."""
+
+    __slots__ = ('start_iso', 'end_iso', 'start', 'end', 'label', 'raw')
+
+    def __init__(self, raw: Dict[str, Any]):
+        self.raw = raw
+        self.start_iso: str = raw.get("startTime") or raw.get("start") or ""
+        self.end_iso: str = raw.get("endTime") or raw.get("end") or ""
+        self.start = parse_iso(self.start_iso)
+        self.end = parse_iso(self.end_iso)
+        # Местное время строки, как в bot.parse_schedule_payload: "YYYY-MM-DD HH:MM"
+        self.label: Optional[str] = f"{self.start_iso[:10]} {self.start_iso[11:16]}" if len(self.start_iso) >= 16 else None
+
+    @property
+    def display(self) -> str:
+        """"YYYY-MM-DD HH:MM" по разобранному времени (формат collect_matching_slots)."""
+        return self.start.strftime("%Y-%m-%d %H:%M") if self.start else (self.label or "")
+
+    def __repr__(self) -> str:
+        return f"Slot({self.start_iso!r}, {self.end_iso!r})"
+
+
+class Day:
+    __slots__ = ('date_str', 'date', 'slots', 'raw')
+
+    def __init__(self, raw: Dict[str, Any]):
+        self.raw = raw
+        self.date_str: str = raw.get("date") or raw.get("scheduleDate") or ""
+        self.date = parse_date(self.date_str)
+        self.slots: List[Slot] = [
+            Slot(s)
+            for block in raw.get("scheduleBySlot", []) or []
+            for s in block.get("slot", []) or []
+        ]
+
+
+class Schedule:
+    """Ответ getAvailableResourceScheduleInfo (payload): дни со слотами и availableResource."""
+
+    __slots__ = ('days', 'resource', 'raw', '_future')
+
+    def __init__(self, raw: Optional[Dict[str, Any]] = None):
+        self.raw: Dict[str, Any] = raw or {}
+        # getDoctorsInfoForLI-расписание (service_shift) называет список дней scheduleByDay
+        days = self.raw.get("scheduleOfDay")
+        if days is None:
+            days = self.raw.get("scheduleByDay")
+        self.days: List[Day] = [Day(d) for d in days or []]
+        self.resource: Dict[str, Any] = self.raw.get("availableResource") or {}
+        self._future = None
+
+    @classmethod
+    def from_response(cls, response: Any) -> Optional['Schedule']:
+        """Полный ответ emias_post_request ({"payload": {...}}) -> Schedule, None если payload нет."""
+        payload = response.get("payload") if isinstance(response, dict) else None
+        return cls(payload) if isinstance(payload, dict) else None
+
+    @property
+    def schedule_days(self) -> List[Dict[str, Any]]:
+        """Исходный scheduleOfDay (для save_doctor_schedule / SlotTable)."""
+        return self.raw.get("scheduleOfDay") or self.raw.get("scheduleByDay") or []
+
+    @property
+    def doctor_name(self) -> str:
+        return self.resource.get("name") or ""
+
+    @property
+    def speciality_name(self) -> str:
+        return self.resource.get("arSpecialityName") or self.resource.get("arSpeciality") or ""
+
+    def iter_slots(self) -> Iterator[Slot]:
+        """Все слоты в порядке ответа."""
+        for day in self.days:
+            yield from day.slots
+
+    def __len__(self) -> int:
+        return sum(len(day.slots) for day in self.days)
+
+    def __bool__(self) -> bool:
+        return any(day.slots for day in self.days)
+
+    def labels(self) -> set:
+        """Множество "YYYY-MM-DD HH:MM" всех слотов (как bot.parse_schedule_payload)."""
+        return {s.label for s in self.iter_slots() if s.label}
+
+    def first_slot(self) -> Optional[Slot]:
+        """Первый слот ответа с началом и концом."""
+        return next((s for s in self.iter_slots() if s.start_iso and s.end_iso), None)
+
+    def find(self, label: str) -> Optional[Slot]:
+        """Слот по "YYYY-MM-DD HH:MM" (сравнение по префиксу ISO)."""
+        prefix = label.replace(" ", "T")[:16]
+        return next((s for s in self.iter_slots() if s.start_iso[:16] == prefix), None)
+
+    def future_slots(self, now: Optional[datetime] = None) -> List[Slot]:
+        """Разобранные слоты позже текущего момента, по возрастанию начала (кэшируется для now=None)."""
+        if now is None and self._future is not None:
+            return self._future
+        now_naive = now or datetime.now()
+        result = [s for s in self.iter_slots() if s.start is not None and s.start > _now_for(s.start, now_naive)]
+        result.sort(key=lambda s: s.start)
+        if now is None:
+            self._future = result
+        return result
+
+
+def as_schedule(value: Union[Schedule, Dict[str, Any], List[Dict[str, Any]], None]) -> Schedule:
+    """Schedule как есть; payload ({"scheduleOfDay": [...]}) или сам список scheduleOfDay — разбирается."""
+    if isinstance(value, Schedule):
+        return value
+    if isinstance(value, list):
+        return Schedule({"scheduleOfDay": value})
+    return Schedule(value if isinstance(value, dict) else None)
+
+
+# ----------------------------- Записи -----------------------------
+# набор возможных вариантов ключа
+_SPECIALITY_KEYS = {
+    "specialityId",
+    "specialtyId",
+    "doctorSpecialityId",
+    "doctorSpecialtyId",
+}
+
+
+def _to_str_or_empty(value) -> str:
+    if value is None:
+        return ""
+    try:
+        return str(int(value))
+    except (ValueError, TypeError):
+        # если это не число (на всякий), просто str()
+        return str(value).strip()
+
+
+def extract_speciality_id_from_appointment(appt: dict) -> str:
+    """Возвращает specialityId из записи, учитывая любые варианты вложенности/имен."""
+    if not appt or not isinstance(appt, Mapping):
+        return ""
+
+    # Специальный случай диагностических процедур (LDP): используем ldpTypeId как псевдо-"специальность"
+    if appt.get("type") == "LDP":
+        to_ldp = appt.get("toLdp")
+        if isinstance(to_ldp, Mapping):
+            ldp_type_id = to_ldp.get("ldpTypeId")
+            if ldp_type_id not in (None, "", 0):
+                try:
+                    return str(int(ldp_type_id))
+                except (ValueError, TypeError):
+                    return str(ldp_type_id)
+
+    # 1) быстрые явные пути
+    # верхний уровень
+    for k in _SPECIALITY_KEYS:
+        if k in appt and appt[k] not in (None, "", 0):
+            return _to_str_or_empty(appt[k])
+
+    # toDoctor
+    to_doctor = appt.get("toDoctor")
+    if isinstance(to_doctor, Mapping):
+        for k in _SPECIALITY_KEYS:
+            if k in to_doctor and to_doctor[k] not in (None, "", 0):
+                return _to_str_or_empty(to_doctor[k])
+
+    # referral
+    referral = appt.get("referral")
+    if isinstance(referral, Mapping):
+        for k in _SPECIALITY_KEYS:
+            if k in referral and referral[k] not in (None, "", 0):
+                return _to_str_or_empty(referral[k])
+
+    # 2) общий глубокий поиск (dicts/lists/tuples)
+    stack = [appt]
+    seen = set()
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+
+        if isinstance(node, Mapping):
+            # прямое попадание ключа
+            for k in _SPECIALITY_KEYS:
+                if k in node and node[k] not in (None, "", 0):
+                    return _to_str_or_empty(node[k])
+            # углубляемся
+            for v in node.values():
+                if isinstance(v, (Mapping, Sequence)) and not isinstance(v, (str, bytes)):
+                    stack.append(v)
+
+        elif isinstance(node, Sequence) and not isinstance(node, (str, bytes)):
+            for v in node:
+                if isinstance(v, (Mapping, Sequence)) and not isinstance(v, (str, bytes)):
+                    stack.append(v)
+
+    return ""
+
+
+class Appointment:
+    """Запись пациента из getAppointmentReceptionsByPatient."""
+
+    __slots__ = ('id', 'type', 'available_resource_id', 'complex_resource_id', 'start_iso', 'end_iso',
+                 'start', 'end', 'speciality_id', 'referral_id', 'enable_shift', 'raw')
+
+    def __init__(self, raw: Dict[str, Any]):
+        self.raw = raw
+        appointment_id = raw.get("appointmentId") or raw.get("id")
+        # int, если ЕМИАС вернул число (как обычно); иначе — как есть
+        self.id = _to_int(appointment_id) if _to_int(appointment_id) is not None else appointment_id
+        self.type: Optional[str] = raw.get("type")
+        self.available_resource_id = str(raw.get("availableResourceId", ""))
+        self.complex_resource_id = raw.get("complexResourceId")
+        self.start_iso: str = raw.get("startTime") or ""
+        self.end_iso: str = raw.get("endTime") or ""
+        self.start = parse_iso(self.start_iso)
+        self.end = parse_iso(self.end_iso)
+        self.speciality_id = extract_speciality_id_from_appointment(raw)
+        ref = raw.get("referral") or {}
+        ref_id = (ref.get("referralId") or ref.get("id")) if isinstance(ref, Mapping) else None
+        self.referral_id: Optional[str] = str(ref_id) if ref_id else None
+        self.enable_shift = bool(raw.get("enableShift"))
+
+    def __repr__(self) -> str:
+        return f"Appointment(id={self.id}, resource={self.available_resource_id}, start={self.start_iso!r})"
+
+
+def appointments_from_payload(payload: Any) -> List[Appointment]:
+    """payload getAppointmentReceptionsByPatient -> [Appointment]."""
+    if not isinstance(payload, dict):
+        return []
+    return [Appointment(a) for a in payload.get("appointment") or payload.get("appointments") or []
+            if isinstance(a, dict)]
+
+
+# ----------------------------- Направления -----------------------------
+class Referral:
+    """Направление из getAssignmentsReferralsInfo (arInfo.referrals.items)."""
+
+    __slots__ = ('id', 'type', 'speciality_id', 'speciality_name', 'start_date', 'end_date', 'raw')
+
+    def __init__(self, raw: Dict[str, Any]):
+        self.raw = raw
+        self.id: Optional[str] = str(raw.get("referralId") or raw.get("id") or "") or None
+        self.type: Optional[str] = raw.get("type")
+        speciality = raw.get("speciality") or {}
+        spec_id = speciality.get("code") or raw.get("specialityId") or raw.get("specialityCode")
+        self.speciality_id: Optional[str] = str(spec_id) if spec_id else None
+        self.speciality_name: str = speciality.get("name") or raw.get("specialityName") or ""
+        self.start_date = parse_date(raw.get("startTime"))
+        self.end_date = parse_date(raw.get("endTime"))
+
+    def valid_on(self, day: date) -> bool:
+        """Действует ли направление в этот день (без дат — считается действующим)."""
+        if self.start_date and self.end_date:
+            return self.start_date <= day <= self.end_date
+        return True
+
+    def __repr__(self) -> str:
+        return f"Referral(id={self.id}, type={self.type}, speciality={self.speciality_id})"
+
+
+def referrals_from_payload(payload: Any) -> List[Referral]:
+    """payload getAssignmentsReferralsInfo -> [Referral]."""
+    if not isinstance(payload, dict):
+        return []
+    items = ((payload.get("arInfo") or {}).get("referrals") or {}).get("items") or []
+    return [Referral(r) for r in items if isinstance(r, dict)]
@@ -0,0 +1,230 @@
+"""
+Общий HTTP-клиент для всех запросов к ЕМИАС (emias_api, service_shift).
+
+Раньше каждый вызов делал module-level requests.post: новое TCP+TLS соединение на каждый запрос.
+Здесь один клиент на процесс с пулом keep-alive соединений:
+  * синхронный — requests.Session с HTTPAdapter (пул EMIAS_HTTP_POOL_SIZE соединений на хост);
+    при EMIAS_HTTP2=1 и установленном httpx[http2] — httpx.Client(http2=True);
+  * асинхронный (поллер бота) — aiohttp.ClientSession с TCPConnector того же размера пула,
+    привязанная к текущему event loop.
+Таймаут выбирается по эндпоинту (последний сегмент пути URL): запись/перенос ждут дольше,
+чем справочники. Значения по умолчанию — ENDPOINT_TIMEOUTS, переопределяются EMIAS_HTTP_TIMEOUTS
+("createAppointment=30,getDoctorsInfo=15"), остальное — EMIAS_HTTP_TIMEOUT.
+
+Перед отправкой каждый запрос проходит rate_limit (глобальный, пользовательский и эндпоинтный
+лимиты с приоритетами): post() ждёт сам, асинхронный код вызывает throttle_async.
+Предохранитель эндпоинта (circuit_breaker) проверяется до этого: при разомкнутом post() сразу
+бросает CircuitOpenError, результат отправленного запроса учитывается предохранителем.
+
+Ответ синхронного post() в обоих режимах ведёт себя как requests.Response (status_code, text,
+json(), raise_for_status() -> requests.HTTPError), ошибки сети — requests.exceptions.RequestException.
+"""
+import asyncio
+import logging
+import threading
+from typing import Any, Dict, Optional
+from urllib.parse import urlsplit
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import EMIAS_HTTP2, EMIAS_HTTP_POOL_SIZE, EMIAS_HTTP_TIMEOUT, EMIAS_HTTP_TIMEOUTS
+import circuit_breaker
+import metrics
+import rate_limit
+
+try:  # HTTP/2 — опционально, только если установлен httpx с h2
+    import httpx
+except ImportError:  # pragma: no cover - зависит от окружения
+    httpx = None
+
+# Таймауты (секунды) по последнему сегменту пути URL
+ENDPOINT_TIMEOUTS: Dict[str, float] = {
+    'refreshTokens': 10,
+    'whoAmI': 10,
+    'getAvailableResourceScheduleInfo': 10,
+    'getAppointmentReceptionsByPatient': 10,
+    'getSpecialitiesInfo': 15,
+    'getAssignmentsReferralsInfo': 15,
+    'getDoctorsInfo': 15,
+    'getDoctorsInfoForLI': 15,
+    'getLpusForSpeciality': 15,
+    'createAppointment': 25,
+    'shiftAppointment': 25,
+    'cancelAppointment': 25,
+}
+KEEPALIVE_SEC = 30
+
+
+def _parse_timeouts(spec: str) -> Dict[str, float]:
+    result = {}
+    for item in (spec or '').split(','):
+        name, _, value = item.partition('=')
+        try:
+            result[name.strip()] = float(value)
+        except ValueError:
+            if item.strip():
+                logging.warning(f"http_client: bad EMIAS_HTTP_TIMEOUTS item {item!r}")
+    return result
+
+
+ENDPOINT_TIMEOUTS.update(_parse_timeouts(EMIAS_HTTP_TIMEOUTS))
+
+
+def endpoint_name(url: str) -> str:
+    """'https://emias.info/web-api/refreshTokens/' -> 'refreshTokens'."""
+    return urlsplit(url).path.rstrip('/').rsplit('/', 1)[-1]
+
+
+def timeout_for(url: str) -> float:
+    return ENDPOINT_TIMEOUTS.get(endpoint_name(url), EMIAS_HTTP_TIMEOUT)
+
+
+class _Http2Response:
+    """Обёртка ответа httpx с интерфейсом requests.Response, который используют вызывающие модули."""
+
+    def __init__(self, response):
+        self._response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.url = str(response.url)
+
+    @property
+    def text(self) -> str:
+        return self._response.text
+
+    @property
+    def content(self) -> bytes:
+        return self._response.content
+
+    def json(self) -> Any:
+        return self._response.json()
+
+    def raise_for_status(self) -> None:
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} for url: {self.url}", response=self)
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """Запрос не отправлен: предохранитель эндпоинта разомкнут (ловится как RequestException)."""
+
+
+_lock = threading.Lock()
+_session = None
+
+
+def _make_session():
+    if EMIAS_HTTP2:
+        if httpx is not None:
+            try:
+                limits = httpx.Limits(max_connections=EMIAS_HTTP_POOL_SIZE,
+                                      max_keepalive_connections=EMIAS_HTTP_POOL_SIZE,
+                                      keepalive_expiry=KEEPALIVE_SEC)
+                return httpx.Client(http2=True, limits=limits)
+            except ImportError:
+                logging.warning("http_client: EMIAS_HTTP2=1, but h2 is not installed — using HTTP/1.1")
+        else:
+            logging.warning("http_client: EMIAS_HTTP2=1, but httpx is not installed — using HTTP/1.1")
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=EMIAS_HTTP_POOL_SIZE, pool_block=False)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session():
+    """Общий синхронный клиент (создаётся при первом обращении)."""
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _session = _make_session()
+    return _session
+
+
+def post(url: str, json: Optional[dict] = None, headers: Optional[Dict[str, str]] = None,
+         timeout: Optional[float] = None, user_id: Optional[int] = None, priority: Optional[int] = None):
+    """
+    POST через общий пул после проверки предохранителя и разрешения rate_limit. timeout=None — таймаут эндпоинта (timeout_for);
+    user_id — чей лимит расходуется; priority — rate_limit.BOOKING/POLLING/REFERENCE (по умолчанию по эндпоинту).
+    """
+    endpoint = endpoint_name(url)
+    breaker = circuit_breaker.for_endpoint(endpoint)
+    if not breaker.allow():
+        metrics.inc('emias_breaker_rejected_total')
+        raise CircuitOpenError(breaker.describe_open())
+    rate_limit.acquire(user_id, endpoint, priority)
+    try:
+        response = _send(url, json, headers, timeout_for(url) if timeout is None else timeout)
+    except requests.RequestException as e:
+        breaker.record_failure(type(e).__name__)
+        raise
+    breaker.record_status(response.status_code)
+    return response
+
+
+def _send(url: str, json: Optional[dict], headers: Optional[Dict[str, str]], timeout: float):
+    session = get_session()
+    if httpx is not None and isinstance(session, httpx.Client):
+        try:
+            return _Http2Response(session.post(url, json=json, headers=headers, timeout=timeout))
+        except httpx.TimeoutException as e:
+            raise requests.Timeout(str(e)) from e
+        except httpx.HTTPError as e:
+            raise requests.ConnectionError(str(e)) from e
+    return session.post(url, json=json, headers=headers, timeout=timeout)
+
+
+def close() -> None:
+    """Закрывает синхронный пул (соединения откроются заново при следующем запросе)."""
+    global _session
+    with _lock:
+        session, _session = _session, None
+    if session is not None:
+        session.close()
+
+
+# ----------------------------- ASYNC (aiohttp) -----------------------------
+_async_session: Optional[aiohttp.ClientSession] = None
+
+
+def get_async_session() -> aiohttp.ClientSession:
+    """Общая aiohttp-сессия текущего event loop с пулом EMIAS_HTTP_POOL_SIZE соединений на хост."""
+    global _async_session
+    loop = asyncio.get_running_loop()
+    if _async_session is None or _async_session.closed or getattr(_async_session, '_loop', None) is not loop:
+        connector = aiohttp.TCPConnector(limit=EMIAS_HTTP_POOL_SIZE * 2, limit_per_host=EMIAS_HTTP_POOL_SIZE,
+                                         keepalive_timeout=KEEPALIVE_SEC)
+        _async_session = aiohttp.ClientSession(connector=connector)
+    return _async_session
+
+
+async def throttle_async(url: str, user_id: Optional[int] = None, priority: Optional[int] = None) -> float:
+    """
+    Перед запросом через get_async_session(): проверяет предохранитель (CircuitOpenError, если разомкнут)
+    и ждёт разрешения rate_limit. Результат запроса затем передаётся в record_result.
+    """
+    endpoint = endpoint_name(url)
+    breaker = circuit_breaker.for_endpoint(endpoint)
+    if not breaker.allow():
+        metrics.inc('emias_breaker_rejected_total')
+        raise CircuitOpenError(breaker.describe_open())
+    return await rate_limit.acquire_async(user_id, endpoint, priority)
+
+
+def record_result(url: str, status: int, error: Optional[str] = None) -> None:
+    """Учитывает результат асинхронного запроса в предохранителе эндпоинта (status 0 — сетевая ошибка)."""
+    circuit_breaker.for_endpoint(endpoint_name(url)).record_status(status, error)
+
+
+def async_timeout_for(url: str, timeout: Optional[float] = None) -> aiohttp.ClientTimeout:
+    return aiohttp.ClientTimeout(total=timeout if timeout is not None else timeout_for(url))
+
+
+async def close_async() -> None:
+    """Закрывает общую aiohttp-сессию (при остановке бота)."""
+    global _async_session
+    if _async_session is not None and not _async_session.closed:
+        await _async_session.close()
+    _async_session = None
@@ -0,0 +1,43 @@
+"""
+Простые in-process метрики (счётчики и текущие значения) бота и поллера.
+
+run_all.py запускает бота и веб-панель в одном процессе, поэтому админ-панель показывает
+значения, накопленные поллером. Модуль без внешних зависимостей; потокобезопасен.
+"""
+import threading
+from datetime import datetime
+from typing import Any, Dict, Union
+
+Number = Union[int, float]
+
+_lock = threading.Lock()
+_counters: Dict[str, Number] = {}
+_gauges: Dict[str, Any] = {}
+_started_at = datetime.utcnow()
+
+
+def inc(name: str, value: Number = 1) -> None:
+    """Увеличивает счётчик name на value."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def set_gauge(name: str, value: Any) -> None:
+    """Запоминает последнее значение метрики name."""
+    with _lock:
+        _gauges[name] = value
+
+
+def get_counter(name: str) -> Number:
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def snapshot() -> Dict[str, Any]:
+    """Копия всех метрик: {'started_at', 'counters', 'gauges'}."""
+    with _lock:
+        return {
+            'started_at': _started_at,
+            'counters': dict(sorted(_counters.items())),
+            'gauges': dict(sorted(_gauges.items())),
+        }
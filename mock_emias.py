@@ -0,0 +1,403 @@
+"""
+Локальный мок ЕМИАС для нагрузочного тестирования и разработки без обращений к emias.info.
+
+Запуск из корня проекта:
+    python mock_emias.py [--port 8085] [--doctors 50] [--latency-ms 20-150] [--error-rate 0.0]
+                         [--unauthorized-rate 0.0] [--density 0.15] [--churn-sec 60] [--seed 1]
+Бот, веб-панель и service_shift направляются на мок переменной окружения:
+    EMIAS_API_BASE_URL=http://127.0.0.1:8085/api-eip/
+(web-api — refreshTokens, whoAmI — тогда берётся с того же хоста: http://127.0.0.1:8085/web-api/).
+
+Эндпоинты (POST; маршрут выбирается по последнему сегменту пути, версия v3/v4/... не важна):
+getAvailableResourceScheduleInfo, getDoctorsInfo, getDoctorsInfoForLI, getAppointmentReceptionsByPatient,
+createAppointment, shiftAppointment, getAssignmentsReferralsInfo, getLpusForSpeciality, getSpecialitiesInfo,
+refreshTokens, whoAmI.
+
+Синтетические данные (детерминированы --seed):
+  * --doctors врачей нескольких специальностей в трёх ЛПУ; id врача = 20000000000 + номер;
+  * расписание на 14 дней вперёд, рабочие дни 08:00–20:00, слоты по 15 минут. Слот виден с
+    вероятностью --density, набор видимых слотов пересчитывается каждые --churn-sec секунд —
+    слоты появляются и исчезают, как в настоящем ЕМИАС; занятые записью слоты не показываются;
+  * записи пациентов (по omsNumber) живут в памяти: createAppointment/shiftAppointment занимают слот
+    (занятый или исчезнувший — ошибка 400, как у ЕМИАС), getAppointmentReceptionsByPatient их возвращает.
+
+Сбои: --latency-ms (число или диапазон "lo-hi"), --error-rate (доля ответов 500),
+--unauthorized-rate (доля ответов 401 — проверка повторного запроса после обновления токена).
+refreshTokens выдаёт новые токены; refreshToken, начинающийся с "invalid", получает invalid_grant.
+
+Служебные маршруты: GET /mock/stats — число вызовов по эндпоинтам и статусам;
+POST /mock/config — изменить параметры на лету ({"error_rate": 0.1, ...}); POST /mock/reset — сбросить
+записи и счётчики.
+"""
+import argparse
+import hashlib
+import itertools
+import random
+import threading
+import time as time_mod
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from flask import Flask, jsonify, request
+
+MSK = timezone(timedelta(hours=3))
+SLOT_MINUTES = 15
+DAYS_AHEAD = 14
+WORK_HOURS = (8, 20)
+
+SPECIALITIES = [
+    ("69", "Врач-терапевт участковый"),
+    ("602", "Врач общей практики"),
+    ("2", "Офтальмолог"),
+    ("5", "Хирург"),
+    ("19", "Оториноларинголог (ЛОР)"),
+    ("2028", "Заболевание кожи (исключая новообразования кожи)"),
+    ("600020", "ЭКГ"),
+]
+LPUS = [
+    (10000431, "ГП № 2", "г. Москва, ул. Тверская, д. 1"),
+    (10000432, "ГП № 7", "г. Москва, Ленинский пр-т, д. 10"),
+    (10000433, "ДЦ № 3", "г. Москва, ул. Арбат, д. 20"),
+]
+LAST_NAMES = ["Иванов", "Петрова", "Сидоров", "Кузнецова", "Смирнов", "Попова", "Волков", "Соколова"]
+
+
+class MockSettings:
+    def __init__(self, latency_ms=(0.0, 0.0), error_rate: float = 0.0, unauthorized_rate: float = 0.0,
+                 density: float = 0.15, churn_sec: float = 60.0, seed: int = 1):
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.unauthorized_rate = unauthorized_rate
+        self.density = density
+        self.churn_sec = churn_sec
+        self.seed = seed
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'latency_ms': list(self.latency_ms),
+            'error_rate': self.error_rate,
+            'unauthorized_rate': self.unauthorized_rate,
+            'density': self.density,
+            'churn_sec': self.churn_sec,
+            'seed': self.seed,
+        }
+
+
+def parse_latency(value) -> tuple:
+    """"50" -> (50, 50), "20-150" -> (20, 150), [20, 150] -> (20, 150)."""
+    if isinstance(value, (list, tuple)):
+        lo, hi = value
+    else:
+        lo, _, hi = str(value).partition('-')
+        hi = hi or lo
+    return float(lo), float(hi)
+
+
+class MockEmias:
+    """Состояние мока: врачи, записи пациентов, счётчики вызовов."""
+
+    def __init__(self, doctors: int = 50, settings: Optional[MockSettings] = None):
+        self.settings = settings or MockSettings()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(900000000)
+        self.doctors = self._make_doctors(doctors)
+        self.by_id = {d['id']: d for d in self.doctors}
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.appointments: Dict[str, List[Dict[str, Any]]] = {}  # omsNumber -> записи
+            self.booked: Dict[tuple, str] = {}  # (resource_id, startTime) -> omsNumber
+            self.calls: Counter = Counter()
+
+    def _make_doctors(self, count: int) -> List[Dict[str, Any]]:
+        rnd = random.Random(self.settings.seed)
+        doctors = []
+        for i in range(count):
+            code, spec_name = SPECIALITIES[i % len(SPECIALITIES)]
+            lpu_id, lpu_name, address = LPUS[i % len(LPUS)]
+            doctors.append({
+                'id': 20000000000 + i,
+                'name': f"{rnd.choice(LAST_NAMES)} {chr(0x410 + rnd.randrange(28))}. {chr(0x410 + rnd.randrange(28))}. <{i}>",
+                'arSpecialityId': int(code),
+                'arSpecialityName': spec_name,
+                'lpuId': lpu_id,
+                'lpuShortName': lpu_name,
+                'complexResource': [{
+                    'id': 600000000 + i,
+                    'name': str(100 + i),
+                    'room': {'number': str(100 + i), 'addressPointId': 5000 + lpu_id % 100,
+                             'lpuId': lpu_id, 'lpuShortName': lpu_name, 'defaultAddress': address},
+                }],
+            })
+        return doctors
+
+    # ----------------------------- Расписание -----------------------------
+    def _visible(self, doctor_id: int, minute: int, window: int) -> bool:
+        digest = hashlib.blake2b(f"{self.settings.seed}:{doctor_id}:{minute}:{window}".encode(), digest_size=4).digest()
+        return int.from_bytes(digest, 'little') < self.settings.density * 0xFFFFFFFF
+
+    def schedule_days(self, doctor_id: int, now: Optional[datetime] = None) -> List[Dict[str, Any]]:
+        now = now or datetime.now(MSK)
+        window = int(time_mod.time() // self.settings.churn_sec) if self.settings.churn_sec > 0 else 0
+        days = []
+        for offset in range(DAYS_AHEAD):
+            day = (now + timedelta(days=offset)).date()
+            if day.weekday() >= 5:
+                continue
+            slots = []
+            start = datetime(day.year, day.month, day.day, WORK_HOURS[0], tzinfo=MSK)
+            end_of_day = start.replace(hour=WORK_HOURS[1])
+            while start < end_of_day:
+                end = start + timedelta(minutes=SLOT_MINUTES)
+                minute = int(start.timestamp() // 60)
+                start_iso = start.isoformat()
+                if start > now and self._visible(doctor_id, minute, window) and (doctor_id, start_iso) not in self.booked:
+                    slots.append({'startTime': start_iso, 'endTime': end.isoformat()})
+                start = end
+            doctor = self.by_id[doctor_id]
+            days.append({'date': day.isoformat(), 'scheduleBySlot': [
+                {'cabinetNumber': doctor['complexResource'][0]['name'], 'slot': slots}
+            ]})
+        return days
+
+    def slot_available(self, doctor_id: int, start_iso: str) -> Optional[str]:
+        """endTime свободного видимого слота или None."""
+        for day in self.schedule_days(doctor_id):
+            for block in day['scheduleBySlot']:
+                for slot in block['slot']:
+                    if slot['startTime'][:16] == (start_iso or '')[:16]:
+                        return slot['endTime']
+        return None
+
+    # ----------------------------- Записи -----------------------------
+    def _appointment(self, oms: str, doctor: Dict[str, Any], start_iso: str, end_iso: str) -> Dict[str, Any]:
+        appointment_id = next(self._ids)
+        return {
+            'id': appointment_id,
+            'appointmentId': appointment_id,
+            'type': 'RECEPTION',
+            'availableResourceId': doctor['id'],
+            'complexResourceId': doctor['complexResource'][0]['id'],
+            'startTime': start_iso,
+            'endTime': end_iso,
+            'enableShift': True,
+            'toDoctor': {'specialityId': doctor['arSpecialityId'], 'specialityName': doctor['arSpecialityName'],
+                         'doctorName': doctor['name']},
+            'lpuId': doctor['lpuId'],
+            'nameLpu': doctor['lpuShortName'],
+            'lpuAddress': doctor['complexResource'][0]['room']['defaultAddress'],
+            'addressPointId': doctor['complexResource'][0]['room']['addressPointId'],
+        }
+
+    def create(self, oms: str, doctor_id: int, start_iso: str) -> Dict[str, Any]:
+        with self._lock:
+            end_iso = self.slot_available(doctor_id, start_iso)
+            if end_iso is None:
+                raise MockError(400, 'SLOT_BUSY', 'Выбранное время уже занято. Выберите другое время')
+            doctor = self.by_id[doctor_id]
+            appt = self._appointment(oms, doctor, start_iso, end_iso)
+            self.appointments.setdefault(oms, []).append(appt)
+            self.booked[(doctor_id, start_iso)] = oms
+            return appt
+
+    def shift(self, oms: str, appointment_id: int, doctor_id: int, start_iso: str) -> Dict[str, Any]:
+        with self._lock:
+            current = next((a for a in self.appointments.get(oms, []) if a['id'] == appointment_id), None)
+            if current is None:
+                raise MockError(400, 'APPOINTMENT_NOT_FOUND', 'Запись не найдена')
+            end_iso = self.slot_available(doctor_id, start_iso)
+            if end_iso is None:
+                raise MockError(400, 'SLOT_BUSY', 'Выбранное время уже занято. Выберите другое время')
+            self.appointments[oms].remove(current)
+            self.booked.pop((current['availableResourceId'], current['startTime']), None)
+            appt = self._appointment(oms, self.by_id[doctor_id], start_iso, end_iso)
+            self.appointments[oms].append(appt)
+            self.booked[(doctor_id, start_iso)] = oms
+            return appt
+
+
+class MockError(Exception):
+    def __init__(self, status: int, code: str, description: str):
+        super().__init__(description)
+        self.status = status
+        self.code = code
+        self.description = description
+
+
+def create_app(state: MockEmias) -> Flask:
+    app = Flask(__name__)
+
+    def _doctor(body: Dict[str, Any]) -> Dict[str, Any]:
+        doctor = state.by_id.get(_int(body.get('availableResourceId')))
+        if doctor is None:
+            raise MockError(400, 'RESOURCE_NOT_FOUND', 'Ресурс не найден')
+        return doctor
+
+    def _lpu_blocks(doctors: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        blocks: Dict[int, Dict[str, Any]] = {}
+        for doctor in doctors:
+            block = blocks.setdefault(doctor['lpuId'], {
+                'lpuId': doctor['lpuId'],
+                'lpuShortName': doctor['lpuShortName'],
+                'defaultAddress': doctor['complexResource'][0]['room']['defaultAddress'],
+                'availableResources': [],
+            })
+            block['availableResources'].append(doctor)
+        return list(blocks.values())
+
+    def get_schedule(body):
+        doctor = _doctor(body)
+        return {'payload': {
+            'availableResource': {k: doctor[k] for k in ('id', 'name', 'arSpecialityId', 'arSpecialityName')},
+            'scheduleOfDay': state.schedule_days(doctor['id']),
+        }}
+
+    def get_doctors(body):
+        codes = {str(c) for c in body.get('specialityId') or [] if c}
+        lpu_id = _int(body.get('lpuId'))
+        doctors = [d for d in state.doctors
+                   if (not codes or str(d['arSpecialityId']) in codes) and (not lpu_id or d['lpuId'] == lpu_id)]
+        return {'payload': {'doctorsInfo': _lpu_blocks(doctors), 'notAvailableDoctors': []}}
+
+    def get_doctors_li(body):
+        return {'payload': {'doctorsInfo': _lpu_blocks(state.doctors)}}
+
+    def get_receptions(body):
+        return {'payload': {'appointment': list(state.appointments.get(str(body.get('omsNumber')), []))}}
+
+    def create_appointment(body):
+        appt = state.create(str(body.get('omsNumber')), _doctor(body)['id'], body.get('startTime'))
+        return {'payload': {'appointmentId': appt['id']}}
+
+    def shift_appointment(body):
+        appt = state.shift(str(body.get('omsNumber')), _int(body.get('appointmentId')), _doctor(body)['id'],
+                           body.get('startTime'))
+        return {'payload': {'appointmentId': appt['id']}}
+
+    def get_referrals(body):
+        today = datetime.now(MSK).date()
+        referrals = [{
+            'id': 700000 + i, 'referralId': 700000 + i,
+            'type': 'REF_TO_LDP' if code.startswith('6000') else 'REF_TO_DOCTOR',
+            'speciality': {'code': code, 'name': name},
+            'startTime': today.isoformat(), 'endTime': (today + timedelta(days=30)).isoformat(),
+        } for i, (code, name) in enumerate(SPECIALITIES)]
+        return {'payload': {'arInfo': {'assignments': {'items': []}, 'referrals': {'items': referrals}}}}
+
+    def get_lpus(body):
+        return {'payload': {'lpu': [{'id': lpu_id, 'shortName': name, 'address': [{'addressString': address}]}
+                                    for lpu_id, name, address in LPUS]}}
+
+    def get_specialities(body):
+        return {'payload': [{'code': code, 'name': name} for code, name in SPECIALITIES]}
+
+    def refresh_tokens(body):
+        refresh_token = str(body.get('refreshToken') or '')
+        if not refresh_token or refresh_token.startswith('invalid'):
+            raise MockError(400, 'invalid_grant', 'refresh token is invalid')
+        return {'access_token': f"mock-{uuid.uuid4().hex}", 'refresh_token': f"mock-r-{uuid.uuid4().hex}",
+                'expires_in': 3600}
+
+    def who_am_i(body):
+        return {'payload': {'omsNumber': '0000000000000000', 'name': 'Тестовый пациент'}}
+
+    handlers = {
+        'getAvailableResourceScheduleInfo': get_schedule,
+        'getDoctorsInfo': get_doctors,
+        'getDoctorsInfoForLI': get_doctors_li,
+        'getAppointmentReceptionsByPatient': get_receptions,
+        'createAppointment': create_appointment,
+        'shiftAppointment': shift_appointment,
+        'getAssignmentsReferralsInfo': get_referrals,
+        'getLpusForSpeciality': get_lpus,
+        'getSpecialitiesInfo': get_specialities,
+        'refreshTokens': refresh_tokens,
+        'whoAmI': who_am_i,
+    }
+
+    @app.route('/mock/stats', methods=['GET'])
+    def mock_stats():
+        with state._lock:
+            calls = dict(state.calls)
+        return jsonify({'calls': calls, 'total': sum(v for k, v in calls.items() if ':' not in k),
+                        'settings': state.settings.as_dict(),
+                        'appointments': sum(len(v) for v in state.appointments.values())})
+
+    @app.route('/mock/config', methods=['POST'])
+    def mock_config():
+        for key, value in (request.get_json(silent=True) or {}).items():
+            if key == 'latency_ms':
+                state.settings.latency_ms = parse_latency(value)
+            elif hasattr(state.settings, key) and key != 'seed':
+                setattr(state.settings, key, float(value))
+        return jsonify(state.settings.as_dict())
+
+    @app.route('/mock/reset', methods=['POST'])
+    def mock_reset():
+        state.reset()
+        return jsonify({'ok': True})
+
+    @app.route('/<path:path>', methods=['POST'])
+    def emias_endpoint(path):
+        endpoint = path.rstrip('/').rsplit('/', 1)[-1]
+        handler = handlers.get(endpoint)
+        if handler is None:
+            return jsonify({'error': {'code': 'NOT_FOUND', 'description': f'Неизвестный метод {endpoint}'}}), 404
+        settings = state.settings
+        lo, hi = settings.latency_ms
+        if hi > 0:
+            time_mod.sleep(random.uniform(lo, hi) / 1000)
+        status = 200
+        if random.random() < settings.error_rate:
+            status, result = 500, {'error': {'code': 'INTERNAL', 'description': 'Внутренняя ошибка сервиса'}}
+        elif endpoint != 'refreshTokens' and (not request.headers.get('ei-token')
+                                             or random.random() < settings.unauthorized_rate):
+            status, result = 401, {'error': {'code': 'invalid_token', 'description': 'invalid token'}}
+        else:
+            try:
+                result = handler(request.get_json(silent=True) or {})
+            except MockError as e:
+                status = e.status
+                # refreshTokens отвечает ошибкой OAuth ({"error": "invalid_grant"}), остальные — {"error": {...}}
+                result = {'error': e.code} if endpoint == 'refreshTokens' else {'error': {'code': e.code, 'description': e.description}}
+        with state._lock:
+            state.calls[endpoint] += 1
+            state.calls[f"{endpoint}:{status}"] += 1
+        return jsonify(result), status
+
+    return app
+
+
+def _int(value: Any) -> Optional[int]:
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8085)
+    parser.add_argument('--doctors', type=int, default=50)
+    parser.add_argument('--latency-ms', default='0', help='задержка ответа, мс: "50" или диапазон "20-150"')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов 500')
+    parser.add_argument('--unauthorized-rate', type=float, default=0.0, help='доля ответов 401')
+    parser.add_argument('--density', type=float, default=0.15, help='доля видимых слотов расписания')
+    parser.add_argument('--churn-sec', type=float, default=60.0, help='период смены набора видимых слотов, с')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    settings = MockSettings(parse_latency(args.latency_ms), args.error_rate, args.unauthorized_rate,
+                            args.density, args.churn_sec, args.seed)
+    state = MockEmias(args.doctors, settings)
+    print(f"mock_emias: {len(state.doctors)} doctors, settings={settings.as_dict()}")
+    print(f"mock_emias: EMIAS_API_BASE_URL=http://{args.host}:{args.port}/api-eip/")
+    create_app(state).run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,313 @@
+"""
+Снимок данных цикла поллера (check_schedule_updates) и отложенные записи цикла.
+
+Раньше цикл ходил в БД по ходу обработки треков: DoctorSchedule каждого врача — отдельным запросом,
+_freeze_rules_if_needed / _cleanup_outdated_rules — commit на трек, синхронизация UserDoctorLink —
+запрос на каждую запись пользователя и commit, автозапись — commit после каждой попытки.
+
+Теперь в начале цикла PollSnapshot.load читает треки, врачей, расписания, связи пользователей
+и специальности (цель обращения и reception_type_id для автозаписи) несколькими IN-запросами
+в неизменяемый снимок (frozen dataclass, не ORM-объекты: они не привязаны к сессии, и сессия
+закрывается сразу после загрузки). Всё, что цикл меняет, копится в PollWrites и пишется в конце
+одной задачей db_writer с одним commit:
+  * правила треков после заморозки/очистки — UPDATE только изменённых колонок с условием на старое
+    значение (WHERE id = :id AND col = :old из снимка): если за время цикла трек поменяли в другом
+    месте (пользователь выключил автозапись, веб-панель поменяла правила), его значение не затирается;
+  * UserDoctorLink — только реально изменившиеся строки (UPDATE по id) и новые (INSERT пачкой);
+  * baseline расписаний — database.save_doctor_schedules;
+  * история слотов (slot_events) и удаление треков без врача.
+Изменения треков видны до записи: PollWrites.track_value накладывает их на снимок, поэтому
+отключённая в этом цикле автозапись соседнего трека группы уже не сработает. Отключение автозаписи
+и группы stop_after_first после успешной записи не ждёт конца цикла: вызывающий сразу пишет его
+через pending_track_rows + write_track_rows (с тем же условием на старое значение), чтобы при сбое
+итоговой записи следующий цикл не записал пользователя повторно.
+"""
+import json
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+from sqlalchemy import JSON, Text, bindparam, cast, insert, or_, update
+
+from database import (
+    DoctorInfo, DoctorSchedule, Specialty, UserDoctorLink, UserTrackedDoctor, save_doctor_schedules,
+)
+from slot_codec import SlotTable
+
+_IN_CHUNK = 500  # не больше стольких значений в одном IN (...) — лимит параметров SQLite
+
+
+@dataclass(frozen=True)
+class TrackView:
+    id: int
+    telegram_user_id: int
+    doctor_api_id: str
+    tracking_rules: Any
+    active: bool
+    auto_booking: bool
+    bulk_batch_id: Optional[str]
+    stop_after_first: bool
+
+
+@dataclass(frozen=True)
+class DoctorView:
+    doctor_api_id: str
+    name: Optional[str]
+    complex_resource_id: Optional[str]
+    ar_speciality_id: Optional[str]
+    ar_speciality_name: Optional[str]
+
+
+@dataclass(frozen=True)
+class ScheduleView:
+    """Последний сохранённый снапшот расписания врача (колонки DoctorSchedule)."""
+    fingerprint: Optional[str]
+    slots_blob: Optional[bytes]
+    schedule_text: Optional[str]
+
+    def slot_table(self) -> SlotTable:
+        # Как DoctorSchedule.slot_table: для записей до появления slots_blob — из JSON
+        if self.slots_blob:
+            return SlotTable.decode(self.slots_blob)
+        return SlotTable.from_schedule_days(json.loads(self.schedule_text or '[]'))
+
+
+@dataclass(frozen=True)
+class LinkView:
+    id: int
+    doctor_speciality: str
+    appointment_id: Optional[str]
+    referral_id: Optional[str]
+
+
+def _chunks(values) -> List[list]:
+    values = list(values)
+    return [values[i:i + _IN_CHUNK] for i in range(0, len(values), _IN_CHUNK)]
+
+
+def _unchanged(column, old: Any):
+    """Условие «в БД всё ещё old» для колонки трека (параметр :b_old)."""
+    if isinstance(column.type, JSON):
+        # У JSON нет оператора = (PostgreSQL) — сравниваем сериализованный текст
+        if old is None:
+            return or_(column.is_(None), cast(column, Text) == 'null')
+        return cast(column, Text) == cast(bindparam('b_old', type_=column.type), Text)
+    return column.is_not_distinct_from(bindparam('b_old', type_=column.type))
+
+
+def write_track_rows(session, rows: Dict[str, List[Dict[str, Any]]]) -> int:
+    """Пишет изменения треков из PollWrites.pending_track_rows: по каждой колонке
+    UPDATE ... SET col = :b_new WHERE id = :b_id AND col = :b_old (executemany).
+    Строки, изменённые с момента снимка, не трогаются. Возвращает число строк в запросах."""
+    table = UserTrackedDoctor.__table__
+    count = 0
+    for name, column_rows in rows.items():
+        column = table.c[name]
+        # Для JSON с old=None условие без параметра — такие строки отдельным запросом
+        groups = [column_rows]
+        if isinstance(column.type, JSON):
+            groups = [[r for r in column_rows if r['b_old'] is None], [r for r in column_rows if r['b_old'] is not None]]
+        for group in groups:
+            if not group:
+                continue
+            stmt = (
+                update(table)
+                .where(table.c.id == bindparam('b_id'), _unchanged(column, group[0]['b_old']))
+                .values({name: bindparam('b_new', type_=column.type)})
+            )
+            # Core executemany (ORM bulk UPDATE по первичному ключу не допускает своего WHERE)
+            session.connection().execute(stmt, group)
+            count += len(group)
+    return count
+
+
+@dataclass(frozen=True)
+class PollSnapshot:
+    tracks: Tuple[TrackView, ...]
+    doctors: Mapping[str, DoctorView]
+    schedules: Mapping[str, ScheduleView]
+    links: Mapping[int, Tuple[LinkView, ...]]  # telegram_user_id -> связи пользователя (по id)
+    inquiry_purpose_ids: Mapping[str, Any]  # код специальности -> ar_inquiry_purpose_id ("" если NULL)
+    reception_type_ids: Mapping[str, int]  # код специальности -> reception_type_id (только заданные)
+
+    @classmethod
+    def load(cls, session) -> 'PollSnapshot':
+        """Читает данные цикла: треки одним запросом, остальное — IN-запросами по их ключам."""
+        tracks = tuple(
+            TrackView(*row) for row in session.query(
+                UserTrackedDoctor.id, UserTrackedDoctor.telegram_user_id, UserTrackedDoctor.doctor_api_id,
+                UserTrackedDoctor.tracking_rules, UserTrackedDoctor.active, UserTrackedDoctor.auto_booking,
+                UserTrackedDoctor.bulk_batch_id, UserTrackedDoctor.stop_after_first,
+            ).order_by(UserTrackedDoctor.id).all()
+        )
+        doctor_ids = {t.doctor_api_id for t in tracks}
+        user_ids = {t.telegram_user_id for t in tracks}
+
+        doctors = {}
+        schedules = {}
+        for chunk in _chunks(doctor_ids):
+            for row in session.query(
+                DoctorInfo.doctor_api_id, DoctorInfo.name, DoctorInfo.complex_resource_id,
+                DoctorInfo.ar_speciality_id, DoctorInfo.ar_speciality_name,
+            ).filter(DoctorInfo.doctor_api_id.in_(chunk)):
+                doctors[row[0]] = DoctorView(*row)
+            for row in session.query(
+                DoctorSchedule.doctor_api_id, DoctorSchedule.fingerprint, DoctorSchedule.slots_blob,
+                DoctorSchedule.schedule_text,
+            ).filter(DoctorSchedule.doctor_api_id.in_(chunk)):
+                schedules[row[0]] = ScheduleView(*row[1:])
+
+        links: Dict[int, List[LinkView]] = {}
+        for chunk in _chunks(user_ids):
+            for row in session.query(
+                UserDoctorLink.telegram_user_id, UserDoctorLink.id, UserDoctorLink.doctor_speciality,
+                UserDoctorLink.appointment_id, UserDoctorLink.referral_id,
+            ).filter(UserDoctorLink.telegram_user_id.in_(chunk)).order_by(UserDoctorLink.id):
+                links.setdefault(row[0], []).append(LinkView(*row[1:]))
+
+        inquiry_purpose_ids = {}
+        reception_type_ids = {}
+        for chunk in _chunks({d.ar_speciality_id for d in doctors.values() if d.ar_speciality_id}):
+            for code, purpose_id, reception_type_id in session.query(
+                Specialty.code, Specialty.ar_inquiry_purpose_id, Specialty.reception_type_id,
+            ).filter(Specialty.code.in_(chunk)):
+                inquiry_purpose_ids[code] = purpose_id if purpose_id is not None else ""
+                try:
+                    if reception_type_id not in (None, "", 0):
+                        reception_type_ids[code] = int(reception_type_id)
+                except (TypeError, ValueError):
+                    pass
+
+        return cls(
+            tracks=tracks,
+            doctors=MappingProxyType(doctors),
+            schedules=MappingProxyType(schedules),
+            links=MappingProxyType({uid: tuple(rows) for uid, rows in links.items()}),
+            inquiry_purpose_ids=MappingProxyType(inquiry_purpose_ids),
+            reception_type_ids=MappingProxyType(reception_type_ids),
+        )
+
+    def inquiry_purpose_id(self, doctor: DoctorView) -> Any:
+        """ar_inquiry_purpose_id специальности врача, "" если её нет (как resolve_inquiry_purpose_codes)."""
+        return self.inquiry_purpose_ids.get(doctor.ar_speciality_id, "") if doctor.ar_speciality_id else ""
+
+    def reception_type_id(self, doctor: DoctorView) -> Optional[int]:
+        """reception_type_id специальности врача; None — не задан (его определит bot._book_appointment_once)."""
+        return self.reception_type_ids.get(doctor.ar_speciality_id) if doctor.ar_speciality_id else None
+
+
+class PollWrites:
+    """Записи одного цикла поллера; flush(session, pending_track_rows()) пишет их в конце цикла (через db_writer)."""
+
+    def __init__(self, snapshot: PollSnapshot, slot_events=None):
+        self.snapshot = snapshot
+        self.slot_events = slot_events  # slot_events.SlotEventRecorder цикла
+        self._track_updates: Dict[int, Dict[str, Any]] = {}
+        self._track_written: Dict[int, Dict[str, Any]] = {}  # уже записанные значения (mark_track_rows_written)
+        self._tracks_by_id = {t.id: t for t in snapshot.tracks}
+        self._deleted_tracks: List[int] = []
+        self._link_updates: Dict[int, Dict[str, Any]] = {}
+        self._link_inserts: List[Dict[str, Any]] = []
+        self._baselines: Dict[str, Tuple[list, SlotTable]] = {}
+
+    # --- Треки ---
+    def update_track(self, track_id: int, **values: Any) -> None:
+        self._track_updates.setdefault(track_id, {}).update(values)
+
+    def track_value(self, track: TrackView, name: str) -> Any:
+        """Значение поля трека с учётом изменений, сделанных в этом цикле."""
+        return self._track_updates.get(track.id, {}).get(name, getattr(track, name))
+
+    def delete_track(self, track_id: int) -> None:
+        self._deleted_tracks.append(track_id)
+
+    def pending_track_rows(self, track_ids=None) -> Dict[str, List[Dict[str, Any]]]:
+        """Ещё не записанные изменения треков (всех или track_ids) для write_track_rows:
+        колонка -> [{'b_id', 'b_old', 'b_new'}], b_old — значение в БД по данным цикла (снимок или
+        прошлая запись). Вызывать из цикла событий, не из потока писателя."""
+        deleted = set(self._deleted_tracks)
+        rows: Dict[str, List[Dict[str, Any]]] = {}
+        for tid in (self._track_updates if track_ids is None else track_ids):
+            if tid in deleted or tid not in self._track_updates:
+                continue
+            written = self._track_written.get(tid, {})
+            for name, value in self._track_updates[tid].items():
+                old = written.get(name, getattr(self._tracks_by_id[tid], name))
+                if value != old:
+                    rows.setdefault(name, []).append({'b_id': tid, 'b_old': old, 'b_new': value})
+        return rows
+
+    def mark_track_rows_written(self, rows: Dict[str, List[Dict[str, Any]]]) -> None:
+        """После успешной write_track_rows: итоговый flush эти значения уже не пишет."""
+        for name, column_rows in rows.items():
+            for row in column_rows:
+                self._track_written.setdefault(row['b_id'], {})[name] = row['b_new']
+
+    # --- UserDoctorLink ---
+    def sync_links(self, user_id: int, appointments) -> None:
+        """Приводит связи пользователя в соответствие с его записями (как bot._sync_user_doctor_links),
+        но запоминает только отличающиеся от снимка строки."""
+        if appointments is None:
+            return
+        existing = self.snapshot.links.get(user_id, ())
+        by_spec: Dict[str, LinkView] = {}
+        for link in existing:
+            by_spec.setdefault(link.doctor_speciality, link)
+        current_specs = set()
+        wanted: Dict[str, Any] = {}
+        for appt in appointments:
+            if appt.speciality_id:
+                current_specs.add(appt.speciality_id)
+            if appt.id and appt.speciality_id:
+                wanted[str(appt.speciality_id)] = appt
+        for spec, appt in wanted.items():
+            link = by_spec.get(spec)
+            if link is None:
+                self._link_inserts.append({
+                    'telegram_user_id': user_id,
+                    'doctor_speciality': spec,
+                    'appointment_id': str(appt.id),
+                    'referral_id': appt.referral_id,
+                })
+                continue
+            values = {'appointment_id': str(appt.id), 'referral_id': appt.referral_id or link.referral_id}
+            if (values['appointment_id'], values['referral_id']) != (link.appointment_id, link.referral_id):
+                self._link_updates[link.id] = values
+        # Очищаем appointment_id для специальностей без активных записей
+        for link in existing:
+            if link.doctor_speciality not in current_specs and link.appointment_id is not None:
+                self._link_updates[link.id] = {'appointment_id': None, 'referral_id': link.referral_id}
+
+    # --- Расписания ---
+    def save_baseline(self, doctor_api_id: str, schedule_days: list, table: SlotTable) -> None:
+        self._baselines[str(doctor_api_id)] = (schedule_days, table)
+
+    def flush(self, session, track_rows: Dict[str, List[Dict[str, Any]]]) -> Dict[str, int]:
+        """Пишет всё накопленное в session (commit — за db_writer). Возвращает число строк по видам.
+        track_rows — pending_track_rows(), взятые в цикле событий до постановки в очередь: при повторе
+        задачи писателем ("database is locked") они те же. Вызывается в конце цикла."""
+        deleted = set(self._deleted_tracks)
+        track_count = write_track_rows(session, track_rows)
+        link_rows = [{'id': lid, **values} for lid, values in self._link_updates.items()]
+        if link_rows:
+            session.execute(update(UserDoctorLink), link_rows)
+        if self._link_inserts:
+            session.execute(insert(UserDoctorLink), self._link_inserts)
+        known = {
+            doctor_api_id: (view.fingerprint, bool(view.slots_blob))
+            for doctor_api_id, view in self.snapshot.schedules.items()
+        }
+        changed = save_doctor_schedules(
+            session, [(doctor_api_id, days, table) for doctor_api_id, (days, table) in self._baselines.items()], known
+        )
+        events = self.slot_events.flush(session, commit=False) if self.slot_events is not None else 0
+        for chunk in _chunks(deleted):
+            session.query(UserTrackedDoctor).filter(UserTrackedDoctor.id.in_(chunk)).delete(synchronize_session=False)
+        return {
+            'tracks': track_count,
+            'links': len(link_rows) + len(self._link_inserts),
+            'baselines': len(self._baselines),
+            'baselines_changed': changed,
+            'slot_events': events,
+            'deleted_tracks': len(deleted),
+        }
@@ -0,0 +1,251 @@
+"""
+Ограничение частоты запросов к ЕМИАС: token bucket на весь процесс, на пользователя и на эндпоинт,
+плюс планировщик с приоритетами и справедливой очередью между пользователями.
+
+Все исходящие запросы (http_client.post / http_client.throttle_async) перед отправкой ждут
+разрешения acquire(). Разрешение выдаётся, когда во всех трёх корзинах есть токен:
+  * глобальная — EMIAS_RATE_GLOBAL запросов/с (всплеск EMIAS_RATE_GLOBAL_BURST);
+  * пользователя — EMIAS_RATE_PER_USER запросов/с (всплеск EMIAS_RATE_PER_USER_BURST);
+  * эндпоинта — ENDPOINT_RATES / EMIAS_RATE_ENDPOINTS ("getDoctorsInfo=2,getLpusForSpeciality=1").
+Скорость 0 — корзина не ограничивает.
+
+Очередь ожидающих разбита по приоритетам: BOOKING (запись, перенос, отмена, обновление токена) →
+POLLING (расписания и записи пользователя для поллера) → REFERENCE (справочники, бэкфилл админки).
+Пока ждёт запрос более высокого приоритета, младшие не забирают глобальные токены, поэтому
+автозапись не стоит за массовыми заданиями. Внутри приоритета пользователи обслуживаются по кругу
+(у каждого своя FIFO-очередь), так что один пользователь с сотней запросов не задерживает остальных.
+Запрос, упёршийся только в корзину своего пользователя или эндпоинта, не блокирует чужие.
+
+Работает и из потоков (Flask, asyncio.to_thread), и из корутин бота — общая очередь под одним замком.
+"""
+import asyncio
+import threading
+import time as time_mod
+from collections import OrderedDict, deque
+from typing import Callable, Deque, Dict, List, Optional
+
+from config import (EMIAS_RATE_ENDPOINTS, EMIAS_RATE_GLOBAL, EMIAS_RATE_GLOBAL_BURST,
+                    EMIAS_RATE_PER_USER, EMIAS_RATE_PER_USER_BURST)
+import metrics
+
+BOOKING, POLLING, REFERENCE = 0, 1, 2
+PRIORITY_NAMES = {BOOKING: 'booking', POLLING: 'polling', REFERENCE: 'reference'}
+
+# Приоритет по эндпоинту (последний сегмент пути URL); остальные — REFERENCE
+ENDPOINT_PRIORITIES: Dict[str, int] = {
+    'createAppointment': BOOKING,
+    'shiftAppointment': BOOKING,
+    'cancelAppointment': BOOKING,
+    'refreshTokens': BOOKING,
+    'getAvailableResourceScheduleInfo': POLLING,
+    'getAppointmentReceptionsByPatient': POLLING,
+}
+
+# Запросов в секунду по эндпоинту (справочники, которые дёргает бэкфилл админки)
+ENDPOINT_RATES: Dict[str, float] = {
+    'getDoctorsInfo': 2,
+    'getDoctorsInfoForLI': 2,
+    'getLpusForSpeciality': 2,
+    'getSpecialitiesInfo': 2,
+}
+_MAX_IDLE_WAIT = 1.0  # ожидающий перепроверяет очередь не реже раза в секунду
+
+
+def _parse_rates(spec: str) -> Dict[str, float]:
+    result = {}
+    for item in (spec or '').split(','):
+        name, _, value = item.partition('=')
+        try:
+            result[name.strip()] = float(value)
+        except ValueError:
+            continue
+    return result
+
+
+ENDPOINT_RATES.update(_parse_rates(EMIAS_RATE_ENDPOINTS))
+
+
+class TokenBucket:
+    """Классическая корзина токенов: rate токенов в секунду, не больше burst."""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.capacity = max(float(burst), 1.0)
+        self.tokens = self.capacity
+        self.updated = time_mod.monotonic()
+
+    def _refill(self, now: float) -> None:
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Через сколько секунд появится токен (0 — уже есть)."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+
+class _Waiter:
+    __slots__ = ('user_id', 'endpoint', 'priority', 'granted', 'notify', 'enqueued_at')
+
+    def __init__(self, user_id: Optional[int], endpoint: str, priority: int, notify: Callable[[], None]):
+        self.user_id = user_id
+        self.endpoint = endpoint
+        self.priority = priority
+        self.granted = False
+        self.notify = notify
+        self.enqueued_at = time_mod.monotonic()
+
+
+class RateLimiter:
+    def __init__(self, global_rate: float = EMIAS_RATE_GLOBAL, global_burst: float = EMIAS_RATE_GLOBAL_BURST,
+                 user_rate: float = EMIAS_RATE_PER_USER, user_burst: float = EMIAS_RATE_PER_USER_BURST,
+                 endpoint_rates: Optional[Dict[str, float]] = None):
+        self._lock = threading.Lock()
+        self._global = TokenBucket(global_rate, global_burst) if global_rate > 0 else None
+        self._user_rate, self._user_burst = user_rate, user_burst
+        self._endpoint_rates = ENDPOINT_RATES if endpoint_rates is None else endpoint_rates
+        self._users: Dict[int, TokenBucket] = {}
+        self._endpoints: Dict[str, TokenBucket] = {}
+        # priority -> {user_id: deque[_Waiter]}; порядок ключей — очередь обхода по кругу
+        self._queues: List[Dict[Optional[int], Deque[_Waiter]]] = [OrderedDict() for _ in PRIORITY_NAMES]
+
+    def _user_bucket(self, user_id: Optional[int]) -> Optional[TokenBucket]:
+        if user_id is None or self._user_rate <= 0:
+            return None
+        bucket = self._users.get(user_id)
+        if bucket is None:
+            bucket = self._users[user_id] = TokenBucket(self._user_rate, self._user_burst)
+        return bucket
+
+    def _endpoint_bucket(self, endpoint: str) -> Optional[TokenBucket]:
+        rate = self._endpoint_rates.get(endpoint, 0)
+        if rate <= 0:
+            return None
+        bucket = self._endpoints.get(endpoint)
+        if bucket is None:
+            bucket = self._endpoints[endpoint] = TokenBucket(rate, max(rate * 2, 1))
+        return bucket
+
+    def _dispatch(self) -> float:
+        """Выдаёт разрешения, пока хватает токенов. Под self._lock. Возвращает, сколько ждать до следующей попытки."""
+        next_wait = _MAX_IDLE_WAIT
+        progress = True
+        while progress:
+            progress = False
+            now = time_mod.monotonic()
+            for queue in self._queues:
+                for user_id in list(queue):
+                    waiter = queue[user_id][0]
+                    global_wait = self._global.wait_time(now) if self._global else 0.0
+                    if global_wait > 0:
+                        # Глобальных токенов нет: младшие приоритеты их тоже не получат
+                        return min(next_wait, global_wait)
+                    user_bucket = self._user_bucket(user_id)
+                    endpoint_bucket = self._endpoint_bucket(waiter.endpoint)
+                    own_wait = max(user_bucket.wait_time(now) if user_bucket else 0.0,
+                                   endpoint_bucket.wait_time(now) if endpoint_bucket else 0.0)
+                    if own_wait > 0:
+                        next_wait = min(next_wait, own_wait)
+                        continue
+                    for bucket in (self._global, user_bucket, endpoint_bucket):
+                        if bucket is not None:
+                            bucket.take()
+                    pending = queue.pop(user_id)
+                    pending.popleft()
+                    if pending:
+                        queue[user_id] = pending  # пользователь уходит в конец круга
+                    waiter.granted = True
+                    waiter.notify()
+                    progress = True
+        return next_wait
+
+    def _enqueue(self, waiter: _Waiter) -> None:
+        queue = self._queues[waiter.priority]
+        pending = queue.get(waiter.user_id)
+        if pending is None:
+            pending = queue[waiter.user_id] = deque()
+        pending.append(waiter)
+
+    def _abandon(self, waiter: _Waiter) -> None:
+        """Убирает из очереди ожидающего, который перестал ждать (отмена корутины, исключение)."""
+        with self._lock:
+            if waiter.granted:
+                return
+            queue = self._queues[waiter.priority]
+            pending = queue.get(waiter.user_id)
+            if pending is not None and waiter in pending:
+                pending.remove(waiter)
+                if not pending:
+                    del queue[waiter.user_id]
+
+    def _granted(self, waiter: _Waiter) -> float:
+        waited = time_mod.monotonic() - waiter.enqueued_at
+        if waited > 0.001:
+            metrics.inc('emias_rate_limited_total')
+            metrics.inc(f'emias_rate_wait_seconds_{PRIORITY_NAMES[waiter.priority]}', round(waited, 3))
+        return waited
+
+    def acquire(self, user_id: Optional[int], endpoint: str, priority: Optional[int] = None) -> float:
+        """Блокирует поток до разрешения на запрос. Возвращает время ожидания в секундах."""
+        event = threading.Event()
+        waiter = _Waiter(user_id, endpoint, self.priority_for(endpoint, priority), event.set)
+        with self._lock:
+            self._enqueue(waiter)
+            wait = self._dispatch()
+        try:
+            while not waiter.granted:
+                event.wait(wait)
+                with self._lock:
+                    wait = self._dispatch()
+        finally:
+            self._abandon(waiter)
+        return self._granted(waiter)
+
+    async def acquire_async(self, user_id: Optional[int], endpoint: str, priority: Optional[int] = None) -> float:
+        """То же, что acquire, но ожидание не блокирует цикл событий."""
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        waiter = _Waiter(user_id, endpoint, self.priority_for(endpoint, priority),
+                         lambda: loop.call_soon_threadsafe(event.set))
+        with self._lock:
+            self._enqueue(waiter)
+            wait = self._dispatch()
+        try:
+            while not waiter.granted:
+                try:
+                    await asyncio.wait_for(event.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                with self._lock:
+                    wait = self._dispatch()
+        finally:
+            self._abandon(waiter)
+        return self._granted(waiter)
+
+    @staticmethod
+    def priority_for(endpoint: str, priority: Optional[int] = None) -> int:
+        if priority is not None:
+            return priority
+        return ENDPOINT_PRIORITIES.get(endpoint, REFERENCE)
+
+    def queue_depth(self) -> Dict[str, int]:
+        """Сколько запросов ждёт в каждом приоритете (для админки)."""
+        with self._lock:
+            return {PRIORITY_NAMES[p]: sum(len(d) for d in q.values()) for p, q in enumerate(self._queues)}
+
+
+limiter = RateLimiter()
+
+
+def acquire(user_id: Optional[int], endpoint: str, priority: Optional[int] = None) -> float:
+    return limiter.acquire(user_id, endpoint, priority)
+
+
+async def acquire_async(user_id: Optional[int], endpoint: str, priority: Optional[int] = None) -> float:
+    return await limiter.acquire_async(user_id, endpoint, priority)
@@ -0,0 +1,138 @@
+"""
+Read-through кэш справочных строк в памяти процесса: профили пользователей, врачи, специальности.
+
+Почти каждая функция emias_api открывала сессию БД только ради oms_number/birth_date профиля,
+а resolve_inquiry_purpose_codes делал ещё два запроса (DoctorInfo, Specialty). Теперь они берутся
+отсюда: первая выборка читает строку из БД, дальше — из памяти, и построение payload запроса
+не ходит в БД.
+
+Значения — снимки колонок (RefRow, атрибуты как у модели), а не ORM-объекты: они не привязаны
+к сессии и не протухают после её закрытия. Отсутствие строки тоже кэшируется.
+
+Инвалидация автоматическая — через события SQLAlchemy на всех сессиях процесса, поэтому её
+не нужно вызывать из каждого обработчика бота и админки:
+  * after_flush / after_commit — добавленные, изменённые и удалённые UserProfile/DoctorInfo/Specialty
+    (включая старое значение ключа, если его поменяли в админке);
+  * do_orm_execute — массовые query.update()/delete() по этим моделям сбрасывают весь их раздел.
+Записи другого процесса (бот и веб запущены раздельно) видны не позже чем через REF_CACHE_TTL секунд.
+"""
+import threading
+import time as time_mod
+from types import SimpleNamespace
+from typing import Any, Dict, Optional, Tuple
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from config import REF_CACHE_TTL
+from database import DoctorInfo, Specialty, UserProfile, get_db_session
+import metrics
+
+
+class RefRow(SimpleNamespace):
+    """Снимок колонок строки модели (profile.oms_number, doctor.ar_speciality_id, ...)."""
+
+
+# модель -> (раздел кэша, колонка-ключ)
+_KEYS = {
+    UserProfile: ('profile', 'telegram_user_id'),
+    DoctorInfo: ('doctor', 'doctor_api_id'),
+    Specialty: ('specialty', 'code'),
+}
+_MODELS = {kind: (model, column) for model, (kind, column) in _KEYS.items()}
+
+_lock = threading.Lock()
+_cache: Dict[Tuple[str, str], Tuple[float, Optional[RefRow]]] = {}
+
+
+def _snapshot(obj) -> RefRow:
+    return RefRow(**{attr.key: getattr(obj, attr.key) for attr in inspect(obj).mapper.column_attrs})
+
+
+def _get(kind: str, key: Any) -> Optional[RefRow]:
+    cache_key = (kind, str(key))
+    entry = _cache.get(cache_key)
+    if entry is not None and entry[0] > time_mod.monotonic():
+        metrics.inc('ref_cache_hits_total')
+        return entry[1]
+    metrics.inc('ref_cache_misses_total')
+    model, column = _MODELS[kind]
+    session = get_db_session()
+    try:
+        obj = session.query(model).filter(getattr(model, column) == cache_key[1]).first()
+        value = _snapshot(obj) if obj is not None else None
+    finally:
+        session.close()
+    with _lock:
+        _cache[cache_key] = (time_mod.monotonic() + REF_CACHE_TTL, value)
+    return value
+
+
+def get_profile(telegram_user_id: int) -> Optional[RefRow]:
+    """Профиль пользователя (oms_number, birth_date, is_admin, ...) или None."""
+    return _get('profile', telegram_user_id)
+
+
+def get_doctor(doctor_api_id: Any) -> Optional[RefRow]:
+    return _get('doctor', doctor_api_id)
+
+
+def get_specialty(code: Any) -> Optional[RefRow]:
+    return _get('specialty', code)
+
+
+def invalidate(kind: str, key: Any) -> None:
+    with _lock:
+        _cache.pop((kind, str(key)), None)
+
+
+def clear(kind: Optional[str] = None) -> None:
+    """Сбрасывает раздел кэша ('profile' | 'doctor' | 'specialty') или весь кэш."""
+    with _lock:
+        if kind is None:
+            _cache.clear()
+        else:
+            for cache_key in [k for k in _cache if k[0] == kind]:
+                del _cache[cache_key]
+
+
+# ----------------------------- Инвалидация -----------------------------
+def _changed_keys(obj):
+    kind, column = _KEYS[type(obj)]
+    state = inspect(obj)
+    # state.dict, а не getattr: внутри flush нельзя догружать истёкшие атрибуты
+    if column in state.dict:
+        yield kind, state.dict[column]
+    # Ключ изменён (например, в админке) — старое значение тоже больше не актуально
+    for old in state.attrs[column].history.deleted or ():
+        yield kind, old
+
+
+@event.listens_for(Session, 'after_flush')
+def _after_flush(session, flush_context):
+    pending = session.info.setdefault('ref_cache_keys', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if type(obj) in _KEYS:
+            for kind, key in _changed_keys(obj):
+                invalidate(kind, key)
+                pending.add((kind, str(key)))
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    # Повторно после коммита: между flush и commit параллельное чтение могло закэшировать старую строку
+    for kind, key in session.info.pop('ref_cache_keys', ()):
+        invalidate(kind, key)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('ref_cache_keys', None)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _on_bulk_write(orm_execute_state):
+    if orm_execute_state.is_update or orm_execute_state.is_delete:
+        mapper = orm_execute_state.bind_mapper
+        if mapper is not None and mapper.class_ in _KEYS:
+            clear(_KEYS[mapper.class_][0])
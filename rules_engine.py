@@ -0,0 +1,410 @@
+"""
+Движок правил отслеживания: нормализация и компиляция tracking_rules в быстрый матчер слотов.
+Независимый модуль без зависимостей от aiogram - единая реализация правил для бота, веб-приложения,
+service_shift и бенчмарков (bench/).
+
+Хранимая форма правил — канонический список dict (см. normalize_rules):
+  {"type": "weekday"|"date"|"any", "value": "<день недели>"|"YYYY-MM-DD"|"", "timeRanges": ["HH:MM-HH:MM", ...]}
+Нормализация выполняется при записи (бот, веб); старые строки ("понедельник 08:00-12:00") и
+относительные даты ("сегодня"/"завтра") приводятся к ней же при первой компиляции.
+
+Правила компилируются один раз в CompiledRules:
+  - битовая маска дней недели + интервалы по каждому дню недели;
+  - множество ординалов дат (date.toordinal()) + интервалы по каждой дате;
+  - интервалы правил без даты (type == 'any').
+Интервалы хранятся в минутах от начала суток, поэтому проверка слота — несколько сравнений int
+без strptime/lower()/fromisoformat. Результат кэшируется по хэшу JSON правил.
+"""
+import hashlib
+import json
+import re
+from datetime import datetime, date, time, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+MONTH_NAME_TO_NUM = {
+    'январь': 1, 'января': 1,
+    'февраль': 2, 'февраля': 2,
+    'март': 3, 'марта': 3,
+    'апрель': 4, 'апреля': 4,
+    'май': 5, 'мая': 5,
+    'июнь': 6, 'июня': 6,
+    'июль': 7, 'июля': 7,
+    'август': 8, 'августа': 8,
+    'сентябрь': 9, 'сентября': 9,
+    'октябрь': 10, 'октября': 10,
+    'ноябрь': 11, 'ноября': 11,
+    'декабрь': 12, 'декабря': 12,
+}
+
+WEEKDAY_NAME_TO_INDEX = {
+    'понедельник': 0,
+    'вторник': 1,
+    'среда': 2,
+    'четверг': 3,
+    'пятница': 4,
+    'суббота': 5,
+    'воскресенье': 6,
+}
+
+# Интервал «весь день» в минутах (правило без timeRanges)
+FULL_DAY: Tuple[Tuple[int, int], ...] = ((0, 24 * 60 - 1),)
+
+# Максимальное число скомпилированных наборов правил в кэше
+COMPILED_CACHE_SIZE = 4096
+
+
+def _parse_clock(value: str) -> time:
+    """HH:MM / H:MM / HH:MM:SS -> time (ValueError, если не распознано)."""
+    value = value.strip()
+    if re.match(r'^\d:\d{2}', value):
+        value = '0' + value
+    return time.fromisoformat(value)
+
+
+def parse_time_range(range_str: str) -> Optional[Tuple[time, time]]:
+    if not range_str:
+        return None
+    cleaned = re.sub(r'[–—]', '-', range_str.strip().replace('.', ':'))
+    parts = cleaned.split('-', maxsplit=1)
+    if len(parts) == 2:
+        try:
+            start = _parse_clock(parts[0])
+            end = _parse_clock(parts[1])
+            return start, end
+        except ValueError:
+            return None
+    # Try to parse as HH:MM:HH:MM
+    colon_parts = cleaned.split(':')
+    if len(colon_parts) == 4:
+        try:
+            start = time(int(colon_parts[0]), int(colon_parts[1]))
+            end = time(int(colon_parts[2]), int(colon_parts[3]))
+            return start, end
+        except (ValueError, IndexError):
+            pass
+    # Fallback to single time
+    try:
+        point = _parse_clock(cleaned)
+        return point, point
+    except ValueError:
+        return None
+
+
+def parse_date_rule(value: str, reference_year: int) -> Optional[date]:
+    if not value:
+        return None
+    v = value.strip().lower()
+    if v in ("сегодня",):
+        return datetime.now().date()
+    if v in ("завтра",):
+        return datetime.now().date() + timedelta(days=1)
+
+    # ISO форматы
+    for fmt in ('%Y-%m-%d', '%d.%m.%Y'):
+        try:
+            return datetime.strptime(v, fmt).date()
+        except ValueError:
+            continue
+
+    # Форматы без года
+    if v.count('.') >= 1:
+        parts = [p for p in v.split('.') if p]
+        if len(parts) >= 2 and parts[0].isdigit() and parts[1].isdigit():
+            day = int(parts[0])
+            month = int(parts[1])
+            year = int(parts[2]) if len(parts) >= 3 and parts[2].isdigit() else reference_year
+            try:
+                return date(year, month, day)
+            except ValueError:
+                pass
+    tokens = v.replace('-', ' ').split()
+    if tokens and tokens[0].isdigit():
+        day = int(tokens[0])
+        month = MONTH_NAME_TO_NUM.get(tokens[1]) if len(tokens) >= 2 else None
+        year = None
+        if len(tokens) >= 3 and tokens[2].isdigit():
+            year = int(tokens[2])
+        if month:
+            try:
+                return date(year or reference_year, month, day)
+            except ValueError:
+                pass
+    return None
+
+
+def normalize_time_range(range_str: str) -> str:
+    """Приводит диапазон к виду HH:MM-HH:MM; нераспознанную строку возвращает как есть (без пробелов по краям)."""
+    parsed = parse_time_range(range_str) if range_str else None
+    if not parsed:
+        return (range_str or '').strip()
+    start, end = parsed
+    return f"{start.strftime('%H:%M')}-{end.strftime('%H:%M')}"
+
+
+def parse_rule_string(raw: str) -> Optional[Dict[str, Any]]:
+    """Преобразует старый строковый формат правила (например: 'завтра 11:20-19:00', 'понедельник 08:00-12:00'
+    или 'понедельник: 08:00-12:00') в dict {type,value,timeRanges}.
+    Поддерживаемые префиксы: дни недели, 'сегодня', 'завтра', ISO-дата YYYY-MM-DD, DD.MM.YYYY, DD.MM, 'DD месяц'.
+    Если префикс не распознан, считаем тип any (ограничение только по времени).
+    """
+    if not raw or not isinstance(raw, str):
+        return None
+    s = raw.strip()
+    if not s:
+        return None
+    # Найти диапазон времени через дефис
+    time_match = re.search(r'(\d{1,2}[:.]\d{2})\s?[-–—]\s?(\d{1,2}[:.]\d{2})', s)
+    time_ranges: List[str] = []
+    if time_match:
+        tr = f"{time_match.group(1).replace('.',':')}-{time_match.group(2).replace('.',':')}"
+        time_ranges.append(tr)
+        prefix_part = s[:time_match.start()].strip()
+    else:
+        prefix_part = s
+    prefix_lower = prefix_part.rstrip(':').strip().lower()
+    rule_type = 'any'
+    value = ''
+    if prefix_lower in WEEKDAY_NAME_TO_INDEX:
+        rule_type = 'weekday'
+        value = prefix_lower
+    elif prefix_lower in ('сегодня', 'завтра'):
+        rule_type = 'relative_date'
+        value = prefix_lower
+    elif prefix_lower:
+        target = parse_date_rule(prefix_lower, datetime.now().year)
+        if target:
+            rule_type = 'date'
+            value = target.strftime('%Y-%m-%d')
+    return {
+        'type': rule_type,
+        'value': value,
+        'timeRanges': time_ranges
+    }
+
+
+def normalize_rule(rule: Any, today: Optional[date] = None) -> Optional[Dict[str, Any]]:
+    """Приводит одно правило (dict или строку) к канонической форме.
+
+    'сегодня'/'завтра' фиксируются в ISO-дату относительно today, даты — в YYYY-MM-DD,
+    диапазоны — в HH:MM-HH:MM. Нераспознанные значения сохраняются как есть.
+    """
+    if isinstance(rule, str):
+        rule = parse_rule_string(rule)
+    if not isinstance(rule, dict):
+        return None
+    today = today or date.today()
+    rule_type = (rule.get('type') or '').strip().lower() or 'any'
+    value = (rule.get('value') or '').strip().lower()
+    time_ranges = [normalize_time_range(tr) for tr in (rule.get('timeRanges') or []) if isinstance(tr, str) and tr.strip()]
+    if rule_type in ('relative_date', 'date') and value in ('сегодня', 'завтра'):
+        target = today if value == 'сегодня' else today + timedelta(days=1)
+        rule_type, value = 'date', target.strftime('%Y-%m-%d')
+    elif rule_type == 'date':
+        target = parse_date_rule(value, today.year)
+        if target:
+            value = target.strftime('%Y-%m-%d')
+    elif rule_type == 'any':
+        value = ''
+    return {'type': rule_type, 'value': value, 'timeRanges': time_ranges}
+
+
+def normalize_rules(rules: Optional[List[Any]], today: Optional[date] = None) -> List[Dict[str, Any]]:
+    """Принимает список правил в любой хранимой форме (dict/str) и возвращает канонический список dict."""
+    if not rules:
+        return []
+    normalized: List[Dict[str, Any]] = []
+    for r in rules:
+        parsed = normalize_rule(r, today)
+        if parsed:
+            normalized.append(parsed)
+    return normalized
+
+
+def _minutes_to_hhmm(minute: int) -> str:
+    return f"{minute // 60:02d}:{minute % 60:02d}"
+
+
+def merge_rules(rules: Optional[List[Any]], today: Optional[date] = None) -> List[Dict[str, Any]]:
+    """Нормализует правила и объединяет правила с одинаковыми (type, value):
+    пересекающиеся/смежные интервалы сливаются, дубликаты удаляются.
+    Правило без интервалов (весь день) поглощает интервалы того же дня. Порядок — по первому появлению.
+    """
+    grouped: Dict[Tuple[str, str], Optional[List[str]]] = {}
+    for rule in normalize_rules(rules, today):
+        key = (rule['type'], rule['value'])
+        time_ranges = rule['timeRanges']
+        if key in grouped and grouped[key] is None:
+            continue
+        if not time_ranges:
+            grouped[key] = None  # весь день
+            continue
+        grouped.setdefault(key, []).extend(time_ranges)
+    merged: List[Dict[str, Any]] = []
+    for (rule_type, value), time_ranges in grouped.items():
+        if time_ranges is None:
+            merged.append({'type': rule_type, 'value': value, 'timeRanges': []})
+            continue
+        plain: List[Tuple[int, int]] = []
+        other: List[str] = []
+        for tr in time_ranges:
+            parsed = parse_time_range(tr)
+            if parsed and parsed[0] <= parsed[1]:
+                plain.append((parsed[0].hour * 60 + parsed[0].minute, parsed[1].hour * 60 + parsed[1].minute))
+            elif tr not in other:
+                other.append(tr)  # «через полночь» и нераспознанные оставляем как есть
+        ranges = [f"{_minutes_to_hhmm(lo)}-{_minutes_to_hhmm(hi)}" for lo, hi in _merge_intervals(plain)] + other
+        merged.append({'type': rule_type, 'value': value, 'timeRanges': ranges})
+    return merged
+
+
+def _time_ranges_to_minutes(ranges: Optional[List[str]]) -> List[Tuple[int, int]]:
+    """Переводит timeRanges в интервалы минут [start, end] включительно.
+
+    Пустой список — весь день. Интервал «через полночь» делится на два.
+    Нераспознанные диапазоны пропускаются (как в _time_matches_ranges).
+    """
+    if not ranges:
+        return list(FULL_DAY)
+    intervals: List[Tuple[int, int]] = []
+    for range_str in ranges:
+        parsed = parse_time_range(range_str)
+        if not parsed:
+            continue
+        start, end = parsed
+        # Слот сравнивается с точностью до минуты: секунды в начале сдвигают границу вверх
+        start_min = start.hour * 60 + start.minute + (1 if (start.second or start.microsecond) else 0)
+        end_min = end.hour * 60 + end.minute
+        if start <= end:
+            if start_min <= end_min:
+                intervals.append((start_min, end_min))
+        else:  # интервал «через полночь»
+            intervals.append((start_min, 24 * 60 - 1))
+            intervals.append((0, end_min))
+    return intervals
+
+
+def _merge_intervals(intervals: List[Tuple[int, int]]) -> Tuple[Tuple[int, int], ...]:
+    if not intervals:
+        return ()
+    intervals = sorted(intervals)
+    merged = [list(intervals[0])]
+    for lo, hi in intervals[1:]:
+        if lo <= merged[-1][1] + 1:
+            if hi > merged[-1][1]:
+                merged[-1][1] = hi
+        else:
+            merged.append([lo, hi])
+    return tuple((lo, hi) for lo, hi in merged)
+
+
+def _in_intervals(minute: int, intervals: Tuple[Tuple[int, int], ...]) -> bool:
+    for lo, hi in intervals:
+        if minute < lo:
+            return False
+        if minute <= hi:
+            return True
+    return False
+
+
+class CompiledRules:
+    """Скомпилированный набор правил отслеживания (см. compile_tracking_rules).
+
+    Принимает правила в любой хранимой форме; normalized — их каноническая форма.
+    """
+
+    __slots__ = ('normalized', 'match_all', 'weekday_mask', 'weekday_intervals', 'date_ordinals', 'date_intervals', 'any_intervals')
+
+    def __init__(self, rules: Optional[List[Any]], today: Optional[date] = None):
+        today = today or date.today()
+        self.normalized = normalize_rules(rules, today)
+        rules = self.normalized
+        # Пустой список правил — подходит любой слот
+        self.match_all = not rules
+        self.weekday_mask = 0
+        weekday: Dict[int, List[Tuple[int, int]]] = {}
+        dates: Dict[int, List[Tuple[int, int]]] = {}
+        any_intervals: List[Tuple[int, int]] = []
+
+        for rule in rules or []:
+            rule_type = (rule.get("type") or "").lower()
+            value = (rule.get("value") or "").strip().lower()
+            intervals = _time_ranges_to_minutes(rule.get("timeRanges") or [])
+            if not intervals:
+                continue
+            if rule_type == "weekday":
+                weekday_idx = WEEKDAY_NAME_TO_INDEX.get(value)
+                if weekday_idx is None:
+                    continue
+                weekday.setdefault(weekday_idx, []).extend(intervals)
+            elif rule_type == "date":
+                target_date = parse_date_rule(value, today.year)
+                if not target_date:
+                    continue
+                dates.setdefault(target_date.toordinal(), []).extend(intervals)
+            elif rule_type == "relative_date":
+                if value == "сегодня":
+                    target_date = today
+                elif value == "завтра":
+                    target_date = today + timedelta(days=1)
+                else:
+                    continue
+                dates.setdefault(target_date.toordinal(), []).extend(intervals)
+            elif rule_type == "any":
+                any_intervals.extend(intervals)
+
+        self.weekday_intervals: List[Tuple[Tuple[int, int], ...]] = [()] * 7
+        for idx, ivs in weekday.items():
+            self.weekday_mask |= 1 << idx
+            self.weekday_intervals[idx] = _merge_intervals(ivs)
+        self.date_intervals = {ordinal: _merge_intervals(ivs) for ordinal, ivs in dates.items()}
+        self.date_ordinals = frozenset(self.date_intervals)
+        self.any_intervals = _merge_intervals(any_intervals)
+
+    def matches(self, slot_dt: datetime) -> bool:
+        """Подходит ли слот (datetime, в том числе с tzinfo — берётся локальное время слота)."""
+        if self.match_all:
+            return True
+        minute = slot_dt.hour * 60 + slot_dt.minute
+        if self.any_intervals and _in_intervals(minute, self.any_intervals):
+            return True
+        weekday_idx = slot_dt.weekday()
+        if (self.weekday_mask >> weekday_idx) & 1 and _in_intervals(minute, self.weekday_intervals[weekday_idx]):
+            return True
+        if self.date_ordinals:
+            ordinal = slot_dt.toordinal()
+            if ordinal in self.date_ordinals and _in_intervals(minute, self.date_intervals[ordinal]):
+                return True
+        return False
+
+    def intervals_for_day(self, day: date) -> Tuple[Tuple[int, int], ...]:
+        """Объединённые интервалы (минуты, включительно), в которые правила разрешают слоты в этот день."""
+        if self.match_all:
+            return FULL_DAY
+        intervals = list(self.any_intervals) + list(self.weekday_intervals[day.weekday()])
+        intervals.extend(self.date_intervals.get(day.toordinal(), ()))
+        return _merge_intervals(intervals)
+
+
+_compiled_cache: Dict[Tuple[str, int], CompiledRules] = {}
+
+
+def rules_hash(rules: Optional[List[Any]]) -> str:
+    """Стабильный хэш правил (по JSON с сортировкой ключей)."""
+    payload = json.dumps(rules or [], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def compile_tracking_rules(rules: Optional[List[Any]]) -> CompiledRules:
+    """Возвращает скомпилированные правила из кэша (ключ — хэш JSON правил и текущая дата).
+
+    Дата входит в ключ, потому что 'сегодня'/'завтра' и год для дат без года считаются от неё.
+    """
+    today = date.today()
+    key = (rules_hash(rules), today.toordinal())
+    compiled = _compiled_cache.get(key)
+    if compiled is None:
+        if len(_compiled_cache) >= COMPILED_CACHE_SIZE:
+            _compiled_cache.clear()
+        compiled = CompiledRules(rules, today)
+        _compiled_cache[key] = compiled
+    return compiled
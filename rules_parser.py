@@ -1,10 +1,13 @@
 """
 Парсер правил отслеживания расписания врачей.
 Независимый модуль без зависимостей от aiogram - для использования в веб-приложении.
+Результат приводится к канонической форме rules_engine.normalize_rules (её же хранят бот и веб).
 """
 import re
 from datetime import datetime, timedelta
 
+from rules_engine import normalize_rules
+
 
 def normalize_time_range(tr):
     if not tr:
@@ -206,4 +209,4 @@ def parse_user_tracking_input(text: str):
                 # Приводим к ISO
                 rule['value'] = parsed.strftime('%Y-%m-%d')
 
-    return rules
\ No newline at end of file
+    return normalize_rules(rules)
\ No newline at end of file
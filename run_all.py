@@ -10,6 +10,39 @@ if not os.path.exists('config.py'):
         _f.write('import os\n')
         _f.write("TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')\n")
         _f.write("EMIAS_API_BASE_URL = os.environ.get('EMIAS_API_BASE_URL', 'https://emias.info/api-eip/')\n")
+        _f.write("POLL_CONCURRENCY = int(os.environ.get('POLL_CONCURRENCY', '8'))\n")
+        _f.write("RECEPTIONS_CACHE_TTL = float(os.environ.get('RECEPTIONS_CACHE_TTL', '45'))\n")
+        _f.write("SCHEDULE_KEEP_RAW_JSON = os.environ.get('SCHEDULE_KEEP_RAW_JSON', '0').lower() in ('1', 'true', 'yes')\n")
+        _f.write("SLOT_EVENTS_RETENTION_DAYS = int(os.environ.get('SLOT_EVENTS_RETENTION_DAYS', '90'))\n")
+        _f.write("TOKEN_REFRESH_LEAD_SEC = int(os.environ.get('TOKEN_REFRESH_LEAD_SEC', '300'))\n")
+        _f.write("TOKEN_REFRESH_JITTER_SEC = int(os.environ.get('TOKEN_REFRESH_JITTER_SEC', '120'))\n")
+        _f.write("EMIAS_HTTP_POOL_SIZE = int(os.environ.get('EMIAS_HTTP_POOL_SIZE', '16'))\n")
+        _f.write("EMIAS_HTTP_TIMEOUT = float(os.environ.get('EMIAS_HTTP_TIMEOUT', '10'))\n")
+        _f.write("EMIAS_HTTP_TIMEOUTS = os.environ.get('EMIAS_HTTP_TIMEOUTS', '')\n")
+        _f.write("EMIAS_HTTP2 = os.environ.get('EMIAS_HTTP2', '0').lower() in ('1', 'true', 'yes')\n")
+        _f.write("EMIAS_RATE_GLOBAL = float(os.environ.get('EMIAS_RATE_GLOBAL', '15'))\n")
+        _f.write("EMIAS_RATE_GLOBAL_BURST = float(os.environ.get('EMIAS_RATE_GLOBAL_BURST', '30'))\n")
+        _f.write("EMIAS_RATE_PER_USER = float(os.environ.get('EMIAS_RATE_PER_USER', '3'))\n")
+        _f.write("EMIAS_RATE_PER_USER_BURST = float(os.environ.get('EMIAS_RATE_PER_USER_BURST', '10'))\n")
+        _f.write("EMIAS_RATE_ENDPOINTS = os.environ.get('EMIAS_RATE_ENDPOINTS', '')\n")
+        _f.write("EMIAS_BREAKER_FAILURES = int(os.environ.get('EMIAS_BREAKER_FAILURES', '5'))\n")
+        _f.write("EMIAS_BREAKER_OPEN_SEC = float(os.environ.get('EMIAS_BREAKER_OPEN_SEC', '30'))\n")
+        _f.write("EMIAS_BREAKER_MAX_OPEN_SEC = float(os.environ.get('EMIAS_BREAKER_MAX_OPEN_SEC', '600'))\n")
+        _f.write("BOOKING_DEADLINE_SEC = float(os.environ.get('BOOKING_DEADLINE_SEC', '20'))\n")
+        _f.write("BOOKING_HEDGE_DEFAULT_SEC = float(os.environ.get('BOOKING_HEDGE_DEFAULT_SEC', '4'))\n")
+        _f.write("REF_CACHE_TTL = float(os.environ.get('REF_CACHE_TTL', '300'))\n")
+        _f.write("AUDIT_LOG_BATCH_SIZE = int(os.environ.get('AUDIT_LOG_BATCH_SIZE', '100'))\n")
+        _f.write("AUDIT_LOG_FLUSH_SEC = float(os.environ.get('AUDIT_LOG_FLUSH_SEC', '2'))\n")
+        _f.write("AUDIT_LOG_KEEP_ROWS = int(os.environ.get('AUDIT_LOG_KEEP_ROWS', '1500'))\n")
+        _f.write("AUDIT_LOG_TRIM_INTERVAL_SEC = int(os.environ.get('AUDIT_LOG_TRIM_INTERVAL_SEC', '600'))\n")
+        _f.write("SQLITE_WAL = os.environ.get('SQLITE_WAL', '1').lower() in ('1', 'true', 'yes')\n")
+        _f.write("SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', '5000'))\n")
+        _f.write("SQLITE_CACHE_SIZE_MB = float(os.environ.get('SQLITE_CACHE_SIZE_MB', '32'))\n")
+        _f.write("SQLITE_MMAP_SIZE_MB = float(os.environ.get('SQLITE_MMAP_SIZE_MB', '256'))\n")
+        _f.write("DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '10'))\n")
+        _f.write("DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', '20'))\n")
+        _f.write("DATABASE_URL = os.environ.get('DATABASE_URL', '')\n")
+        _f.write("DB_POOL_RECYCLE_SEC = int(os.environ.get('DB_POOL_RECYCLE_SEC', '1800'))\n")
 
 from bot import main as bot_main
 from web_app import app
@@ -31,11 +31,15 @@ from typing import List, Optional, Tuple, Dict, Any
 import time
 import requests
 
-from emias_api import refresh_emias_token, create_appointment
-from database import get_db_session, get_tokens, get_profile, ServiceShiftTask, log_user_action, Specialty, SERVICE_SPECIALITY_CODES
-from emias_api import get_assignments_referrals_info
-
-BASE_URL = "https://emias.info/api-eip/v3/saOrchestrator"
+from emias_api import api_url, refresh_emias_token, create_appointment
+from database import get_db_session, get_profile, ServiceShiftTask, log_user_action, Specialty, SERVICE_SPECIALITY_CODES
+from emias_client import EmiasClient
+from emias_models import Referral, Schedule, as_schedule
+from rules_engine import compile_tracking_rules
+import http_client
+import token_manager
+
+BASE_URL = api_url("v3/saOrchestrator")  # EMIAS_API_BASE_URL (мок-сервер — mock_emias.py)
 URL_GET_LI = f"{BASE_URL}/getDoctorsInfoForLI"
 URL_GET_SCHED = f"{BASE_URL}/getAvailableResourceScheduleInfo"
 URL_SHIFT = f"{BASE_URL}/shiftAppointment"
@@ -65,22 +69,19 @@ def _make_headers(token: str) -> Dict[str, str]:
     }
 
 
-def _api_post(url: str, headers: Dict[str, str], body: Dict[str, Any], timeout: int = 25) -> requests.Response:
-    return requests.post(url, headers=headers, json=body, timeout=timeout)
+def _api_post(url: str, headers: Dict[str, str], body: Dict[str, Any], timeout: Optional[float] = None,
+              user_id: Optional[int] = None) -> requests.Response:
+    return http_client.post(url, headers=headers, json=body, timeout=timeout, user_id=user_id)
 
 
 def _get_valid_token(user_id: int) -> Optional[str]:
-    sess = get_db_session()
-    try:
-        tokens = get_tokens(sess, user_id)
-        if not tokens:
-            return None
-        access, _, expires_at = tokens
-        if datetime.utcnow() >= expires_at:
-            return refresh_emias_token(user_id, source='system')
-        return access
-    finally:
-        sess.close()
+    tokens = token_manager.get_tokens(user_id)
+    if not tokens:
+        return None
+    access, _, expires_at = tokens
+    if not expires_at or datetime.utcnow() >= expires_at:
+        return refresh_emias_token(user_id, source='system')
+    return access
 
 
 def _fetch_li(user_id: int, token: str, appointment_id: int, profile) -> Dict[str, Any]:
@@ -97,7 +98,7 @@ def _fetch_li(user_id: int, token: str, appointment_id: int, profile) -> Dict[st
         },
         "appointmentId": str(appointment_id),
     }
-    r = _api_post(URL_GET_LI, _make_headers(token), body)
+    r = _api_post(URL_GET_LI, _make_headers(token), body, user_id=user_id)
     if r.status_code == 401:
         raise requests.HTTPError("401", response=r)
     r.raise_for_status()
@@ -129,7 +130,7 @@ def _fetch_sched(token: str, profile, appointment_id: int, ar_id: int, cr_id: in
         },
         "appointmentId": int(appointment_id),
     }
-    r = _api_post(URL_GET_SCHED, _make_headers(token), body)
+    r = _api_post(URL_GET_SCHED, _make_headers(token), body, user_id=profile.telegram_user_id)
     if r.status_code in (400,):  # бизнес-ошибка – трактуем как нет слотов
         return {}
     if r.status_code == 401:
@@ -149,22 +150,18 @@ def _slot_passes(tw: List[TimeWindow], fw: List[TimeWindow], start: datetime, en
     return True
 
 
-def _pick_earliest(schedule_payload: Dict[str, Any], allowed: List[TimeWindow], forbidden: List[TimeWindow]) -> Optional[Tuple[datetime, datetime]]:
+def _pick_earliest(schedule_payload, allowed: List[TimeWindow], forbidden: List[TimeWindow]) -> Optional[Tuple[datetime, datetime]]:
+    """Самый ранний подходящий слот payload или Schedule (даты уже разобраны в emias_models)."""
     if not schedule_payload:
         return None
     best = None
-    for day in schedule_payload.get("scheduleOfDay", []):
-        for blk in day.get("scheduleBySlot", []):
-            for s in blk.get("slot", []):
-                try:
-                    st = datetime.fromisoformat(s["startTime"])  # naive ISO ok (server local)
-                    en = datetime.fromisoformat(s["endTime"])
-                except Exception:
-                    continue
-                if not _slot_passes(allowed, forbidden, st, en):
-                    continue
-                if best is None or st < best[0]:
-                    best = (st, en)
+    for s in as_schedule(schedule_payload).iter_slots():
+        if s.start is None or s.end is None:
+            continue
+        if not _slot_passes(allowed, forbidden, s.start, s.end):
+            continue
+        if best is None or s.start < best[0]:
+            best = (s.start, s.end)
     return best
 
 def _time_in_allowed(st: datetime, en: datetime, allowed: List[TimeWindow], forbidden: List[TimeWindow]) -> bool:
@@ -221,12 +218,13 @@ def shift_service_appointment(
                     "endTime": en.isoformat(),
                     "appointmentId": int(appointment_id),
                 }
-                r = _api_post(URL_SHIFT, _make_headers(token), body)
+                r = _api_post(URL_SHIFT, _make_headers(token), body, user_id=user_id)
                 r.raise_for_status()
                 return {"status": "shifted", "cabinet": cab, "start": st.isoformat(), "end": en.isoformat(), "service": service_label}
         except requests.HTTPError as e:
             if e.response is not None and e.response.status_code == 401:
-                token = refresh_emias_token(user_id, source='system')
+                # Токен отклонён: принудительное обновление (параллельные вызовы ждут одно обновление)
+                token = refresh_emias_token(user_id, source='system', force=True)
                 if not token:
                     return {"status": "error", "error": "refresh_failed"}
                 continue
@@ -282,8 +280,8 @@ def process_service_shift_tasks(max_tasks: int = 10) -> int:
     tasks = sess.query(ServiceShiftTask).filter_by(active=True).order_by(ServiceShiftTask.id.asc()).limit(max_tasks).all()
     processed = 0
     now = datetime.utcnow()
-    # Предзагрузка направлений кэшом: user_id -> list(referrals)
-    referral_cache: dict[int, list[dict]] = {}
+    # Предзагрузка направлений кэшом: user_id -> list(Referral)
+    referral_cache: dict[int, List[Referral]] = {}
     for task in tasks:
         processed += 1
         try:
@@ -325,37 +323,26 @@ def process_service_shift_tasks(max_tasks: int = 10) -> int:
             if needs_ref and spec_code:
                 if task.telegram_user_id not in referral_cache:
                     try:
-                        raw_payload = get_assignments_referrals_info(task.telegram_user_id)  # уже payload из emias_api
-                        ar_info = (raw_payload or {}).get('arInfo', {})
-                        # Основной список направлений
-                        ref_items = ar_info.get('referrals', {}).get('items', []) or []
-                        referral_cache[task.telegram_user_id] = ref_items
+                        # Основной список направлений (arInfo.referrals.items), уже разобранный в Referral
+                        referral_cache[task.telegram_user_id] = EmiasClient(task.telegram_user_id).referrals_sync() or []
                     except Exception as _ref_e:
                         referral_cache[task.telegram_user_id] = []
                 refs = referral_cache[task.telegram_user_id]
                 has_ref = False
                 from database import SERVICE_SPECIALITY_CODES as _SVC_CODES
                 import datetime as _dt
-                today_iso = _dt.date.today().isoformat()
+                today = _dt.date.today()
                 for r in refs:
-                    try:
-                        r_type = r.get('type')
-                        st = r.get('startTime')
-                        en = r.get('endTime')
-                        if st and en and not (st <= today_iso <= en):
-                            continue
-                        # Для услуг (LDP) используем REF_TO_LDP как валидное направление независимо от ldpTypeId.
-                        if spec_code in _SVC_CODES and r_type == 'REF_TO_LDP':
-                            has_ref = True
-                            break
-                        # Для некоторых случаев может быть specialityId/Code внутри (REF_TO_DOCTOR / иное)
-                        spec_obj = r.get('speciality') or {}
-                        spec_id_any = spec_obj.get('code') or r.get('specialityId') or r.get('specialityCode')
-                        if spec_id_any and str(spec_id_any) == str(spec_code):
-                            has_ref = True
-                            break
-                    except Exception:
+                    if not r.valid_on(today):
                         continue
+                    # Для услуг (LDP) используем REF_TO_LDP как валидное направление независимо от ldpTypeId.
+                    if spec_code in _SVC_CODES and r.type == 'REF_TO_LDP':
+                        has_ref = True
+                        break
+                    # Для некоторых случаев может быть specialityId/Code внутри (REF_TO_DOCTOR / иное)
+                    if r.speciality_id and r.speciality_id == str(spec_code):
+                        has_ref = True
+                        break
                 if not has_ref:
                     task.last_status = 'need_referral'
                     task.last_result = f'Нет направления для {spec_code}'
@@ -369,6 +356,7 @@ def process_service_shift_tasks(max_tasks: int = 10) -> int:
                 task.last_run_at = now
                 continue
             best = None  # (ar, cr, cab, st, en, lpuName)
+            service_rules = compile_tracking_rules(task.service_rules) if task.service_rules else None
             for lpu in li.get('doctorsInfo', []):
                 lpu_name = lpu.get('lpuShortName','')
                 if task.lpu_substring.lower() not in lpu_name.lower():
@@ -379,60 +367,27 @@ def process_service_shift_tasks(max_tasks: int = 10) -> int:
                         cr_id = int(comp['id'])
                         sched = _fetch_sched(token, profile, appt_for_li, ar_id, cr_id)
                         # Перебираем все слоты в расписании вместо только earliest, применяем фильтры дат
-                        for day in sched.get('scheduleByDay', []):
-                            for block in day.get('scheduleBySlot', []):
-                                for s in block.get('slot', []):
-                                    st_iso = s.get('startTime') or s.get('start')
-                                    en_iso = s.get('endTime') or s.get('end')
-                                    if not st_iso or not en_iso:
-                                        continue
-                                    try:
-                                        st = datetime.fromisoformat(st_iso.replace('Z',''))
-                                        en = datetime.fromisoformat(en_iso.replace('Z',''))
-                                    except Exception:
-                                        continue
-                                    # week day filter
-                                    if task.week_days and st.weekday() not in task.week_days:
-                                        continue
-                                    # exact dates filter
-                                    if task.exact_dates and st.date().isoformat() not in task.exact_dates:
-                                        continue
-                                    # service_rules filtering (reuse subset of doctor logic): each rule is dict {type,value,timeRanges}
-                                    if task.service_rules:
-                                        def slot_matches_rules():
-                                            day_iso = st.date().isoformat()
-                                            wd_idx = st.weekday()
-                                            wd_map = ['понедельник','вторник','среда','четверг','пятница','суббота','воскресенье']
-                                            wd_ru = wd_map[wd_idx]
-                                            t_part = st.strftime('%H:%M')
-                                            for rule in task.service_rules:
-                                                try:
-                                                    r_type = rule.get('type')
-                                                    val = rule.get('value')
-                                                    trs = rule.get('timeRanges') or []
-                                                except AttributeError:
-                                                    continue
-                                                match_day = False
-                                                if r_type == 'weekday' and val == wd_ru:
-                                                    match_day = True
-                                                elif r_type == 'date' and val == day_iso:
-                                                    match_day = True
-                                                if match_day:
-                                                    if not trs:
-                                                        return True
-                                                    for tr in trs:
-                                                        if '-' in tr:
-                                                            rs,re = tr.split('-',1)
-                                                            if rs <= t_part < re:
-                                                                return True
-                                            return False
-                                        if not slot_matches_rules():
-                                            continue
-                                    if not _time_in_allowed(st, en, allowed, forbidden):
-                                        continue
-                                    if best is None or st < best[3]:
-                                        cab = comp.get('name') or comp.get('room', {}).get('number', '')
-                                        best = (ar_id, cr_id, cab, st, en, lpu_name)
+                        # (расписание LI — scheduleByDay; даты слотов разобраны один раз в Schedule)
+                        for s in Schedule(sched).iter_slots():
+                            if s.start is None or s.end is None:
+                                continue
+                            st, en = s.start, s.end
+                            if s.start_iso.endswith('Z'):  # как и раньше: 'Z' отбрасывается, время ЕМИАС — местное
+                                st, en = st.replace(tzinfo=None), en.replace(tzinfo=None)
+                            # week day filter
+                            if task.week_days and st.weekday() not in task.week_days:
+                                continue
+                            # exact dates filter
+                            if task.exact_dates and st.date().isoformat() not in task.exact_dates:
+                                continue
+                            # service_rules: тот же движок правил, что и у отслеживания врачей (компилируется один раз на задачу)
+                            if service_rules is not None and not service_rules.matches(st):
+                                continue
+                            if not _time_in_allowed(st, en, allowed, forbidden):
+                                continue
+                            if best is None or st < best[3]:
+                                cab = comp.get('name') or comp.get('room', {}).get('number', '')
+                                best = (ar_id, cr_id, cab, st, en, lpu_name)
             if not best:
                 task.last_status = 'no_slot'
                 task.last_run_at = now
@@ -451,20 +406,16 @@ def process_service_shift_tasks(max_tasks: int = 10) -> int:
                 if action == 'shift' and task.appointment_id:
                     from emias_api import shift_appointment
                     # Attempt to resolve reception_type_id from specialties table if possible
-                    from database import get_db_session, DoctorInfo, Specialty
-                    _sess = get_db_session()
+                    import ref_cache
                     rtid = 0
-                    try:
-                        doc = _sess.query(DoctorInfo).filter_by(doctor_api_id=str(ar_id)).first()
-                        if doc and doc.ar_speciality_id:
-                            spec = _sess.query(Specialty).filter_by(code=doc.ar_speciality_id).first()
-                            if spec and spec.reception_type_id not in (None, "", 0):
-                                try:
-                                    rtid = int(spec.reception_type_id)
-                                except Exception:
-                                    rtid = 0
-                    finally:
-                        _sess.close()
+                    doc = ref_cache.get_doctor(ar_id)
+                    if doc and doc.ar_speciality_id:
+                        spec = ref_cache.get_specialty(doc.ar_speciality_id)
+                        if spec and spec.reception_type_id not in (None, "", 0):
+                            try:
+                                rtid = int(spec.reception_type_id)
+                            except Exception:
+                                rtid = 0
                     resp = shift_appointment(task.telegram_user_id, ar_id, cr_id, st.isoformat(), en.isoformat(), int(task.appointment_id), rtid)
                     status_code = 'shifted'
                 elif action == 'create':
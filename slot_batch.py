@@ -0,0 +1,127 @@
+"""
+Пакетная проверка слотов одного расписания по правилам многих подписчиков.
+
+Расписание (emias_models.Schedule или payload getAvailableResourceScheduleInfo) раскладывается один раз
+в ScheduleSlots: массивы минуты суток, дня недели и ординала даты для каждого будущего слота. Правила каждого
+подписчика (rules_engine.CompiledRules) раскладываются в таблицу «подписчик × день × минута»,
+после чего совпадения всех подписчиков со всеми слотами получаются одной выборкой из таблицы.
+
+NumPy — необязательная зависимость: без неё используется тот же разбор расписания и
+CompiledRules.matches() в цикле (результат идентичен).
+"""
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from emias_models import Schedule, as_schedule
+from rules_engine import CompiledRules, compile_tracking_rules
+
+try:
+    import numpy as np
+except ImportError:  # NumPy не установлен — работаем на чистом Python
+    np = None
+
+SlotEntry = Tuple[str, str, str]  # (display "YYYY-MM-DD HH:MM", start_iso, end_iso)
+
+
+class ScheduleSlots:
+    """Будущие слоты расписания, отсортированные по времени (как в collect_matching_slots)."""
+
+    def __init__(self, schedule_payload: Union[Schedule, Dict[str, Any], None], now: Optional[datetime] = None):
+        # Даты слотов уже разобраны в Schedule (emias_models) — здесь только будущие слоты по порядку
+        future = as_schedule(schedule_payload).future_slots(now)
+        self.datetimes: List[datetime] = [s.start for s in future]
+        self.entries: List[SlotEntry] = [(s.display, s.start_iso, s.end_iso) for s in future]
+        self.minutes = [dt.hour * 60 + dt.minute for dt in self.datetimes]
+        self.ordinals = [dt.toordinal() for dt in self.datetimes]
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+def _match_python(slots: ScheduleSlots, compiled: List[CompiledRules]) -> List[List[int]]:
+    result = []
+    for rules in compiled:
+        if rules.match_all:
+            result.append(list(range(len(slots))))
+        else:
+            result.append([i for i, dt in enumerate(slots.datetimes) if rules.matches(dt)])
+    return result
+
+
+def _match_numpy(slots: ScheduleSlots, compiled: List[CompiledRules]) -> List[List[int]]:
+    minutes = np.asarray(slots.minutes, dtype=np.int32)
+    ordinals = np.asarray(slots.ordinals, dtype=np.int64)
+    # Уникальные дни и минуты расписания: таблица правил строится только по ним
+    day_ordinals, slot_day_idx = np.unique(ordinals, return_inverse=True)
+    uniq_minutes, slot_min_idx = np.unique(minutes, return_inverse=True)
+    day_weekdays = [datetime.fromordinal(int(o)).weekday() for o in day_ordinals]
+    days_by_weekday: Dict[int, List[int]] = {}
+    for d_idx, wd in enumerate(day_weekdays):
+        days_by_weekday.setdefault(wd, []).append(d_idx)
+    day_index = {int(o): i for i, o in enumerate(day_ordinals)}
+    all_days = list(range(len(day_ordinals)))
+
+    # Интервалы всех подписчиков: (подписчик, день, lo, hi) — минуты суток, hi включительно
+    sub_idx: List[int] = []
+    dayi: List[int] = []
+    lo_min: List[int] = []
+    hi_min: List[int] = []
+    match_all_rows: List[int] = []
+    for s, rules in enumerate(compiled):
+        if rules.match_all:
+            match_all_rows.append(s)
+            continue
+        scoped = [(all_days, rules.any_intervals)]
+        for wd in range(7):
+            if (rules.weekday_mask >> wd) & 1 and wd in days_by_weekday:
+                scoped.append((days_by_weekday[wd], rules.weekday_intervals[wd]))
+        for ordinal, intervals in rules.date_intervals.items():
+            if ordinal in day_index:
+                scoped.append(([day_index[ordinal]], intervals))
+        for days, intervals in scoped:
+            for lo, hi in intervals:
+                for d in days:
+                    sub_idx.append(s)
+                    dayi.append(d)
+                    lo_min.append(lo)
+                    hi_min.append(hi)
+
+    n_subs, n_days, n_min = len(compiled), len(day_ordinals), len(uniq_minutes)
+    # Разностный массив: +1 на начале интервала, -1 после конца; cumsum > 0 — минута разрешена
+    diff = np.zeros((n_subs, n_days, n_min + 1), dtype=np.int16)
+    if sub_idx:
+        lo_idx = np.searchsorted(uniq_minutes, np.asarray(lo_min), side='left')
+        hi_idx = np.searchsorted(uniq_minutes, np.asarray(hi_min), side='right')
+        s_arr = np.asarray(sub_idx)
+        d_arr = np.asarray(dayi)
+        np.add.at(diff, (s_arr, d_arr, lo_idx), 1)
+        np.add.at(diff, (s_arr, d_arr, hi_idx), -1)
+    table = np.cumsum(diff[:, :, :n_min], axis=2, dtype=np.int16) > 0
+    if match_all_rows:
+        table[match_all_rows] = True
+
+    matches = table[:, slot_day_idx, slot_min_idx]  # (подписчики × слоты)
+    return [np.flatnonzero(row).tolist() for row in matches]
+
+
+def match_subscribers(schedule_payload: Union[Schedule, Dict[str, Any], None], rules_per_subscriber: List[Any],
+                      slots: Optional[ScheduleSlots] = None, use_numpy: Optional[bool] = None) -> List[List[SlotEntry]]:
+    """Для каждого набора правил возвращает подходящие будущие слоты — как collect_matching_slots,
+    но расписание разбирается один раз, а проверка идёт сразу для всех подписчиков.
+
+    rules_per_subscriber — tracking_rules в любой хранимой форме (компилируются через кэш rules_engine).
+    use_numpy=None — использовать NumPy, если он установлен.
+    """
+    if slots is None:
+        slots = ScheduleSlots(schedule_payload)
+    if not rules_per_subscriber:
+        return []
+    if not len(slots):
+        return [[] for _ in rules_per_subscriber]
+    compiled = [compile_tracking_rules(r) for r in rules_per_subscriber]
+    if use_numpy is None:
+        use_numpy = np is not None
+    if use_numpy and np is None:
+        raise RuntimeError("NumPy не установлен")
+    indices = _match_numpy(slots, compiled) if use_numpy else _match_python(slots, compiled)
+    return [[slots.entries[i] for i in idx] for idx in indices]
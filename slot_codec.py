@@ -0,0 +1,237 @@
+"""
+Компактное представление слотов расписания врача для сравнения и хранения.
+Независимый модуль без зависимостей от aiogram/SQLAlchemy.
+
+Вместо полного JSON scheduleOfDay (кабинеты, ресурсы, вложенные блоки) хранится SlotTable:
+  * отсортированный массив начал слотов в «эпохе-минутах» (минуты от 1970-01-01 по местному
+    времени ЕМИАС, без таймзоны) и массив длительностей слотов в минутах;
+  * таблица рабочего времени по дням: номер дня, первая и последняя минута приёма.
+Таймзона ответа (обычно +03:00) хранится один раз на расписание.
+
+Формат blob (little-endian):
+    заголовок '<2sBhII' — magic b'SC', версия, смещение таймзоны в минутах (NO_TZ — нет),
+                          число слотов, число дней;
+    starts    uint32 × число слотов;
+    durations uint16 × число слотов;
+    days      uint32 × число дней, day_lo uint16 × число дней, day_hi uint16 × число дней.
+Слот занимает 6 байт, день — 8 байт; кодирование/декодирование — array.frombytes/tobytes без разбора JSON.
+
+schedule_fingerprint — стабильный отпечаток набора слотов (начало/конец с точностью до минуты).
+Не зависит от порядка дней и блоков и от метаданных кабинетов, поэтому два ответа ЕМИАС
+с одинаковыми слотами дают одинаковый отпечаток, и поллер может пропустить diff и проверку правил.
+"""
+import hashlib
+import struct
+import sys
+from array import array
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+MAGIC = b'SC'
+VERSION = 1
+NO_TZ = -32768
+_HEADER = struct.Struct('<2sBhII')
+_EPOCH = datetime(1970, 1, 1)
+_EPOCH_ORDINAL = _EPOCH.toordinal()
+_MAX_DURATION = 0xFFFF
+
+
+def iter_slot_times(schedule_days: Iterable[Dict[str, Any]]) -> Iterable[Tuple[str, str]]:
+    """Перебирает (startTime, endTime) всех слотов scheduleOfDay."""
+    for day_info in schedule_days or []:
+        for slot_block in day_info.get("scheduleBySlot", []) or []:
+            for s in slot_block.get("slot", []) or []:
+                start_time = s.get("startTime") or ""
+                if start_time:
+                    yield start_time, s.get("endTime") or ""
+
+
+def _epoch_minute(iso: str) -> Optional[int]:
+    """"YYYY-MM-DDTHH:MM..." -> минуты от 1970-01-01 (местное время строки, таймзона отбрасывается)."""
+    try:
+        dt = datetime.fromisoformat(iso[:16])
+    except ValueError:
+        return None
+    return (dt.toordinal() - _EPOCH_ORDINAL) * 1440 + dt.hour * 60 + dt.minute
+
+
+def _tz_offset(iso: str) -> int:
+    """Смещение таймзоны ISO-строки в минутах ('+03:00' -> 180), NO_TZ если его нет."""
+    tail = iso[19:] if len(iso) > 19 else ''
+    if tail.startswith('.'):
+        tail = tail.lstrip('.0123456789')
+    if tail in ('Z', 'z'):
+        return 0
+    if len(tail) >= 6 and tail[0] in '+-':
+        try:
+            minutes = int(tail[1:3]) * 60 + int(tail[4:6])
+        except ValueError:
+            return NO_TZ
+        return -minutes if tail[0] == '-' else minutes
+    return NO_TZ
+
+
+def _day_number(day_info: Dict[str, Any]) -> Optional[int]:
+    day_str = day_info.get('date') or day_info.get('scheduleDate') or ''
+    for fmt in ('%Y-%m-%d', '%d.%m.%Y'):
+        try:
+            return datetime.strptime(day_str[:10], fmt).toordinal() - _EPOCH_ORDINAL
+        except ValueError:
+            continue
+    return None
+
+
+def _le_bytes(arr: array) -> bytes:
+    if sys.byteorder == 'big':
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def _le_array(typecode: str, data: bytes) -> array:
+    arr = array(typecode)
+    arr.frombytes(data)
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr
+
+
+class SlotTable:
+    """Слоты одного расписания: starts/durations отсортированы по началу, дни — по дате."""
+
+    __slots__ = ('starts', 'durations', 'day_numbers', 'day_lo', 'day_hi', 'tz_offset')
+
+    def __init__(self, starts: array, durations: array, day_numbers: array, day_lo: array, day_hi: array,
+                 tz_offset: int = NO_TZ):
+        self.starts = starts
+        self.durations = durations
+        self.day_numbers = day_numbers
+        self.day_lo = day_lo
+        self.day_hi = day_hi
+        self.tz_offset = tz_offset
+
+    @classmethod
+    def from_schedule_days(cls, schedule_days: Optional[Iterable[Dict[str, Any]]]) -> 'SlotTable':
+        """Строит таблицу из scheduleOfDay ответа getAvailableResourceScheduleInfo."""
+        pairs = set()
+        first_start_iso = ''
+        days: Dict[int, List[int]] = {}
+        for day_info in schedule_days or []:
+            day_number = _day_number(day_info)
+            if day_number is not None:
+                days[day_number] = []
+            for slot_block in day_info.get("scheduleBySlot", []) or []:
+                for s in slot_block.get("slot", []) or []:
+                    start_iso = s.get("startTime") or ""
+                    start = _epoch_minute(start_iso)
+                    if start is None:
+                        continue
+                    end = _epoch_minute(s.get("endTime") or "")
+                    pairs.add((start, min(end - start, _MAX_DURATION) if end is not None and end > start else 0))
+                    first_start_iso = first_start_iso or start_iso
+        ordered = sorted(pairs)
+        # Рабочее время дня: первая минута приёма и конец самого позднего слота (слоты уже отсортированы)
+        for start, duration in ordered:
+            day_number, lo = divmod(start, 1440)
+            bounds = days.get(day_number)
+            if bounds:
+                bounds[1] = max(bounds[1], min(lo + duration, 1440))
+            else:
+                days[day_number] = [lo, min(lo + duration, 1440)]
+        day_numbers = sorted(days)
+        return cls(
+            array('I', [p[0] for p in ordered]),
+            array('H', [p[1] for p in ordered]),
+            array('I', day_numbers),
+            array('H', [days[d][0] if days[d] else 0 for d in day_numbers]),
+            array('H', [days[d][1] if days[d] else 0 for d in day_numbers]),
+            _tz_offset(first_start_iso) if first_start_iso else NO_TZ,
+        )
+
+    def encode(self) -> bytes:
+        return b''.join((
+            _HEADER.pack(MAGIC, VERSION, self.tz_offset, len(self.starts), len(self.day_numbers)),
+            _le_bytes(self.starts), _le_bytes(self.durations),
+            _le_bytes(self.day_numbers), _le_bytes(self.day_lo), _le_bytes(self.day_hi),
+        ))
+
+    @classmethod
+    def decode(cls, blob: bytes) -> 'SlotTable':
+        magic, version, tz_offset, n_slots, n_days = _HEADER.unpack_from(blob, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"Неизвестный формат slot blob: {magic!r} v{version}")
+        offset = _HEADER.size
+        parts = []
+        for typecode, count, width in (('I', n_slots, 4), ('H', n_slots, 2),
+                                       ('I', n_days, 4), ('H', n_days, 2), ('H', n_days, 2)):
+            parts.append(_le_array(typecode, blob[offset:offset + count * width]))
+            offset += count * width
+        return cls(*parts, tz_offset=tz_offset)
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def fingerprint(self) -> str:
+        """SHA1 массивов начал и длительностей (таблица дней не влияет)."""
+        digest = hashlib.sha1(_le_bytes(self.starts))
+        digest.update(_le_bytes(self.durations))
+        return digest.hexdigest()
+
+    def difference(self, other: 'SlotTable') -> List[int]:
+        """Начала слотов (эпоха-минуты), которых нет в other. Слияние двух отсортированных массивов."""
+        result = []
+        theirs = other.starts
+        j, n = 0, len(theirs)
+        last = None
+        for start in self.starts:
+            if start == last:
+                continue
+            last = start
+            while j < n and theirs[j] < start:
+                j += 1
+            if j >= n or theirs[j] != start:
+                result.append(start)
+        return result
+
+    @staticmethod
+    def moment(minute: int) -> datetime:
+        """Эпоха-минута -> наивный datetime (местное время расписания)."""
+        return _EPOCH + timedelta(minutes=minute)
+
+    @staticmethod
+    def label(minute: int) -> str:
+        """Эпоха-минута -> "YYYY-MM-DD HH:MM" (формат bot.parse_schedule_payload)."""
+        return (_EPOCH + timedelta(minutes=minute)).strftime('%Y-%m-%d %H:%M')
+
+    def slot_labels(self) -> Set[str]:
+        return {self.label(m) for m in self.starts}
+
+    def _iso(self, minute: int) -> str:
+        text = (_EPOCH + timedelta(minutes=minute)).strftime('%Y-%m-%dT%H:%M:00')
+        if self.tz_offset == NO_TZ:
+            return text
+        sign = '-' if self.tz_offset < 0 else '+'
+        hours, minutes = divmod(abs(self.tz_offset), 60)
+        return f"{text}{sign}{hours:02d}:{minutes:02d}"
+
+    def iter_slots(self) -> Iterator[Tuple[str, str]]:
+        """(startTime, endTime) в ISO с таймзоной ответа — как в scheduleOfDay."""
+        for start, duration in zip(self.starts, self.durations):
+            yield self._iso(start), self._iso(start + duration)
+
+    def days(self) -> List[Tuple[date, Optional[Tuple[str, str]], List[str]]]:
+        """По дням: (дата, рабочее время ("HH:MM", "HH:MM") или None, ["YYYY-MM-DD HH:MM", ...])."""
+        by_day: Dict[int, List[str]] = {}
+        for start in self.starts:
+            by_day.setdefault(start // 1440, []).append(self.label(start))
+        result = []
+        for day_number, lo, hi in zip(self.day_numbers, self.day_lo, self.day_hi):
+            labels = by_day.get(day_number, [])
+            worktime = (f"{lo // 60:02d}:{lo % 60:02d}", f"{hi // 60:02d}:{hi % 60:02d}") if labels else None
+            result.append((date.fromordinal(day_number + _EPOCH_ORDINAL), worktime, labels))
+        return result
+
+
+def schedule_fingerprint(schedule_days: Iterable[Dict[str, Any]]) -> str:
+    """Отпечаток набора слотов scheduleOfDay (см. SlotTable.fingerprint)."""
+    return SlotTable.from_schedule_days(schedule_days).fingerprint()
@@ -0,0 +1,196 @@
+"""
+История появления и исчезновения слотов врачей (таблица slot_events).
+
+DoctorSchedule хранит только последний снапшот, поэтому момент, когда слот появился или исчез,
+теряется при следующей перезаписи. Поллер (check_schedule_updates) передаёт diff каждого
+изменившегося расписания в SlotEventRecorder, а в конце цикла события пишутся в БД пачкой:
+  * появившийся слот — новая строка (appeared_at, appeared_cycle);
+  * исчезнувший слот — закрытие открытой строки (disappeared_at, disappeared_cycle, expired).
+Слоты, которые уже были в расписании при первом наблюдении врача, не записываются:
+момент их появления неизвестен, и они исказили бы время жизни.
+
+Запросы для настройки поллинга: slot_lifetimes / median_slot_lifetime, appearance_hour_histogram,
+replay_events. Ретеншн — compact_slot_events (SLOT_EVENTS_RETENTION_DAYS).
+
+CLI:
+    python slot_events.py median <doctor_api_id> [--days 30]
+    python slot_events.py hours <doctor_api_id> [--days 30]
+    python slot_events.py compact
+"""
+import argparse
+import logging
+import statistics
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from config import SLOT_EVENTS_RETENTION_DAYS
+from database import SlotEvent, get_db_session
+from slot_codec import NO_TZ, SlotTable
+import metrics
+
+_UPDATE_CHUNK = 500  # не больше стольких slot_start в одном IN (...) — лимит параметров SQLite
+
+
+def new_cycle_id() -> str:
+    return uuid.uuid4().hex[:12]
+
+
+class SlotEventRecorder:
+    """Накопитель событий одного цикла поллера; flush() пишет их одной пачкой."""
+
+    def __init__(self, cycle_id: Optional[str] = None):
+        self.cycle_id = cycle_id or new_cycle_id()
+        self._appeared: List[dict] = []
+        self._disappeared: Dict[Tuple[str, bool], List[datetime]] = {}
+        self._observed_at: Dict[str, datetime] = {}
+
+    def record_diff(self, doctor_api_id: str, old_table: SlotTable, new_table: SlotTable,
+                    observed_at: Optional[datetime] = None) -> Tuple[int, int]:
+        """Запоминает появившиеся и исчезнувшие слоты врача. Возвращает (появилось, исчезло)."""
+        observed_at = observed_at or datetime.utcnow()
+        doctor_api_id = str(doctor_api_id)
+        appeared = new_table.difference(old_table)
+        vanished = old_table.difference(new_table)
+        for minute in appeared:
+            self._appeared.append({
+                'doctor_api_id': doctor_api_id,
+                'slot_start': SlotTable.moment(minute),
+                'appeared_at': observed_at,
+                'appeared_cycle': self.cycle_id,
+            })
+        if vanished:
+            # Слот, время которого уже наступило, исчез сам (expired), а не был занят
+            if old_table.tz_offset != NO_TZ:
+                now_local = observed_at + timedelta(minutes=old_table.tz_offset)
+            else:
+                now_local = datetime.now()
+            for minute in vanished:
+                slot_start = SlotTable.moment(minute)
+                self._disappeared.setdefault((doctor_api_id, slot_start <= now_local), []).append(slot_start)
+            self._observed_at[doctor_api_id] = observed_at
+        return len(appeared), len(vanished)
+
+    def __len__(self) -> int:
+        return len(self._appeared) + sum(len(v) for v in self._disappeared.values())
+
+    def flush(self, session, commit: bool = True) -> int:
+        """Пишет накопленные события (bulk insert + UPDATE ... IN пачками) и коммитит
+        (commit=False — коммит за вызывающим кодом). Возвращает число событий."""
+        if not len(self):
+            return 0
+        total = len(self)
+        appeared_count = len(self._appeared)
+        if self._appeared:
+            session.bulk_insert_mappings(SlotEvent, self._appeared)
+        for (doctor_api_id, expired), starts in self._disappeared.items():
+            for i in range(0, len(starts), _UPDATE_CHUNK):
+                session.query(SlotEvent).filter(
+                    SlotEvent.doctor_api_id == doctor_api_id,
+                    SlotEvent.slot_start.in_(starts[i:i + _UPDATE_CHUNK]),
+                    SlotEvent.disappeared_at.is_(None),
+                ).update({
+                    SlotEvent.disappeared_at: self._observed_at[doctor_api_id],
+                    SlotEvent.disappeared_cycle: self.cycle_id,
+                    SlotEvent.expired: expired,
+                }, synchronize_session=False)
+        if commit:
+            session.commit()
+        metrics.inc('slot_events_appeared_total', appeared_count)
+        metrics.inc('slot_events_disappeared_total', total - appeared_count)
+        self._appeared = []
+        self._disappeared = {}
+        self._observed_at = {}
+        return total
+
+
+def slot_lifetimes(session, doctor_api_id: str, since: Optional[datetime] = None,
+                   include_expired: bool = False) -> List[float]:
+    """Время жизни (секунды) закрытых слотов врача, появившихся не раньше since.
+    По умолчанию без слотов, исчезнувших из-за наступления их времени."""
+    query = session.query(SlotEvent.appeared_at, SlotEvent.disappeared_at).filter(
+        SlotEvent.doctor_api_id == str(doctor_api_id),
+        SlotEvent.disappeared_at.isnot(None),
+    )
+    if since is not None:
+        query = query.filter(SlotEvent.appeared_at >= since)
+    if not include_expired:
+        query = query.filter((SlotEvent.expired.is_(None)) | (SlotEvent.expired.is_(False)))
+    return [(gone - appeared).total_seconds() for appeared, gone in query.all()]
+
+
+def median_slot_lifetime(session, doctor_api_id: str, since: Optional[datetime] = None) -> Optional[float]:
+    """Медианное время жизни свободного слота врача в секундах (None — нет данных)."""
+    lifetimes = slot_lifetimes(session, doctor_api_id, since)
+    return statistics.median(lifetimes) if lifetimes else None
+
+
+def appearance_hour_histogram(session, doctor_api_id: str, since: Optional[datetime] = None) -> Dict[int, int]:
+    """Сколько слотов врача появилось в каждый час суток (UTC) — когда имеет смысл опрашивать чаще."""
+    query = session.query(SlotEvent.appeared_at).filter(SlotEvent.doctor_api_id == str(doctor_api_id))
+    if since is not None:
+        query = query.filter(SlotEvent.appeared_at >= since)
+    histogram = {hour: 0 for hour in range(24)}
+    for (appeared_at,) in query.all():
+        histogram[appeared_at.hour] += 1
+    return histogram
+
+
+def replay_events(session, doctor_api_id: str, start: Optional[datetime] = None,
+                  end: Optional[datetime] = None) -> List[Tuple[datetime, str, datetime]]:
+    """События врача в хронологическом порядке: (момент UTC, 'appeared'|'disappeared', slot_start)."""
+    query = session.query(SlotEvent).filter(SlotEvent.doctor_api_id == str(doctor_api_id))
+    if end is not None:
+        query = query.filter(SlotEvent.appeared_at < end)
+    events = []
+    for ev in query.all():
+        events.append((ev.appeared_at, 'appeared', ev.slot_start))
+        if ev.disappeared_at is not None:
+            events.append((ev.disappeared_at, 'disappeared', ev.slot_start))
+    return sorted(
+        (e for e in events if (start is None or e[0] >= start) and (end is None or e[0] < end)),
+        key=lambda e: (e[0], e[1] != 'disappeared', e[2]),
+    )
+
+
+def compact_slot_events(session, retention_days: int = SLOT_EVENTS_RETENTION_DAYS) -> int:
+    """Удаляет события старше retention_days: закрытые давно и открытые, чьё время слота давно прошло."""
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    deleted = session.query(SlotEvent).filter(
+        (SlotEvent.disappeared_at < cutoff) | (SlotEvent.disappeared_at.is_(None) & (SlotEvent.slot_start < cutoff))
+    ).delete(synchronize_session=False)
+    session.commit()
+    if deleted:
+        logging.info(f"compact_slot_events: deleted={deleted} retention_days={retention_days}")
+    return deleted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['median', 'hours', 'compact'])
+    parser.add_argument('doctor_api_id', nargs='?')
+    parser.add_argument('--days', type=int, default=30, help='Окно анализа в днях')
+    args = parser.parse_args()
+
+    session = get_db_session()
+    try:
+        if args.command == 'compact':
+            print(f"deleted={compact_slot_events(session)}")
+            return
+        if not args.doctor_api_id:
+            parser.error('doctor_api_id обязателен для median/hours')
+        since = datetime.utcnow() - timedelta(days=args.days)
+        if args.command == 'median':
+            lifetimes = slot_lifetimes(session, args.doctor_api_id, since)
+            median = statistics.median(lifetimes) if lifetimes else None
+            print(f"doctor={args.doctor_api_id} closed_slots={len(lifetimes)} "
+                  f"median_lifetime={'-' if median is None else f'{median / 60:.1f} min'}")
+        else:
+            for hour, count in appearance_hour_histogram(session, args.doctor_api_id, since).items():
+                print(f"{hour:02d}:00 UTC {count:>6} {'#' * min(count, 60)}")
+    finally:
+        session.close()
+
+
+if __name__ == '__main__':
+    main()
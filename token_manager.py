@@ -0,0 +1,330 @@
+"""
+Процессный кэш токенов ЕМИАС (access/refresh/expires_at) с фоновым обновлением.
+
+Раньше каждый запрос к ЕМИАС открывал сессию БД и читал UserToken, а refresh_emias_token
+дополнительно делал два запроса только чтобы решить, не слишком ли часто обновляемся.
+Теперь токены пользователя читаются из БД один раз (или все сразу — preload_tokens) и дальше
+отдаются из памяти; в UserToken пишется только действительно изменившийся токен.
+
+Бот, веб и поллер могут работать отдельными процессами на одной БД, поэтому запись кэша
+не старше _DB_RECHECK_SEC: затем строка UserToken перечитывается, и если там другие токены
+(сохранены веб-панелью через /user/update_tokens или обновлены другим процессом) и они не старше
+закэшированных по issued_at — кэш берёт их.
+
+Фоновое обновление: для каждого токена вычисляется момент refresh_due = expires_at − LEAD − jitter
+(TOKEN_REFRESH_LEAD_SEC, TOKEN_REFRESH_JITTER_SEC), и задание планировщика бота вызывает
+refresh_due_tokens — токены обновляются заранее, до истечения, и не все в одну секунду.
+Неудачное обновление откладывается с растущей паузой (до часа).
+
+Обновление идёт через singleflight: одновременно для пользователя выполняется не больше одного
+запроса refreshTokens в процессе, остальные вызовы ждут его результат. Между процессами —
+refresh_guard: advisory lock PostgreSQL или файл-замок refresh_lock_<uid> рядом с файлом SQLite;
+под замком токены перечитываются из БД, и если другой процесс уже обновил refresh_token,
+повторного refreshTokens (и invalid_grant на старом токене) не будет.
+
+Все времена — наивные UTC. Модуль потокобезопасен (бот, веб и asyncio.to_thread в одном процессе).
+"""
+import asyncio
+import logging
+import os
+import random
+import tempfile
+import threading
+import time as time_mod
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import text
+
+from config import TOKEN_REFRESH_JITTER_SEC, TOKEN_REFRESH_LEAD_SEC
+import database
+from database import UserToken, get_db_session, save_tokens
+import circuit_breaker
+
+_RETRY_MIN_SEC = 60
+_RETRY_MAX_SEC = 3600
+_DB_RECHECK_SEC = 30  # запись кэша старше — сверяется со строкой UserToken (токены из других процессов)
+SINGLEFLIGHT_WAIT_SEC = 30  # дольше запроса refreshTokens (timeout=10) с запасом
+_LOCK_STALE_SEC = 120  # файл-замок старше — остался от упавшего процесса
+_LOCK_POLL_SEC = 0.2
+
+
+class _TokenState:
+    __slots__ = ('access_token', 'refresh_token', 'expires_at', 'issued_at', 'refresh_due', 'failures', 'checked_at')
+
+    def __init__(self, access_token: str, refresh_token: str, expires_at: Optional[datetime],
+                 issued_at: Optional[datetime]):
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+        self.expires_at = expires_at
+        self.issued_at = issued_at
+        self.failures = 0
+        self.refresh_due = _due_time(expires_at)
+        self.checked_at = time_mod.monotonic()
+
+
+_lock = threading.Lock()
+_tokens: Dict[int, _TokenState] = {}
+
+
+def _naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _due_time(expires_at: Optional[datetime]) -> datetime:
+    if expires_at is None:
+        return datetime.utcnow()
+    return expires_at - timedelta(seconds=TOKEN_REFRESH_LEAD_SEC + random.uniform(0, TOKEN_REFRESH_JITTER_SEC))
+
+
+def _state_from_row(row: UserToken) -> _TokenState:
+    return _TokenState(row.access_token, row.refresh_token, _naive_utc(row.expires_at), _naive_utc(row.issued_at))
+
+
+def preload_tokens() -> int:
+    """Загружает токены всех пользователей одним запросом (при старте бота). Возвращает их число."""
+    session = get_db_session()
+    try:
+        rows = session.query(UserToken).all()
+        loaded = {row.telegram_user_id: _state_from_row(row) for row in rows if row.access_token}
+    finally:
+        session.close()
+    with _lock:
+        for user_id, state in loaded.items():
+            _tokens.setdefault(user_id, state)
+    return len(loaded)
+
+
+def _load(user_id: int) -> Optional[_TokenState]:
+    """Сверяет кэш пользователя со строкой UserToken; возвращает актуальное состояние."""
+    try:
+        session = get_db_session()
+        try:
+            row = session.query(UserToken).filter_by(telegram_user_id=user_id).first()
+            fresh = _state_from_row(row) if row and row.access_token else None
+        finally:
+            session.close()
+    except Exception as e:
+        logging.warning(f"token_manager: reload user={user_id} failed: {e}")
+        return _tokens.get(user_id)
+    rotated = False
+    with _lock:
+        current = _tokens.get(user_id)
+        if fresh is None:
+            if current is not None:
+                current.checked_at = time_mod.monotonic()
+            return current
+        same = current is not None and (current.access_token, current.refresh_token) == (fresh.access_token, fresh.refresh_token)
+        older = (current is not None and current.issued_at and fresh.issued_at
+                 and fresh.issued_at < current.issued_at)
+        if current is None or (not same and not older):
+            rotated = current is not None and current.refresh_token != fresh.refresh_token
+            _tokens[user_id] = current = fresh
+        else:
+            current.checked_at = time_mod.monotonic()
+    if rotated:
+        # Токены заменены в другом процессе (/auth, /user/update_tokens) — снимаем парковку после invalid_grant
+        circuit_breaker.unpark_user(user_id)
+    return current
+
+
+def _state(user_id: int, reload: bool = False) -> Optional[_TokenState]:
+    state = _tokens.get(user_id)
+    if reload or state is None or time_mod.monotonic() - state.checked_at >= _DB_RECHECK_SEC:
+        state = _load(user_id)
+    return state
+
+
+def get_tokens(user_id: int, reload: bool = False) -> Optional[Tuple[str, str, Optional[datetime]]]:
+    """(access_token, refresh_token, expires_at) как database.get_tokens, но из памяти.
+    reload=True — сначала сверить с БД (не дожидаясь _DB_RECHECK_SEC)."""
+    state = _state(user_id, reload)
+    if state is None:
+        return None
+    return state.access_token, state.refresh_token, state.expires_at
+
+
+def issued_at(user_id: int) -> Optional[datetime]:
+    """Когда токен пользователя был последний раз выдан/обновлён (UTC)."""
+    state = _state(user_id)
+    return state.issued_at if state else None
+
+
+def store_tokens(user_id: int, access_token: str, refresh_token: str, expires_in: int, session=None) -> bool:
+    """
+    Запоминает токены пользователя. В UserToken пишет только если access/refresh токен изменился
+    (тот же токен, пришедший повторно, БД не трогает). Возвращает True, если токен изменился.
+    session — уже открытая сессия вызывающего кода (иначе открывается своя).
+    """
+    now = datetime.utcnow()
+    with _lock:
+        current = _tokens.get(user_id)
+        changed = current is None or current.access_token != access_token or current.refresh_token != refresh_token
+    if not changed:
+        with _lock:
+            current.failures = 0
+        return False
+    own_session = session is None
+    if own_session:
+        session = get_db_session()
+    try:
+        save_tokens(session, user_id, access_token, refresh_token, expires_in)
+    finally:
+        if own_session:
+            session.close()
+    with _lock:
+        _tokens[user_id] = _TokenState(access_token, refresh_token, now + timedelta(seconds=expires_in), now)
+    # Новые токены (/auth, /user/update_tokens, обновление) — снимаем парковку после invalid_grant
+    circuit_breaker.unpark_user(user_id)
+    return True
+
+
+class _Flight:
+    __slots__ = ('done', 'result')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+_flights: Dict[int, _Flight] = {}
+
+
+def singleflight(user_id: int, refresh: Callable[[], Optional[str]], timeout: float = SINGLEFLIGHT_WAIT_SEC) -> Optional[str]:
+    """
+    Выполняет refresh() не более одного раза одновременно для пользователя: первый вызов
+    обновляет токен, остальные (из других потоков / asyncio.to_thread) ждут и получают его результат.
+    Только внутри процесса; между процессами — refresh_guard.
+    """
+    with _lock:
+        flight = _flights.get(user_id)
+        leader = flight is None
+        if leader:
+            flight = _flights[user_id] = _Flight()
+    if not leader:
+        if not flight.done.wait(timeout):
+            logging.warning(f"token_manager: refresh for user={user_id} still running after {timeout}s")
+            # Обновление не дождались — это не его неудача: отдаём текущий токен
+            tokens = get_tokens(user_id)
+            return tokens[0] if tokens else None
+        return flight.result
+    try:
+        flight.result = refresh()
+    finally:
+        with _lock:
+            _flights.pop(user_id, None)
+        flight.done.set()
+    return flight.result
+
+
+def _lock_path(user_id: int) -> str:
+    db_file = database.engine.url.database if database.IS_SQLITE else None
+    lock_dir = os.path.dirname(os.path.abspath(db_file)) if db_file and db_file != ':memory:' else tempfile.gettempdir()
+    return os.path.join(lock_dir, f"refresh_lock_{user_id}")
+
+
+def _try_file_lock(path: str) -> bool:
+    try:
+        if time_mod.time() - os.stat(path).st_mtime > _LOCK_STALE_SEC:
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+    except OSError:
+        return False
+    try:
+        os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return True
+    except OSError:
+        return False
+
+
+@contextmanager
+def refresh_guard(user_id: int, timeout: float = SINGLEFLIGHT_WAIT_SEC) -> Iterator[bool]:
+    """
+    Межпроцессный замок обновления токена пользователя. Отдаёт True, если замок получен
+    за timeout секунд (иначе False — обновлять не стоит, его делает другой процесс).
+    PostgreSQL — pg_try_advisory_lock(user_id) на отдельном соединении; SQLite — файл-замок.
+    """
+    deadline = time_mod.monotonic() + timeout
+    if database.IS_SQLITE:
+        path = _lock_path(user_id)
+        acquired = _try_file_lock(path)
+        while not acquired and time_mod.monotonic() < deadline:
+            time_mod.sleep(_LOCK_POLL_SEC)
+            acquired = _try_file_lock(path)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+        return
+    conn = database.engine.connect()
+    try:
+        acquired = conn.execute(text("SELECT pg_try_advisory_lock(:k)"), {"k": user_id}).scalar()
+        while not acquired and time_mod.monotonic() < deadline:
+            time_mod.sleep(_LOCK_POLL_SEC)
+            acquired = conn.execute(text("SELECT pg_try_advisory_lock(:k)"), {"k": user_id}).scalar()
+        conn.commit()
+        try:
+            yield bool(acquired)
+        finally:
+            if acquired:
+                conn.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": user_id})
+                conn.commit()
+    finally:
+        conn.close()
+
+
+def invalidate(user_id: int) -> None:
+    """Забывает токены пользователя — следующий get_tokens перечитает их из БД."""
+    with _lock:
+        _tokens.pop(user_id, None)
+
+
+def mark_refresh_failed(user_id: int) -> None:
+    """Откладывает следующую фоновую попытку обновления (60 с, 120 с, ... до часа)."""
+    with _lock:
+        state = _tokens.get(user_id)
+        if state is None:
+            return
+        state.failures += 1
+        delay = min(_RETRY_MIN_SEC * (2 ** (state.failures - 1)), _RETRY_MAX_SEC)
+        state.refresh_due = datetime.utcnow() + timedelta(seconds=delay)
+
+
+def due_for_refresh(now: Optional[datetime] = None) -> List[int]:
+    """Пользователи, чьи токены пора обновить заранее."""
+    now = now or datetime.utcnow()
+    with _lock:
+        return [user_id for user_id, state in _tokens.items() if state.refresh_due <= now]
+
+
+async def refresh_due_tokens(refresher: Callable[[int], Optional[str]]) -> int:
+    """
+    Обновляет все токены, для которых наступил refresh_due. refresher(user_id) — синхронная
+    функция обновления (emias_api.refresh_emias_token), выполняется в отдельном потоке.
+    Возвращает число успешно обновлённых токенов.
+    """
+    refreshed = 0
+    for user_id in due_for_refresh():
+        try:
+            token = await asyncio.to_thread(refresher, user_id)
+        except Exception as e:
+            logging.warning(f"token_manager: background refresh user={user_id} failed: {e}")
+            token = None
+        if token:
+            refreshed += 1
+            with _lock:
+                state = _tokens.get(user_id)
+                if state is not None and state.refresh_due <= datetime.utcnow():
+                    # Сервер вернул тот же токен — пробуем снова ближе к истечению
+                    state.refresh_due = datetime.utcnow() + timedelta(seconds=_RETRY_MIN_SEC)
+        else:
+            mark_refresh_failed(user_id)
+    return refreshed
@@ -11,7 +11,7 @@ from database import (
     engine,
     Base,
     DoctorSchedule,
-    save_tokens,
+    save_doctor_schedule,
     Specialty,
     UserDoctorLink
 )
@@ -23,10 +23,16 @@ from emias_api import (
     get_appointment_receptions_by_patient,
     refresh_emias_token,
 )
+import copy
 import json, datetime as dt
 from datetime import timezone, timedelta
 import os
 from sqlalchemy import text, or_, func
+from rules_engine import compile_tracking_rules, merge_rules, normalize_rules
+from metrics import snapshot as metrics_snapshot
+import audit_log
+import circuit_breaker
+import token_manager
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'default_secret_key')
@@ -118,6 +124,7 @@ def user_dashboard():
         lpu_map = {a.address_point_id: a.short_name or a.address for a in addr_rows}
     
     # Логи токенов: ищем последний success и последний error для api_refresh_token
+    audit_log.flush()  # журнал пишется пачками — дописываем очередь этого процесса перед чтением
     last_refresh_log = session_db.query(UserLog).filter_by(telegram_user_id=user_id, action='api_refresh_token').order_by(UserLog.timestamp.desc()).first()
     last_success_refresh = session_db.query(UserLog).filter_by(telegram_user_id=user_id, action='api_refresh_token', status='success').order_by(UserLog.timestamp.desc()).first()
     last_error_refresh = session_db.query(UserLog).filter_by(telegram_user_id=user_id, action='api_refresh_token', status='error').order_by(UserLog.timestamp.desc()).first()
@@ -274,7 +281,7 @@ def user_update_tokens():
         if not access or not refresh:
             raise ValueError('Нужны access_token и refresh_token')
         sess = get_db_session()
-        save_tokens(sess, user_id, access, refresh, expires_in)
+        token_manager.store_tokens(user_id, access, refresh, expires_in, session=sess)
         log_user_action(sess, user_id, 'manual_token_update', f'Обновлены токены вручную expires_in={expires_in}', source='web', status='success')
         sess.close()
         flash('Токены обновлены', 'success')
@@ -315,7 +322,8 @@ def admin_dashboard():
     users = session_db.query(UserProfile).all()
     doctors = session_db.query(DoctorInfo).all()
     session_db.close()
-    return render_template('admin_dashboard.html', users=users, doctors=doctors, models=ADMIN_MODELS)
+    return render_template('admin_dashboard.html', users=users, doctors=doctors, models=ADMIN_MODELS,
+                           metrics=metrics_snapshot(), breakers=circuit_breaker.snapshot())
 
 
 def _get_ldp_specialty_codes(sess):
@@ -358,12 +366,9 @@ def admin_bulk():
                 keep = int(request.form.get('keep', 500))
             except Exception:
                 keep = 500
-            # Оставляем последние keep логов глобально
-            ids_keep = [row[0] for row in sess.query(UserLog.id).order_by(UserLog.timestamp.desc()).limit(keep).all()]
-            if ids_keep:
-                deleted = sess.query(UserLog).filter(~UserLog.id.in_(ids_keep)).delete(synchronize_session=False)
-            else:
-                deleted = 0
+            # Оставляем последние keep логов глобально (удаление порциями)
+            audit_log.flush()
+            deleted = audit_log.trim_logs(sess, keep=keep)
             sess.commit()
             flash(f'Оставлено {keep}, удалено {deleted} логов', 'warning')
             try:
@@ -859,7 +864,7 @@ def admin_backfill_lpu_short_names():
       1. Находим LPUAddress без short_name.
       2. Для связанных DoctorInfo собираем пары (speciality_id, lpu_id).
       3. Для каждой пары вызываем getDoctorsInfo (c lpuId если есть).
-      4. Прогоняем все availableResources через save_or_update_doctor -> обновляется short_name.
+      4. Прогоняем все availableResources через save_or_update_doctors -> обновляется short_name.
     """
     if not _admin_required():
         return redirect(url_for('login'))
@@ -880,7 +885,7 @@ def admin_backfill_lpu_short_names():
         s_chk.close()
 
     session_db = get_db_session()
-    from database import LPUAddress, save_or_update_doctor
+    from database import LPUAddress, save_or_update_doctors
     try:
         # Собираем адреса без short_name
         missing = session_db.query(LPUAddress).filter(or_(LPUAddress.short_name == None, LPUAddress.short_name == '')).all()
@@ -926,6 +931,7 @@ def admin_backfill_lpu_short_names():
             payload = resp['payload']
             blocks = payload.get('doctorsInfo', [])
             not_av = payload.get('notAvailableDoctors', [])
+            resources = []
             for block in blocks:
                 block_lpu_id = block.get('lpuId') or block.get('lpuID')
                 block_addr = block.get('defaultAddress') or block.get('lpuAddress')
@@ -937,10 +943,8 @@ def admin_backfill_lpu_short_names():
                         resource['lpuAddress'] = block_addr
                     if block_lpu_short and not resource.get('lpuShortName'):
                         resource['lpuShortName'] = block_lpu_short
-                    save_or_update_doctor(session_db, admin_uid, resource)
-            for doc in not_av:
-                save_or_update_doctor(session_db, admin_uid, doc)
-            session_db.commit()
+                    resources.append(resource)
+            save_or_update_doctors(session_db, admin_uid, resources + not_av)
         # Повторно загрузим затронутые адреса
         refetched = session_db.query(LPUAddress).filter(or_(LPUAddress.address_point_id.in_(updated_addresses_before.keys()))).all()
         filled = [a for a in refetched if a.short_name]
@@ -966,6 +970,8 @@ def admin_model_delete(model_key, obj_id):
             # Вместо удаления строки очищаем расписание, чтобы не ловить UNIQUE ошибки при повторном сохранении.
             try:
                 obj.schedule_text = '[]'
+                obj.slots_blob = None
+                obj.fingerprint = None
                 # Ставим updated_at на сейчас
                 try:
                     import datetime as _dt
@@ -1023,80 +1029,11 @@ def toggle_track(doctor_id):
         session_db.close()
     return redirect(url_for('user_dashboard'))
 
-def _parse_rule(rule: str):
-    # Returns (prefix, start, end) or None
-    try:
-        parts = rule.strip().split()
-        if len(parts) != 2:
-            return None
-        prefix, times = parts
-        if '-' not in times:
-            return None
-        start, end = times.split('-', 1)
-        if len(start) != 5 or len(end) != 5:
-            return None
-        return prefix.lower(), start, end
-    except Exception:
-        return None
-
-def _merge_intervals(intervals):
-    # intervals: list of (start,end) strings HH:MM
-    if not intervals:
-        return []
-    to_minutes = lambda t: int(t[:2]) * 60 + int(t[3:5])
-    intervals_num = sorted([(to_minutes(s), to_minutes(e)) for s, e in intervals])
-    merged = []
-    for s, e in intervals_num:
-        if not merged or s > merged[-1][1]:
-            merged.append([s, e])
-        else:
-            if e > merged[-1][1]:
-                merged[-1][1] = e
-    # back to strings
+def _coverage_for_day(date_obj, rules):
+    # Интервалы правил (в любой хранимой форме) на конкретную дату — через общий движок правил
     def to_str(m):
         return f"{m//60:02d}:{m%60:02d}"
-    return [(to_str(s), to_str(e)) for s, e in merged]
-
-def _merge_rules(rules):
-    # group by prefix
-    grouped = {}
-    for r in rules:
-        parsed = _parse_rule(r)
-        if not parsed:
-            continue
-        prefix, s, e = parsed
-        grouped.setdefault(prefix, []).append((s, e))
-    merged_rules = []
-    for prefix, intervals in grouped.items():
-        for s, e in _merge_intervals(intervals):
-            merged_rules.append(f"{prefix} {s}-{e}")
-    # Preserve stable ordering by sorting prefixes alphabetically then time
-    return sorted(merged_rules)
-
-WEEKDAY_MAP = {0:'понедельник',1:'вторник',2:'среда',3:'четверг',4:'пятница',5:'суббота',6:'воскресенье'}
-
-def _coverage_for_day(date_obj, rules):
-    # returns dict with intervals and coverage classification
-    # Build rule intervals for this specific date: match weekday name or exact date yyyy-mm-dd or relative labels
-    date_prefixes = set()
-    iso_date = date_obj.strftime('%Y-%m-%d')
-    date_prefixes.add(iso_date)
-    date_prefixes.add(WEEKDAY_MAP[date_obj.weekday()])
-    today = dt.date.today()
-    if date_obj == today:
-        date_prefixes.add('сегодня')
-    if date_obj == today + dt.timedelta(days=1):
-        date_prefixes.add('завтра')
-    # Collect intervals
-    day_intervals = []
-    for r in rules:
-        parsed = _parse_rule(r)
-        if not parsed: continue
-        prefix,s,e = parsed
-        if prefix in date_prefixes:
-            day_intervals.append((s,e))
-    merged = _merge_intervals(day_intervals)
-    return merged  # list of (s,e)
+    return [(to_str(lo), to_str(hi)) for lo, hi in compile_tracking_rules(rules).intervals_for_day(date_obj)]  # list of (s,e)
 
 def _classify_coverage(work_intervals, rule_intervals):
     # work_intervals, rule_intervals lists of (s,e)
@@ -1127,8 +1064,25 @@ def _classify_coverage(work_intervals, rule_intervals):
         return 'full'
     return 'partial'
 
+def _schedule_preview_days(sched, limit=21):
+    """Дни сохранённого расписания для предпросмотра (не более limit — 3 недели).
+    worktimes — рабочее время дня из таблицы дней slot_codec (используется для покрытия правилами)."""
+    days = []
+    try:
+        for day_date, worktime, labels in sched.slot_table().days()[:limit]:
+            days.append({
+                'date': day_date.strftime('%d.%m'),
+                'weekday': ['Пн','Вт','Ср','Чт','Пт','Сб','Вс'][day_date.weekday()],
+                'slots': labels,
+                'is_today': day_date == dt.date.today(),
+                'worktimes': [f"{worktime[0]}-{worktime[1]}"] if worktime else [],
+            })
+    except Exception:
+        pass
+    return days
+
 def _enrich_schedule_with_coverage(schedule_days, rules):
-    # rules expected already merged
+    # rules: tracking_rules трека в хранимой форме
     for d in schedule_days:
         # parse date dd.mm -> construct date with current year (approx) by searching in original extraction? We don't have year; skip coverage if ambiguous
         try:
@@ -1205,30 +1159,16 @@ def edit_track(doctor_id):
                             # простейший поиск ближайшего слота из сохранённого расписания (если есть)
                             sched_rec = session_db.query(DoctorSchedule).filter_by(doctor_api_id=doctor_id).first()
                             if sched_rec:
-                                import json, datetime as _dt
-                                raw_sched = json.loads(sched_rec.schedule_text)
-                                # собрать все слоты ISO -> отфильтровать по правилам
-                                all_slots = []
-                                for day in raw_sched:
-                                    for block in day.get('scheduleBySlot', []):
-                                        for sl in block.get('slot', []):
-                                            st = sl.get('startTime') or sl.get('start')
-                                            if st:
-                                                all_slots.append(st[:16])
+                                import datetime as _dt
+                                # все слоты сохранённого расписания "YYYY-MM-DD HH:MM" -> отфильтровать по правилам
+                                all_slots = sched_rec.slot_table().slot_labels()
                                 # фильтрация по правилам
+                                compiled_rules = compile_tracking_rules(track.tracking_rules)
                                 def slot_matches(slot):
-                                    # slot: YYYY-MM-DDTHH:MM
-                                    date_part = slot[:10]
-                                    time_part = slot[11:16]
-                                    weekday_ru = WEEKDAY_MAP[_dt.datetime.strptime(date_part, '%Y-%m-%d').weekday()].lower()
-                                    for r in track.tracking_rules:
-                                        pr = _parse_rule(r)
-                                        if not pr: continue
-                                        prefix, rs, re = pr
-                                        if prefix == date_part or prefix == weekday_ru or (prefix=='сегодня' and date_part == _dt.date.today().strftime('%Y-%m-%d')) or (prefix=='завтра' and date_part == (_dt.date.today()+_dt.timedelta(days=1)).strftime('%Y-%m-%d')):
-                                            if rs <= time_part < re:
-                                                return True
-                                    return False
+                                    try:
+                                        return compiled_rules.matches(_dt.datetime.strptime(slot, '%Y-%m-%d %H:%M'))
+                                    except ValueError:
+                                        return False
                                 matched = sorted([s for s in all_slots if slot_matches(s)])
                                 if matched:
                                     # Здесь можно дернуть асинхронный бот booking через таск/очередь — пока просто лог
@@ -1277,51 +1217,15 @@ def edit_track(doctor_id):
                 if api_resp and api_resp.get('payload') and api_resp['payload'].get('scheduleOfDay'):
                     payload_part = api_resp['payload']['scheduleOfDay']
                     if isinstance(payload_part, list):
-                        text = json.dumps(payload_part, ensure_ascii=False)
-                        if not sched:
-                            sched = DoctorSchedule(doctor_api_id=doctor_id, schedule_text=text)
-                            session_db.add(sched)
-                        else:
-                            sched.schedule_text = text
-                        sched.updated_at = dt.datetime.utcnow()
-                        session_db.commit()
+                        save_doctor_schedule(session_db, doctor_id, payload_part)
+                        sched = session_db.query(DoctorSchedule).filter_by(doctor_api_id=doctor_id).first()
                         flash('Расписание обновлено из API', 'success')
             except Exception as e:
                 flash(f'Не удалось обновить расписание: {e}', 'warning')
         if sched:
-            try:
-                import json, datetime as _dt
-                raw = json.loads(sched.schedule_text)
-                for day in raw[:21]:
-                    day_date_str = day.get('date') or day.get('scheduleDate')
-                    if not day_date_str:
-                        continue
-                    parsed_date = None
-                    for fmt in ('%Y-%m-%d', '%d.%m.%Y'):
-                        try:
-                            parsed_date = _dt.datetime.strptime(day_date_str[:10], fmt).date()
-                            break
-                        except Exception:
-                            continue
-                    if not parsed_date:
-                        continue
-                    slots_collected = []
-                    for block in day.get('scheduleBySlot', []):
-                        for sl in block.get('slot', []):
-                            st_iso = sl.get('startTime') or sl.get('start')
-                            if st_iso and len(st_iso) >= 16:
-                                slots_collected.append(st_iso.replace('T',' ')[:16])
-                    schedule_days.append({
-                        'date': parsed_date.strftime('%d.%m'),
-                        'weekday': ['Пн','Вт','Ср','Чт','Пт','Сб','Вс'][parsed_date.weekday()],
-                        'slots': sorted(slots_collected),
-                        'is_today': parsed_date == _dt.date.today(),
-                    })
-            except Exception:
-                pass
+            schedule_days = _schedule_preview_days(sched)
         # coverage enrichment
-        merged_rules = _merge_rules(rules)
-        schedule_days = _enrich_schedule_with_coverage(schedule_days, merged_rules)
+        schedule_days = _enrich_schedule_with_coverage(schedule_days, raw_rules)
         return render_template('edit_track.html', track=track, doctor=doctor, rules=rules, schedule_days=schedule_days, sched=sched)
     finally:
         session_db.close()
@@ -1375,15 +1279,8 @@ def add_track():
             # Проверить, не существует ли уже
             existing = session_db.query(UserTrackedDoctor).filter_by(telegram_user_id=user_id, doctor_api_id=doctor_id).first()
             rule_list = [r.strip() for r in (rules.split(',') if rules else []) if r.strip()]
-            # merge overlaps
-            rule_list = _merge_rules(rule_list)
-            # deduplicate
-            seen = set()
-            dedup_rules = []
-            for r in rule_list:
-                if r not in seen:
-                    seen.add(r)
-                    dedup_rules.append(r)
+            # нормализация в общий формат (как в боте) + слияние пересечений и дублей
+            dedup_rules = merge_rules(rule_list)
             if not existing:
                 track = UserTrackedDoctor(
                     telegram_user_id=user_id,
@@ -1401,7 +1298,7 @@ def add_track():
                 flash('Врач добавлен в отслеживание!', 'success')
             else:
                 # Добавляем новые правила к существующим без дублей
-                current = existing.tracking_rules or []
+                current = normalize_rules(existing.tracking_rules)
                 added = 0
                 for r in dedup_rules:
                     if r not in current:
@@ -1445,49 +1342,13 @@ def add_track():
                     if api_resp and api_resp.get('payload') and api_resp['payload'].get('scheduleOfDay'):
                         payload_part = api_resp['payload']['scheduleOfDay']
                         if isinstance(payload_part, list):
-                            text = json.dumps(payload_part, ensure_ascii=False)
-                            if not sched:
-                                sched = DoctorSchedule(doctor_api_id=preview_doctor_id, schedule_text=text)
-                                session_db.add(sched)
-                            else:
-                                sched.schedule_text = text
-                            sched.updated_at = dt.datetime.utcnow()
-                            session_db.commit()
+                            save_doctor_schedule(session_db, preview_doctor_id, payload_part)
+                            sched = session_db.query(DoctorSchedule).filter_by(doctor_api_id=preview_doctor_id).first()
                             flash('Расписание обновлено из API', 'success')
                 except Exception as e:
                     flash(f'Не удалось обновить расписание: {e}', 'warning')
         if sched:
-            try:
-                import json, datetime as _dt
-                raw = json.loads(sched.schedule_text)
-                for day in raw[:21]:  # ограничим 3 недели
-                    day_date_str = day.get('date') or day.get('scheduleDate')
-                    if not day_date_str:
-                        continue
-                    # пытаемся разные форматы
-                    parsed_date = None
-                    for fmt in ('%Y-%m-%d', '%d.%m.%Y'):
-                        try:
-                            parsed_date = _dt.datetime.strptime(day_date_str[:10], fmt).date()
-                            break
-                        except Exception:
-                            continue
-                    if not parsed_date:
-                        continue
-                    slots_collected = []
-                    for block in day.get('scheduleBySlot', []):
-                        for sl in block.get('slot', []):
-                            st_iso = sl.get('startTime') or sl.get('start')
-                            if st_iso and len(st_iso) >= 16:
-                                slots_collected.append(st_iso.replace('T',' ')[:16])
-                    schedule_days.append({
-                        'date': parsed_date.strftime('%d.%m'),
-                        'weekday': ['Пн','Вт','Ср','Чт','Пт','Сб','Вс'][parsed_date.weekday()],
-                        'slots': sorted(slots_collected),
-                        'is_today': parsed_date == _dt.date.today(),
-                    })
-            except Exception:
-                pass
+            schedule_days = _schedule_preview_days(sched)
     # No coverage on add page (rules not yet persisted) – could compute later if needed
     session_db.close()
     return render_template('add_track.html', doctors=doctors, schedule_days=schedule_days, preview_doctor_id=preview_doctor_id, sched=sched)
@@ -1497,6 +1358,7 @@ def user_logs():
     if 'user_id' not in session:
         return redirect(url_for('login'))
     user_id = session['user_id']
+    audit_log.flush()
     session_db = get_db_session()
     q = session_db.query(UserLog).filter_by(telegram_user_id=user_id).order_by(UserLog.timestamp.desc())
     # параметры
@@ -1607,6 +1469,7 @@ def admin_logs():
     user_param = request.args.get('user')
     show_all = request.args.get('all') == '1'
     selected_user_id = None
+    audit_log.flush()
     query = session_db.query(UserLog)
     if not show_all:
         if user_param:
@@ -1738,14 +1601,8 @@ def bulk_track():
             else:
                 norm_rules.append(r)
         rule_list = norm_rules
-        # merge + dedup
-        rule_list = _merge_rules(rule_list)
-        seen_rules = set()
-        dedup_rules = []
-        for r in rule_list:
-            if r not in seen_rules:
-                seen_rules.add(r)
-                dedup_rules.append(r)
+        # нормализация + merge + dedup
+        dedup_rules = merge_rules(rule_list)
         sess = get_db_session()
         added = 0
         updated = 0
@@ -1762,7 +1619,7 @@ def bulk_track():
                     continue
                 track = sess.query(UserTrackedDoctor).filter_by(telegram_user_id=user_id, doctor_api_id=did).first()
                 if not track:
-                    track = UserTrackedDoctor(telegram_user_id=user_id, doctor_api_id=did, tracking_rules=dedup_rules.copy(), active=True)
+                    track = UserTrackedDoctor(telegram_user_id=user_id, doctor_api_id=did, tracking_rules=copy.deepcopy(dedup_rules), active=True)
                     if auto_booking_all:
                         track.auto_booking = True
                     if batch_id:
@@ -1779,7 +1636,7 @@ def bulk_track():
                         pass
                 else:
                     # дополняем правила
-                    current = track.tracking_rules or []
+                    current = normalize_rules(track.tracking_rules)
                     add_cnt = 0
                     for r in dedup_rules:
                         if r not in current: